@@ -0,0 +1,93 @@
+"""
+Compare the throughput and size of the images written with each encoding profile.
+
+A synthetic 16-bit radiograph is written as PNG, and a synthetic volume as
+NIfTI, with every named profile (or with the profiles given).
+
+Usage::
+
+    python benchmarks/bench_encoding.py --size 3000 --slices 200
+    python benchmarks/bench_encoding.py --profiles default fast,png_bits=16 uncompressed
+"""
+import argparse
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import numpy as np
+import SimpleITK as sitk
+
+from dcm2mids.encoding import PROFILES, parse_profile
+from dcm2mids.procedures.nifti import NiftiStreamWriter
+
+
+def synthetic_radiograph(size: int) -> sitk.Image:
+    """A smooth 12-bit image with noise, compressing like a real radiograph."""
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[:size, :size] / size
+    signal = 2000 + 1500 * np.sin(6 * x) * np.cos(4 * y)
+    pixels = signal + rng.normal(0, 20, (size, size))
+    return sitk.GetImageFromArray(np.clip(pixels, 0, 4095).astype(np.uint16))
+
+
+def synthetic_volume(size: int, slices: int) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    z, y, x = np.mgrid[:slices, :size, :size] / size
+    signal = 500 + 400 * np.sin(8 * x) * np.cos(6 * y) * np.cos(3 * z)
+    return (signal + rng.normal(0, 10, signal.shape)).astype(np.int16)
+
+
+def timed(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size", type=int, default=3000, help="Radiograph side, in pixels")
+    parser.add_argument("--volume-size", type=int, default=256, help="Volume side, in pixels")
+    parser.add_argument("--slices", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--profiles", nargs="+", default=list(PROFILES))
+    args = parser.parse_args()
+
+    image = synthetic_radiograph(args.size)
+    image_bytes = args.size * args.size * 2
+    volume = synthetic_volume(args.volume_size, args.slices)
+    print(
+        f"radiograph {args.size}x{args.size} uint16 ({image_bytes / 1e6:.1f} MB), "
+        f"volume {args.volume_size}x{args.volume_size}x{args.slices} int16 "
+        f"({volume.nbytes / 1e6:.1f} MB)"
+    )
+    print(f"{'profile':<28} {'png MB/s':>9} {'png MB':>8} {'nifti MB/s':>11} {'nifti MB':>9}")
+    with TemporaryDirectory() as tmp:
+        for spec in args.profiles:
+            profile = parse_profile(spec)
+            png_path = Path(tmp, "image.png")
+            nifti_path = Path(tmp, "volume" + profile.nifti_suffix)
+
+            def write_nifti():
+                with open(nifti_path, "wb") as f, profile.compress(f) as gz:
+                    nifti = NiftiStreamWriter(
+                        gz, volume.shape[1:], len(volume), volume.dtype, slice_spacing=1.0
+                    )
+                    for frame in volume:
+                        nifti.write(frame)
+
+            t_png = timed(lambda: profile.write_image(image, png_path), args.repeat)
+            t_nifti = timed(write_nifti, args.repeat)
+            print(
+                f"{spec:<28} {image_bytes / 1e6 / t_png:9.1f} "
+                f"{png_path.stat().st_size / 1e6:8.2f} "
+                f"{volume.nbytes / 1e6 / t_nifti:11.1f} "
+                f"{nifti_path.stat().st_size / 1e6:9.2f}"
+            )
+            profile.close()
+
+
+if __name__ == "__main__":
+    main()
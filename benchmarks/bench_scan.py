@@ -0,0 +1,88 @@
+"""
+Compare the `os.scandir` walker with the previous `rglob` scan on a deep tree.
+
+Usage::
+
+    python benchmarks/bench_scan.py --depth 6 --fanout 3 --files 20
+"""
+import argparse
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from dcm2mids.get_dicomdir import iter_dicom_files
+
+FAKE_DICOM = bytes(128) + b"DICM" + bytes(64)
+
+
+def build_tree(root: Path, depth: int, fanout: int, files: int, extensionless: bool):
+    """Create `fanout ** depth` leaf folders with `files` DICOM files each."""
+    folders = [root]
+    for _ in range(depth):
+        folders = [
+            folder.joinpath(f"d{i}") for folder in folders for i in range(fanout)
+        ]
+    for folder in folders:
+        folder.mkdir(parents=True)
+        for i in range(files):
+            folder.joinpath(f"IM{i:05d}.dcm").write_bytes(FAKE_DICOM)
+            if extensionless:
+                folder.joinpath(f"IM{i:05d}").write_bytes(FAKE_DICOM)
+            folder.joinpath(f"note{i}.txt").write_text("n/a")
+    return folders
+
+
+def rglob_scan(root: Path, exclude_paths):
+    """The scan used before the walker: rglob and filter every file."""
+    return [
+        filename
+        for filename in root.rglob("*.[dD][cC][mM]")
+        if not any(filename.is_relative_to(p) for p in exclude_paths)
+    ]
+
+
+def timed(label, fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    print(f"{label:<28} {best:8.3f} s  {len(result):8d} files")
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--depth", type=int, default=5)
+    parser.add_argument("--fanout", type=int, default=3)
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--extensionless",
+        action="store_true",
+        help="Also create extensionless DICOM files (only found by the walker)",
+    )
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        build_tree(root, args.depth, args.fanout, args.files, args.extensionless)
+        # Exclude one of the top-level subtrees
+        exclude_paths = [root / "d0"]
+        print(
+            f"depth={args.depth} fanout={args.fanout} files/leaf={args.files} "
+            f"excluded={exclude_paths[0].name}"
+        )
+        t_rglob = timed(
+            "rglob + is_relative_to", lambda: rglob_scan(root, exclude_paths), args.repeat
+        )
+        t_walk = timed(
+            "scandir walker (pruned)",
+            lambda: list(iter_dicom_files(root, exclude_paths)),
+            args.repeat,
+        )
+        print(f"speed-up: {t_rglob / t_walk:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
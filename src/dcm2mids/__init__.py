@@ -16,3 +16,5 @@ except PackageNotFoundError:  # pragma: no cover
     __version__ = "unknown"
 finally:
     del version, PackageNotFoundError
+
+from .api import ConversionResult, Converter, convert  # noqa: E402
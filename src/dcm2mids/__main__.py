@@ -3,8 +3,19 @@ import logging
 from pathlib import Path
 
 from .create_mids_directory import create_mids_directory
+from .deduplicate import STATE_FOLDER, ContentStore, DuplicateDetector
+from .encoding import PROFILES, parse_profile
+from .export_metadata import EXPORT_FORMATS, MetadataExporter
 from .get_dicomdir import get_dicomdir
+from .journal import FailureJournal, FaultPolicy
 from .logger import set_logger
+from .memory import MemoryBudget, parse_size
+from .procedures.decoders import FrameDecoder
+from .profiles import load_profiles
+from .scan_index import ScanIndex
+from .shard import SHARD_KEYS, Shard
+from .watch import QUIET_PERIOD, Watcher
+from .writers import FilesystemWriter, open_writer
 
 parser = argparse.ArgumentParser(
     formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -12,10 +23,22 @@ parser = argparse.ArgumentParser(
 )
 
 parser.add_argument(
-    "-i", "--input", type=Path, help="Path to the input folder", required=True
+    "-i", "--input", type=Path, help="Path to the input folder, or a zip or tar archive", required=True
 )
 parser.add_argument(
-    "-o", "--output", type=Path, help="Path to the output folder", required=True
+    "-e",
+    "--exclude",
+    dest="exclude",
+    type=Path,
+    nargs="+",
+    help="Files or folders inside the input folder to skip",
+)
+parser.add_argument(
+    "-o",
+    "--output",
+    type=Path,
+    help="Path to the output folder, or to a .tar, .tar.gz, .tgz or .zip archive to stream the output into",
+    required=True,
 )
 parser.add_argument(
     "-bp",
@@ -32,6 +55,139 @@ parser.add_argument(
     action="store_true",
     help="Use BIDS standard. Only applicable for protocols/body parts considered in BIDS.",
 )
+parser.add_argument(
+    "-fi",
+    "--fast-index",
+    dest="fast_index",
+    action="store_true",
+    help="Index the dataset from the DICOMDIR directory records; instances are only opened for conversion.",
+)
+parser.add_argument(
+    "-u",
+    "--update",
+    dest="update",
+    action="store_true",
+    help="Merge the processed subjects, sessions and scans into the existing TSV files",
+)
+parser.add_argument(
+    "--dedupe-pixels",
+    dest="dedupe_pixels",
+    action="store_true",
+    help="Also skip instances whose pixel data is identical to an already scanned one",
+)
+parser.add_argument(
+    "--reuse-output",
+    dest="reuse_output",
+    action="store_true",
+    help="Link images whose content is already present in the output instead of re-encoding them",
+)
+parser.add_argument(
+    "-dw",
+    "--decode-workers",
+    dest="decode_workers",
+    type=int,
+    help="Decode pixel data in this many threads, decoding compressed frames in parallel",
+)
+parser.add_argument(
+    "-sw",
+    "--series-workers",
+    dest="series_workers",
+    type=int,
+    default=1,
+    help="Convert this many series at once, largest first, balancing the load of the workers",
+)
+parser.add_argument(
+    "-as",
+    "--archive-size",
+    dest="archive_size",
+    type=parse_size,
+    help="Split the output archive in parts of at most this size, e.g. 4G",
+)
+parser.add_argument(
+    "-mm",
+    "--max-memory",
+    dest="max_memory",
+    type=parse_size,
+    help="Memory budget for loaded datasets and decoded pixels, e.g. 512M or 8G",
+)
+parser.add_argument(
+    "--encoding",
+    dest="encoding",
+    type=str,
+    default="default",
+    help=f"Encoding profile of the images, one of {', '.join(PROFILES)}, "
+    "optionally followed by overrides, e.g. fast,png_bits=16",
+)
+parser.add_argument(
+    "--profiles",
+    dest="profiles",
+    type=Path,
+    help="TOML or YAML file selecting the images, sidecars and TSV files written for each modality",
+)
+parser.add_argument(
+    "--shard",
+    dest="shard",
+    type=str,
+    help="Only convert shard i of N (zero-based), given as i/N, e.g. 0/4",
+)
+parser.add_argument(
+    "--shard-key",
+    dest="shard_key",
+    choices=SHARD_KEYS,
+    default="PatientID",
+    help="Header key hashed to assign subjects (or studies) to shards",
+)
+parser.add_argument(
+    "--export-metadata",
+    dest="export_metadata",
+    choices=sorted(EXPORT_FORMATS),
+    help="Also export the header of every instance into a Parquet or Arrow table, partitioned by subject",
+)
+parser.add_argument(
+    "--batch",
+    dest="batch",
+    action="store_true",
+    help="Quarantine the files and series that fail in .dcm2mids/failures.tsv and go on, instead of stopping",
+)
+parser.add_argument(
+    "--file-timeout",
+    dest="file_timeout",
+    type=float,
+    help="In batch mode, seconds allowed to read a file, and per instance to convert a series",
+)
+parser.add_argument(
+    "--retries",
+    dest="retries",
+    type=int,
+    default=2,
+    help="In batch mode, retries of a read or conversion failing with a transient I/O error",
+)
+parser.add_argument(
+    "--replay-failures",
+    dest="replay_failures",
+    action="store_true",
+    help="Convert again the files of the failure journal, merging them into the output. Implies --batch",
+)
+parser.add_argument(
+    "-w",
+    "--watch",
+    dest="watch",
+    action="store_true",
+    help="Keep running and convert the series arriving in the input folder, updating the TSV files",
+)
+parser.add_argument(
+    "--quiet-period",
+    dest="quiet_period",
+    type=float,
+    default=QUIET_PERIOD,
+    help="In watch mode, seconds without new files after which a series is converted",
+)
+parser.add_argument(
+    "--poll",
+    dest="poll",
+    action="store_true",
+    help="In watch mode, poll the input folder even if inotify is available",
+)
 parser.add_argument(
     "-v",
     "--verbose",
@@ -44,12 +200,123 @@ parser.add_argument(
     "-log", "--logfile", type=Path, help="Path to the file to store logs"
 )
 args = parser.parse_args()
+try:
+    shard = Shard.parse(args.shard, args.shard_key) if args.shard else None
+except ValueError as e:
+    parser.error(str(e))
+
+try:
+    encoding = parse_profile(args.encoding)
+except (ValueError, RuntimeError) as e:
+    parser.error(str(e))
+
+try:
+    output_profiles = load_profiles(args.profiles) if args.profiles else None
+except (OSError, ValueError, TypeError, RuntimeError) as e:
+    parser.error(str(e))
+
+writer = open_writer(args.output, args.archive_size, encoding)
+if not isinstance(writer, FilesystemWriter) and (args.update or args.reuse_output):
+    parser.error("--update and --reuse-output need an output folder, not an archive")
+if args.watch and (not isinstance(writer, FilesystemWriter) or shard is not None):
+    parser.error("--watch needs an output folder, and can not be combined with --shard")
+if args.watch and not args.input.is_dir():
+    parser.error("--watch needs an input folder, not an archive")
+if args.watch and args.replay_failures:
+    parser.error("--replay-failures can not be combined with --watch")
+
+if args.replay_failures:
+    args.batch = True
+if args.batch and not isinstance(writer, FilesystemWriter):
+    parser.error("--batch needs an output folder, not an archive")
+
+metadata_exporter = None
+if args.export_metadata:
+    try:
+        metadata_exporter = MetadataExporter(writer.root, args.export_metadata, writer=writer)
+    except RuntimeError as e:
+        parser.error(str(e))
 
 log_level = getattr(logging, args.verbose)
 root_logger = set_logger(level=log_level, outpath=args.logfile)
 
-fileset = get_dicomdir(args.input)
+memory_budget = MemoryBudget(args.max_memory) if args.max_memory else None
+
+duplicate_detector = DuplicateDetector(hash_pixels=args.dedupe_pixels)
+
+fault_policy = None
+replay_paths = None
+if args.batch:
+    journal = FailureJournal(writer.root, f"failures_{shard.name}" if shard else "failures")
+    if args.replay_failures:
+        replay_paths = journal.pop_paths()
+        if not replay_paths:
+            root_logger.info("The failure journal is empty")
+            raise SystemExit(0)
+        args.update = True
+    fault_policy = FaultPolicy(journal, args.file_timeout, args.retries)
+
+if args.watch:
+    decoder = FrameDecoder(args.decode_workers) if args.decode_workers else None
+    watcher = Watcher(
+        args.input,
+        writer.root,
+        args.body_part,
+        quiet_period=args.quiet_period,
+        exclude_paths=args.exclude,
+        polling=args.poll,
+        duplicate_detector=duplicate_detector,
+        memory_budget=memory_budget,
+        content_store=ContentStore(args.output) if args.reuse_output else None,
+        decoder=decoder,
+        writer=writer,
+        metadata_exporter=metadata_exporter,
+        output_profiles=output_profiles,
+        fault_policy=fault_policy,
+    )
+    watcher.run()
+    if decoder is not None:
+        decoder.close()
+    raise SystemExit(0)
 
-create_mids_directory(fileset, args.output, args.body_part)
+fileset = get_dicomdir(
+    args.input,
+    args.exclude,
+    shard,
+    duplicate_detector,
+    paths=replay_paths,
+    fault_policy=fault_policy,
+)
+if duplicate_detector.skipped:
+    duplicate_detector.save_report(
+        writer.root / STATE_FOLDER / "duplicates.tsv", writer
+    )
+if args.fast_index:
+    fileset = ScanIndex.from_fileset(fileset)
+
+decoder = FrameDecoder(args.decode_workers) if args.decode_workers else None
+
+report = create_mids_directory(
+    fileset,
+    writer.root,
+    args.body_part,
+    memory_budget=memory_budget,
+    shard=shard,
+    update=args.update,
+    content_store=ContentStore(args.output) if args.reuse_output else None,
+    decoder=decoder,
+    writer=writer,
+    metadata_exporter=metadata_exporter,
+    fault_policy=fault_policy,
+    series_workers=args.series_workers,
+    output_profiles=output_profiles,
+)
+if decoder is not None:
+    decoder.close()
+writer.close()
+if args.replay_failures:
+    journal.finish_replay()
+report.stats["duplicates_skipped"] = len(duplicate_detector.skipped)
+report.log()
 
 # generate_tsvs(args.output)
@@ -0,0 +1,270 @@
+import logging
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Union
+
+from .create_mids_directory import create_mids_directory, update_mids_directory
+from .deduplicate import STATE_FOLDER, ContentStore, DuplicateDetector
+from .encoding import EncodingProfile, parse_profile
+from .export_metadata import MetadataExporter
+from .get_dicomdir import get_dicomdir
+from .journal import FaultPolicy
+from .memory import MemoryBudget, parse_size
+from .procedures import Procedures
+from .procedures.decoders import FrameDecoder
+from .profiles import OutputProfiles, load_profiles
+from .report import RunReport
+from .scan_index import ScanIndex
+from .writers import FilesystemWriter
+
+logger = logging.getLogger("dcm2mids").getChild("api")
+
+
+class ConversionResult:
+    """Outcome of a call to `convert`: one row per series of every input, and the run reports.
+
+    Each row holds the `input` root, the `subject`, `session`, `series` and
+    `modality` of the series, its `status` (`converted`, `skipped` or
+    `failed`), its `outputs` relative to the MIDS root, the `seconds` it took
+    and, if it failed, the `error`.
+    """
+
+    def __init__(self, output: Path):
+        self.output = output
+        self.series: List[Dict[str, Any]] = []
+        self.reports: Dict[str, RunReport] = {}
+        self.elapsed: Optional[float] = None
+
+    def add_report(self, input_dir: Path, report: RunReport):
+        """Record the report of an input root and its series."""
+        self.reports[str(input_dir)] = report
+        for row in report.series:
+            self.series.append({"input": str(input_dir), "error": None, **row})
+
+    @property
+    def failed(self) -> List[Dict[str, Any]]:
+        """The series whose conversion failed."""
+        return [row for row in self.series if row.get("status") == "failed"]
+
+    def outputs(self) -> List[Path]:
+        """The paths of every file converted, under the MIDS root."""
+        return [self.output / path for row in self.series for path in row.get("outputs", [])]
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Return the result as a plain dictionary, e.g. to dump it as JSON."""
+        return {
+            "output": str(self.output),
+            "elapsed": self.elapsed,
+            "series": self.series,
+            "inputs": {key: report.as_dict() for key, report in self.reports.items()},
+        }
+
+
+class Converter:
+    """Convert several input roots into one MIDS dataset, sharing state between them.
+
+    The duplicate detector, the decoder threads, the memory budget and the
+    procedure instances are created once and reused for every input, so an
+    instance found under two roots is converted once and a batch of small
+    inputs does not pay the start-up of each conversion.
+
+    Each input gets its own scan index: conversion goes through every series
+    of the index it is given, so an index shared across inputs would convert
+    the series of the earlier inputs again. What is shared is the record of
+    the instances already seen, in the duplicate detector.
+
+    :param output: The MIDS root.
+    :type output: Union[pathlib.Path, str]
+    :param bodypart: The body part of the dataset.
+    :type bodypart: str
+    :param decode_workers: Decode pixel data in this many threads.
+    :type decode_workers: int, optional
+    :param max_memory: Memory budget, e.g. `2G`, or a number of bytes.
+    :type max_memory: Union[int, str], optional
+    :param dedupe_pixels: Also skip instances with the same pixel data.
+    :type dedupe_pixels: bool
+    :param reuse_output: Link images already present in the output instead of writing them again.
+    :type reuse_output: bool
+    :param fast_index: Index the headers into a `ScanIndex` before converting.
+    :type fast_index: bool
+    :param continue_on_error: Record failed series in the result instead of raising.
+    :type continue_on_error: bool
+    :param export_metadata: Also export the headers into a `parquet` or `arrow` table.
+    :type export_metadata: str, optional
+    :param fault_policy: Read files and convert series with the timeout and retries
+        of the policy, quarantining the failures in its journal.
+    :type fault_policy: dcm2mids.journal.FaultPolicy, optional
+    :param encoding: How images are encoded, a profile or a spec such as `fast,png_bits=16`.
+    :type encoding: Union[dcm2mids.encoding.EncodingProfile, str], optional
+    :param series_workers: Convert this many series at once, see `dcm2mids.scheduler`.
+    :type series_workers: int
+    :param output_profiles: The outputs written for each modality, as profiles or
+        the path of a TOML or YAML file, see `dcm2mids.profiles.load_profiles`.
+    :type output_profiles: Union[dcm2mids.profiles.OutputProfiles, pathlib.Path, str], optional
+    """
+
+    def __init__(
+        self,
+        output: Union[Path, str],
+        bodypart: str,
+        decode_workers: Optional[int] = None,
+        max_memory: Optional[Union[int, str]] = None,
+        dedupe_pixels: bool = False,
+        reuse_output: bool = False,
+        fast_index: bool = False,
+        continue_on_error: bool = True,
+        export_metadata: Optional[str] = None,
+        fault_policy: Optional[FaultPolicy] = None,
+        encoding: Optional[Union[EncodingProfile, str]] = None,
+        series_workers: int = 1,
+        output_profiles: Optional[Union[OutputProfiles, Path, str]] = None,
+    ):
+        self.output = Path(output)
+        self.bodypart = bodypart
+        self.fast_index = fast_index
+        self.continue_on_error = continue_on_error
+        if isinstance(encoding, str):
+            encoding = parse_profile(encoding)
+        self.writer = FilesystemWriter(self.output, encoding)
+        self.duplicate_detector = DuplicateDetector(hash_pixels=dedupe_pixels)
+        self.decoder = FrameDecoder(decode_workers) if decode_workers else None
+        self.memory_budget = None
+        if max_memory is not None:
+            if isinstance(max_memory, str):
+                max_memory = parse_size(max_memory)
+            self.memory_budget = MemoryBudget(max_memory)
+        self.content_store = ContentStore(self.output) if reuse_output else None
+        self.procedure_cache: Dict[tuple, Procedures] = {}
+        self.fault_policy = fault_policy
+        self.series_workers = series_workers
+        if isinstance(output_profiles, (Path, str)):
+            output_profiles = load_profiles(output_profiles)
+        self.output_profiles = output_profiles or OutputProfiles()
+        self.metadata_exporter = (
+            MetadataExporter(self.output, export_metadata, writer=self.writer)
+            if export_metadata
+            else None
+        )
+
+    def convert(
+        self,
+        input_dir: Union[Path, str],
+        exclude: Optional[List[Union[Path, str]]] = None,
+        update: bool = False,
+    ) -> RunReport:
+        """
+        Convert one input root.
+
+        :param input_dir: The input root.
+        :type input_dir: Union[pathlib.Path, str]
+        :param exclude: Files or folders inside the input root to skip.
+        :type exclude: List[Union[pathlib.Path, str]], optional
+        :param update: Merge into the TSV files already in the output.
+        :type update: bool
+        :return: The report of the conversion. If the input can not be read and
+            `continue_on_error` is set, it has no series and its `error` stat is set.
+        :rtype: dcm2mids.report.RunReport
+        """
+        try:
+            fileset = get_dicomdir(
+                input_dir,
+                exclude,
+                duplicate_detector=self.duplicate_detector,
+                fault_policy=self.fault_policy,
+            )
+            if self.fast_index:
+                fileset = ScanIndex.from_fileset(fileset)
+        except Exception as e:
+            if not self.continue_on_error:
+                raise
+            # An input without DICOM files must not stop the following ones
+            logger.exception("Reading %s failed", input_dir)
+            report = RunReport()
+            report.stats["error"] = f"{type(e).__name__}: {e}"
+            return report.finish()
+        options = {
+            "memory_budget": self.memory_budget,
+            "content_store": self.content_store,
+            "decoder": self.decoder,
+            "procedure_cache": self.procedure_cache,
+            "continue_on_error": self.continue_on_error,
+            "metadata_exporter": self.metadata_exporter,
+            "fault_policy": self.fault_policy,
+            "series_workers": self.series_workers,
+            "output_profiles": self.output_profiles,
+        }
+        if update:
+            return update_mids_directory(
+                fileset, self.output, self.bodypart, writer=self.writer, **options
+            )
+        return create_mids_directory(
+            fileset, self.output, self.bodypart, writer=self.writer, **options
+        )
+
+    def close(self):
+        """
+        Save the list of skipped duplicates, write the exported metadata still
+        buffered and stop the decoder and encoder threads.
+        """
+        if self.duplicate_detector.skipped:
+            self.duplicate_detector.save_report(
+                self.output / STATE_FOLDER / "duplicates.tsv", self.writer
+            )
+        if self.metadata_exporter is not None:
+            self.metadata_exporter.close()
+            self.metadata_exporter = None
+        if self.decoder is not None:
+            self.decoder.close()
+            self.decoder = None
+        self.writer.encoding.close()
+
+    def __enter__(self) -> "Converter":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def convert(
+    inputs: Union[Path, str, Iterable[Union[Path, str]]],
+    output: Union[Path, str],
+    bodypart: str,
+    exclude: Optional[List[Union[Path, str]]] = None,
+    update: bool = False,
+    **options,
+) -> ConversionResult:
+    """
+    Convert one or more input roots into a MIDS dataset, in the calling process.
+
+    The inputs are converted one after the other by the same `Converter`. The
+    first one creates the TSV files unless `update` is set, and the following
+    ones are merged into them.
+
+    :param inputs: The input root, or a list of them.
+    :type inputs: Union[pathlib.Path, str, Iterable[Union[pathlib.Path, str]]]
+    :param output: The MIDS root.
+    :type output: Union[pathlib.Path, str]
+    :param bodypart: The body part of the dataset.
+    :type bodypart: str
+    :param exclude: Files or folders to skip, inside any of the inputs.
+    :type exclude: List[Union[pathlib.Path, str]], optional
+    :param update: Merge the first input into the TSV files already in the output.
+    :type update: bool
+    :param options: Passed to `Converter`, e.g. `decode_workers` or `continue_on_error`.
+    :return: The series converted, skipped or failed, with their outputs and timings.
+    :rtype: dcm2mids.api.ConversionResult
+    """
+    if isinstance(inputs, (str, Path)):
+        inputs = [inputs]
+    start_time = time.perf_counter()
+    with Converter(output, bodypart, **options) as converter:
+        result = ConversionResult(converter.output)
+        for index, input_dir in enumerate(inputs):
+            input_dir = Path(input_dir)
+            logger.info("Converting %s", input_dir)
+            report = converter.convert(input_dir, exclude, update=update or index > 0)
+            result.add_report(input_dir, report)
+    result.elapsed = time.perf_counter() - start_time
+    if result.failed:
+        logger.warning("%d series failed", len(result.failed))
+    return result
@@ -0,0 +1,401 @@
+import gzip
+import io
+import logging
+import os
+import posixpath
+import tarfile
+import zipfile
+from contextlib import contextmanager
+from pathlib import Path, PurePosixPath
+from typing import Any, BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+logger = logging.getLogger("dcm2mids").getChild("archives")
+
+# Inputs ending with one of these are read as archives
+INPUT_ARCHIVE_SUFFIXES = [".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz"]
+
+# DICOM files compressed on their own
+GZIP_DICOM_SUFFIX = ".dcm.gz"
+
+DICOM_PREAMBLE_LENGTH = 128
+DICOM_PREFIX = b"DICM"
+
+
+def is_archive(path: Union[Path, str]) -> bool:
+    """Whether a path names a zip or tar archive, from its extension."""
+    name = str(path).lower()
+    return any(name.endswith(suffix) for suffix in INPUT_ARCHIVE_SUFFIXES)
+
+
+def is_gzip_dicom(path: Union[Path, str]) -> bool:
+    """Whether a path names a gzip-compressed DICOM file, from its extension."""
+    return str(path).lower().endswith(GZIP_DICOM_SUFFIX)
+
+
+def has_dicom_prefix(header: bytes) -> bool:
+    """Whether the first bytes of a file hold the DICOM preamble and prefix."""
+    return header[DICOM_PREAMBLE_LENGTH : DICOM_PREAMBLE_LENGTH + len(DICOM_PREFIX)] == DICOM_PREFIX
+
+
+def is_dicom_member(name: str, header: bytes) -> bool:
+    """Whether an archive member is a DICOM file, from its name or its first bytes."""
+    basename = posixpath.basename(name)
+    if basename == "DICOMDIR":
+        return False
+    lower = basename.lower()
+    return lower.endswith(".dcm") or lower.endswith(GZIP_DICOM_SUFFIX) or has_dicom_prefix(header)
+
+
+class DicomSource:
+    """A DICOM file to read: a file on disk, a gzip-compressed file or an archive member.
+
+    Members of archives and compressed files are decompressed in memory when
+    opened, and never extracted to disk. Their `path` is the path of the
+    archive followed by the name of the member, as if the archive was a
+    folder, e.g. `export.zip/study/IM0001.dcm`, which `open_source` accepts.
+
+    :param path: The path of the file, or of the member under its archive.
+    :type path: pathlib.Path
+    :param size: The size of the file, decompressed if known.
+    :type size: int
+    :param opener: Returns the contents of the file. The file is opened from
+        `path` if None.
+    :type opener: Callable[[], bytes], optional
+    :param note: The contents of the `note.txt` next to the file, if it is
+        read from an archive.
+    :type note: str, optional
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        size: int,
+        opener: Optional[Callable[[], bytes]] = None,
+        note: Optional[str] = None,
+    ):
+        self.path = path
+        self.size = size
+        self.opener = opener
+        self.note = note
+
+    def __repr__(self) -> str:
+        return f"DicomSource({str(self.path)!r})"
+
+    @property
+    def in_memory(self) -> bool:
+        """Whether the file is decompressed in memory rather than read from disk."""
+        return self.opener is not None
+
+    def open(self) -> Union[Path, BinaryIO]:
+        """Return the path of the file, or its decompressed contents as a file object."""
+        if self.opener is None:
+            return self.path
+        return io.BytesIO(self.opener())
+
+    def read_note(self) -> str:
+        """Return the contents of the `note.txt` next to the file, or an empty string."""
+        if self.note is not None:
+            return self.note
+        txt_file = self.path.parent / "note.txt"
+        if txt_file.is_file():
+            return txt_file.read_text()
+        return ""
+
+    def reference(self) -> "DicomSource":
+        """
+        Return a source that reads the file again from its path each time it is opened.
+
+        Archive members can only be read while their archive is iterated; the
+        reference opens the archive again instead, so it can be kept, e.g. to
+        read the pixel data of an instance staged without it.
+
+        :return: The source itself for a file on disk, otherwise the reference.
+        :rtype: dcm2mids.archives.DicomSource
+        """
+        if self.opener is None:
+            return self
+        path = self.path
+
+        def read() -> bytes:
+            return open_source(path).opener()  # type: ignore[misc]
+
+        return DicomSource(path, self.size, read, self.note)
+
+
+def file_source(path: Union[Path, str]) -> DicomSource:
+    """
+    Return the source of a DICOM file on disk, gzip-compressed or not.
+
+    :param path: The path of the file.
+    :type path: Union[pathlib.Path, str]
+    :return: The source.
+    :rtype: dcm2mids.archives.DicomSource
+    """
+    path = Path(path)
+    if not is_gzip_dicom(path):
+        return DicomSource(path, path.stat().st_size)
+
+    def read() -> bytes:
+        with gzip.open(path, "rb") as f:
+            return f.read()
+
+    return DicomSource(path, gzip_size(path), read)
+
+
+def gzip_size(path: Union[Path, str]) -> int:
+    """Return the decompressed size of a gzip file, from its trailer (modulo 4 GiB)."""
+    with open(path, "rb") as f:
+        f.seek(-4, os.SEEK_END)
+        return int.from_bytes(f.read(4), "little")
+
+
+def _member_path(archive: Path, name: str) -> Path:
+    return archive.joinpath(*PurePosixPath(name).parts)
+
+
+def _decompress_member(name: str, data: bytes) -> bytes:
+    return gzip.decompress(data) if is_gzip_dicom(name) else data
+
+
+def _zip_note(zf: zipfile.ZipFile, names: set, name: str) -> str:
+    note_name = posixpath.join(posixpath.dirname(name), "note.txt")
+    return zf.read(note_name).decode() if note_name in names else ""
+
+
+def iter_zip(archive: Path) -> Iterator[DicomSource]:
+    """
+    List the DICOM members of a zip archive, in name order.
+
+    The central directory gives every member at once; only the first bytes of
+    members without a `.dcm` extension are read to check the DICOM prefix, and
+    each member is read on its own, when its source is opened. The sources
+    must be opened while iterating, as the archive is closed afterwards.
+
+    :param archive: The path of the archive.
+    :type archive: pathlib.Path
+    :return: An iterator over the sources of the DICOM members.
+    :rtype: Iterator[dcm2mids.archives.DicomSource]
+    """
+    with zipfile.ZipFile(archive) as zf:
+        infos = sorted((info for info in zf.infolist() if not info.is_dir()), key=lambda i: i.filename)
+        names = {info.filename for info in infos}
+        notes: Dict[str, str] = {}
+        for info in infos:
+            name = info.filename
+            header = b""
+            if not (name.lower().endswith(".dcm") or is_gzip_dicom(name)):
+                with zf.open(info) as f:
+                    header = f.read(DICOM_PREAMBLE_LENGTH + len(DICOM_PREFIX))
+            if not is_dicom_member(name, header):
+                continue
+            folder = posixpath.dirname(name)
+            if folder not in notes:
+                notes[folder] = _zip_note(zf, names, name)
+
+            def read(name: str = name) -> bytes:
+                return _decompress_member(name, zf.read(name))
+
+            yield DicomSource(_member_path(archive, name), info.file_size, read, notes[folder])
+
+
+def iter_tar(archive: Path) -> Iterator[DicomSource]:
+    """
+    List the DICOM members of a tar archive, compressed or not, in a single sequential pass.
+
+    Only the first bytes of each member are read to check the DICOM prefix;
+    the rest is read when its source is opened, so the archive is never read
+    twice, even when it is compressed. As the archive is streamed, a source
+    must be opened, at most once, before the iteration moves on to the next
+    member. A `note.txt` only applies to the members that follow it in the
+    archive.
+
+    :param archive: The path of the archive.
+    :type archive: pathlib.Path
+    :return: An iterator over the sources of the DICOM members. Their size is
+        the size of the member, compressed for `.dcm.gz` members.
+    :rtype: Iterator[dcm2mids.archives.DicomSource]
+    """
+    notes: Dict[str, str] = {}
+    with tarfile.open(archive, "r|*") as tf:
+        for member in tf:
+            if not member.isfile():
+                continue
+            name = member.name
+            folder = posixpath.dirname(name)
+            f = tf.extractfile(member)
+            if f is None:
+                continue
+            if posixpath.basename(name) == "note.txt":
+                notes[folder] = f.read().decode()
+                continue
+            header = f.read(DICOM_PREAMBLE_LENGTH + len(DICOM_PREFIX))
+            if not is_dicom_member(name, header):
+                continue
+
+            def read(name: str = name, header: bytes = header, f: BinaryIO = f) -> bytes:
+                return _decompress_member(name, header + f.read())
+
+            yield DicomSource(_member_path(archive, name), member.size, read, notes.get(folder, ""))
+
+
+def iter_archive(archive: Union[Path, str]) -> Iterator[DicomSource]:
+    """
+    List the DICOM members of a zip or tar archive, without extracting them.
+
+    :param archive: The path of the archive.
+    :type archive: Union[pathlib.Path, str]
+    :return: An iterator over the sources of the DICOM members.
+    :rtype: Iterator[dcm2mids.archives.DicomSource]
+    """
+    archive = Path(archive)
+    logger.info("Reading archive %s", archive)
+    if str(archive).lower().endswith(".zip"):
+        return iter_zip(archive)
+    return iter_tar(archive)
+
+
+def split_archive_path(path: Union[Path, str]) -> Optional[Tuple[Path, str]]:
+    """
+    Split the path of an archive member into the archive and the member name.
+
+    :param path: A path such as `export.zip/study/IM0001.dcm`.
+    :type path: Union[pathlib.Path, str]
+    :return: The archive and the name of the member, or None if no parent of
+        the path is an archive file.
+    :rtype: Optional[Tuple[pathlib.Path, str]]
+    """
+    path = Path(path)
+    for parent in path.parents:
+        if is_archive(parent) and parent.is_file():
+            return parent, path.relative_to(parent).as_posix()
+    return None
+
+
+def open_sources(
+    paths: Iterable[Union[Path, str]]
+) -> Iterator[Tuple[Path, Union[DicomSource, Exception]]]:
+    """
+    Return the sources of files given by their path, reading each archive only once.
+
+    Files on disk are returned first, in the given order. The members of each
+    zip archive are then read from its central directory, and those of each
+    tar archive in a single pass over it, in the order they are stored. As
+    for `iter_archive`, the source of a member must be opened before the
+    iteration moves on.
+
+    :param paths: The paths of the files, or of archive members under their archive.
+    :type paths: Iterable[Union[pathlib.Path, str]]
+    :return: An iterator over each path and its source, or the error raised
+        resolving it, e.g. a FileNotFoundError if the archive has no such member.
+    :rtype: Iterator[Tuple[pathlib.Path, Union[dcm2mids.archives.DicomSource, Exception]]]
+    """
+    archives: Dict[Path, List[Tuple[Path, str]]] = {}
+    for path in map(Path, paths):
+        if path.is_file():
+            try:
+                yield path, file_source(path)
+            except OSError as e:
+                yield path, e
+            continue
+        split = split_archive_path(path)
+        if split is None:
+            yield path, FileNotFoundError(f"{path} does not exist.")
+            continue
+        archives.setdefault(split[0], []).append((path, split[1]))
+    for archive, members in archives.items():
+        found = set()
+        try:
+            if str(archive).lower().endswith(".zip"):
+                with zipfile.ZipFile(archive) as zf:
+                    names = set(zf.namelist())
+                    for path, name in members:
+                        if name not in names:
+                            continue
+                        found.add(path)
+
+                        def read(name: str = name, zf: zipfile.ZipFile = zf) -> bytes:
+                            return _decompress_member(name, zf.read(name))
+
+                        yield path, DicomSource(
+                            path, zf.getinfo(name).file_size, read, _zip_note(zf, names, name)
+                        )
+            else:
+                wanted = {path for path, _ in members}
+                for source in iter_tar(archive):
+                    if source.path in wanted:
+                        found.add(source.path)
+                        yield source.path, source
+                        if found == wanted:
+                            break
+        except (OSError, tarfile.TarError, zipfile.BadZipFile) as e:
+            for path, _ in members:
+                if path not in found:
+                    found.add(path)
+                    yield path, e
+        for path, name in members:
+            if path not in found:
+                yield path, FileNotFoundError(f"{name} not found in {archive}")
+
+
+def open_source(path: Union[Path, str]) -> DicomSource:
+    """
+    Return the source of a file given by its path, which may be inside an archive.
+
+    The contents of an archive member are read right away, as its archive is
+    closed afterwards. Use `open_sources` to read several members of the same
+    archive.
+
+    :param path: The path of a file, or of an archive member under its archive.
+    :type path: Union[pathlib.Path, str]
+    :raises FileNotFoundError: If the archive has no such member.
+    :return: The source.
+    :rtype: dcm2mids.archives.DicomSource
+    """
+    for path, source in open_sources([path]):
+        if isinstance(source, Exception):
+            raise source
+        if path.is_file():
+            return source
+        data = source.opener()
+        return DicomSource(path, len(data), lambda: data, source.note)
+    raise FileNotFoundError(f"{path} does not exist.")  # pragma: no cover
+
+
+def is_tar_member(path: Union[Path, str]) -> bool:
+    """Whether a path names a member of a tar archive, which can only be read by streaming it."""
+    split = split_archive_path(path)
+    return split is not None and not str(split[0]).lower().endswith(".zip")
+
+
+@contextmanager
+def loaded_members(instances: Iterable[Any]) -> Iterator[None]:
+    """
+    Read the tar archive members of a series in one pass over each archive, while it is converted.
+
+    Instances staged from archives keep the `source` their pixel data is read
+    from. A tar member can only be reached by streaming its archive up to it,
+    so the members of the series are read together, and kept in memory until
+    the series is converted. Zip members and gzip files are read when opened.
+
+    :param instances: The instances of the series.
+    :type instances: Iterable[pydicom.fileset.FileInstance]
+    """
+    references = []
+    for instance in instances:
+        source = getattr(instance, "source", None)
+        if source is not None and source.opener is not None and is_tar_member(source.path):
+            references.append((instance, source))
+    loaded: Dict[Path, DicomSource] = {}
+    for path, source in open_sources(source.path for _, source in references):
+        if isinstance(source, Exception):
+            # Raised again when the member is opened
+            continue
+        data = source.opener()  # type: ignore[misc]
+        loaded[path] = DicomSource(path, len(data), lambda data=data: data, source.note)
+    for instance, source in references:
+        instance.source = loaded.get(source.path, source)
+    try:
+        yield
+    finally:
+        for instance, source in references:
+            instance.source = source
@@ -1,30 +1,161 @@
 import logging
+import time
 from datetime import datetime
 from pathlib import Path
-from typing import Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 from pydicom.fileset import FileSet
 
+from .archives import loaded_members
+from .deduplicate import ContentStore
+from .export_metadata import MetadataExporter
 from .generate_tsvs import *
+from .journal import FaultPolicy
+from .memory import MemoryBudget
 from .procedures import *
+from .procedures.decoders import FrameDecoder
+from .profiles import OutputProfiles
+from .report import RunReport
+from .scan_index import ScanIndex
+from .scheduler import SeriesScheduler, SeriesTask
+from .shard import Shard
+from .writers import FilesystemWriter, OutputWriter
 
 logger = logging.getLogger(__name__)
 
+# Procedures converting each modality
+MODALITY_PROCEDURES = [
+    (["MR"], MagneticResonanceProcedures),
+    (["CR", "DX"], ConventionalRadiologyProcedures),
+    (["CT", "PT"], TomographyProcedures),
+    (["OP", "SC", "XC", "OT"], OphthalmographyProcedures),
+    (["SM", "BF"], MicroscopyProcedures),
+    (["NM"], NuclearMedicineProcedures),
+    (["US"], UltrasoundProcedures),
+    (["ECG", "EEG", "EMG", "EOG", "EPS", "HD", "RESP"], WaveformProcedures),
+]
+
+
+def instance_number(instance) -> int:
+    """Return the InstanceNumber of an instance, 0 if it is missing or empty."""
+    try:
+        return int(instance.InstanceNumber)
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return 0
+
+
+def get_procedures(
+    modality: str,
+    cache: Optional[Dict[tuple, Procedures]],
+    mids_path: Path,
+    bodypart: str,
+    use_bodypart: bool,
+    use_viewposition: bool,
+    **procedure_options,
+) -> Optional[Procedures]:
+    """
+    Return the procedures converting a modality, reusing a cached instance if possible.
+
+    :param modality: The modality of the series.
+    :type modality: str
+    :param cache: Instances already created, by class and settings. A new
+        instance is created for every series if None.
+    :type cache: Dict[tuple, dcm2mids.procedures.Procedures], optional
+    :return: The procedures, or None if the modality is not supported.
+    :rtype: Optional[dcm2mids.procedures.Procedures]
+    """
+    cls = next((cls for modalities, cls in MODALITY_PROCEDURES if modality in modalities), None)
+    if cls is None:
+        return None
+    key = (
+        cls,
+        mids_path,
+        bodypart,
+        use_bodypart,
+        use_viewposition,
+        *(id(option) for option in procedure_options.values()),
+    )
+    if cache is not None and key in cache:
+        return cache[key]
+    procedures = cls(mids_path, bodypart, use_bodypart, use_viewposition, **procedure_options)
+    if cache is not None:
+        cache[key] = procedures
+    return procedures
+
 
 def create_mids_directory(
-    fileset: FileSet, mids_path: Union[Path, str], bodypart: str
-) -> None:
+    fileset: Union[FileSet, ScanIndex],
+    mids_path: Union[Path, str],
+    bodypart: str,
+    memory_budget: Optional[MemoryBudget] = None,
+    report: Optional[RunReport] = None,
+    shard: Optional[Shard] = None,
+    update: bool = False,
+    content_store: Optional[ContentStore] = None,
+    decoder: Optional[FrameDecoder] = None,
+    writer: Optional[OutputWriter] = None,
+    procedure_cache: Optional[Dict[tuple, Procedures]] = None,
+    continue_on_error: bool = False,
+    metadata_exporter: Optional[MetadataExporter] = None,
+    fault_policy: Optional[FaultPolicy] = None,
+    series_workers: int = 1,
+    output_profiles: Optional[OutputProfiles] = None,
+) -> RunReport:
     """
     Create the MIDS directory structure for a given file set and body  part.
 
-    :param fileset: The FileSet object containing the data to be processed.
-    :type fileset: pydicom.fileset.FileSet
+    :param fileset: The FileSet object containing the data to be processed, or a
+        ScanIndex built from it to avoid opening every instance while indexing.
+    :type fileset: Union[pydicom.fileset.FileSet, dcm2mids.scan_index.ScanIndex]
     :param mids_path: The path to the MIDS directory where the data will be stored.
     :type mids_path: Union[pathlib.Path, str]
     :param bodypart: The body part to be processed (e.g., "head", "neck", etc.).
     :type bodypart: str
-    :return: None
-    :rtype: None
+    :param memory_budget: Budget for the loaded datasets and decoded pixels. The
+        estimated size of each series is reserved before it is converted and
+        released as soon as it is done, even if it fails.
+    :type memory_budget: dcm2mids.memory.MemoryBudget, optional
+    :param report: Report to add the processed series to. A new one is created if None.
+    :type report: dcm2mids.report.RunReport, optional
+    :param shard: Only convert the subjects (or sessions, depending on the shard
+        key) of this shard. The participants TSV is then written as a fragment
+        under `shards/`, to be combined with the fragments of the other shards.
+    :type shard: dcm2mids.shard.Shard, optional
+    :param update: Merge the rows of the processed subjects, sessions and scans
+        into the existing TSV files instead of overwriting them.
+    :type update: bool
+    :param content_store: Index of the images already present in the output. Images
+        whose pixel data was already converted are linked instead of re-encoded.
+    :type content_store: dcm2mids.deduplicate.ContentStore, optional
+    :param decoder: Decoder used to read the pixel data of each series in a thread
+        pool, decoding compressed frames in parallel. Images are read one at a
+        time with SimpleITK if None.
+    :type decoder: dcm2mids.procedures.decoders.FrameDecoder, optional
+    :param writer: Writer for every output file, e.g. to stream the dataset into
+        an archive. Its root must contain `mids_path`. Files are written to
+        `mids_path` on the filesystem if None.
+    :type writer: dcm2mids.writers.OutputWriter, optional
+    :param procedure_cache: Procedure instances by modality and settings, reused
+        for every series and kept by the caller across calls.
+    :type procedure_cache: Dict[tuple, dcm2mids.procedures.Procedures], optional
+    :param continue_on_error: Record a series whose conversion raised as failed in
+        the report and go on with the next one, instead of raising.
+    :type continue_on_error: bool
+    :param metadata_exporter: Exporter collecting the header of every converted
+        instance into a columnar table. Its buffered rows are written at the end.
+    :type metadata_exporter: dcm2mids.export_metadata.MetadataExporter, optional
+    :param fault_policy: Convert each series with the timeout and retries of the
+        policy, and quarantine its files if it fails. Implies `continue_on_error`.
+    :type fault_policy: dcm2mids.journal.FaultPolicy, optional
+    :param series_workers: Convert this many series at once, in threads scheduled
+        by `dcm2mids.scheduler.SeriesScheduler`: largest series first, within the
+        memory budget, with idle workers stealing series from the busy ones.
+    :type series_workers: int
+    :param output_profiles: The outputs written for each modality: images,
+        sidecars and rows of the TSV files. Everything is written if None.
+    :type output_profiles: dcm2mids.profiles.OutputProfiles, optional
+    :return: The report of the run.
+    :rtype: dcm2mids.report.RunReport
     """
 
     use_bodypart = len(fileset.find_values("BodyPartExamined", load=True)) > 1
@@ -32,49 +163,171 @@ def create_mids_directory(
     use_viewposition = len(fileset.find_values("ViewPosition", load=True)) > 1
     logger.debug("`ViewPosition` tag: %s", use_bodypart)
     mids_path = Path(mids_path)
-    participants = []
-    for subject in fileset.find_values("PatientID", load=True):
+    report = report or RunReport()
+    writer = writer or FilesystemWriter(mids_path)
+    procedure_options = {
+        "content_store": content_store,
+        "decoder": decoder,
+        "writer": writer,
+        "metadata_exporter": metadata_exporter,
+        "output_profiles": output_profiles,
+    }
+    # Kept out of the options, so the procedure cache key stays the same across calls
+    output_profiles = output_profiles or OutputProfiles()
+    subjects = fileset.find_values("PatientID", load=True)
+    if shard is not None:
+        mids_path = shard.output_root(mids_path)
+        report.stats["shard"] = shard.name
+        if shard.key == "PatientID":
+            subjects = [subject for subject in subjects if shard.owns(subject)]
+    # Series sizes are only estimated when something uses them
+    estimate = memory_budget is not None or series_workers > 1
+    plan: List[Tuple[str, List[str]]] = []
+    tasks: List[SeriesTask] = []
+    for subject in subjects:
         logger.debug("Subject: %s", subject)
-        participant = {}
-        sessions = []
-        for session in fileset.find_values("StudyID", fileset.find(PatientID=subject, load=True), load=True):
+        subject_sessions = fileset.find_values(
+            "StudyID", fileset.find(PatientID=subject, load=True), load=True
+        )
+        if shard is not None and shard.key == "StudyInstanceUID":
+            subject_sessions = [
+                session
+                for session in subject_sessions
+                if any(
+                    shard.owns(uid)
+                    for uid in fileset.find_values(
+                        "StudyInstanceUID",
+                        fileset.find(PatientID=subject, StudyID=session, load=True),
+                        load=True,
+                    )
+                )
+            ]
+            if not subject_sessions:
+                continue
+        plan.append((subject, subject_sessions))
+        for session in subject_sessions:
             logger.debug("Session: %s", session)
-            scans = []
             for scan in fileset.find_values(
                 "SeriesNumber", fileset.find(PatientID=subject, StudyID=session, load=True), load=True
             ):
-                logger.debug("Scan: %s", scan)
                 instance_list = fileset.find(
                     PatientID=subject, StudyID=session, SeriesNumber=scan,
                     load=True
                 )
-                instance_list = sorted(
-                    instance_list, key=lambda x: int(x.InstanceNumber)
+                instance_list = sorted(instance_list, key=instance_number)
+                tasks.append(
+                    SeriesTask((subject, session, scan), instance_list, None if estimate else 0)
                 )
-                logger.debug("Number of instances: %d", len(instance_list))
-                modality = instance_list[0].Modality
-                if modality == "MR":
-                    scans_row = MagneticResonanceProcedures(
-                        mids_path, bodypart, use_bodypart, use_viewposition
-                    ).run(instance_list)
-                if modality in ["CR", "DX"]:
-                    scans_row = ConventionalRadiologyProcedures(
-                        mids_path, bodypart, use_bodypart, use_viewposition
-                    ).run(instance_list)
-                if modality in ["CT", "PT"]:
-                    scans_row = TomographyProcedures(
-                        mids_path,  bodypart, use_bodypart, use_viewposition
-                    ).run(instance_list)
-                if modality in ["OP", "SC", "XC", "OT"]:
-                    scans_row = OphthalmographyProcedures(
-                        mids_path, bodypart, use_bodypart, use_viewposition
-                    ).run(instance_list)
-                if modality in ["SM", "BF"]:
-                    scans_row = MicroscopyProcedures(
-                        mids_path, bodypart, use_bodypart, use_viewposition
-                    ).run(instance_list)
-                scans.extend(scans_row)
-            save_scans_tsv(scans, mids_path, subject, session)  # type: ignore
+
+    # Series converted in other threads get their own procedures and decoder prefetch queue
+    worker_options = [procedure_options] + [
+        dict(procedure_options, decoder=decoder.fork() if decoder is not None else None)
+        for _ in range(1, series_workers)
+    ]
+    worker_caches = [procedure_cache] + [{} for _ in range(1, series_workers)]
+
+    def convert_series(task: SeriesTask, worker: int = 0) -> List[Dict[str, Any]]:
+        subject, session, scan = task.key
+        instance_list = task.instances
+        logger.debug("Scan: %s", scan)
+        logger.debug("Number of instances: %d", len(instance_list))
+        start_time = time.perf_counter()
+        modality = instance_list[0].Modality
+        procedures = get_procedures(
+            modality,
+            worker_caches[worker],
+            mids_path,
+            bodypart,
+            use_bodypart,
+            use_viewposition,
+            **worker_options[worker],
+        )
+        scans_row, status, error = [], "converted", None
+
+        def run_series(instances: List[Any]) -> List[Dict[str, Any]]:
+            # Each attempt gets its own procedures: an attempt abandoned after
+            # its timeout keeps running and changing the ones it was given
+            attempt = get_procedures(
+                modality,
+                None,
+                mids_path,
+                bodypart,
+                use_bodypart,
+                use_viewposition,
+                **worker_options[worker],
+            )
+            return attempt.run(instances)
+
+        if procedures is None:
+            logger.warning("Modality %s is not supported, skipping series %s", modality, scan)
+            status = "skipped"
+        else:
+            try:
+                # Members of tar archives are read in one pass for the whole series
+                with loaded_members(instance_list):
+                    if fault_policy is None:
+                        scans_row = procedures.run(instance_list)
+                    else:
+                        scans_row = fault_policy.isolate(
+                            "series",
+                            [fault_policy.source(instance) for instance in instance_list],
+                            run_series,
+                            instance_list,
+                            subject=subject,
+                            session=session,
+                            series=scan,
+                        )
+            except Exception as e:
+                if not continue_on_error and fault_policy is None:
+                    raise
+                logger.exception("Series %s of session %s failed", scan, session)
+                status, error = "failed", f"{type(e).__name__}: {e}"
+        report.add_series(
+            subject=subject,
+            session=session,
+            series=scan,
+            modality=modality,
+            instances=len(instance_list),
+            seconds=time.perf_counter() - start_time,
+            status=status,
+            error=error,
+            outputs=[
+                str(Path(f"sub-{subject}", f"ses-{session}", next(iter(row.values()))))
+                for row in scans_row
+                if output_profiles.get(modality).image
+            ],
+        )
+        return scans_row
+
+    if series_workers > 1:
+        scheduler = SeriesScheduler(series_workers, memory_budget)
+        scheduler.run(tasks, convert_series)
+        scheduler.log_stats()
+        report.stats.update(scheduler.summary())
+        failed = next((task for task in tasks if task.error is not None), None)
+        if failed is not None:
+            raise failed.error  # type: ignore[misc]
+    else:
+        for task in tasks:
+            if memory_budget is None:
+                task.result = convert_series(task)
+                continue
+            with memory_budget.reserve(task.nbytes):
+                task.result = convert_series(task)
+
+    # The TSV files list the scans in the order of the series, however they were converted
+    session_scans: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+    for task in tasks:
+        if "scans" in output_profiles.get(task.instances[0].Modality).tsvs:
+            session_scans.setdefault(task.key[:2], []).extend(task.result or [])
+    participants = []
+    for subject, subject_sessions in plan:
+        participant = {}
+        sessions = []
+        for session in subject_sessions:
+            scans = session_scans.get((subject, session), [])
+            if scans:
+                save_scans_tsv(scans, mids_path, subject, session, update, writer)  # type: ignore
             logger.debug(
                 "%d scans created from session %s in subject %s.",
                 len(scans),
@@ -88,7 +341,8 @@ def create_mids_directory(
             participant["ages"].append(patient_age)
             participant_birthday = session_row.pop("PatientBirthDate")
             sessions.append(session_row)
-        save_session_tsv(sessions, mids_path, subject)  # type: ignore
+        if output_profiles.writes_tsv("sessions"):
+            save_session_tsv(sessions, mids_path, subject, update, writer)  # type: ignore
         logger.debug(
             "%d sessions created from subject %s.",
             len(sessions),
@@ -98,5 +352,62 @@ def create_mids_directory(
             participant, fileset, subject, bodypart, participant_birthday  # type: ignore
         )
         participants.append(participant)
-    save_participant_tsv(participants, mids_path)
+    if output_profiles.writes_tsv("participants"):
+        save_participant_tsv(
+            participants,
+            mids_path,
+            None if shard is None else shard.participants_fragment(mids_path),
+            merge=update,
+            writer=writer,
+        )
     logger.debug("%d participants processed.", len(participants))
+    if content_store is not None:
+        content_store.save()
+        report.stats["outputs_linked"] = content_store.linked
+    if fault_policy is not None:
+        report.stats.update(fault_policy.summary())
+    if metadata_exporter is not None:
+        metadata_exporter.flush()
+        report.stats["rows_exported"] = metadata_exporter.exported
+    if decoder is not None:
+        decoder.log_stats()
+        report.stats.update(decoder.summary())
+    report.stats["files_written"] = writer.files_written
+    report.stats["output_bytes"] = writer.bytes_written
+    if memory_budget is not None:
+        report.stats["memory_budget_bytes"] = memory_budget.max_bytes
+        report.stats["peak_reserved_bytes"] = memory_budget.peak_in_use
+    return report.finish()
+
+
+def update_mids_directory(
+    fileset: Union[FileSet, ScanIndex],
+    mids_path: Union[Path, str],
+    bodypart: str,
+    writer: Optional[OutputWriter] = None,
+    **options,
+) -> RunReport:
+    """
+    Add the series of a file set to an existing MIDS directory.
+
+    The rows of the converted scans and sessions are merged into the existing
+    TSV files, and the list columns of `participants.tsv` (ages, modalities,
+    body parts) are combined with the existing row of each participant, so
+    converting a few new series of a known subject keeps its other series,
+    see `save_participant_tsv`.
+
+    :param fileset: The new series.
+    :type fileset: Union[pydicom.fileset.FileSet, dcm2mids.scan_index.ScanIndex]
+    :param mids_path: The path to the MIDS directory.
+    :type mids_path: Union[pathlib.Path, str]
+    :param bodypart: The body part to be processed.
+    :type bodypart: str
+    :param writer: Writer for every output file, on the filesystem if None.
+    :type writer: dcm2mids.writers.OutputWriter, optional
+    :param options: Passed to `create_mids_directory`, e.g. `decoder` or `content_store`.
+    :return: The report of the run.
+    :rtype: dcm2mids.report.RunReport
+    """
+    return create_mids_directory(
+        fileset, mids_path, bodypart, update=True, writer=writer, **options
+    )
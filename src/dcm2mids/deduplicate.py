@@ -0,0 +1,169 @@
+import hashlib
+import logging
+import os
+import shutil
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+import pandas as pd
+from pydicom import Dataset
+
+from .generate_tsvs import read_tsv, write_tsv
+from .writers import OutputWriter, output_discarded, output_suffix
+
+logger = logging.getLogger("dcm2mids").getChild("deduplicate")
+
+# Folder inside the MIDS root where dcm2mids keeps its bookkeeping files
+STATE_FOLDER = ".dcm2mids"
+
+
+def pixel_digest(dataset: Dataset) -> Optional[str]:
+    """
+    Return a digest of the pixel data of a dataset.
+
+    The encoded bytes are hashed, so the same image stored with two different
+    transfer syntaxes gets two different digests.
+
+    :param dataset: The dataset.
+    :type dataset: pydicom.Dataset
+    :return: The hexadecimal BLAKE2b digest, or None if there is no pixel data.
+    :rtype: Optional[str]
+    """
+    if "PixelData" not in dataset:
+        return None
+    return hashlib.blake2b(dataset.PixelData, digest_size=20).hexdigest()
+
+
+class DuplicateDetector:
+    """Detect instances that were already seen during the scan.
+
+    An instance is a duplicate if its SOPInstanceUID was seen before or, when
+    `hash_pixels` is enabled, if its pixel data is identical to that of a
+    previous instance.
+    """
+
+    def __init__(self, hash_pixels: bool = False):
+        self.hash_pixels = hash_pixels
+        self.instances: Dict[str, str] = {}
+        self.pixel_digests: Dict[str, str] = {}
+        self.skipped: List[Dict[str, str]] = []
+
+    def check(self, dataset: Dataset, path: Union[Path, str]) -> Optional[str]:
+        """
+        Register an instance and check whether it is a duplicate.
+
+        :param dataset: The dataset read from `path`.
+        :type dataset: pydicom.Dataset
+        :param path: The path of the instance.
+        :type path: Union[pathlib.Path, str]
+        :return: The path of the first copy if the instance is a duplicate, None otherwise.
+        :rtype: Optional[str]
+        """
+        path = str(path)
+        uid = str(dataset.get("SOPInstanceUID", ""))
+        if uid and uid in self.instances:
+            return self._skip(path, self.instances[uid], "SOPInstanceUID")
+        digest = pixel_digest(dataset) if self.hash_pixels else None
+        if digest is not None and digest in self.pixel_digests:
+            return self._skip(path, self.pixel_digests[digest], "PixelData")
+        if uid:
+            self.instances[uid] = path
+        if digest is not None:
+            self.pixel_digests[digest] = path
+        return None
+
+    def _skip(self, path: str, original: str, reason: str) -> str:
+        logger.info("Skipping %s: same %s as %s", path, reason, original)
+        self.skipped.append({"path": path, "duplicate_of": original, "reason": reason})
+        return original
+
+    def save_report(self, tsv_path: Path, writer: Optional[OutputWriter] = None):
+        """Write the skipped duplicates to a TSV file."""
+        write_tsv(
+            pd.DataFrame(self.skipped, columns=["path", "duplicate_of", "reason"]),
+            tsv_path,
+            writer,
+        )
+
+
+def link_or_copy(source: Path, target: Path):
+    """Hard link `source` to `target`, falling back to a symbolic link and then a copy."""
+    target.parent.mkdir(parents=True, exist_ok=True)
+    if target.exists() or target.is_symlink():
+        target.unlink()
+    try:
+        os.link(source, target)
+    except OSError:
+        try:
+            target.symlink_to(os.path.relpath(source, target.parent))
+        except OSError:
+            shutil.copy2(source, target)
+
+
+class ContentStore:
+    """Content-addressed index of the images written to a MIDS dataset.
+
+    Maps the digest of the pixel data of an instance, together with the output
+    extension, to the file it was converted to. It is persisted in
+    `<mids_path>/.dcm2mids/content_index.tsv` so that later runs can reuse the
+    files written by earlier ones.
+    """
+
+    def __init__(self, mids_path: Union[Path, str]):
+        self.mids_path = Path(mids_path)
+        self.index_path = self.mids_path.joinpath(STATE_FOLDER, "content_index.tsv")
+        self.files: Dict[str, str] = {}
+        self.linked = 0
+        self._lock = threading.Lock()
+        if self.index_path.exists():
+            df = read_tsv(self.index_path)
+            self.files = dict(zip(df["digest"], df["path"]))
+            logger.debug("Loaded %d entries from %s", len(self.files), self.index_path)
+
+    def lookup(self, digest: Optional[str], suffix: str) -> Optional[Path]:
+        """Return the existing output file for this content, if any."""
+        if digest is None:
+            return None
+        with self._lock:
+            relative_path = self.files.get(digest + suffix)
+        if relative_path is None:
+            return None
+        path = self.mids_path.joinpath(relative_path)
+        return path if path.exists() else None
+
+    def add(self, digest: Optional[str], path: Path):
+        """Register the output file written for this content."""
+        if digest is not None:
+            with self._lock:
+                self.files[digest + output_suffix(path)] = str(path.relative_to(self.mids_path))
+
+    def reuse(self, digest: Optional[str], path: Path) -> bool:
+        """
+        Link `path` to an existing file with the same content.
+
+        :param digest: The pixel digest of the instance.
+        :type digest: Optional[str]
+        :param path: The output file to create.
+        :type path: pathlib.Path
+        :return: True if an existing file was linked, False if it must be converted.
+        :rtype: bool
+        """
+        existing = self.lookup(digest, output_suffix(path))
+        # Links bypass the writer, which drops the files of abandoned conversions
+        if existing is None or existing == path or output_discarded():
+            return False
+        link_or_copy(existing, path)
+        with self._lock:
+            self.linked += 1
+        logger.info("Linked %s to existing %s", path, existing)
+        return True
+
+    def save(self):
+        """Write the index to disk."""
+        with self._lock:
+            files = dict(self.files)
+        write_tsv(
+            pd.DataFrame({"digest": list(files), "path": list(files.values())}),
+            self.index_path,
+        )
@@ -0,0 +1,302 @@
+import gzip
+import logging
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import BinaryIO, Deque, Dict, Iterator, Optional, Union
+
+import SimpleITK as sitk
+
+try:
+    from isal import igzip
+except ImportError:  # pragma: no cover
+    igzip = None
+
+logger = logging.getLogger("dcm2mids").getChild("encoding")
+
+# Uncompressed bytes deflated by each task of the parallel gzip writer
+GZIP_BLOCK_BYTES = 1 << 20
+# Deflate window, primed with the end of the previous block
+DEFLATE_WINDOW = 1 << 15
+
+NIFTI_COMPRESSIONS = ["gzip", "none"]
+CODECS = [None, "isal"]
+
+
+def _deflate_block(data: bytes, dictionary: bytes, level: int, last: bool) -> bytes:
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(
+        zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+    )
+
+
+class ParallelGzipFile:
+    """Write a gzip stream, deflating blocks of it in a thread pool, as pigz does.
+
+    The data is cut in blocks of `block_size` bytes, each deflated by a
+    separate task primed with the last 32 KiB of the previous block, and the
+    raw deflate streams are written in order between a single gzip header
+    and trailer. The result is a standard single-member gzip file, almost as
+    small as the one written by `gzip.GzipFile`. zlib releases the GIL, so the
+    blocks are compressed in parallel.
+
+    :param fileobj: The output file, opened in binary mode.
+    :type fileobj: BinaryIO
+    :param executor: The thread pool deflating the blocks.
+    :type executor: concurrent.futures.ThreadPoolExecutor
+    :param compresslevel: The zlib level, 0 to 9.
+    :type compresslevel: int
+    :param block_size: Uncompressed bytes per block.
+    :type block_size: int
+    :param max_pending: Blocks being deflated at most, bounding the memory used.
+    :type max_pending: int
+    """
+
+    def __init__(
+        self,
+        fileobj: BinaryIO,
+        executor: ThreadPoolExecutor,
+        compresslevel: int = 6,
+        block_size: int = GZIP_BLOCK_BYTES,
+        max_pending: int = 16,
+    ):
+        self.fileobj = fileobj
+        self.executor = executor
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        self.max_pending = max_pending
+        self.buffer = bytearray()
+        self.pending: Deque[Future] = deque()
+        self.dictionary = b""
+        self.crc = 0
+        self.size = 0
+        self.closed = False
+        # Header: magic, deflate, no flags, no mtime, no extra flags, unknown OS
+        self.fileobj.write(b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff")
+
+    def write(self, data: bytes) -> int:
+        self.buffer += data
+        size = memoryview(data).nbytes
+        while len(self.buffer) >= self.block_size:
+            block = bytes(self.buffer[: self.block_size])
+            del self.buffer[: self.block_size]
+            self._submit(block, last=False)
+        return size
+
+    def _submit(self, block: bytes, last: bool):
+        self.crc = zlib.crc32(block, self.crc)
+        self.size += len(block)
+        self.pending.append(
+            self.executor.submit(_deflate_block, block, self.dictionary, self.compresslevel, last)
+        )
+        self.dictionary = block[-DEFLATE_WINDOW:]
+        while len(self.pending) > self.max_pending or (last and self.pending):
+            self.fileobj.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        self._submit(bytes(self.buffer), last=True)
+        self.buffer = bytearray()
+        self.fileobj.write(struct.pack("<II", self.crc & 0xFFFFFFFF, self.size & 0xFFFFFFFF))
+        self.closed = True
+
+    def __enter__(self) -> "ParallelGzipFile":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class EncodingProfile:
+    """How the images of each output type are encoded.
+
+    :param png_level: zlib level of PNG images, from 1 (fastest) to 9 (smallest).
+        ITK writes level 0 as level 1, so PNG images are never stored uncompressed.
+    :type png_level: int
+    :param png_bits: Bit depth of PNG images. 16 keeps the values of images
+        with up to 16 bits losslessly (others are rescaled to the 16-bit range),
+        8 rescales every image to 0-255. Images are written as they are if None.
+    :type png_bits: int, optional
+    :param nifti_compression: `gzip` to write `.nii.gz`, `none` to write `.nii`.
+    :type nifti_compression: str
+    :param gzip_level: zlib level of `.nii.gz` volumes.
+    :type gzip_level: int
+    :param gzip_threads: Threads deflating each `.nii.gz` volume. More than one
+        writes it in parallel blocks, see `ParallelGzipFile`.
+    :type gzip_threads: int
+    :param codec: `isal` to write `.nii.gz` with the ISA-L deflate of the optional
+        `isal` package, several times faster than zlib at levels 0 to 3.
+    :type codec: str, optional
+    """
+
+    def __init__(
+        self,
+        png_level: int = 6,
+        png_bits: Optional[int] = None,
+        nifti_compression: str = "gzip",
+        gzip_level: int = 6,
+        gzip_threads: int = 1,
+        codec: Optional[str] = None,
+    ):
+        if not 1 <= png_level <= 9:
+            raise ValueError("PNG compression levels go from 1 to 9")
+        if not 0 <= gzip_level <= 9:
+            raise ValueError("gzip compression levels go from 0 to 9")
+        if png_bits not in (None, 8, 16):
+            raise ValueError("PNG images are written with 8 or 16 bits")
+        if nifti_compression not in NIFTI_COMPRESSIONS:
+            raise ValueError(f"Unknown NIfTI compression {nifti_compression}")
+        if codec not in CODECS:
+            raise ValueError(f"Unknown codec {codec}")
+        if codec == "isal" and igzip is None:
+            raise RuntimeError("The isal package is needed for the isal codec")
+        self.png_level = png_level
+        self.png_bits = png_bits
+        self.nifti_compression = nifti_compression
+        self.gzip_level = gzip_level
+        self.gzip_threads = max(int(gzip_threads), 1)
+        self.codec = codec
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def __repr__(self) -> str:
+        return (
+            f"EncodingProfile(png_level={self.png_level}, png_bits={self.png_bits}, "
+            f"nifti_compression={self.nifti_compression!r}, gzip_level={self.gzip_level}, "
+            f"gzip_threads={self.gzip_threads}, codec={self.codec!r})"
+        )
+
+    @property
+    def nifti_suffix(self) -> str:
+        """The extension of NIfTI volumes: `.nii.gz`, or `.nii` if uncompressed."""
+        return ".nii" if self.nifti_compression == "none" else ".nii.gz"
+
+    @contextmanager
+    def compress(self, f: BinaryIO) -> Iterator[BinaryIO]:
+        """
+        Wrap an output file to write a NIfTI volume with this profile.
+
+        :param f: The output file, opened in binary mode.
+        :type f: BinaryIO
+        :return: A context manager yielding the file to write the volume to.
+        :rtype: Iterator[BinaryIO]
+        """
+        if self.nifti_compression == "none":
+            yield f
+        elif self.codec == "isal":
+            with igzip.GzipFile(
+                fileobj=f, mode="wb", compresslevel=min(self.gzip_level, 3), mtime=0
+            ) as gz:
+                yield gz
+        elif self.gzip_threads > 1:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    self.gzip_threads, thread_name_prefix="dcm2mids-gzip"
+                )
+            with ParallelGzipFile(
+                f, self._executor, self.gzip_level, max_pending=2 * self.gzip_threads
+            ) as gz:
+                yield gz
+        else:
+            with gzip.GzipFile(
+                fileobj=f, mode="wb", compresslevel=self.gzip_level, mtime=0
+            ) as gz:
+                yield gz
+
+    def convert_png_bits(self, image: sitk.Image) -> sitk.Image:
+        """
+        Convert an image to the PNG bit depth of the profile.
+
+        :param image: The image.
+        :type image: SimpleITK.Image
+        :return: The image, with unsigned 8 or 16-bit pixels.
+        :rtype: SimpleITK.Image
+        """
+        if self.png_bits is None:
+            return image
+        if image.GetNumberOfComponentsPerPixel() > 1:
+            # Colour images are 8-bit, which fit 16-bit PNG as they are
+            if self.png_bits == 16:
+                return sitk.Cast(image, sitk.sitkVectorUInt16)
+            return sitk.Cast(image, sitk.sitkVectorUInt8)
+        pixel_id = sitk.sitkUInt8 if self.png_bits == 8 else sitk.sitkUInt16
+        if image.GetPixelID() == pixel_id:
+            return image
+        statistics = sitk.MinimumMaximumImageFilter()
+        statistics.Execute(image)
+        maximum = 255 if self.png_bits == 8 else 65535
+        if self.png_bits == 16 and statistics.GetMinimum() >= 0 and statistics.GetMaximum() <= maximum:
+            # Lossless: the values fit as they are
+            return sitk.Cast(image, pixel_id)
+        # Rescale in floating point, the range may not fit the input type
+        rescaled = sitk.RescaleIntensity(sitk.Cast(image, sitk.sitkFloat32), 0, maximum)
+        return sitk.Cast(sitk.Round(rescaled), pixel_id)
+
+    def write_image(self, image: sitk.Image, path: Union[Path, str]):
+        """
+        Write an image to a file, in the format given by its extension.
+
+        :param image: The image.
+        :type image: SimpleITK.Image
+        :param path: The path of the file.
+        :type path: Union[pathlib.Path, str]
+        """
+        writer = sitk.ImageFileWriter()
+        writer.SetFileName(str(path))
+        if str(path).endswith(".png"):
+            image = self.convert_png_bits(image)
+            # Without compression ITK falls back to the libpng default level
+            writer.SetUseCompression(True)
+            writer.SetCompressionLevel(self.png_level)
+        elif str(path).endswith(".nii.gz"):
+            writer.SetUseCompression(True)
+            writer.SetCompressionLevel(self.gzip_level)
+        writer.Execute(image)
+
+    def close(self):
+        """Stop the threads of the parallel gzip writer."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+# Named profiles, also the base of the profiles given as `name,key=value,...`
+PROFILES: Dict[str, Dict[str, object]] = {
+    "default": {},
+    "fast": {"png_level": 1, "gzip_level": 1, "gzip_threads": os.cpu_count() or 1},
+    "small": {"png_level": 9, "gzip_level": 9, "gzip_threads": os.cpu_count() or 1},
+    "uncompressed": {"png_level": 1, "nifti_compression": "none"},
+}
+
+
+def parse_profile(spec: str) -> EncodingProfile:
+    """
+    Build an encoding profile from a name and overrides, e.g. `fast,png_bits=16`.
+
+    :param spec: A profile name from `PROFILES`, optionally followed by
+        comma-separated `key=value` overrides of its parameters.
+    :type spec: str
+    :raises ValueError: If the name or a parameter is unknown or invalid.
+    :return: The profile.
+    :rtype: dcm2mids.encoding.EncodingProfile
+    """
+    name, *overrides = [part.strip() for part in spec.split(",") if part.strip()]
+    if name not in PROFILES:
+        raise ValueError(f"Unknown encoding profile {name}, expected one of {', '.join(PROFILES)}")
+    options = dict(PROFILES[name])
+    for override in overrides:
+        key, _, value = override.partition("=")
+        if key not in ("png_level", "png_bits", "nifti_compression", "gzip_level", "gzip_threads", "codec"):
+            raise ValueError(f"Unknown encoding parameter {key}")
+        if key in ("nifti_compression", "codec"):
+            options[key] = value or None
+        else:
+            options[key] = int(value)
+    return EncodingProfile(**options)
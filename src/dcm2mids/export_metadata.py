@@ -0,0 +1,245 @@
+import json
+import logging
+import re
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from pydicom import Dataset
+from pydicom.datadict import dictionary_VM, dictionary_VR, keyword_for_tag
+from pydicom.multival import MultiValue
+
+from .procedures.dictify import convert_string, dictify
+from .procedures.enhanced import EnhancedFrames
+from .writers import FilesystemWriter, OutputWriter
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc as ipc
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover
+    pa = None
+
+logger = logging.getLogger("dcm2mids").getChild("export_metadata")
+
+# Folder of the exported tables, under the MIDS root
+METADATA_FOLDER = Path("derivatives", "metadata")
+EXPORT_FORMATS = {"parquet": ".parquet", "arrow": ".arrow"}
+# Rows buffered per subject before they are written as a new part
+BATCH_ROWS = 10_000
+
+INTEGER_VRS = {"IS", "SL", "SS", "SV", "UL", "US", "UV"}
+FLOAT_VRS = {"DS", "FD", "FL"}
+BINARY_VRS = {"OB", "OD", "OF", "OL", "OV", "OW", "UN"}
+
+# Columns describing where each row comes from, before the header fields
+LOCATION_COLUMNS = ["participant_id", "session_id", "file"]
+
+
+def column_kind(keyword: str) -> Tuple[str, bool]:
+    """
+    Return the type of the column of a keyword, from the DICOM dictionary.
+
+    The type only depends on the keyword, never on the values of a given
+    instance, so every part of the table has the same schema.
+
+    :param keyword: The keyword of the element.
+    :type keyword: str
+    :return: The kind, one of `int`, `float`, `json` or `str`, and whether the
+        column holds lists.
+    :rtype: Tuple[str, bool]
+    """
+    try:
+        vr, vm = dictionary_VR(keyword), dictionary_VM(keyword)
+    except (KeyError, ValueError):
+        return "str", False
+    multiple = vm != "1"
+    if vr in INTEGER_VRS:
+        return "int", multiple
+    if vr in FLOAT_VRS:
+        return "float", multiple
+    if vr == "SQ":
+        return "json", False
+    return "str", multiple and vr not in BINARY_VRS
+
+
+def _convert(value: Any, kind: str) -> Any:
+    if value is None or value == "":
+        return None
+    try:
+        if kind == "int":
+            return int(value)
+        if kind == "float":
+            return float(value)
+    except (TypeError, ValueError):
+        return None
+    return str(value)
+
+
+def metadata_record(dataset: Dataset) -> Dict[str, Any]:
+    """
+    Turn the header of an instance into a row of typed values.
+
+    The columns are the keys of `dictify`. Numbers are kept as numbers, values
+    with several items as lists, and sequences as their `dictify` JSON.
+
+    :param dataset: The dataset of the instance.
+    :type dataset: pydicom.Dataset
+    :return: The value of each column.
+    :rtype: Dict[str, Any]
+    """
+    record: Dict[str, Any] = {}
+    for elem in dataset:
+        if elem.keyword == "PixelData":
+            continue
+        if elem.tag.is_private:
+            if elem.VR != "SQ":
+                record[convert_string(elem.name)] = str(elem.value)
+            continue
+        keyword = keyword_for_tag(elem.tag)
+        if not keyword:
+            continue
+        if keyword == "PerFrameFunctionalGroupsSequence":
+            record["PerFrameFunctionalGroupsSummary"] = json.dumps(EnhancedFrames(dataset).summary())
+            continue
+        if elem.VR == "SQ":
+            nested = dictify(Dataset({elem.tag: elem}))
+            record[keyword] = json.dumps(next(iter(nested.values()), None))
+            continue
+        kind, multiple = column_kind(keyword)
+        values = list(elem.value) if isinstance(elem.value, MultiValue) else [elem.value]
+        if multiple:
+            record[keyword] = [_convert(value, kind) for value in values]
+        else:
+            record[keyword] = _convert(values[0] if values else None, kind)
+    return record
+
+
+def arrow_type(keyword: str):
+    """Return the Arrow type of the column of a keyword."""
+    if keyword in LOCATION_COLUMNS:
+        return pa.string()
+    kind, multiple = column_kind(keyword)
+    value_type = {"int": pa.int64(), "float": pa.float64()}.get(kind, pa.string())
+    return pa.list_(value_type) if multiple else value_type
+
+
+class MetadataExporter:
+    """Export the header of every converted instance into a columnar table.
+
+    Rows are buffered per subject and written every `batch_rows` rows as a
+    new part of a Hive-partitioned dataset, so memory stays bounded however
+    many instances are converted:
+
+        derivatives/metadata/participant_id=sub-X/part-00000.parquet
+
+    Each part only holds the columns present in its rows. Column types come
+    from the DICOM dictionary, so the parts can be read as one table, e.g.
+    with `pyarrow.dataset.dataset(path, partitioning="hive")`.
+
+    :param mids_path: The MIDS root.
+    :type mids_path: pathlib.Path
+    :param export_format: `parquet` or `arrow` (Arrow IPC file).
+    :type export_format: str
+    :param batch_rows: Rows buffered per subject before they are written.
+    :type batch_rows: int
+    :param writer: Writer for the parts, on the filesystem if None.
+    :type writer: dcm2mids.writers.OutputWriter, optional
+    :raises RuntimeError: If pyarrow is not installed.
+    :raises ValueError: If the format is not supported.
+    """
+
+    def __init__(
+        self,
+        mids_path: Path,
+        export_format: str = "parquet",
+        batch_rows: int = BATCH_ROWS,
+        writer: Optional[OutputWriter] = None,
+    ):
+        if pa is None:
+            raise RuntimeError("pyarrow is needed to export the metadata")
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError(f"Unknown export format {export_format}")
+        self.mids_path = Path(mids_path)
+        self.export_format = export_format
+        self.batch_rows = batch_rows
+        self.writer = writer or FilesystemWriter(self.mids_path)
+        self.root = self.mids_path / METADATA_FOLDER
+        self.rows: Dict[str, List[Dict[str, Any]]] = {}
+        self.parts: Dict[str, int] = {}
+        self.exported = 0
+        self._lock = threading.Lock()
+
+    def add(self, dataset: Dataset, file_path_mids: Path):
+        """
+        Add the header of an instance, converted to `file_path_mids`.
+
+        :param dataset: The dataset of the instance.
+        :type dataset: pydicom.Dataset
+        :param file_path_mids: The path of the JSON sidecar of the instance.
+        :type file_path_mids: pathlib.Path
+        """
+        try:
+            relative = Path(file_path_mids).relative_to(self.mids_path)
+        except ValueError:
+            relative = Path(file_path_mids)
+        subject = next((p for p in relative.parts if p.startswith("sub-")), "n/a")
+        session = next((p for p in relative.parts if p.startswith("ses-")), None)
+        record = {
+            "participant_id": subject,
+            "session_id": session,
+            "file": str(relative),
+            **metadata_record(dataset),
+        }
+        with self._lock:
+            rows = self.rows.setdefault(subject, [])
+            rows.append(record)
+            if len(rows) >= self.batch_rows:
+                self._write_part(subject)
+
+    def _part_path(self, subject: str) -> Path:
+        folder = self.root / f"participant_id={subject}"
+        if subject not in self.parts:
+            # Continue the numbering of a previous run instead of overwriting it
+            existing = [
+                int(match.group(1))
+                for path in (folder.iterdir() if folder.is_dir() else [])
+                for match in [re.match(r"part-(\d+)\.", path.name)]
+                if match
+            ]
+            self.parts[subject] = max(existing, default=-1) + 1
+        index = self.parts[subject]
+        self.parts[subject] += 1
+        return folder / f"part-{index:05d}{EXPORT_FORMATS[self.export_format]}"
+
+    def _write_part(self, subject: str):
+        rows = self.rows.pop(subject, [])
+        if not rows:
+            return
+        columns: Dict[str, None] = {}
+        for row in rows:
+            columns.update(dict.fromkeys(row))
+        # The subject is the partition key, it is not stored in the file
+        del columns["participant_id"]
+        schema = pa.schema([(column, arrow_type(column)) for column in columns])
+        table = pa.Table.from_pylist(rows, schema=schema)
+        sink = pa.BufferOutputStream()
+        if self.export_format == "parquet":
+            pq.write_table(table, sink, compression="zstd")
+        else:
+            with ipc.new_file(sink, schema) as f:
+                f.write_table(table)
+        path = self._part_path(subject)
+        self.writer.write_bytes(path, sink.getvalue().to_pybytes())
+        self.exported += len(rows)
+        logger.debug("%d rows exported to %s", len(rows), path)
+
+    def flush(self):
+        """Write the rows still buffered."""
+        with self._lock:
+            for subject in list(self.rows):
+                self._write_part(subject)
+
+    def close(self):
+        """Write the rows still buffered, once no more instances are added."""
+        self.flush()
@@ -1,11 +1,14 @@
+import ast
 import logging
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, List, Union
+from typing import Dict, List, Optional, Union
 
 import pandas as pd
 from pydicom.fileset import FileSet
 
+from .writers import FilesystemWriter, OutputWriter
+
 logger = logging.getLogger("dcm2mids").getChild("generate_tsvs")
 
 participants_header = [
@@ -63,7 +66,7 @@ def get_session_row(fileset: FileSet, subject: str, session: str) -> Dict[str, s
         datetime.strptime(s, "%Y%m%d%H%M%S.%f")
         for s in session_row["session_date_time"]
     ][0]
-    if session_row.get("PatientBirthDate")[0]:
+    if session_row.get("PatientBirthDate") and session_row["PatientBirthDate"][0]:
 
         session_row["PatientBirthDate"] = datetime.strptime(
             session_row["PatientBirthDate"][0], "%Y%m%d"
@@ -119,7 +122,8 @@ def get_participant_row(
             load=True,
         )
     )
-    participant["sex"] = list(set(participant.pop("PatientSex")))[0]
+    sexes = list(set(participant.pop("PatientSex")))
+    participant["sex"] = sexes[0] if sexes else "n/a"
     if len(participant["BodyPartExamined"]) == 0:
         participant["BodyPartExamined"] = [bodypart]
     participant["participant_birthday"] = participant_birthday
@@ -128,7 +132,130 @@ def get_participant_row(
     return participant
 
 
-def save_session_tsv(sessions: List[Dict[str, str]], mids_path: Path, subject: str):
+def read_tsv(tsv_path: Path) -> pd.DataFrame:
+    """
+    Read a TSV file written by dcm2mids, keeping every value as a string.
+
+    :param tsv_path: The path to the TSV file.
+    :type tsv_path: pathlib.Path
+    :return: The contents of the file.
+    :rtype: pandas.DataFrame
+    """
+    return pd.read_csv(tsv_path, sep="\t", dtype=str, keep_default_na=False)
+
+
+def write_tsv(df: pd.DataFrame, tsv_path: Path, writer: Optional[OutputWriter] = None):
+    """
+    Write a TSV file.
+
+    By default the file is written atomically to the filesystem: the data is
+    written to a temporary file in the same directory, which then replaces the
+    target, so readers never see a partially written file.
+
+    :param df: The rows to write.
+    :type df: pandas.DataFrame
+    :param tsv_path: The path to the TSV file.
+    :type tsv_path: pathlib.Path
+    :param writer: Write the file through this writer, e.g. into an archive.
+    :type writer: dcm2mids.writers.OutputWriter, optional
+    """
+    writer = writer or FilesystemWriter(tsv_path.parent)
+    writer.write_text(tsv_path, df.to_csv(sep="\t", index=False))
+
+
+def append_tsv(df: pd.DataFrame, tsv_path: Path):
+    """
+    Append rows to a TSV file on the filesystem, creating it with its header if needed.
+
+    Only the new rows are written, so a journal growing a few rows at a time
+    is not rewritten as a whole each time. The columns of `df` must be those
+    of the existing file.
+
+    :param df: The rows to append.
+    :type df: pandas.DataFrame
+    :param tsv_path: The path to the TSV file.
+    :type tsv_path: pathlib.Path
+    """
+    tsv_path.parent.mkdir(parents=True, exist_ok=True)
+    header = not tsv_path.exists() or tsv_path.stat().st_size == 0
+    with open(tsv_path, "a", newline="") as f:
+        f.write(df.to_csv(sep="\t", index=False, header=header))
+
+
+def upsert_rows(df: pd.DataFrame, tsv_path: Path, key: str) -> pd.DataFrame:
+    """
+    Merge new rows into the rows of an existing TSV file.
+
+    Existing rows whose `key` matches one of the new rows are replaced; all
+    other existing rows are kept.
+
+    :param df: The new rows.
+    :type df: pandas.DataFrame
+    :param tsv_path: The existing TSV file. If it does not exist, `df` is returned.
+    :type tsv_path: pathlib.Path
+    :param key: The column identifying a row.
+    :type key: str
+    :return: The merged rows, unsorted.
+    :rtype: pandas.DataFrame
+    """
+    if not tsv_path.exists():
+        return df
+    existing = read_tsv(tsv_path)
+    if key in existing.columns:
+        existing = existing[~existing[key].isin(df[key].astype(str))]
+    logger.debug("Keeping %d rows from %s", len(existing), tsv_path)
+    return pd.concat([existing, df], ignore_index=True)
+
+
+# Participant columns holding lists, combined when a subject spans several shards or runs
+LIST_COLUMNS = ["ages", "modalities", "body_parts_examined"]
+
+
+def parse_list(value: Union[str, list]) -> list:
+    """Parse a list written to a TSV by pandas (e.g. `['CT', 'MR']`), or return a list as it is."""
+    if isinstance(value, (list, tuple, set)):
+        return list(value)
+    try:
+        parsed = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return [value] if value else []
+    return list(parsed) if isinstance(parsed, (list, tuple, set)) else [parsed]
+
+
+def combine_participant_fragments(frames: List[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Combine the partial participants TSVs written by several shards, or by several runs.
+
+    A subject present in several fragments gets a single row, with the union of
+    the list columns and the last value of the other columns.
+
+    :param frames: The rows of each fragment.
+    :type frames: List[pandas.DataFrame]
+    :return: One row per participant.
+    :rtype: pandas.DataFrame
+    """
+    df = pd.concat(frames, ignore_index=True)
+    rows = []
+    for _, group in df.groupby("participant_id", sort=False):
+        row = group.iloc[-1].to_dict()
+        for column in LIST_COLUMNS:
+            if column not in group.columns:
+                continue
+            values = []
+            for value in group[column]:
+                values.extend(v for v in parse_list(value) if v not in values)
+            row[column] = str(values)
+        rows.append(row)
+    return pd.DataFrame(rows, columns=df.columns)
+
+
+def save_session_tsv(
+    sessions: List[Dict[str, str]],
+    mids_path: Path,
+    subject: str,
+    merge: bool = False,
+    writer: Optional[OutputWriter] = None,
+):
     """
     Save the sessions for a given subject to a TSV file in the MIDS directory.
 
@@ -138,17 +265,27 @@ def save_session_tsv(sessions: List[Dict[str, str]], mids_path: Path, subject: s
     :type mids_path: pathlib.Path
     :param subject: The ID of the subject for which to save the sessions.
     :type subject: str
+    :param merge: Keep the rows of the sessions already in the file that were not
+        reprocessed, instead of overwriting it.
+    :type merge: bool
+    :param writer: Write the file through this writer, e.g. into an archive.
+    :type writer: dcm2mids.writers.OutputWriter, optional
     """
 
     session_tsv = mids_path.joinpath(f"sub-{subject}", f"sub-{subject}_sessions.tsv")
-    df = pd.DataFrame(sessions)[session_header]
+    df = pd.DataFrame(sessions, columns=session_header)
+    if merge:
+        df = upsert_rows(df, session_tsv, "session_id")
     df = df.sort_values("acq_time", ascending=False)  # type: ignore
-    session_tsv.parent.mkdir(parents=True, exist_ok=True)
-    df.to_csv(session_tsv, sep="\t", index=False)
+    write_tsv(df, session_tsv, writer)
 
 
 def save_participant_tsv(
-    participants: List[Dict[str, Union[str, list]]], mids_path: Path
+    participants: List[Dict[str, Union[str, list]]],
+    mids_path: Path,
+    participant_tsv: Optional[Path] = None,
+    merge: bool = False,
+    writer: Optional[OutputWriter] = None,
 ):
     """
     Save the participants to a TSV file in the MIDS directory.
@@ -157,17 +294,33 @@ def save_participant_tsv(
     :type participants: List[Dict]
     :param mids_path: The path to the MIDS directory.
     :type mids_path: Path
+    :param participant_tsv: Write to this file instead of `participants.tsv`,
+        e.g. the partial TSV of a shard.
+    :type participant_tsv: Path, optional
+    :param merge: Merge into the rows already in the file instead of overwriting
+        it: the list columns (ages, modalities, body parts) of a reprocessed
+        participant are combined with its existing row, and the rows of the
+        other participants are kept.
+    :type merge: bool
+    :param writer: Write the file through this writer, e.g. into an archive.
+    :type writer: dcm2mids.writers.OutputWriter, optional
     """
 
-    participant_tsv = mids_path.joinpath("participants.tsv")
-    df = pd.DataFrame(participants)[participants_header]
+    participant_tsv = participant_tsv or mids_path.joinpath("participants.tsv")
+    df = pd.DataFrame(participants, columns=participants_header)
+    if merge and participant_tsv.exists():
+        df = combine_participant_fragments([read_tsv(participant_tsv), df])
     df = df.sort_values("participant_id", ascending=False)  # type: ignore
-    participant_tsv.parent.mkdir(parents=True, exist_ok=True)
-    df.to_csv(participant_tsv, sep="\t", index=False)
+    write_tsv(df, participant_tsv, writer)
 
 
 def save_scans_tsv(
-    scans: List[Dict[str, str]], mids_path: Path, subject: str, session: str
+    scans: List[Dict[str, str]],
+    mids_path: Path,
+    subject: str,
+    session: str,
+    merge: bool = False,
+    writer: Optional[OutputWriter] = None,
 ):
     """
     Save the scans for a given subject and session to a TSV file in the MIDS directory.
@@ -180,7 +333,15 @@ def save_scans_tsv(
     :type subject: str
     :param session: The ID of the session for which to save the scans.
     :type session: str
+    :param merge: Keep the rows of the scans already in the file that were not
+        reprocessed, instead of overwriting it.
+    :type merge: bool
+    :param writer: Write the file through this writer, e.g. into an archive.
+    :type writer: dcm2mids.writers.OutputWriter, optional
     """
+    if not scans:
+        logger.debug("No scans in session %s of subject %s, the TSV is left as it is", session, subject)
+        return
 
     scan_tsv = mids_path.joinpath(
         f"sub-{subject}",
@@ -188,6 +349,8 @@ def save_scans_tsv(
         f"sub-{subject}_ses-{session}_scans.tsv",
     )
     df = pd.DataFrame(scans)
-    df = df.sort_values("scan_file", ascending=False)
-    scan_tsv.parent.mkdir(parents=True, exist_ok=True)
-    df.to_csv(scan_tsv, sep="\t", index=False)
+    key = "scan_file" if "scan_file" in df.columns else df.columns[0]
+    if merge:
+        df = upsert_rows(df, scan_tsv, key)
+    df = df.sort_values(key, ascending=False)
+    write_tsv(df, scan_tsv, writer)
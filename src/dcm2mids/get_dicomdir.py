@@ -1,22 +1,265 @@
 import logging
+import os
 from pathlib import Path
-from typing import List, Union
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Tuple, Union
 from datetime import datetime
 
-from pydicom import dcmread
-from pydicom.fileset import FileSet
+from pydicom import Dataset, dcmread
+from pydicom.fileset import FileInstance, FileSet
+
+from .archives import DicomSource, file_source, is_archive, is_gzip_dicom, iter_archive, open_sources
+from .deduplicate import DuplicateDetector
+from .journal import FaultPolicy
+from .shard import Shard
 
 logger = logging.getLogger(__name__)
 
+DICOM_PREAMBLE_LENGTH = 128
+DICOM_PREFIX = b"DICM"
+
+# Pixel Data, Float Pixel Data and Double Float Pixel Data
+PIXEL_DATA_TAGS = [0x7FE00010, 0x7FE00008, 0x7FE00009]
 
-def get_dicomdir(input_dir: Union[Path, str], exclude_paths: List[Union[Path, str]] = None) -> FileSet:
+
+def is_dicom_file(path: Union[Path, str]) -> bool:
+    """
+    Check whether a file is a DICOM Part 10 file.
+
+    Only the 128-byte preamble and the `DICM` prefix are read (132 bytes).
+
+    :param path: The path to the file.
+    :type path: Union[pathlib.Path, str]
+    :return: True if the file has the DICOM prefix, False otherwise.
+    :rtype: bool
+    """
+    try:
+        with open(path, "rb") as f:
+            header = f.read(DICOM_PREAMBLE_LENGTH + len(DICOM_PREFIX))
+    except OSError:
+        return False
+    return header[DICOM_PREAMBLE_LENGTH:] == DICOM_PREFIX
+
+
+def iter_dicom_files(
+    input_dir: Union[Path, str],
+    exclude_paths: List[Union[Path, str]] = None,
+    archives: bool = False,
+) -> Iterator[Path]:
+    """
+    Walk the input directory and yield the DICOM files found in it.
+
+    Excluded directories are pruned before descending into them. Files with a
+    `.dcm` extension are accepted as they are; any other file is accepted if it
+    starts with the DICOM preamble and prefix. `DICOMDIR` files are skipped.
+
+    :param input_dir: The directory to walk.
+    :type input_dir: Union[pathlib.Path, str]
+    :param exclude_paths: Files or directories to leave out of the walk.
+    :type exclude_paths: List[Union[pathlib.Path, str]], optional
+    :param archives: Also yield zip and tar archives, and `.dcm.gz` files.
+    :type archives: bool
+    :return: An iterator over the paths of the DICOM files, in name order.
+    :rtype: Iterator[pathlib.Path]
+    """
+    excluded = {os.path.abspath(p) for p in exclude_paths or []}
+    stack = [os.path.abspath(input_dir)]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError as e:
+            logger.warning("Cannot list %s: %s", directory, e)
+            continue
+        subdirectories = []
+        for entry in entries:
+            if entry.path in excluded:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.path)
+            elif entry.name == "DICOMDIR":
+                continue
+            elif archives and (is_archive(entry.name) or is_gzip_dicom(entry.name)):
+                yield Path(entry.path)
+            elif entry.name.lower().endswith(".dcm") or is_dicom_file(entry.path):
+                yield Path(entry.path)
+        stack.extend(reversed(subdirectories))
+
+
+def iter_sources(
+    input_path: Union[Path, str], exclude_paths: List[Union[Path, str]] = None
+) -> Iterator[DicomSource]:
+    """
+    Yield the DICOM files of an input folder or archive, and of the archives in the folder.
+
+    Members of zip and tar archives, and `.dcm.gz` files, are decompressed in
+    memory when read, without extracting them to disk.
+
+    :param input_path: The input folder, or a zip or tar archive.
+    :type input_path: Union[pathlib.Path, str]
+    :param exclude_paths: Files or directories to leave out of the walk.
+    :type exclude_paths: List[Union[pathlib.Path, str]], optional
+    :return: An iterator over the DICOM files.
+    :rtype: Iterator[dcm2mids.archives.DicomSource]
+    """
+    if Path(input_path).is_file() and is_archive(input_path):
+        yield from iter_archive(input_path)
+        return
+    for filename in iter_dicom_files(input_path, exclude_paths, archives=True):
+        if is_archive(filename):
+            yield from iter_archive(filename)
+        else:
+            yield file_source(filename)
+
+
+def stage_dataset(
+    fs: FileSet,
+    ds: Dataset,
+    source: Union[Path, str],
+    note: str = "",
+    reference: Optional[DicomSource] = None,
+) -> FileInstance:
+    """
+    Add a dataset to a FileSet, filling in the keys used to index it.
+
+    The note of the instance is stored in a private `Note` block. A missing
+    `StudyID`, `StudyTime` or `SeriesNumber` is derived from other elements.
+
+    The FileSet stages a copy of every dataset in a temporary folder. Given a
+    reference, the dataset is staged without its pixel data, which is read
+    from the reference when the instance is converted, and the reference is
+    kept as the `source` of the instance.
+
+    :param fs: The FileSet.
+    :type fs: pydicom.fileset.FileSet
+    :param ds: The dataset, with its file meta information.
+    :type ds: pydicom.Dataset
+    :param source: Where the dataset comes from, e.g. its file, for the log.
+    :type source: Union[pathlib.Path, str]
+    :param note: The contents of the `note.txt` next to the instance, if any.
+    :type note: str
+    :param reference: Where to read the whole dataset from, e.g. its archive member.
+    :type reference: dcm2mids.archives.DicomSource, optional
+    :return: The staged instance.
+    :rtype: pydicom.fileset.FileInstance
+    """
+    txt_content = note or "n/a"
+
+    # Reserve a private tag block
+    private_creator_tag = 0x000b  # (gggg,00XX) for reserving block
+    block = ds.private_block(private_creator_tag, 'Note', create=True)
+
+    # Define the private tag (for example, in the reserved block)
+    private_tag = 0x10  # (gggg,xxYY) where xxYY is within the reserved block
+
+    # Add the private tag with VR (e.g., LO for Long String) and value
+    block.add_new(private_tag, 'LO', txt_content)
+
+    if not ds.StudyID:
+        logger.warning(
+            "`StudyID` tag not found for file %s. `AccessionNumber` will be used instead.",
+            source,
+        )
+        ds.StudyID = ds.AccessionNumber
+    if not ds.StudyTime:
+        logger.warning(
+            "`StudyTime` tag not found for file %s. Time part of `AdquisitionDateTime` will be used instead.",
+            source,
+        )
+        ds.StudyTime = datetime.strptime(
+            ds.AcquisitionDateTime[:14], "%Y%m%d%H%M%S"
+        ).strftime("%H%M%S")
+    if not ds.SeriesNumber:
+        logger.warning(
+            "`SeriesNumber` tag not found for file %s. `InstanceNumber` will be used instead.",
+            source,
+        )
+        ds.SeriesNumber = ds.InstanceNumber
+    if reference is None:
+        return fs.add(ds)
+    for tag in PIXEL_DATA_TAGS:
+        if tag in ds:
+            del ds[tag]
+    instance = fs.add(ds)
+    instance.source = reference
+    return instance
+
+
+def read_instance(
+    filename: Union[Path, DicomSource], shard: Optional[Shard] = None
+) -> Optional[Dataset]:
+    """
+    Read a DICOM file to stage it.
+
+    :param filename: The path to the file, or its source if it may be compressed
+        or inside an archive.
+    :type filename: Union[pathlib.Path, dcm2mids.archives.DicomSource]
+    :param shard: Only read the file fully if it belongs to this shard.
+    :type shard: dcm2mids.shard.Shard, optional
+    :return: The dataset, or None if the file belongs to another shard.
+    :rtype: Optional[pydicom.Dataset]
+    """
+    source: Union[Path, BinaryIO]
+    if isinstance(filename, DicomSource):
+        source, filename = filename.open(), filename.path
+    else:
+        source = filename
+    if shard is None:
+        return dcmread(source)
+    if isinstance(source, Path):
+        ds = dcmread(source, defer_size="1 KB")
+    else:
+        # Already decompressed in memory, deferring the pixel data would save nothing
+        ds = dcmread(source)
+    if not shard.owns(ds.get(shard.key)):
+        logger.debug("Skipping %s: not in %s", filename, shard.name)
+        return None
+    return ds
+
+
+def get_dicomdir(
+    input_dir: Union[Path, str],
+    exclude_paths: List[Union[Path, str]] = None,
+    shard: Optional[Shard] = None,
+    duplicate_detector: Optional[DuplicateDetector] = None,
+    paths: Optional[Iterable[Union[Path, str]]] = None,
+    fault_policy: Optional[FaultPolicy] = None,
+) -> FileSet:
     """
     Get the DICOM structure from the input directory.
 
-    :param input_dir: The input directory as a Path object or a string.
+    DICOM files inside zip and tar archives (in the input directory, or given
+    as the input itself) and `.dcm.gz` files are read without extracting them:
+    zip members are read one at a time from the central directory, tar
+    archives in a single sequential pass. Their path is the path of the
+    archive followed by the name of the member. They are staged without their
+    pixel data, which is read again from the archive when they are converted,
+    so they are never written in full to disk.
+
+    Files are read one at a time, and none is held in memory once it is
+    staged, so indexing is not counted in the memory budget of the conversion.
+
+    :param input_dir: The input directory, or a zip or tar archive, as a Path object or a string.
     :type input_dir: Union[pathlib.Path, str]
+    :param exclude_paths: Files or directories to skip when searching for DICOM files.
+    :type exclude_paths: List[Union[pathlib.Path, str]], optional
+    :param shard: Only keep the files of this shard. Files are assigned from their
+        header, with the pixel data deferred, so files of other shards are never
+        fully read. DICOMDIR inputs are filtered by `create_mids_directory`.
+    :type shard: dcm2mids.shard.Shard, optional
+    :param duplicate_detector: Detector used to skip repeated instances, which keeps
+        the list of skipped files. By default only repeated SOPInstanceUIDs are skipped.
+        The instances listed in a DICOMDIR are removed from its FileSet.
+    :type duplicate_detector: dcm2mids.deduplicate.DuplicateDetector, optional
+    :param paths: Only add these files, e.g. the files that arrived since the last
+        run, instead of searching the input directory. The DICOMDIR is ignored.
+    :type paths: Iterable[Union[pathlib.Path, str]], optional
+    :param fault_policy: Read each file with the timeout and retries of the policy,
+        and quarantine the files that can not be read or staged instead of raising.
+    :type fault_policy: dcm2mids.journal.FaultPolicy, optional
     :raises TypeError: If the input_dir is not a Path object or a string.
-    :raises FileNotFoundError: If the input_dir does not exist or is not a directory.
+    :raises FileNotFoundError: If the input_dir does not exist.
+    :raises NotADirectoryError: If the input_dir is neither a directory nor an archive.
     :return: A FileSet object containing the DICOM files from the input directory.
     :rtype: pydicom.fileset.FileSet
     """
@@ -27,75 +270,80 @@ def get_dicomdir(input_dir: Union[Path, str], exclude_paths: List[Union[Path, st
         raise FileNotFoundError(f"{input_dir} does not exist.")
     if exclude_paths is not None:
         exclude_paths = [Path(p) if not isinstance(p, Path) else p for p in exclude_paths]
+    if duplicate_detector is None:
+        duplicate_detector = DuplicateDetector()
     
     dicomdir = input_dir / "DICOMDIR"
     if (
-        dicomdir.exists()
+        dicomdir.exists() and paths is None
     ):  # If DICOMDIR exists, we will use it to get the DICOM structure.
         logger.info("DICOMDIR file found")
         ds = dcmread(dicomdir)
         fs = FileSet(ds)
+        for instance in list(fs):
+            # The records give the UID; instances are only read to compare their pixel data
+            if duplicate_detector.hash_pixels:
+                header = instance.load()
+            else:
+                header = Dataset()
+                header.SOPInstanceUID = instance.SOPInstanceUID
+            if duplicate_detector.check(header, instance.path) is not None:
+                fs.remove(instance)
     elif (
-        input_dir.is_dir()
+        input_dir.is_dir() or is_archive(input_dir)
     ):  # If DICOMDIR does not exist, we will search for DICOM files in the input dir.
         fs = FileSet()
         logger.info(
-            "DICOMDIR file not found. Listing all `.dcm` files on the directory."
+            "DICOMDIR file not found. Listing all DICOM files on the directory."
         )
-        suffix = "*.[dD][cC][mM]"
-        for filename in input_dir.rglob(suffix):
-            
-            
-            if exclude_paths and any(filename.is_relative_to(exclude_path) for exclude_path in exclude_paths): continue
-            ds = dcmread(filename)
-            txt_file = filename.parent / "note.txt"
-            txt_content = ""
-            if txt_file.exists():
-                with txt_file.open('r') as file:
-                    txt_content = file.read()
-            if txt_content == "": txt_content = "n/a"
-            
-            # Reserve a private tag block
-            private_creator_tag = 0x000b  # (gggg,00XX) for reserving block
-            block = ds.private_block(private_creator_tag, 'Note', create=True)
-
-            # Define the private tag (for example, in the reserved block)
-            private_tag = 0x10  # (gggg,xxYY) where xxYY is within the reserved block
-
-            # Add the private tag with VR (e.g., LO for Long String) and value
-            block.add_new(private_tag, 'LO', txt_content)
-            
-            if not ds.StudyID:
-                logger.warning(
-                    "`StudyID` tag not found for file %s. `AccessionNumber` will be used instead.",
-                    filename,
-                )
-                ds.StudyID = ds.AccessionNumber
-            if not ds.StudyTime:
-                logger.warning(
-                    "`StudyTime` tag not found for file %s. Time part of `AdquisitionDateTime` will be used instead.",
-                    filename,
-                )
-                ds.StudyTime = datetime.strptime(
-                    ds.AcquisitionDateTime[:14], "%Y%m%d%H%M%S"
-                ).strftime("%H%M%S")
-            if not ds.SeriesNumber:
-                logger.warning(
-                    "`SeriesNumber` tag not found for file %s. `InstanceNumber` will be used instead.",
+        sources: Iterable[Tuple[Path, Union[DicomSource, Exception]]]
+        if paths is not None:
+            # Each archive is read once; a file that is gone can be quarantined
+            sources = open_sources(paths)
+        else:
+            sources = ((source.path, source) for source in iter_sources(input_dir, exclude_paths))
+        for filename, source in sources:
+            if isinstance(source, Exception):
+                if fault_policy is None:
+                    raise source
+                fault_policy.quarantine("read", [filename], source)
+                continue
+            try:
+                if fault_policy is None:
+                    ds = read_instance(source, shard)
+                else:
+                    ds = fault_policy.isolate("read", [filename], read_instance, source, shard)
+            except Exception:
+                if fault_policy is None:
+                    raise
+                ds = None
+            if ds is None or duplicate_detector.check(ds, filename) is not None:
+                continue
+            try:
+                stage_dataset(
+                    fs,
+                    ds,
                     filename,
+                    source.read_note(),
+                    source.reference() if source.in_memory else None,
                 )
-                ds.SeriesNumber = ds.InstanceNumber
-            # try:
-            fs.add(ds)
-            # except ValueError as e:
-            #     print(e)
-            #     continue
+            except Exception as e:
+                if fault_policy is None:
+                    raise
+                fault_policy.quarantine("read", [filename], e)
+            else:
+                if fault_policy is not None:
+                    fault_policy.add_source(ds.SOPInstanceUID, filename)
 
     else:
-        logger.error("%s is not a directory.", input_dir)
-        raise NotADirectoryError(f"{input_dir} is not a directory.")
-    if len(fs) == 0:
+        logger.error("%s is not a directory nor an archive.", input_dir)
+        raise NotADirectoryError(f"{input_dir} is not a directory nor an archive.")
+    if len(fs) == 0 and shard is not None:
+        logger.warning("No DICOM files of %s found in %s.", shard.name, input_dir)
+    elif len(fs) == 0:
         logger.error("No DICOMDIR/DICOM files found in %s.", input_dir)
         raise RuntimeError(f"No DICOM files found in {input_dir}.")
+    if duplicate_detector.skipped:
+        logger.info("%d duplicate files skipped", len(duplicate_detector.skipped))
     logger.info("FileSet has %d elements", len(fs))
     return fs
@@ -0,0 +1,303 @@
+import argparse
+import io
+import logging
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Hashable, List, Optional, Set, Union
+
+from pydicom import Dataset
+from pydicom.fileset import FileSet
+
+from .archives import DicomSource
+from .create_mids_directory import update_mids_directory
+from .deduplicate import DuplicateDetector
+from .get_dicomdir import stage_dataset
+from .logger import set_logger
+from .procedures.decoders import FrameDecoder
+from .report import RunReport
+
+try:
+    from pynetdicom import AE, AllStoragePresentationContexts, evt
+    from pynetdicom.sop_class import Verification
+except ImportError:  # pragma: no cover
+    AE = None
+
+logger = logging.getLogger("dcm2mids").getChild("ingest")
+
+# Seconds without new instances after which a series is converted, even if
+# the association that sent it is still open
+SERIES_TIMEOUT = 60.0
+
+# C-STORE status codes
+STATUS_SUCCESS = 0x0000
+STATUS_OUT_OF_RESOURCES = 0xA700
+
+
+class PendingSeries:
+    """The instances of a series received so far, staged in their own FileSet."""
+
+    def __init__(self, now: float):
+        self.fileset = FileSet()
+        self.associations: Set[Hashable] = set()
+        self.last_received = now
+
+
+class StorageIngest:
+    """Convert the instances received by a Storage SCP into a MIDS dataset.
+
+    Received datasets are staged by series, without going through the input
+    folder, and each series is converted with `update_mids_directory` once
+    every association that sent it has ended, or after `series_timeout`
+    seconds without new instances. Instances are staged without their pixel
+    data, which is kept in memory, encoded, until their series is converted.
+    Conversions run one at a time in a background thread, so the SCP keeps
+    accepting instances meanwhile.
+
+    :param mids_path: The MIDS root.
+    :type mids_path: Union[pathlib.Path, str]
+    :param bodypart: The body part of the dataset.
+    :type bodypart: str
+    :param series_timeout: Seconds without new instances after which a series is converted.
+    :type series_timeout: float
+    :param duplicate_detector: Detector used to skip instances received twice.
+    :type duplicate_detector: dcm2mids.deduplicate.DuplicateDetector, optional
+    :param options: Passed to `create_mids_directory`, e.g. `decoder` or `writer`.
+    """
+
+    def __init__(
+        self,
+        mids_path: Union[Path, str],
+        bodypart: str,
+        series_timeout: float = SERIES_TIMEOUT,
+        duplicate_detector: Optional[DuplicateDetector] = None,
+        **options,
+    ):
+        self.mids_path = Path(mids_path)
+        self.bodypart = bodypart
+        self.series_timeout = series_timeout
+        self.duplicate_detector = duplicate_detector or DuplicateDetector()
+        self.options = options
+        self.pending: Dict[str, PendingSeries] = {}
+        self.reports: List[RunReport] = []
+        self.received = 0
+        self._lock = threading.Lock()
+        self._queue: "queue.Queue[Optional[FileSet]]" = queue.Queue()
+        self._worker = threading.Thread(target=self._convert_loop, daemon=True)
+        self._worker.start()
+        self._server = None
+        self._stop = threading.Event()
+        self._timer: Optional[threading.Thread] = None
+
+    def receive(
+        self, dataset: Dataset, association: Hashable = None, now: Optional[float] = None
+    ) -> bool:
+        """
+        Stage a received instance in the FileSet of its series.
+
+        :param dataset: The instance, with its file meta information.
+        :type dataset: pydicom.Dataset
+        :param association: The association that sent it, if any.
+        :type association: Hashable, optional
+        :param now: The time of arrival, from `time.monotonic()`.
+        :type now: float, optional
+        :return: False if the instance was a duplicate and was skipped.
+        :rtype: bool
+        """
+        now = time.monotonic() if now is None else now
+        source = f"{association or 'local'}:{dataset.SOPInstanceUID}"
+        with self._lock:
+            if self.duplicate_detector.check(dataset, source) is not None:
+                return False
+            uid = str(dataset.SeriesInstanceUID)
+            series = self.pending.get(uid)
+            if series is None:
+                series = self.pending[uid] = PendingSeries(now)
+            buffer = io.BytesIO()
+            dataset.save_as(buffer, write_like_original=False)
+            data = buffer.getvalue()
+            reference = DicomSource(Path(source), len(data), lambda: data)
+            stage_dataset(series.fileset, dataset, source, reference=reference)
+            if association is not None:
+                series.associations.add(association)
+            series.last_received = now
+            self.received += 1
+        return True
+
+    def end_association(self, association: Hashable):
+        """
+        Convert the series sent by an association that no other open association is sending.
+
+        Series received without an association are only converted after
+        `series_timeout` seconds, or when the ingest is closed.
+
+        :param association: The association that ended.
+        :type association: Hashable
+        """
+        with self._lock:
+            for uid, series in list(self.pending.items()):
+                if association not in series.associations:
+                    continue
+                series.associations.discard(association)
+                if not series.associations:
+                    self._flush(uid)
+
+    def flush_expired(self, now: Optional[float] = None):
+        """Convert the series that received no instance for `series_timeout` seconds."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            for uid, series in list(self.pending.items()):
+                if now - series.last_received >= self.series_timeout:
+                    logger.debug("Series %s timed out", uid)
+                    self._flush(uid)
+
+    def _flush(self, uid: str):
+        series = self.pending.pop(uid)
+        logger.info("Queueing series %s (%d instances)", uid, len(series.fileset))
+        self._queue.put(series.fileset)
+
+    def _convert_loop(self):
+        while True:
+            fileset = self._queue.get()
+            try:
+                if fileset is None:
+                    return
+                report = update_mids_directory(
+                    fileset, self.mids_path, self.bodypart, **self.options
+                )
+                self.reports.append(report)
+                report.log()
+            except Exception:
+                logger.exception("Conversion of a received series failed")
+            finally:
+                self._queue.task_done()
+
+    def join(self):
+        """Wait until every queued series is converted."""
+        self._queue.join()
+
+    def start(self, address: str = "0.0.0.0", port: int = 11112, ae_title: str = "DCM2MIDS"):
+        """
+        Start the Storage SCP in the background.
+
+        :param address: The address to listen on.
+        :type address: str
+        :param port: The port to listen on.
+        :type port: int
+        :param ae_title: The AE title of the SCP.
+        :type ae_title: str
+        :raises RuntimeError: If pynetdicom is not installed.
+        """
+        if AE is None:
+            raise RuntimeError("pynetdicom is needed to receive instances over the network")
+        ae = AE(ae_title=ae_title)
+        ae.supported_contexts = AllStoragePresentationContexts
+        ae.add_supported_context(Verification)
+        handlers = [
+            (evt.EVT_C_STORE, self._on_store),
+            (evt.EVT_RELEASED, self._on_end),
+            (evt.EVT_ABORTED, self._on_end),
+        ]
+        self._server = ae.start_server((address, port), block=False, evt_handlers=handlers)
+        self._timer = threading.Thread(target=self._timer_loop, daemon=True)
+        self._timer.start()
+        logger.info("Storage SCP %s listening on %s:%d", ae_title, address, port)
+
+    def _on_store(self, event) -> int:
+        dataset = event.dataset
+        dataset.file_meta = event.file_meta
+        try:
+            self.receive(dataset, id(event.assoc))
+        except Exception:
+            logger.exception("Could not stage %s", dataset.get("SOPInstanceUID"))
+            return STATUS_OUT_OF_RESOURCES
+        return STATUS_SUCCESS
+
+    def _on_end(self, event):
+        self.end_association(id(event.assoc))
+
+    def _timer_loop(self):
+        interval = max(min(self.series_timeout / 4, 1.0), 0.01)
+        while not self._stop.wait(interval):
+            self.flush_expired()
+
+    def close(self):
+        """Stop the SCP, convert the series still pending and wait for the conversions."""
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+        with self._lock:
+            for uid in list(self.pending):
+                self._flush(uid)
+        self._queue.put(None)
+        self._worker.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Receive DICOM instances with a Storage SCP and convert them into a MIDS dataset."
+    )
+    parser.add_argument(
+        "-o", "--output", type=Path, help="Path to the MIDS folder", required=True
+    )
+    parser.add_argument(
+        "-bp",
+        "--body-part",
+        dest="body_part",
+        type=str,
+        help="Specify which part of the body is in the dataset",
+        required=True,
+    )
+    parser.add_argument("--port", type=int, default=11112, help="Port to listen on")
+    parser.add_argument(
+        "--address", type=str, default="0.0.0.0", help="Address to listen on"
+    )
+    parser.add_argument(
+        "-aet", "--ae-title", dest="ae_title", default="DCM2MIDS", help="AE title of the SCP"
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=SERIES_TIMEOUT,
+        help="Seconds without new instances after which a series is converted",
+    )
+    parser.add_argument(
+        "-dw",
+        "--decode-workers",
+        dest="decode_workers",
+        type=int,
+        help="Decode pixel data in this many threads, decoding compressed frames in parallel",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        dest="verbose",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        default="INFO",
+        help="Verbose level. One of DEBUG, INFO, WARNING, ERROR",
+    )
+    parser.add_argument(
+        "-log", "--logfile", type=Path, help="Path to the file to store logs"
+    )
+    args = parser.parse_args()
+    set_logger(level=getattr(logging, args.verbose), outpath=args.logfile)
+    if AE is None:
+        parser.error("pynetdicom is not installed")
+    decoder = FrameDecoder(args.decode_workers) if args.decode_workers else None
+    ingest = StorageIngest(args.output, args.body_part, args.timeout, decoder=decoder)
+    ingest.start(args.address, args.port, args.ae_title)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        logger.info("Stopping the Storage SCP")
+    finally:
+        ingest.close()
+        if decoder is not None:
+            decoder.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+import errno
+import logging
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Union
+
+import pandas as pd
+
+from .deduplicate import STATE_FOLDER
+from .generate_tsvs import append_tsv, read_tsv, write_tsv
+from .writers import discard_output
+
+logger = logging.getLogger("dcm2mids").getChild("journal")
+
+JOURNAL_COLUMNS = ["path", "stage", "subject", "session", "series", "error", "attempts", "time"]
+
+# Errors of the filesystem or of the network that may go away if the call is retried
+TRANSIENT_ERRNOS = {
+    errno.EAGAIN,
+    errno.EBUSY,
+    errno.EINTR,
+    errno.EIO,
+    errno.ESTALE,
+    errno.ETIMEDOUT,
+}
+
+
+def is_transient(error: BaseException) -> bool:
+    """Whether an error is a transient I/O error, worth retrying."""
+    if isinstance(error, (ConnectionError, InterruptedError, BlockingIOError)):
+        return True
+    return isinstance(error, OSError) and error.errno in TRANSIENT_ERRNOS
+
+
+class WatchdogTimeout(TimeoutError):
+    """Raised when a call runs for longer than its timeout."""
+
+
+def call_with_timeout(func: Callable, timeout: Optional[float], *args, **kwargs) -> Any:
+    """
+    Call a function, giving up after `timeout` seconds.
+
+    The call runs in a daemon thread. Python threads can not be killed, so a
+    call that hangs keeps its thread until it returns, but the caller is free
+    to go on with the next file. Once the call is abandoned, whatever its
+    thread still writes through an output writer is discarded.
+
+    :param func: The function.
+    :type func: Callable
+    :param timeout: Seconds to wait for the call, or None to wait forever.
+    :type timeout: float, optional
+    :raises WatchdogTimeout: If the call did not return in time.
+    :return: The result of the call.
+    :rtype: Any
+    """
+    if timeout is None:
+        return func(*args, **kwargs)
+    outcome: Dict[str, Any] = {}
+
+    def target():
+        try:
+            outcome["result"] = func(*args, **kwargs)
+        except BaseException as e:
+            outcome["error"] = e
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        discard_output(thread)
+        raise WatchdogTimeout(f"{getattr(func, '__name__', func)} did not return in {timeout} s")
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome.get("result")
+
+
+class FailureJournal:
+    """Quarantine journal of the files that could not be converted.
+
+    Each row holds a file, the stage that failed (`read` for a file that
+    could not be indexed, `series` for a file of a series whose conversion
+    failed, `batch` for a file of a watched batch that failed), the subject, session and series if known, the error and the
+    number of attempts. The journal is kept in `.dcm2mids/failures.tsv`, so
+    the files can be converted again later with `--replay-failures`.
+
+    The rows taken out by `pop_paths` are kept in `failures.replaying.tsv`
+    until `finish_replay` is called, and put back into the journal if the
+    replay was interrupted, so a quarantined file is never lost.
+
+    :param mids_path: The MIDS root.
+    :type mids_path: Union[pathlib.Path, str]
+    :param name: The name of the journal, e.g. to keep one per shard.
+    :type name: str
+    """
+
+    def __init__(self, mids_path: Union[Path, str], name: str = "failures"):
+        self.path = Path(mids_path).joinpath(STATE_FOLDER, f"{name}.tsv")
+        self.replaying_path = self.path.with_name(f"{name}.replaying.tsv")
+        self.rows: List[Dict[str, Any]] = []
+        if self.path.exists():
+            self.rows = read_tsv(self.path).to_dict("records")
+        self._lock = threading.Lock()
+        if self.replaying_path.exists():
+            logger.warning("The last replay of %s was interrupted, its files are journaled again", self.path)
+            self.rows.extend(read_tsv(self.replaying_path).to_dict("records"))
+            self.save()
+            self.replaying_path.unlink()
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def record(
+        self,
+        stage: str,
+        paths: Iterable[Union[Path, str]],
+        error: BaseException,
+        attempts: int = 1,
+        **context: Any,
+    ):
+        """
+        Add the files of a failure to the journal, appending them to its file.
+
+        :param stage: The stage that failed, `read`, `series` or `batch`.
+        :type stage: str
+        :param paths: The files involved.
+        :type paths: Iterable[Union[pathlib.Path, str]]
+        :param error: The error raised.
+        :type error: BaseException
+        :param attempts: The number of attempts made.
+        :type attempts: int
+        :param context: The `subject`, `session` and `series`, if known.
+        """
+        now = datetime.now().isoformat(timespec="seconds")
+        rows = [
+            {
+                "path": str(path),
+                "stage": stage,
+                "subject": context.get("subject", "n/a"),
+                "session": context.get("session", "n/a"),
+                "series": context.get("series", "n/a"),
+                "error": f"{type(error).__name__}: {error}".replace("\t", " ").replace("\n", " "),
+                "attempts": attempts,
+                "time": now,
+            }
+            for path in paths
+        ]
+        with self._lock:
+            self.rows.extend(rows)
+            append_tsv(pd.DataFrame(rows, columns=JOURNAL_COLUMNS), self.path)
+
+    def save(self):
+        """Write the journal, or remove it once it is empty."""
+        if not self.rows:
+            self.path.unlink(missing_ok=True)
+            return
+        write_tsv(pd.DataFrame(self.rows, columns=JOURNAL_COLUMNS), self.path)
+
+    def pop_paths(self) -> List[Path]:
+        """
+        Take the files out of the journal to convert them again.
+
+        Files that fail again are recorded again by the replay. The rows are
+        moved to `replaying_path` until `finish_replay` is called.
+
+        :return: The distinct files of the journal, in the order they were recorded.
+        :rtype: List[pathlib.Path]
+        """
+        with self._lock:
+            paths = list(dict.fromkeys(Path(row["path"]) for row in self.rows))
+            if self.rows:
+                write_tsv(pd.DataFrame(self.rows, columns=JOURNAL_COLUMNS), self.replaying_path)
+            self.rows = []
+            self.save()
+        return paths
+
+    def finish_replay(self):
+        """Forget the rows taken by `pop_paths`, once the replay is done."""
+        self.replaying_path.unlink(missing_ok=True)
+
+
+class FaultPolicy:
+    """Isolate failures during a batch conversion.
+
+    Calls made through `run` are retried with exponential backoff on transient
+    I/O errors and abandoned after a timeout. Calls made through `isolate`
+    also catch any other error, record the files involved in the journal and
+    let the batch go on.
+
+    A call abandoned after its timeout can not be stopped and keeps running
+    in its thread. Every file that thread writes afterwards through an output
+    writer is discarded, so it can not overwrite the outputs of a replay of
+    the quarantined files. A file it was streaming when the timeout expired
+    is dropped as well.
+
+    :param journal: The journal of the failed files.
+    :type journal: dcm2mids.journal.FailureJournal
+    :param file_timeout: Seconds allowed to read a file, and per instance to
+        convert a series. No timeout if None.
+    :type file_timeout: float, optional
+    :param retries: Retries of a call failing with a transient I/O error.
+    :type retries: int
+    :param backoff: Seconds to wait before the first retry, doubled for each next one.
+    :type backoff: float
+    """
+
+    def __init__(
+        self,
+        journal: FailureJournal,
+        file_timeout: Optional[float] = None,
+        retries: int = 2,
+        backoff: float = 1.0,
+    ):
+        self.journal = journal
+        self.file_timeout = file_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.failures = 0
+        self.timeouts = 0
+        self.retried = 0
+        # Input file of each staged instance, by SOPInstanceUID, to journal the
+        # input files of a failed series rather than their staged copies
+        self.sources: Dict[str, str] = {}
+
+    def add_source(self, uid: str, path: Union[Path, str]):
+        """Remember the input file of an instance."""
+        self.sources[str(uid)] = str(path)
+
+    def source(self, instance) -> str:
+        """Return the input file of a staged instance, or its own path if unknown."""
+        return self.sources.get(str(instance.SOPInstanceUID), str(instance.path))
+
+    def run(self, func: Callable, *args, files: int = 1, **kwargs) -> Any:
+        """
+        Call a function with the timeout and retries of the policy.
+
+        :param func: The function.
+        :type func: Callable
+        :param files: The number of files handled by the call, which scales the timeout.
+        :type files: int
+        :return: The result of the call.
+        :rtype: Any
+        """
+        timeout = None if self.file_timeout is None else self.file_timeout * max(files, 1)
+        attempt = 0
+        while True:
+            try:
+                return call_with_timeout(func, timeout, *args, **kwargs)
+            except Exception as e:
+                if attempt >= self.retries or not is_transient(e):
+                    e.attempts = attempt + 1  # type: ignore[attr-defined]
+                    raise
+                delay = self.backoff * 2**attempt
+                attempt += 1
+                self.retried += 1
+                logger.warning("%s, retrying in %.1f s (%d/%d)", e, delay, attempt, self.retries)
+                time.sleep(delay)
+
+    def isolate(
+        self,
+        stage: str,
+        paths: List[Union[Path, str]],
+        func: Callable,
+        *args,
+        **context: Any,
+    ) -> Any:
+        """
+        Call a function through `run`, recording its files in the journal if it fails.
+
+        :param stage: The stage, `read` or `series`.
+        :type stage: str
+        :param paths: The files handled by the call.
+        :type paths: List[Union[pathlib.Path, str]]
+        :param func: The function, called with `args`.
+        :type func: Callable
+        :param context: The `subject`, `session` and `series`, for the journal.
+        :raises Exception: The error of the call, once it is recorded.
+        :return: The result of the call.
+        :rtype: Any
+        """
+        try:
+            return self.run(func, *args, files=len(paths))
+        except Exception as e:
+            self.quarantine(stage, paths, e, **context)
+            raise
+
+    def quarantine(
+        self, stage: str, paths: List[Union[Path, str]], error: Exception, **context: Any
+    ):
+        """Record the files of a failure in the journal."""
+        self.failures += 1
+        if isinstance(error, WatchdogTimeout):
+            self.timeouts += 1
+        logger.error("%s failed for %d file(s): %s", stage.capitalize(), len(paths), error)
+        self.journal.record(stage, paths, error, getattr(error, "attempts", 1), **context)
+
+    def summary(self) -> Dict[str, int]:
+        """Return the counters of the policy, for the run report."""
+        return {
+            "failures_quarantined": self.failures,
+            "timeouts": self.timeouts,
+            "retries": self.retried,
+        }
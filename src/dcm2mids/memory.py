@@ -0,0 +1,174 @@
+import logging
+import os
+import re
+import sys
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+logger = logging.getLogger("dcm2mids").getChild("memory")
+
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+
+def parse_size(size: str) -> int:
+    """
+    Parse a human readable size such as `512M` or `8G` into bytes.
+
+    :param size: The size, optionally followed by K, M, G or T (and an optional `B`).
+    :type size: str
+    :raises ValueError: If the size cannot be parsed.
+    :return: The size in bytes.
+    :rtype: int
+    """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*", str(size).upper())
+    if not match:
+        raise ValueError(f"Invalid size: {size}")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+def format_size(nbytes: int) -> str:
+    """Format a number of bytes with a binary unit suffix."""
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if abs(nbytes) < 1024:
+            return f"{nbytes:.1f} {unit}"
+        nbytes /= 1024
+    return f"{nbytes:.1f} TiB"
+
+
+def current_rss() -> int:
+    """
+    Return the resident set size of the current process in bytes.
+
+    Falls back to the peak RSS where `/proc` is not available.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return peak_rss()
+
+
+def peak_rss() -> int:
+    """Return the peak resident set size of the current process in bytes (0 if unknown)."""
+    try:
+        import resource
+    except ImportError:  # pragma: no cover (Windows)
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS reports bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def estimate_instance_size(instance) -> int:
+    """
+    Estimate the memory taken by a loaded instance and its decoded pixels.
+
+    The encoded size is the size of the file, or of its `source` for instances
+    staged without their pixel data; the decoded size is computed from
+    the image pixel module when those values are available in the header
+    (or in the directory records), otherwise the file size is used again.
+
+    :param instance: A FileInstance, IndexedInstance or anything with a `path`.
+    :return: The estimated size in bytes.
+    :rtype: int
+    """
+    source = getattr(instance, "source", None)
+    try:
+        encoded = source.size if source is not None else os.path.getsize(instance.path)
+    except (OSError, TypeError, AttributeError):
+        encoded = 0
+    try:
+        decoded = (
+            int(instance.Rows)
+            * int(instance.Columns)
+            * int(getattr(instance, "SamplesPerPixel", 1) or 1)
+            * ((int(getattr(instance, "BitsAllocated", 16) or 16) + 7) // 8)
+            * int(getattr(instance, "NumberOfFrames", 1) or 1)
+        )
+    except (AttributeError, KeyError, TypeError, ValueError):
+        decoded = encoded
+    return encoded + decoded
+
+
+class MemoryBudget:
+    """Global budget for the bytes of loaded datasets and decoded pixels.
+
+    Stages reserve the estimated size of what they are about to load and
+    release it when done. A reservation blocks while it does not fit in the
+    budget, which applies backpressure to the stage that requested it. A
+    single reservation larger than the whole budget is only admitted when
+    nothing else is reserved, so it can never deadlock.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.waits = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, nbytes: int, timeout: Optional[float] = None) -> bool:
+        """
+        Reserve `nbytes`, waiting until they fit in the budget.
+
+        :param nbytes: The number of bytes to reserve.
+        :type nbytes: int
+        :param timeout: Maximum number of seconds to wait. Wait forever if None.
+        :type timeout: float, optional
+        :return: True if the bytes were reserved, False on timeout.
+        :rtype: bool
+        """
+        with self._condition:
+            if not self._fits(nbytes):
+                self.waits += 1
+                logger.debug(
+                    "Waiting for %s (%s of %s in use)",
+                    format_size(nbytes),
+                    format_size(self.in_use),
+                    format_size(self.max_bytes),
+                )
+                if not self._condition.wait_for(lambda: self._fits(nbytes), timeout):
+                    return False
+            self.in_use += nbytes
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            return True
+
+    def try_acquire(self, nbytes: int) -> bool:
+        """
+        Reserve `nbytes` only if they fit in the budget right now, without waiting.
+
+        :param nbytes: The number of bytes to reserve.
+        :type nbytes: int
+        :return: True if the bytes were reserved.
+        :rtype: bool
+        """
+        with self._condition:
+            if not self._fits(nbytes):
+                return False
+            self.in_use += nbytes
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            return True
+
+    def release(self, nbytes: int):
+        """
+        Return `nbytes` to the budget and wake up the waiting stages.
+
+        :param nbytes: The number of bytes to release.
+        :type nbytes: int
+        """
+        with self._condition:
+            self.in_use = max(0, self.in_use - nbytes)
+            self._condition.notify_all()
+
+    @contextmanager
+    def reserve(self, nbytes: int) -> Iterator[int]:
+        """Reserve `nbytes` for the duration of a `with` block."""
+        self.acquire(nbytes)
+        try:
+            yield nbytes
+        finally:
+            self.release(nbytes)
+
+    def _fits(self, nbytes: int) -> bool:
+        return self.in_use == 0 or self.in_use + nbytes <= self.max_bytes
@@ -0,0 +1,115 @@
+import argparse
+import logging
+import shutil
+from pathlib import Path
+from typing import Union
+
+import pandas as pd
+
+from .generate_tsvs import (
+    combine_participant_fragments,
+    read_tsv,
+    upsert_rows,
+    write_tsv,
+)
+from .logger import set_logger
+
+logger = logging.getLogger("dcm2mids").getChild("merge_tsvs")
+
+
+def move_shard_roots(mids_path: Path) -> int:
+    """
+    Move the sessions written into per-shard roots into the main MIDS root.
+
+    Sessions already present in the main root are replaced, and the sessions
+    TSVs are merged. The participants fragments of each shard are moved to the
+    `shards/` folder of the main root.
+
+    :param mids_path: The main MIDS root.
+    :type mids_path: pathlib.Path
+    :return: The number of sessions moved.
+    :rtype: int
+    """
+    moved = 0
+    for shard_root in sorted(mids_path.glob("shard-*-of-*")):
+        logger.info("Combining %s", shard_root.name)
+        for subject_dir in sorted(shard_root.glob("sub-*")):
+            target_subject = mids_path.joinpath(subject_dir.name)
+            target_subject.mkdir(parents=True, exist_ok=True)
+            for session_dir in sorted(subject_dir.glob("ses-*")):
+                target_session = target_subject.joinpath(session_dir.name)
+                if target_session.exists():
+                    shutil.rmtree(target_session)
+                session_dir.rename(target_session)
+                moved += 1
+            sessions_tsv = subject_dir.joinpath(f"{subject_dir.name}_sessions.tsv")
+            if sessions_tsv.exists():
+                target_tsv = target_subject.joinpath(sessions_tsv.name)
+                df = upsert_rows(read_tsv(sessions_tsv), target_tsv, "session_id")
+                write_tsv(df.sort_values("acq_time", ascending=False), target_tsv)
+            shutil.rmtree(subject_dir)
+        for fragment in sorted(shard_root.glob("shards/*.tsv")):
+            target_fragment = mids_path.joinpath("shards", fragment.name)
+            target_fragment.parent.mkdir(parents=True, exist_ok=True)
+            fragment.replace(target_fragment)
+        shutil.rmtree(shard_root)
+    return moved
+
+
+def merge_tsvs(mids_path: Union[Path, str]) -> pd.DataFrame:
+    """
+    Merge the shard fragments into the TSV files of a MIDS dataset.
+
+    Per-shard roots are moved into the main root first. Then the participants
+    fragments under `shards/` are combined and upserted into `participants.tsv`:
+    rows of the participants found in the fragments are replaced, all other
+    rows are kept, and the file is rewritten atomically.
+
+    :param mids_path: The MIDS root.
+    :type mids_path: Union[pathlib.Path, str]
+    :return: The rows of the merged participants TSV.
+    :rtype: pandas.DataFrame
+    """
+    mids_path = Path(mids_path)
+    moved = move_shard_roots(mids_path)
+    logger.debug("%d sessions moved from per-shard roots.", moved)
+    participants_tsv = mids_path.joinpath("participants.tsv")
+    fragments = sorted(mids_path.glob("shards/*_participants.tsv"))
+    if not fragments:
+        logger.warning("No participants fragments found in %s.", mids_path)
+        return read_tsv(participants_tsv) if participants_tsv.exists() else pd.DataFrame()
+    df = combine_participant_fragments([read_tsv(fragment) for fragment in fragments])
+    df = upsert_rows(df, participants_tsv, "participant_id")
+    df = df.sort_values("participant_id", ascending=False)
+    write_tsv(df, participants_tsv)
+    logger.info(
+        "%d participants merged from %d fragments.", len(df), len(fragments)
+    )
+    return df
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Merge the TSV fragments of a sharded run into a MIDS dataset."
+    )
+    parser.add_argument(
+        "-o", "--output", type=Path, help="Path to the MIDS folder", required=True
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        dest="verbose",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        default="INFO",
+        help="Verbose level. One of DEBUG, INFO, WARNING, ERROR",
+    )
+    parser.add_argument(
+        "-log", "--logfile", type=Path, help="Path to the file to store logs"
+    )
+    args = parser.parse_args()
+    set_logger(level=getattr(logging, args.verbose), outpath=args.logfile)
+    merge_tsvs(args.output)
+
+
+if __name__ == "__main__":
+    main()
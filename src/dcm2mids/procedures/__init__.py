@@ -1,4 +1,7 @@
+from .electrical_activity import *
 from .general_radiology import *
 from .magnetic_resonance import *
+from .nuclear_medicine import *
 from .procedures import Procedures
+from .ultrasound import *
 from .visible_light import *
@@ -0,0 +1,362 @@
+import copy
+import importlib
+import logging
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import SimpleITK as sitk
+from pydicom import Dataset
+from pydicom.encaps import generate_pixel_data_frame
+from pydicom.pixel_data_handlers.util import pixel_dtype
+from pydicom.uid import (
+    JPEG2000,
+    JPEG2000Lossless,
+    JPEGBaseline8Bit,
+    JPEGExtended12Bit,
+    UID,
+    JPEGLosslessSV1,
+    JPEGLSLossless,
+    JPEGLSNearLossless,
+)
+
+from .pixel_data import instance_file, load_instance, map_pixels
+
+logger = logging.getLogger("dcm2mids").getChild("decoders")
+
+JPEG_SYNTAXES = {JPEGBaseline8Bit, JPEGExtended12Bit}
+# JPEG Lossless (Process 14), spelled out as its pydicom keyword changes in v3.0
+JPEG_LOSSLESS_SYNTAXES = {UID("1.2.840.10008.1.2.4.57"), JPEGLosslessSV1}
+JPEG_LS_SYNTAXES = {JPEGLSLossless, JPEGLSNearLossless}
+JPEG_2000_SYNTAXES = {JPEG2000Lossless, JPEG2000}
+
+
+class DecoderBackend(ABC):
+    """A codec library able to decode single compressed frames.
+
+    Backends are only used for the transfer syntaxes they declare, and must
+    release the GIL while decoding so that frames decode in parallel threads.
+    """
+
+    name: str = ""
+    module: str = ""
+    transfer_syntaxes: set = set()
+
+    def is_available(self) -> bool:
+        """Return True if the codec library can be imported."""
+        try:
+            importlib.import_module(self.module)
+        except ImportError:
+            return False
+        return True
+
+    def supports(self, transfer_syntax: str) -> bool:
+        return transfer_syntax in self.transfer_syntaxes
+
+    @abstractmethod
+    def decode(self, frame: bytes, dataset: Dataset) -> np.ndarray:
+        """Decode one encapsulated frame into an array of shape (rows, columns[, samples])."""
+
+
+class ImagecodecsBackend(DecoderBackend):
+    """Decode JPEG, lossless JPEG, JPEG-LS and JPEG 2000 with `imagecodecs`."""
+
+    name = "imagecodecs"
+    module = "imagecodecs"
+    transfer_syntaxes = (
+        JPEG_SYNTAXES | JPEG_LOSSLESS_SYNTAXES | JPEG_LS_SYNTAXES | JPEG_2000_SYNTAXES
+    )
+
+    def decode(self, frame: bytes, dataset: Dataset) -> np.ndarray:
+        import imagecodecs
+
+        transfer_syntax = dataset.file_meta.TransferSyntaxUID
+        if transfer_syntax in JPEG_2000_SYNTAXES:
+            return imagecodecs.jpeg2k_decode(frame)
+        if transfer_syntax in JPEG_LS_SYNTAXES:
+            return imagecodecs.jpegls_decode(frame)
+        if transfer_syntax in JPEG_LOSSLESS_SYNTAXES:
+            return imagecodecs.ljpeg_decode(frame)
+        return imagecodecs.jpeg8_decode(frame)
+
+
+class PylibjpegBackend(DecoderBackend):
+    """Decode JPEG, JPEG-LS and JPEG 2000 with `pylibjpeg` and its plugins."""
+
+    name = "pylibjpeg"
+    module = "pylibjpeg"
+    transfer_syntaxes = (
+        JPEG_SYNTAXES | JPEG_LOSSLESS_SYNTAXES | JPEG_LS_SYNTAXES | JPEG_2000_SYNTAXES
+    )
+
+    def decode(self, frame: bytes, dataset: Dataset) -> np.ndarray:
+        from pylibjpeg import decode
+
+        return decode(frame)
+
+
+class PillowBackend(DecoderBackend):
+    """Decode baseline JPEG and JPEG 2000 with Pillow."""
+
+    name = "pillow"
+    module = "PIL"
+    transfer_syntaxes = JPEG_SYNTAXES | JPEG_2000_SYNTAXES
+
+    def decode(self, frame: bytes, dataset: Dataset) -> np.ndarray:
+        from io import BytesIO
+
+        from PIL import Image
+
+        with Image.open(BytesIO(frame)) as image:
+            return np.asarray(image)
+
+
+# In order of preference
+BACKENDS = [ImagecodecsBackend, PylibjpegBackend, PillowBackend]
+
+
+def array_to_image(array: np.ndarray, dataset: Dataset) -> sitk.Image:
+    """
+    Build a SimpleITK image from decoded pixels and the header of their dataset.
+
+    The rescale slope and intercept are applied, as `sitk.ReadImage` does, and
+    the pixel spacing is copied to the image.
+
+    :param array: The decoded pixels, with the frames along the first axis.
+    :type array: numpy.ndarray
+    :param dataset: The dataset the pixels were decoded from.
+    :type dataset: pydicom.Dataset
+    :return: The image.
+    :rtype: SimpleITK.Image
+    """
+    slope = float(dataset.get("RescaleSlope", 1) or 1)
+    intercept = float(dataset.get("RescaleIntercept", 0) or 0)
+    if slope != 1 or intercept != 0:
+        array = array * slope + intercept
+        if slope.is_integer() and intercept.is_integer():
+            array = array.astype(np.int32)
+    is_vector = int(dataset.get("SamplesPerPixel", 1) or 1) > 1
+    image = sitk.GetImageFromArray(array, isVector=is_vector)
+    if "PixelSpacing" in dataset:
+        row_spacing, column_spacing = (float(v) for v in dataset.PixelSpacing)
+        spacing = [column_spacing, row_spacing, 1.0][: image.GetDimension()]
+        image.SetSpacing(spacing)
+    return image
+
+
+class FrameDecoder:
+    """Decode the pixel data of instances and frames in a thread pool.
+
+    Instances are read and split into frames by an instance pool, and their
+    encapsulated frames are decoded by a separate frame pool with the first
+    available backend supporting the transfer syntax. Uncompressed data is
+    memory-mapped from the file, see `map_pixels`. Compressed data no backend
+    can decode falls back to pydicom (`Dataset.pixel_array`), one instance per task.
+
+    :param max_workers: Number of decoding threads. Defaults to the CPU count.
+    :type max_workers: int, optional
+    :param backends: Backends to try, in order of preference. Defaults to all
+        the known backends whose library is installed.
+    :type backends: List[DecoderBackend], optional
+    :param window: Maximum number of instances decoded ahead of the consumer.
+    :type window: int, optional
+    """
+
+    def __init__(
+        self,
+        max_workers: Optional[int] = None,
+        backends: Optional[List[DecoderBackend]] = None,
+        window: Optional[int] = None,
+    ):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.window = window or 2 * self.max_workers
+        if backends is None:
+            backends = [backend() for backend in BACKENDS]
+        self.backends = [backend for backend in backends if backend.is_available()]
+        missing = [backend.name for backend in backends if backend not in self.backends]
+        if missing:
+            logger.debug("Decoder backends not available: %s", ", ".join(missing))
+        self.stats: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+        self._frame_pool = ThreadPoolExecutor(self.max_workers, "dcm2mids-frame")
+        self._instance_pool = ThreadPoolExecutor(self.max_workers, "dcm2mids-instance")
+        self._queue: List[Any] = []
+        self._next = 0
+        self._pending: Dict[str, Future] = {}
+
+    def _load_and_decode(self, instance: Any) -> Tuple[Dataset, np.ndarray]:
+        try:
+            # Uncompressed pixels are mapped from the file instead of being read and copied
+            return map_pixels(instance_file(instance))
+        except ValueError:
+            pass
+        dataset = load_instance(instance)
+        array = self.decode_instance(dataset)
+        # The header is kept for the geometry; the encoded pixels are not needed anymore
+        del dataset.PixelData
+        return dataset, array
+
+    def prefetch(self, instances: List[Any]):
+        """
+        Start decoding the instances of a series in the order they will be read.
+
+        At most `window` instances are decoded ahead of the consumer, which
+        bounds the memory taken by decoded but unused pixels.
+
+        :param instances: The instances, with a `path` and a `load()` method.
+        :type instances: List[pydicom.fileset.FileInstance]
+        """
+        for future in self._pending.values():
+            future.cancel()
+        self._queue = list(instances)
+        self._next = 0
+        self._pending = {}
+        self._fill()
+
+    def _fill(self):
+        while self._next < len(self._queue) and len(self._pending) < self.window:
+            instance = self._queue[self._next]
+            self._pending[str(instance.path)] = self._instance_pool.submit(
+                self._load_and_decode, instance
+            )
+            self._next += 1
+
+    def read(self, instance: Any) -> Tuple[Dataset, np.ndarray]:
+        """
+        Return the header and the decoded pixels of an instance, prefetched if possible.
+
+        :param instance: The instance, with a `path` and a `load()` method.
+        :type instance: pydicom.fileset.FileInstance
+        :return: The dataset without its pixel data, and the pixel array with
+            the frames along the first axis.
+        :rtype: Tuple[pydicom.Dataset, numpy.ndarray]
+        """
+        future = self._pending.pop(str(instance.path), None)
+        self._fill()
+        if future is not None:
+            return future.result()
+        return self._load_and_decode(instance)
+
+    def decode_instance(self, dataset: Dataset) -> np.ndarray:
+        """
+        Decode all the frames of a dataset, in parallel when they are encapsulated.
+
+        :param dataset: The dataset, including its pixel data.
+        :type dataset: pydicom.Dataset
+        :return: The pixel array, with the same shape as `Dataset.pixel_array`.
+        :rtype: numpy.ndarray
+        """
+        transfer_syntax = dataset.file_meta.TransferSyntaxUID
+        backends = [b for b in self.backends if b.supports(transfer_syntax)]
+        if not transfer_syntax.is_compressed or not backends:
+            return self._timed("pydicom", len(dataset.PixelData), lambda: dataset.pixel_array)
+        n_frames = int(dataset.get("NumberOfFrames", 1) or 1)
+        frames = list(generate_pixel_data_frame(dataset.PixelData, n_frames))
+        futures = [
+            self._frame_pool.submit(self._decode_frame, frame, dataset, backends)
+            for frame in frames
+        ]
+        arrays = [future.result() for future in futures]
+        if any(array is None for array in arrays):
+            # At least one backend failed: decode the whole instance with pydicom
+            return self._timed("pydicom", len(dataset.PixelData), lambda: dataset.pixel_array)
+        return np.stack(arrays) if n_frames > 1 else arrays[0]
+
+    def decode_frame(self, frame: bytes, dataset: Dataset) -> Optional[np.ndarray]:
+        """
+        Decode a single encapsulated frame in the calling thread.
+
+        :param frame: The encoded frame.
+        :type frame: bytes
+        :param dataset: The header of the instance the frame belongs to.
+        :type dataset: pydicom.Dataset
+        :return: The decoded frame, or None if no backend supports the transfer
+            syntax or all of them failed.
+        :rtype: Optional[numpy.ndarray]
+        """
+        transfer_syntax = dataset.file_meta.TransferSyntaxUID
+        backends = [b for b in self.backends if b.supports(transfer_syntax)]
+        return self._decode_frame(frame, dataset, backends)
+
+    def _decode_frame(
+        self, frame: bytes, dataset: Dataset, backends: List[DecoderBackend]
+    ) -> Optional[np.ndarray]:
+        for backend in backends:
+            try:
+                array = self._timed(backend.name, len(frame), lambda: backend.decode(frame, dataset))
+            except Exception as e:
+                logger.debug("%s failed to decode a frame: %s", backend.name, e)
+                continue
+            expected = pixel_dtype(dataset)
+            if array.dtype != expected:
+                if array.dtype.itemsize == expected.itemsize:
+                    array = array.view(expected)
+                else:
+                    array = array.astype(expected)
+            return array
+        return None
+
+    def _timed(self, name: str, nbytes: int, decode) -> np.ndarray:
+        start = time.perf_counter()
+        array = decode()
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            stats = self.stats.setdefault(
+                name, {"decodes": 0, "bytes_in": 0, "bytes_out": 0, "seconds": 0.0}
+            )
+            stats["decodes"] += 1
+            stats["bytes_in"] += nbytes
+            stats["bytes_out"] += array.nbytes
+            stats["seconds"] += elapsed
+        return array
+
+    def summary(self) -> Dict[str, float]:
+        """Return the decode throughput of each backend, in decoded MB per second."""
+        return {
+            f"decode_{name}_mb_per_s": round(
+                stats["bytes_out"] / 1e6 / stats["seconds"], 1
+            )
+            if stats["seconds"]
+            else 0.0
+            for name, stats in self.stats.items()
+        }
+
+    def log_stats(self):
+        """Write the throughput of each backend to the log."""
+        for name, stats in self.stats.items():
+            logger.info(
+                "%s: %d decodes, %.1f MB in, %.1f MB out, %.2f s (%.1f MB/s)",
+                name,
+                stats["decodes"],
+                stats["bytes_in"] / 1e6,
+                stats["bytes_out"] / 1e6,
+                stats["seconds"],
+                stats["bytes_out"] / 1e6 / stats["seconds"] if stats["seconds"] else 0,
+            )
+
+    def fork(self) -> "FrameDecoder":
+        """
+        Return a decoder with its own prefetch queue, sharing the thread pools and statistics.
+
+        Each series converted in its own thread needs a fork, so the prefetches
+        of one series do not cancel those of another. Only the original
+        decoder is closed.
+
+        :return: The fork.
+        :rtype: dcm2mids.procedures.decoders.FrameDecoder
+        """
+        decoder = copy.copy(self)
+        decoder._queue, decoder._next, decoder._pending = [], 0, {}
+        return decoder
+
+    def close(self):
+        """Cancel the pending prefetches and shut down the thread pools."""
+        for future in self._pending.values():
+            future.cancel()
+        self._pending = {}
+        self._instance_pool.shutdown(wait=True)
+        self._frame_pool.shutdown(wait=True)
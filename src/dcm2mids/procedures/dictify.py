@@ -1,6 +1,8 @@
 from pydicom.dataset import Dataset
 from pydicom.datadict import get_entry
 
+from .enhanced import EnhancedFrames
+
 
 def convert_string(input_string: str) -> str:
     """Split the string into words, capitalize each word, and then join them without spaces"""
@@ -13,6 +15,10 @@ def dictify(ds: Dataset, stop_before_pixels: bool = True) -> dict:
     for elem in ds:
         if elem.name == "Pixel Data" and stop_before_pixels:
             continue
+        if elem.keyword == "PerFrameFunctionalGroupsSequence":
+            # One item per frame: summarize it rather than dumping every item
+            output["PerFrameFunctionalGroupsSummary"] = EnhancedFrames(ds).summary()
+            continue
         if elem.VR != "SQ":
             if not elem.tag.is_private:
                 output[get_entry(elem.tag)[-1]] = str(elem.value)
@@ -0,0 +1 @@
+from .waveform_procedure import WaveformProcedures
@@ -0,0 +1,298 @@
+import json
+import logging
+import re
+from pathlib import Path
+from typing import BinaryIO, Iterator, List, Tuple
+
+import numpy as np
+from pydicom import Dataset
+from pydicom.fileset import FileInstance
+from pydicom.waveforms.numpy_handler import WAVEFORM_DTYPES
+
+from ..dictify import dictify
+from ..pixel_data import load_instance
+from ..procedures import Procedures
+
+logger = logging.getLogger("dcm2mids").getChild("waveform_procedure")
+
+# Default number of samples decoded at once
+CHUNK_SAMPLES = 1 << 16
+
+
+def channel_calibration(group: Dataset) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Return the per-channel factors converting raw samples to physical values.
+
+    :param group: The multiplex group, an item of the Waveform Sequence.
+    :type group: pydicom.Dataset
+    :return: The scale (sensitivity times correction factor) and the baseline of
+        each channel, so that `value = raw * scale + baseline`.
+    :rtype: Tuple[numpy.ndarray, numpy.ndarray]
+    """
+    channels = group.get("ChannelDefinitionSequence", [])
+    n_channels = int(group.NumberOfWaveformChannels)
+    scale = np.ones(n_channels)
+    baseline = np.zeros(n_channels)
+    for index, channel in enumerate(channels[:n_channels]):
+        scale[index] = float(channel.get("ChannelSensitivity", 1.0) or 1.0) * float(
+            channel.get("ChannelSensitivityCorrectionFactor", 1.0) or 1.0
+        )
+        baseline[index] = float(channel.get("ChannelBaseline", 0.0) or 0.0)
+    return scale, baseline
+
+
+def channel_labels(group: Dataset) -> Tuple[List[str], List[str]]:
+    """Return the name and the unit of each channel of a multiplex group."""
+    names, units = [], []
+    for index, channel in enumerate(group.get("ChannelDefinitionSequence", [])):
+        if channel.get("ChannelLabel"):
+            names.append(str(channel.ChannelLabel))
+        elif channel.get("ChannelSourceSequence"):
+            names.append(str(channel.ChannelSourceSequence[0].get("CodeMeaning", "")))
+        else:
+            names.append(f"channel_{index + 1}")
+        unit = channel.get("ChannelSensitivityUnitsSequence")
+        units.append(str(unit[0].get("CodeValue", "n/a")) if unit else "n/a")
+    return names, units
+
+
+def iter_samples(
+    group: Dataset, chunk_samples: int = CHUNK_SAMPLES, as_raw: bool = False
+) -> Iterator[np.ndarray]:
+    """
+    Decode the samples of a multiplex group in chunks.
+
+    The raw samples are viewed in place in the Waveform Data bytes and each
+    chunk is calibrated with one broadcast multiply-add over all its
+    channels, so only one chunk of decoded values exists at a time.
+
+    :param group: The multiplex group, an item of the Waveform Sequence.
+    :type group: pydicom.Dataset
+    :param chunk_samples: Number of samples (rows) per chunk.
+    :type chunk_samples: int
+    :param as_raw: Yield the raw stored values instead of physical values.
+    :type as_raw: bool
+    :return: An iterator over arrays of shape (samples, channels), float32
+        unless `as_raw`.
+    :rtype: Iterator[numpy.ndarray]
+    """
+    dtype = WAVEFORM_DTYPES[
+        (int(group.WaveformBitsAllocated), str(group.WaveformSampleInterpretation))
+    ]
+    n_channels = int(group.NumberOfWaveformChannels)
+    n_samples = int(group.NumberOfWaveformSamples)
+    raw = np.frombuffer(group.WaveformData, dtype=dtype, count=n_samples * n_channels)
+    raw = raw.reshape(n_samples, n_channels)
+    scale, baseline = channel_calibration(group)
+    scale, baseline = scale.astype(np.float32), baseline.astype(np.float32)
+    for start in range(0, n_samples, chunk_samples):
+        chunk = raw[start : start + chunk_samples]
+        yield chunk if as_raw else chunk * scale + baseline
+
+
+def write_npy_header(f: BinaryIO, shape: Tuple[int, ...], dtype: np.dtype):
+    """Write the header of a C-ordered `.npy` array, to be followed by its data."""
+    np.lib.format.write_array_header_1_0(
+        f,
+        {
+            "descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+            "fortran_order": False,
+            "shape": shape,
+        },
+    )
+
+
+class WaveformProcedures(Procedures):
+    """Conversion logic for electrical activity waveforms (ECG, EEG, ...).
+
+    Each multiplex group of the Waveform Sequence is written as a float32
+    `.npy` array of shape (samples, channels), in physical units, with a JSON
+    sidecar describing the channels. Samples are decoded and written in
+    chunks, so long recordings such as Holter ECGs are never decoded whole.
+    """
+
+    def __init__(
+        self,
+        mids_path: Path,
+        bodypart: str,
+        use_bodypart: bool,
+        use_viewposition: bool,
+        chunk_samples: int = CHUNK_SAMPLES,
+        **kwargs,
+    ):
+        super().__init__(mids_path, bodypart, use_bodypart, use_viewposition, **kwargs)
+        self.chunk_samples = chunk_samples
+        self.scans_header = [
+            "ScanFile",
+            "BodyPart",
+            "SeriesNumber",
+            "AccessionNumber",
+            "Manufacturer",
+            "ManufacturerModelName",
+            "Modality",
+            "AcquisitionDateTime",
+        ]
+
+    def get_name(
+        self, dataset: Dataset, group_label: str, mim: Tuple[str, ...]
+    ) -> Tuple[Path, Path]:
+        """
+        Generates a name for a multiplex group based on its metadata.
+
+        :param dataset: The dataset containing the waveform metadata.
+        :type dataset: pydicom.Dataset
+        :param group_label: The label of the multiplex group, empty if the
+            instance has a single group.
+        :type group_label: str
+        :param mim: A tuple of labels to be included in the filepath.
+        :type mim: tuple[str, ...]
+        :returns: The path of the recording, without extension, and the path of its session.
+        :rtype: tuple[pathlib.Path, pathlib.Path]
+        """
+
+        sub = f"sub-{dataset.PatientID}"
+        ses = f"ses-{dataset.StudyID}"
+        run = (
+            f"run-{dataset.SeriesNumber}"
+            if dataset.data_element("SeriesNumber")
+            else ""
+        )
+        chunk = (
+            f"chunk-{dataset.InstanceNumber}"
+            if dataset.data_element("InstanceNumber") and self.use_chunk
+            else ""
+        )
+        acq = f"acq-{group_label}" if group_label else ""
+        filename = "_".join(
+            [
+                part
+                for part in [sub, ses, run, chunk, acq, dataset.Modality.lower()]
+                if part != ""
+            ]
+        )
+        return (
+            self.mids_path.joinpath(sub, ses, *mim, filename),
+            self.mids_path.joinpath(sub, ses),
+        )
+
+    @staticmethod
+    def group_labels(dataset: Dataset) -> List[str]:
+        """Return a unique file name label for each multiplex group."""
+        groups = dataset.WaveformSequence
+        if len(groups) == 1:
+            return [""]
+        labels = []
+        for index, group in enumerate(groups):
+            label = str(group.get("MultiplexGroupLabel", ""))
+            label = re.sub(r"[^a-zA-Z0-9]", "", label).lower()
+            if not label or label in labels:
+                label = f"group{index + 1}"
+            labels.append(label)
+        return labels
+
+    def convert_group(self, group: Dataset, file_path_mids: Path):
+        """
+        Writes the samples of a multiplex group to a `.npy` file, chunk by chunk.
+
+        :param group: The multiplex group, an item of the Waveform Sequence.
+        :type group: pydicom.Dataset
+        :param file_path_mids: The path where the recording will be saved.
+        :type file_path_mids: pathlib.Path
+        """
+        shape = (int(group.NumberOfWaveformSamples), int(group.NumberOfWaveformChannels))
+        with self.writer.open(file_path_mids) as f:
+            write_npy_header(f, shape, np.float32)
+            for chunk in iter_samples(group, self.chunk_samples):
+                f.write(np.ascontiguousarray(chunk, dtype=np.float32).tobytes())
+
+    def convert_to_sidecar(self, header: Dataset, group: Dataset, file_path_mids: Path):
+        """
+        Writes the JSON sidecar of a multiplex group.
+
+        :param header: The dataset without its Waveform Sequence.
+        :type header: pydicom.Dataset
+        :param group: The multiplex group.
+        :type group: pydicom.Dataset
+        :param file_path_mids: The path to the JSON file.
+        :type file_path_mids: pathlib.Path
+        """
+        if self.profile.sidecar != "off":
+            names, units = channel_labels(group)
+            sidecar = dictify(self.profile.sidecar_dataset(header))
+            sidecar.update(
+                {
+                    "SamplingFrequency": float(group.SamplingFrequency),
+                    "StartTime": float(group.get("MultiplexGroupTimeOffset", 0) or 0) / 1000,
+                    "Columns": names,
+                    "Units": units,
+                    "MultiplexGroupLabel": str(group.get("MultiplexGroupLabel", "")),
+                }
+            )
+            self.writer.write_text(file_path_mids, json.dumps(sidecar, indent=4))
+        if self.metadata_exporter is not None:
+            self.metadata_exporter.add(header, file_path_mids)
+
+    def get_scan_metadata(self, dataset, file_path_mids):
+        subs = lambda s: re.sub(r"(?<!^)(?=[A-Z])", "_", s).lower()
+        return {
+            subs(key): value
+            for key, value in zip(
+                self.scans_header,
+                [
+                    str(file_path_mids),
+                    (
+                        dataset.BodyPartExamined
+                        if "BodyPartExamined" in dataset
+                        else self.bodypart
+                    ),
+                    *[
+                        (dataset[i].value if i in dataset else "n/a")
+                        for i in self.scans_header[2:]
+                    ],
+                ],
+            )
+        }
+
+    def run(self, instance_list: List[FileInstance]):
+        """
+        Runs the waveform conversion pipeline on a list of instances.
+
+        :param instance_list: The DICOM instances of the series.
+        :type instance_list: list[pydicom.fileset.FileInstance]
+        """
+
+        self.use_chunk = len(instance_list) > 1
+        self.select_profile(instance_list)
+        list_scan_metadata = []
+        for instance in instance_list:
+            dataset = load_instance(instance)
+            if "WaveformSequence" not in dataset:
+                logger.warning("%s has no waveform, skipping it", instance.path)
+                continue
+            header = Dataset()
+            header.update(
+                {elem.tag: elem for elem in dataset if elem.keyword != "WaveformSequence"}
+            )
+            mim = ("mim-ephys", dataset.Modality.lower())
+            labels = self.group_labels(dataset)
+            for group, label in zip(dataset.WaveformSequence, labels):
+                file_path_mids, session_absolute_path_mids = self.get_name(
+                    dataset, label, mim
+                )
+                if self.profile.image:
+                    self.convert_group(group, file_path_mids.with_suffix(".npy"))
+                self.convert_to_sidecar(
+                    header, group, file_path_mids.with_suffix(".json")
+                )
+                file_path_relative_mids = file_path_mids.relative_to(
+                    session_absolute_path_mids
+                ).with_suffix(".npy")
+                list_scan_metadata.append(
+                    self.get_scan_metadata(dataset, self.scan_path(file_path_relative_mids))
+                )
+                logger.info("Saved to %s", file_path_relative_mids.name)
+            logger.info(
+                "Successfully processed instance %s",
+                instance.path,
+            )
+        return list_scan_metadata
@@ -0,0 +1,210 @@
+import logging
+from functools import cached_property
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from pydicom import Dataset
+from pydicom.datadict import keyword_for_tag
+
+logger = logging.getLogger("dcm2mids").getChild("enhanced")
+
+
+def is_enhanced(dataset: Dataset) -> bool:
+    """Whether a dataset is an enhanced multi-frame instance with functional groups."""
+    return "PerFrameFunctionalGroupsSequence" in dataset
+
+
+class EnhancedFrames:
+    """Per-frame geometry and indices of an enhanced multi-frame instance.
+
+    Each attribute is gathered from the Per-frame Functional Groups, falling
+    back to the Shared Functional Groups, into one NumPy array with a row per
+    frame. The groups are only walked when an attribute is first accessed,
+    once per attribute, so building the reader costs nothing and fields that
+    are never used are never parsed.
+
+    :param dataset: The dataset of the instance, pixel data excluded.
+    :type dataset: pydicom.Dataset
+    """
+
+    def __init__(self, dataset: Dataset):
+        self.dataset = dataset
+        shared = dataset.get("SharedFunctionalGroupsSequence")
+        self.shared = shared[0] if shared else Dataset()
+        self.per_frame = dataset.get("PerFrameFunctionalGroupsSequence") or []
+        self.n_frames = int(dataset.get("NumberOfFrames", 1) or 1)
+        if self.per_frame and len(self.per_frame) != self.n_frames:
+            logger.warning(
+                "%d per-frame functional groups for %d frames",
+                len(self.per_frame),
+                self.n_frames,
+            )
+
+    def values(self, path: List[str], default: Any = None) -> List[Any]:
+        """
+        Return the value of an attribute nested in the functional groups, for each frame.
+
+        :param path: The keywords of the nested sequences, then of the attribute,
+            e.g. `["PlanePositionSequence", "ImagePositionPatient"]`.
+        :type path: List[str]
+        :param default: The value of frames without the attribute.
+        :type default: Any
+        :return: The values, one per frame.
+        :rtype: List[Any]
+        """
+        shared = self._lookup(self.shared, path)
+        if not self.per_frame:
+            return [default if shared is None else shared] * self.n_frames
+        values = []
+        for index in range(self.n_frames):
+            item = self.per_frame[index] if index < len(self.per_frame) else Dataset()
+            value = self._lookup(item, path)
+            if value is None:
+                value = shared
+            values.append(default if value is None else value)
+        return values
+
+    @staticmethod
+    def _lookup(item: Dataset, path: List[str]) -> Optional[Any]:
+        for keyword in path[:-1]:
+            sequence = item.get(keyword)
+            if not sequence:
+                return None
+            item = sequence[0]
+        value = item.get(path[-1])
+        return None if value in (None, "") else value
+
+    def _array(self, path: List[str], default: Any, width: int = 0) -> np.ndarray:
+        values = self.values(path, default)
+        if width:
+            return np.array([[float(v) for v in value] for value in values]).reshape(-1, width)
+        return np.array([float(value) for value in values])
+
+    @cached_property
+    def positions(self) -> np.ndarray:
+        """The Image Position (Patient) of each frame, of shape (frames, 3)."""
+        return self._array(
+            ["PlanePositionSequence", "ImagePositionPatient"], [0.0, 0.0, 0.0], 3
+        )
+
+    @cached_property
+    def orientations(self) -> np.ndarray:
+        """The Image Orientation (Patient) of each frame, of shape (frames, 6)."""
+        return self._array(
+            ["PlaneOrientationSequence", "ImageOrientationPatient"],
+            [1.0, 0.0, 0.0, 0.0, 1.0, 0.0],
+            6,
+        )
+
+    @cached_property
+    def pixel_spacings(self) -> np.ndarray:
+        """The Pixel Spacing of each frame, (rows, columns), of shape (frames, 2)."""
+        return self._array(["PixelMeasuresSequence", "PixelSpacing"], [1.0, 1.0], 2)
+
+    @cached_property
+    def slice_thicknesses(self) -> np.ndarray:
+        return self._array(["PixelMeasuresSequence", "SliceThickness"], np.nan)
+
+    @cached_property
+    def dimension_keywords(self) -> List[str]:
+        """The keyword of the attribute indexed by each dimension."""
+        return [
+            keyword_for_tag(item.DimensionIndexPointer) or str(item.DimensionIndexPointer)
+            for item in self.dataset.get("DimensionIndexSequence", [])
+            if "DimensionIndexPointer" in item
+        ]
+
+    @cached_property
+    def dimension_indices(self) -> np.ndarray:
+        """The Dimension Index Values of each frame, of shape (frames, dimensions)."""
+        values = self.values(["FrameContentSequence", "DimensionIndexValues"], [])
+        width = max((len(np.atleast_1d(v)) for v in values), default=0)
+        indices = np.zeros((self.n_frames, width), dtype=int)
+        for row, value in enumerate(values):
+            value = np.atleast_1d(np.asarray(value, dtype=int))
+            indices[row, : len(value)] = value
+        return indices
+
+    @cached_property
+    def temporal_positions(self) -> np.ndarray:
+        return self._array(["FrameContentSequence", "TemporalPositionIndex"], 0)
+
+    @cached_property
+    def stack_positions(self) -> np.ndarray:
+        return self._array(["FrameContentSequence", "InStackPositionNumber"], 0)
+
+    @cached_property
+    def echo_times(self) -> np.ndarray:
+        return self._array(["MREchoSequence", "EffectiveEchoTime"], 0)
+
+    @cached_property
+    def b_values(self) -> np.ndarray:
+        """The b-value of each frame, nan for frames without diffusion information."""
+        return self._array(["MRDiffusionSequence", "DiffusionBValue"], np.nan)
+
+    @cached_property
+    def gradients(self) -> np.ndarray:
+        """The diffusion gradient direction of each frame, of shape (frames, 3)."""
+        return self._array(
+            [
+                "MRDiffusionSequence",
+                "DiffusionGradientDirectionSequence",
+                "DiffusionGradientOrientation",
+            ],
+            [0.0, 0.0, 0.0],
+            3,
+        )
+
+    @cached_property
+    def rescale_slopes(self) -> np.ndarray:
+        return self._array(
+            ["PixelValueTransformationSequence", "RescaleSlope"],
+            self.dataset.get("RescaleSlope", 1),
+        )
+
+    @cached_property
+    def rescale_intercepts(self) -> np.ndarray:
+        return self._array(
+            ["PixelValueTransformationSequence", "RescaleIntercept"],
+            self.dataset.get("RescaleIntercept", 0),
+        )
+
+    @cached_property
+    def repetition_time(self) -> float:
+        values = self.values(["MRTimingAndRelatedParametersSequence", "RepetitionTime"], 0)
+        return float(values[0]) if values else 0.0
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        Summarize the functional groups for a JSON sidecar.
+
+        :return: The dimensions, and the distinct values or the range of each
+            per-frame attribute, instead of one item per frame.
+        :rtype: Dict[str, Any]
+        """
+        unique = lambda array: np.unique(array[~np.isnan(array)]).tolist()
+        summary: Dict[str, Any] = {
+            "NumberOfFrames": self.n_frames,
+            "DimensionIndexPointers": self.dimension_keywords,
+        }
+        if self.dimension_indices.size:
+            summary["DimensionIndexRanges"] = np.stack(
+                [self.dimension_indices.min(axis=0), self.dimension_indices.max(axis=0)],
+                axis=1,
+            ).tolist()
+        orientations = np.unique(self.orientations.round(6), axis=0)
+        summary["ImageOrientationPatient"] = (
+            orientations[0].tolist() if len(orientations) == 1 else orientations.tolist()
+        )
+        summary["ImagePositionPatientFirst"] = self.positions[0].tolist()
+        summary["ImagePositionPatientLast"] = self.positions[-1].tolist()
+        summary["PixelSpacing"] = np.unique(self.pixel_spacings, axis=0).tolist()
+        summary["TemporalPositions"] = len(unique(self.temporal_positions))
+        if np.any(self.echo_times):
+            summary["EffectiveEchoTimes"] = unique(self.echo_times)
+        if not np.all(np.isnan(self.b_values)):
+            summary["DiffusionBValues"] = unique(self.b_values)
+            summary["DiffusionDirections"] = len(
+                np.unique(self.gradients[np.any(self.gradients, axis=1)].round(6), axis=0)
+            )
+        return summary
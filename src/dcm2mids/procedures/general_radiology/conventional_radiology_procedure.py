@@ -1,4 +1,5 @@
 import logging
+import re
 from pathlib import Path
 from typing import Tuple, List
 from pydicom import Dataset
@@ -17,12 +18,12 @@ class ConventionalRadiologyProcedures(Procedures):
     def __init__(
         self,
         mids_path: Path,
-        modality: str,
         bodypart: str,
         use_bodypart: bool,
         use_viewposition: bool,
+        **kwargs,
     ):
-        super().__init__(mids_path, modality, bodypart, use_bodypart, use_viewposition)
+        super().__init__(mids_path, bodypart, use_bodypart, use_viewposition, **kwargs)
         self.scans_header = [
                 "Filename",
                 "BodyPart",
@@ -36,15 +37,25 @@ class ConventionalRadiologyProcedures(Procedures):
                 "PhotometricInterpretation",
                 "Laterality",
             ]
-        self.modality = modality.lower()
-        self.bodypart = bodypart
-        self.use_bodypart = use_bodypart
-        self.use_viewposition = use_viewposition
-        self.mim = "mim-rx" if self.bodypart in bids_bp else ""
-        self.bids_folder = modality.lower()
         self.extension = ".png"
 
-    def get_name(self, dataset: Dataset) -> Tuple[Path, Path]:
+    def classify_image_type(self, instance: FileInstance) -> Tuple[str, Tuple[str, ...]]:
+        """
+        Classifies an image based on its modality.
+
+        Head images follow BIDS; other body parts go under the MIDS `mim-rx` folder.
+
+        :param instance: The instance to be classified.
+        :type instance: pydicom.fileset.FileInstance
+        :returns: A tuple containing the image type and a tuple of labels for that type.
+        :rtype: tuple[str, tuple[str, ...]]
+        """
+        modality = instance.Modality.lower()
+        return modality, ((modality,) if self.bodypart in bids_bp else ("mim-rx", modality))
+
+    def get_name(
+        self, dataset: Dataset, modality: str, mim: Tuple[str, ...]
+    ) -> Tuple[Path, Path]:
         """
         Generates a name for the image based on its metadata.
 
@@ -77,7 +88,7 @@ class ConventionalRadiologyProcedures(Procedures):
         if self.use_viewposition:
             
             vp = (
-                f"vp-{convert_orientation_2D(dataset.data_element('ImageOrientationPatient'))}"
+                f"vp-{convert_orientation_2D(orientation_key(dataset.ImageOrientationPatient))}"
                 if dataset.data_element("ImageOrientationPatient")
                 else ""
             )
@@ -89,7 +100,7 @@ class ConventionalRadiologyProcedures(Procedures):
             if dataset.data_element("InstanceNumber") and self.use_chunk
             else ""
         )
-        mod = self.modality
+        mod = modality
         filename = "_".join(
             [part for part in [sub, ses, run, bp, lat, vp, chunk, mod] if part != ""]
         )
@@ -107,9 +118,8 @@ class ConventionalRadiologyProcedures(Procedures):
         :param file_path_mids: The path where the converted image will be saved.
         :type file_path_mids: pathlib.Path
         """
-        file_path_mids.parent.mkdir(parents=True, exist_ok=True)
-        image = sitk.ReadImage(instance.path)
-        sitk.WriteImage(image, file_path_mids)
+        image = self.read_image(instance)
+        self.writer.write_image(image, file_path_mids)
 
     
     def get_scan_metadata(self, dataset, file_path_mids):
@@ -119,7 +129,7 @@ class ConventionalRadiologyProcedures(Procedures):
             for key, value in zip(
                 self.scans_header,
                 [
-                    str(file_path_mids.with_suffix(".png")),
+                    str(file_path_mids),
                     (
                         dataset.BodyPartExamined
                         if "BodyPartExamined" in dataset
@@ -132,32 +142,36 @@ class ConventionalRadiologyProcedures(Procedures):
                 ],
             )
         }
-    
 
-def run(self, instance_list: List[FileInstance]):
+
+    def run(self, instance_list: List[FileInstance]):
         """
         Runs the image conversion pipeline on a list of instances.
 
-        :param instance_list: A list of tuples containing the instance number and the DICOM instance.
-        :type instance_list: list[uuple[int, pydicom.fileset.FileInstance]]
+        :param instance_list: The DICOM instances of the series.
+        :type instance_list: list[pydicom.fileset.FileInstance]
         """
 
         self.use_chunk = len(instance_list) > 1
+        self.select_profile(instance_list)
+        if self.decoder is not None and self.profile.image:
+            self.decoder.prefetch(instance_list)
         list_scan_metadata = []
         for instance in instance_list:
-            dataset = instance.load()
-            modality, mim, ext = self.classify_image_type(instance)
+            dataset = self.load_dataset(instance)
+            modality, mim = self.classify_image_type(instance)
             file_path_mids, session_absolute_path_mids = self.get_name(
                 dataset, modality, mim
             )
 
-            self.convert_to_image(instance, file_path_mids.with_suffix(ext))
+            if self.profile.image:
+                self.save_image(instance, dataset, file_path_mids.with_suffix(self.extension))
             self.convert_to_jsonfile(dataset, file_path_mids.with_suffix(".json"))
             file_path_relative_mids = file_path_mids.relative_to(
                 session_absolute_path_mids
-            ).with_suffix(".png")
+            ).with_suffix(self.extension)
             list_scan_metadata.append(
-                self.get_scan_metadata(dataset, file_path_relative_mids)
+                self.get_scan_metadata(dataset, self.scan_path(file_path_relative_mids))
             )
             logger.info(
                 "Successfully processed instance %s",
@@ -169,6 +183,12 @@ def run(self, instance_list: List[FileInstance]):
             )
         return list_scan_metadata
 
+
+def orientation_key(orientation) -> str:
+    """Format an Image Orientation (Patient) as the keys of the orientation mappings, e.g. `1\\0\\0\\0\\1\\0`."""
+    return "\\".join(str(round(float(v))) for v in orientation)
+
+
 def convert_orientation_2D(orientation):
     mapping = {
         "1\\0\\0\\0\\1\\0": "AP",  # Anterior-Posterior
@@ -1,17 +1,32 @@
 import logging
+import re
 from pathlib import Path
-from typing import List, Tuple
+from typing import List, Optional, Sequence, Tuple
 
-from pydicom import Dataset
+import numpy as np
+from pydicom import Dataset, dcmread
 from pydicom.fileset import FileInstance
 
+from ..magnetic_resonance.magnetic_resonance_procedure import (
+    MagneticResonanceProcedures,
+    assemble_volumes,
+    header_arrays,
+)
 from ..procedures import Procedures
+from .conventional_radiology_procedure import orientation_key
 
 logger = logging.getLogger("dcm2mids").getChild("tomography_procedure")
 
 
 class TomographyProcedures(Procedures):
-    """Conversion logic for General Radiologic Imaging procedures."""
+    """Conversion logic for General Radiologic Imaging procedures.
+
+    CT and PT series are written as one NIfTI volume each, or a 4D stack when
+    several volumes share the slice positions.
+    """
+
+    # Slices are streamed into the volume as for MR acquisitions
+    convert_acquisition = MagneticResonanceProcedures.convert_acquisition
 
     def __init__(
         self,
@@ -19,8 +34,9 @@ class TomographyProcedures(Procedures):
         bodypart: str,
         use_bodypart: bool,
         use_viewposition: bool,
+        **kwargs,
     ):
-        super().__init__(mids_path, bodypart, use_bodypart, use_viewposition)
+        super().__init__(mids_path, bodypart, use_bodypart, use_viewposition, **kwargs)
         self.scans_header = [
                 'Filename',
                 'BodyPart',
@@ -83,7 +99,7 @@ class TomographyProcedures(Procedures):
                 ".png",
             )
 
-        if instance.Modality in ["CT"]:
+        if instance.Modality in ["CT", "PT"]:
             self.scans_header = [
                 "ScanFile",
                 "BodyPart",
@@ -98,14 +114,16 @@ class TomographyProcedures(Procedures):
                 "PhotometricInterpretation",
                 "Laterality",
                 "KVP",
-                "Exposure" "ExposureTime",
+                "Exposure",
+                "ExposureTime",
                 "XRayTubeCurrent",
                 "DataCollectionDiameter",
                 "ReconstructionDiameter",
                 "SliceThickness",
                 "ConvolutionKernel",
                 "ReconstructionAlgorithm",
-                "DistanceSourceToDetector" "Image Orientation",
+                "DistanceSourceToDetector",
+                "ImageOrientationPatient",
                 "SmallestImagePixelValue",
                 "LargestImagePixelValue",
                 "WindowCenter",
@@ -121,12 +139,16 @@ class TomographyProcedures(Procedures):
                         instance.Modality.lower(),
                     )
                 ),
-                ".nii.gz",
+                self.writer.encoding.nifti_suffix,
             )
         return ("", tuple(), "")
 
     def get_name(
-        self, dataset: Dataset, modality: str, mim: Tuple[str, ...]
+        self,
+        dataset: Dataset,
+        modality: str,
+        mim: Tuple[str, ...],
+        orientation: Optional[Sequence[float]] = None,
     ) -> Tuple[Path, Path]:
         """
         Generates a name for the image based on its metadata.
@@ -137,6 +159,9 @@ class TomographyProcedures(Procedures):
         :type modality: str
         :param mim: A tuple of labels to be included in the filepath.
         :type mim: tuple[str, ...]
+        :param orientation: The Image Orientation (Patient) of the slices, read
+            from the dataset if None.
+        :type orientation: Sequence[float], optional
         :returns: A Path object representing the generated name.
         :rtype: pathlib.Path
         """
@@ -157,9 +182,11 @@ class TomographyProcedures(Procedures):
         else:
             bp = ""
         lat = f"lat-{dataset.Laterality}" if dataset.data_element("Laterality") else ""
+        if orientation is None:
+            orientation = dataset.get("ImageOrientationPatient")
         vp = (
-            f"vp-{convert_orientation(dataset.data_element('ImageOrientationPatient'))[0]}"
-            if dataset.data_element("ImageOrientationPatient")
+            f"vp-{convert_orientation(orientation_key(orientation))[0]}"
+            if orientation is not None
             else ""
         )
         chunk = (
@@ -176,50 +203,79 @@ class TomographyProcedures(Procedures):
             self.mids_path.joinpath(sub, ses),
         )
 
-    def convert_to_image(self, instance: FileInstance, file_path_mids: Path):
-        """
-        Converts a DICOM to an image.
+    def get_scan_metadata(self, dataset, file_path_mids):
+        subs = lambda s: re.sub(r"(?<!^)(?=[A-Z])", "_", s).lower()
+        return {
+            subs(key): value
+            for key, value in zip(
+                self.scans_header,
+                [
+                    str(file_path_mids),
+                    (
+                        dataset.BodyPartExamined
+                        if "BodyPartExamined" in dataset
+                        else self.bodypart
+                    ),
+                    *[
+                        (dataset[i].value if i in dataset else "n/a")
+                        for i in self.scans_header[2:]
+                    ],
+                ],
+            )
+        }
 
-        :param instance: The DICOM image instance.
-        :type instance: pydicom.fileset.FileInstance
-        :param file_path_mids: The path where the converted image will be saved.
-        :type file_path_mids: pathlib.Path
+    def run(self, instance_list: List[FileInstance]):
         """
-        if "".join(file_path_mids.suffixes) == ".nii.gz":
-            pass
-        else:
-            file_path_mids.parent.mkdir(parents=True, exist_ok=True)
-            image = sitk.ReadImage(instance.path)
-            sitk.WriteImage(image, file_path_mids)
+        Runs the CT/PT conversion pipeline on the slices of a series.
 
+        As for MR acquisitions, only the headers are read up front: the slices,
+        or the frames of enhanced multi-frame instances, are placed in a volume
+        from their geometry and streamed into a single NIfTI file.
 
-def run(self, instance_list: List[Tuple[int, FileInstance]]):
-    """
-    Runs the image conversion pipeline on a list of instances.
-
-    :param instance_list: A list of tuples containing the instance number and the DICOM instance.
-    :type instance_list: list[uuple[int, pydicom.fileset.FileInstance]]
-    """
+        :param instance_list: The DICOM instances of the series.
+        :type instance_list: list[pydicom.fileset.FileInstance]
+        """
 
-    self.use_chunk = len(instance_list) > 1
-    list_scan_metadata = []
-    for _, instance in sorted(instance_list, key=lambda x: x[0]):
-        print(instance)
-        dataset = instance.load()
-        modality, mim, ext = self.classify_image_type(instance)
+        self.use_chunk = False
+        self.select_profile(instance_list)
+        headers = [
+            dcmread(instance.path, stop_before_pixels=True) for instance in instance_list
+        ]
+        arrays = header_arrays(headers)
+        orientation = arrays["orientation"][0]
+        try:
+            grid, positions = assemble_volumes(
+                arrays, np.cross(orientation[:3], orientation[3:])
+            )
+        except ValueError as error:
+            logger.warning(
+                "Series %s can not be assembled into volumes: %s",
+                headers[0].get("SeriesInstanceUID"),
+                error,
+            )
+            return []
+        header = headers[arrays["file"][grid[0, 0]]]
+        del headers
+        modality, mim, ext = self.classify_image_type(instance_list[0])
+        # Enhanced instances only hold their orientation in the functional groups
         file_path_mids, session_absolute_path_mids = self.get_name(
-            dataset, modality, mim
+            header, modality, mim, arrays["orientation"][grid[0, 0]]
         )
-
-        self.convert_to_image(instance, file_path_mids.with_suffix(ext))
-        self.convert_to_jsonfile(dataset, file_path_mids.with_suffix(".json"))
+        if self.profile.image:
+            self.convert_acquisition(
+                instance_list,
+                header,
+                arrays,
+                grid,
+                positions,
+                file_path_mids.with_suffix(ext),
+            )
+        self.convert_to_jsonfile(header, file_path_mids.with_suffix(".json"))
         file_path_relative_mids = file_path_mids.relative_to(
             session_absolute_path_mids
-        ).with_suffix(".png")
-        list_scan_metadata.append(
-            self.get_scan_metadata(dataset, file_path_relative_mids)
-        )
-    return list_scan_metadata
+        ).with_suffix(ext)
+        logger.info("Saved to %s", file_path_relative_mids.name)
+        return [self.get_scan_metadata(header, self.scan_path(file_path_relative_mids))]
 
 
 def convert_orientation(orientation):
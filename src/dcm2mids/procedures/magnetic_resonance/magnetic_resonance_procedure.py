@@ -1,48 +1,541 @@
 import logging
+import re
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 
-from dcm2mids.procedures.dictify import dictify
+import numpy as np
+from pydicom import Dataset, dcmread
+from pydicom.fileset import FileInstance
+from pydicom.multival import MultiValue
+from pydicom.pixel_data_handlers.util import pixel_dtype
 
+from ..enhanced import EnhancedFrames, is_enhanced
+from ..nifti import NiftiStreamWriter
+from ..pixel_data import FrameReader, frame_shape, instance_file
 from ..procedures import Procedures
 
 logger = logging.getLogger("dcm2mids").getChild("magnetic_resonance_procedure")
 
+# Slice positions closer than this, in mm, are the same slice
+POSITION_DECIMALS = 3
+
+# Suffix of anatomical acquisitions, by pattern of their series description
+ANAT_SUFFIXES = [
+    (re.compile(r"flair", re.IGNORECASE), "FLAIR"),
+    (re.compile(r"t2\*|t2star|swi|gre", re.IGNORECASE), "T2starw"),
+    (re.compile(r"t2", re.IGNORECASE), "T2w"),
+    (re.compile(r"pd", re.IGNORECASE), "PDw"),
+    (re.compile(r"t1|mprage", re.IGNORECASE), "T1w"),
+]
+
+
+def diffusion(dataset: Dataset) -> Tuple[float, np.ndarray]:
+    """
+    Return the b-value and the gradient direction of a diffusion weighted slice.
+
+    :param dataset: The dataset of the slice.
+    :type dataset: pydicom.Dataset
+    :return: The b-value (nan if it is not a diffusion acquisition) and the
+        gradient direction in patient (LPS) coordinates (zeros if unknown).
+    :rtype: Tuple[float, numpy.ndarray]
+    """
+    b_value, gradient = dataset.get("DiffusionBValue"), dataset.get(
+        "DiffusionGradientOrientation"
+    )
+    if b_value is None:
+        try:
+            block = dataset.private_block(0x0019, "SIEMENS MR HEADER")
+            b_value = block[0x0C].value if 0x0C in block else None
+            gradient = block[0x0E].value if 0x0E in block else gradient
+        except KeyError:
+            pass
+    if b_value is None or b_value == "":
+        return np.nan, np.zeros(3)
+    gradient = np.asarray(gradient if gradient else [0.0, 0.0, 0.0], dtype=float)
+    return float(b_value), gradient
+
+
+def header_arrays(headers: List[Dataset]) -> Dict[str, np.ndarray]:
+    """
+    Gather the fields used to assemble volumes into one array per field.
+
+    Classic instances contribute one row each. Enhanced multi-frame instances
+    contribute one row per frame, read from their functional groups.
+
+    :param headers: The datasets of the instances, pixel data excluded.
+    :type headers: List[pydicom.Dataset]
+    :return: The arrays, with one row per frame; `file` and `frame` locate
+        each frame in the list of instances.
+    :rtype: Dict[str, numpy.ndarray]
+    """
+    get = lambda ds, keyword, default: (
+        ds.get(keyword) if ds.get(keyword) not in (None, "") else default
+    )
+    rows = []
+    for index, ds in enumerate(headers):
+        if is_enhanced(ds):
+            frames = EnhancedFrames(ds)
+            echo_times = frames.echo_times
+            rows.append(
+                {
+                    "file": np.full(frames.n_frames, index),
+                    "frame": np.arange(frames.n_frames),
+                    "position": frames.positions,
+                    "orientation": frames.orientations,
+                    "spacing": frames.pixel_spacings,
+                    "echo": np.unique(echo_times, return_inverse=True)[1].reshape(-1) + 1,
+                    "echo_time": echo_times,
+                    "temporal": frames.temporal_positions,
+                    "instance": np.full(frames.n_frames, float(get(ds, "InstanceNumber", 0))),
+                    "b_value": frames.b_values,
+                    "gradient": frames.gradients,
+                    "slope": frames.rescale_slopes,
+                    "intercept": frames.rescale_intercepts,
+                }
+            )
+            continue
+        b_value, gradient = diffusion(ds)
+        echo = get(ds, "EchoNumbers", 1)
+        # An image may belong to several echoes, it is sorted by the first one
+        echo = echo[0] if isinstance(echo, MultiValue) else echo
+        rows.append(
+            {
+                "file": [index],
+                "frame": [0],
+                "position": [[float(v) for v in get(ds, "ImagePositionPatient", [0, 0, 0])]],
+                "orientation": [
+                    [float(v) for v in get(ds, "ImageOrientationPatient", [1, 0, 0, 0, 1, 0])]
+                ],
+                "spacing": [[float(v) for v in get(ds, "PixelSpacing", [1, 1])]],
+                "echo": [float(echo)],
+                "echo_time": [float(get(ds, "EchoTime", 0))],
+                "temporal": [float(get(ds, "TemporalPositionIdentifier", 0))],
+                "instance": [float(get(ds, "InstanceNumber", 0))],
+                "b_value": [b_value],
+                "gradient": [gradient],
+                "slope": [float(get(ds, "RescaleSlope", 1))],
+                "intercept": [float(get(ds, "RescaleIntercept", 0))],
+            }
+        )
+    return {
+        key: np.concatenate([np.asarray(row[key]) for row in rows]) for key in rows[0]
+    }
+
+
+def assemble_volumes(
+    arrays: Dict[str, np.ndarray], normal: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Place each slice of an acquisition in a (volume, slice) grid.
+
+    Slices are sorted along the slice normal. Slices sharing a position are
+    ordered into volumes by b-value, gradient direction, temporal position
+    and instance number, all with array operations over the whole series.
+
+    :param arrays: The header arrays of the slices of one acquisition.
+    :type arrays: Dict[str, numpy.ndarray]
+    :param normal: The unit normal of the slices.
+    :type normal: numpy.ndarray
+    :return: The grid of slice indices, of shape (volumes, slices), and the
+        sorted slice positions along the normal.
+    :rtype: Tuple[numpy.ndarray, numpy.ndarray]
+    :raises ValueError: If the slice positions do not all have the same number of slices.
+    """
+    distance = np.round(arrays["position"] @ normal, POSITION_DECIMALS)
+    positions, slice_index = np.unique(distance, return_inverse=True)
+    slice_index = slice_index.reshape(-1)
+    counts = np.bincount(slice_index)
+    if np.any(counts != counts[0]):
+        raise ValueError(
+            f"Slice positions have between {counts.min()} and {counts.max()} slices"
+        )
+    gradient = arrays["gradient"]
+    b_value = np.nan_to_num(arrays["b_value"], nan=-1)
+    # lexsort sorts by the last key first
+    order = np.lexsort(
+        (
+            arrays["frame"],
+            arrays["instance"],
+            arrays["temporal"],
+            gradient[:, 2],
+            gradient[:, 1],
+            gradient[:, 0],
+            b_value,
+            slice_index,
+        )
+    )
+    # Rank of each slice among the slices at the same position
+    volume_index = np.empty(len(order), dtype=int)
+    volume_index[order] = np.arange(len(order)) % counts[0]
+    grid = np.empty((counts[0], len(positions)), dtype=int)
+    grid[volume_index, slice_index] = np.arange(len(order))
+    return grid, positions
+
+
+def slice_affine(
+    orientation: np.ndarray,
+    pixel_spacing: np.ndarray,
+    first: np.ndarray,
+    last: np.ndarray,
+    n_slices: int,
+    slice_thickness: float = 1.0,
+) -> np.ndarray:
+    """
+    Return the affine mapping voxel indices to RAS+ millimetres.
+
+    :param orientation: The Image Orientation (Patient) of the slices.
+    :type orientation: numpy.ndarray
+    :param pixel_spacing: The Pixel Spacing of the slices, (rows, columns).
+    :type pixel_spacing: numpy.ndarray
+    :param first: The position of the first slice, in LPS millimetres.
+    :type first: numpy.ndarray
+    :param last: The position of the last slice, in LPS millimetres.
+    :type last: numpy.ndarray
+    :param n_slices: The number of slices.
+    :type n_slices: int
+    :param slice_thickness: The distance between slices when there is only one.
+    :type slice_thickness: float
+    :return: The 4x4 affine.
+    :rtype: numpy.ndarray
+    """
+    row_spacing, column_spacing = pixel_spacing
+    affine = np.eye(4)
+    affine[:3, 0] = orientation[:3] * column_spacing
+    affine[:3, 1] = orientation[3:] * row_spacing
+    if n_slices > 1:
+        affine[:3, 2] = (last - first) / (n_slices - 1)
+    else:
+        affine[:3, 2] = np.cross(orientation[:3], orientation[3:]) * slice_thickness
+    affine[:3, 3] = first
+    # DICOM patient coordinates are LPS+
+    return np.diag([-1.0, -1.0, 1.0, 1.0]) @ affine
+
 
 class MagneticResonanceProcedures(Procedures):
-    def __init__(self, mids_path, bodypart):
-        super().__init__(mids_path, bodypart)
-        self.reset()
-
-    def reset(self):
-        self.dicom_dict = {}
-
-    def generate_metadata(self, instance_list: list):
-        """Generate metadata from dicom files."""
-        dicom_jsons = []
-        ordered_instance_list = [
-            instance[1] for instance in sorted(instance_list, key=lambda x: x[0])
+    """Conversion logic for Magnetic Resonance procedures.
+
+    The slices of a series are grouped into one acquisition per echo, and
+    each acquisition is assembled from its header fields into a 3D volume or,
+    for diffusion and functional series, a 4D stack. Each acquisition is
+    written to a single NIfTI file, with `.bval`/`.bvec` files for diffusion,
+    by streaming one slice at a time from the DICOM files.
+    """
+
+    def __init__(
+        self,
+        mids_path: Path,
+        bodypart: str,
+        use_bodypart: bool,
+        use_viewposition: bool,
+        **kwargs,
+    ):
+        super().__init__(mids_path, bodypart, use_bodypart, use_viewposition, **kwargs)
+        self.scans_header = [
+            "ScanFile",
+            "BodyPart",
+            "SeriesNumber",
+            "AccessionNumber",
+            "Manufacturer",
+            "ManufacturerModelName",
+            "Modality",
+            "SeriesDescription",
+            "MagneticFieldStrength",
+            "ScanningSequence",
+            "RepetitionTime",
+            "EchoTime",
+            "Columns",
+            "Rows",
         ]
-        for instance in ordered_instance_list:
-            dicom_jsons.append(dictify(instance.load()))
-        for item in zip(*[items for items in [json.items() for json in dicom_jsons]]):
-            values = [i[1] for i in item]
-            print(values)
-            if len(set(values)) == 1:
-                dicom_dict[item[0][0]] = item[0][1]
-            else:
-                dicom_dict[item[0][0]] = values
-            print(dicom_dict[item[0][0]])
-
-    def classify_image_type(self):
-        pass
-
-    def control_session_image(self):
-        pass
-
-    def get_name(self):
-        pass
-
-    def run(self, instance_list: list):
-        self.generate_metadata(instance_list)
-        self.classify_image_type()
-        self.control_session_image()
-        self.get_name()
+
+    @staticmethod
+    def classify_image_type(
+        dataset: Dataset, arrays: Dict[str, np.ndarray], n_volumes: int
+    ) -> Tuple[str, Tuple[str, ...]]:
+        """
+        Classifies an acquisition as diffusion, functional or anatomical.
+
+        :param dataset: The header of a slice of the acquisition.
+        :type dataset: pydicom.Dataset
+        :param arrays: The header arrays of the acquisition.
+        :type arrays: Dict[str, numpy.ndarray]
+        :param n_volumes: The number of volumes of the acquisition.
+        :type n_volumes: int
+        :returns: A tuple containing the suffix and a tuple of labels for that type.
+        :rtype: tuple[str, tuple[str, ...]]
+        """
+        if not np.all(np.isnan(arrays["b_value"])):
+            return ("dwi", ("dwi",))
+        if n_volumes > 1:
+            return ("bold", ("func",))
+        description = str(dataset.get("SeriesDescription", "")) + " " + str(
+            dataset.get("ProtocolName", "")
+        )
+        for pattern, suffix in ANAT_SUFFIXES:
+            if pattern.search(description):
+                return (suffix, ("anat",))
+        return ("mr", ("anat",))
+
+    def get_name(
+        self,
+        dataset: Dataset,
+        modality: str,
+        mim: Tuple[str, ...],
+        echo: Optional[int] = None,
+    ) -> Tuple[Path, Path]:
+        """
+        Generates a name for an acquisition based on its metadata.
+
+        :param dataset: The dataset containing the image metadata.
+        :type dataset: pydicom.Dataset
+        :param modality: The suffix of the acquisition.
+        :type modality: str
+        :param mim: A tuple of labels to be included in the filepath.
+        :type mim: tuple[str, ...]
+        :param echo: The echo number, for multi-echo series.
+        :type echo: int, optional
+        :returns: The path of the acquisition, without extension, and the path of its session.
+        :rtype: tuple[pathlib.Path, pathlib.Path]
+        """
+
+        sub = f"sub-{dataset.PatientID}"
+        ses = f"ses-{dataset.StudyID}"
+        run = (
+            f"run-{dataset.SeriesNumber}"
+            if dataset.data_element("SeriesNumber")
+            else ""
+        )
+        if self.use_bodypart:
+            bp = (
+                f"bp-{dataset.BodyPartExamined}"
+                if "BodyPartExamined" in dataset
+                else f"bp-{self.bodypart}"
+            )
+        else:
+            bp = ""
+        echo_part = f"echo-{echo}" if echo is not None else ""
+        filename = "_".join(
+            [part for part in [sub, ses, run, bp, echo_part, modality] if part != ""]
+        )
+        return (
+            self.mids_path.joinpath(sub, ses, *mim, filename),
+            self.mids_path.joinpath(sub, ses),
+        )
+
+    def convert_acquisition(
+        self,
+        instances: List[FileInstance],
+        header: Dataset,
+        arrays: Dict[str, np.ndarray],
+        grid: np.ndarray,
+        positions: np.ndarray,
+        file_path_mids: Path,
+    ):
+        """
+        Writes an acquisition to a NIfTI file, one slice at a time.
+
+        :param instances: The DICOM instances of the series.
+        :type instances: List[pydicom.fileset.FileInstance]
+        :param header: The header of an instance of the acquisition.
+        :type header: pydicom.Dataset
+        :param arrays: The header arrays of the acquisition.
+        :type arrays: Dict[str, numpy.ndarray]
+        :param grid: The index of each slice, of shape (volumes, slices).
+        :type grid: numpy.ndarray
+        :param positions: The sorted slice positions along the normal.
+        :type positions: numpy.ndarray
+        :param file_path_mids: The path where the acquisition will be saved.
+        :type file_path_mids: pathlib.Path
+        """
+        n_volumes, n_slices = grid.shape
+        slope, intercept = arrays["slope"], arrays["intercept"]
+        # Store the raw values unless the rescale changes between slices
+        rescale = np.ptp(slope) > 0 or np.ptp(intercept) > 0
+        dtype = np.dtype(np.float32) if rescale else pixel_dtype(header)
+        first, last = arrays["position"][grid[0, 0]], arrays["position"][grid[0, -1]]
+        thickness = float(header.get("SliceThickness") or 1.0)
+        spacing = np.linalg.norm(last - first) / (n_slices - 1) if n_slices > 1 else thickness
+        repetition_time = is_enhanced(header) and EnhancedFrames(header).repetition_time
+        repetition_time = repetition_time or float(header.get("RepetitionTime") or 0)
+        reader: Optional[FrameReader] = None
+        reader_path = None
+        with self.writer.open(file_path_mids) as f, self.writer.encoding.compress(f) as gz:
+            nifti = NiftiStreamWriter(
+                gz,
+                frame_shape(header),
+                grid.size,
+                dtype,
+                arrays["spacing"][grid[0, 0]],
+                repetition_time / 1000,
+                spacing,
+                (1.0, 0.0) if rescale else (slope[0], intercept[0]),
+                n_volumes,
+                slice_affine(
+                    arrays["orientation"][grid[0, 0]],
+                    arrays["spacing"][grid[0, 0]],
+                    first,
+                    last,
+                    n_slices,
+                    thickness,
+                ),
+            )
+            try:
+                for index in grid.ravel():
+                    # Frames of a multi-frame instance are read from the same reader
+                    instance = instances[arrays["file"][index]]
+                    if reader is None or reader_path != instance.path:
+                        if reader is not None:
+                            reader.close()
+                        reader = FrameReader(instance_file(instance), self.decoder)
+                        reader_path = instance.path
+                    frame = reader.read(int(arrays["frame"][index]))
+                    if rescale:
+                        frame = frame * np.float32(slope[index]) + np.float32(intercept[index])
+                    nifti.write(frame)
+            finally:
+                if reader is not None:
+                    reader.close()
+            nifti.close()
+        logger.debug(
+            "%d volumes of %d slices from %.1f to %.1f mm",
+            n_volumes,
+            n_slices,
+            positions[0],
+            positions[-1],
+        )
+
+    def convert_gradients(
+        self, arrays: Dict[str, np.ndarray], grid: np.ndarray, file_path_mids: Path
+    ):
+        """
+        Writes the b-values and gradient directions of each volume in FSL format.
+
+        The gradient directions are projected from patient coordinates onto
+        the voxel axes of the NIfTI image: the row and column directions, and
+        the slice direction of the sorted stack, as in its affine. Following
+        FSL, the x component is flipped when the determinant of the affine is
+        positive.
+
+        :param arrays: The header arrays of the acquisition.
+        :type arrays: Dict[str, numpy.ndarray]
+        :param grid: The index of each slice, of shape (volumes, slices).
+        :type grid: numpy.ndarray
+        :param file_path_mids: The path of the acquisition, without extension.
+        :type file_path_mids: pathlib.Path
+        """
+        volumes = grid[:, 0]
+        b_values = np.nan_to_num(arrays["b_value"][volumes], nan=0.0)
+        orientation = arrays["orientation"][grid[0, 0]]
+        if grid.shape[1] > 1:
+            slice_direction = arrays["position"][grid[0, -1]] - arrays["position"][grid[0, 0]]
+        else:
+            slice_direction = np.cross(orientation[:3], orientation[3:])
+        rotation = np.column_stack(
+            [orientation[:3], orientation[3:], slice_direction / np.linalg.norm(slice_direction)]
+        )
+        vectors = arrays["gradient"][volumes] @ rotation
+        # The LPS to RAS flip of the affine does not change the sign of its determinant
+        if np.linalg.det(rotation) > 0:
+            vectors[:, 0] = -vectors[:, 0]
+        self.writer.write_text(
+            file_path_mids.with_suffix(".bval"),
+            " ".join(f"{b:g}" for b in b_values) + "\n",
+        )
+        self.writer.write_text(
+            file_path_mids.with_suffix(".bvec"),
+            "\n".join(" ".join(f"{v:.6f}" for v in axis) for axis in vectors.T) + "\n",
+        )
+
+    def get_scan_metadata(self, dataset, file_path_mids):
+        subs = lambda s: re.sub(r"(?<!^)(?=[A-Z])", "_", s).lower()
+        return {
+            subs(key): value
+            for key, value in zip(
+                self.scans_header,
+                [
+                    str(file_path_mids),
+                    (
+                        dataset.BodyPartExamined
+                        if "BodyPartExamined" in dataset
+                        else self.bodypart
+                    ),
+                    *[
+                        (dataset[i].value if i in dataset else "n/a")
+                        for i in self.scans_header[2:]
+                    ],
+                ],
+            )
+        }
+
+    def run(self, instance_list: List[FileInstance]):
+        """
+        Runs the MR conversion pipeline on the slices of a series.
+
+        Only the headers are read up front; the pixel data of each slice is
+        read when it is written, so memory use does not grow with the series.
+        Enhanced multi-frame instances are assembled from the geometry of
+        their functional groups. When the output profile disables images, no
+        pixel data is read at all.
+
+        :param instance_list: The DICOM instances of the series.
+        :type instance_list: list[pydicom.fileset.FileInstance]
+        """
+
+        self.use_chunk = False
+        self.select_profile(instance_list)
+        headers = [dcmread(instance.path, stop_before_pixels=True) for instance in instance_list]
+        arrays = header_arrays(headers)
+        # Echoes are told apart by their number and their time, as some
+        # scanners number every echo 1
+        echoes, first_rows, echo_index = np.unique(
+            np.column_stack([arrays["echo"], arrays["echo_time"]]),
+            axis=0,
+            return_index=True,
+            return_inverse=True,
+        )
+        echo_index = echo_index.reshape(-1)
+        numbers = echoes[:, 0].astype(int)
+        labels = numbers if len(set(numbers)) == len(numbers) else np.arange(1, len(echoes) + 1)
+        # Only keep the header of the first instance of each echo
+        first_header = [headers[arrays["file"][row]] for row in first_rows]
+        del headers
+        list_scan_metadata = []
+        for echo, label in enumerate(labels):
+            selected = np.flatnonzero(echo_index == echo)
+            header = first_header[echo]
+            echo_arrays = {key: value[selected] for key, value in arrays.items()}
+            orientation = echo_arrays["orientation"][0]
+            try:
+                grid, positions = assemble_volumes(
+                    echo_arrays, np.cross(orientation[:3], orientation[3:])
+                )
+            except ValueError as error:
+                logger.warning(
+                    "Series %s can not be assembled into volumes: %s",
+                    header.get("SeriesInstanceUID"),
+                    error,
+                )
+                continue
+            modality, mim = self.classify_image_type(header, echo_arrays, grid.shape[0])
+            file_path_mids, session_absolute_path_mids = self.get_name(
+                header, modality, mim, int(label) if len(echoes) > 1 else None
+            )
+            if self.profile.image:
+                self.convert_acquisition(
+                    instance_list,
+                    header,
+                    echo_arrays,
+                    grid,
+                    positions,
+                    file_path_mids.with_suffix(self.writer.encoding.nifti_suffix),
+                )
+                if modality == "dwi":
+                    self.convert_gradients(echo_arrays, grid, file_path_mids)
+            self.convert_to_jsonfile(header, file_path_mids.with_suffix(".json"))
+            file_path_relative_mids = file_path_mids.relative_to(
+                session_absolute_path_mids
+            ).with_suffix(self.writer.encoding.nifti_suffix)
+            list_scan_metadata.append(
+                self.get_scan_metadata(header, self.scan_path(file_path_relative_mids))
+            )
+            logger.info("Saved to %s", file_path_relative_mids.name)
+        return list_scan_metadata
@@ -0,0 +1,182 @@
+import logging
+import struct
+from typing import BinaryIO, Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger("dcm2mids").getChild("nifti")
+
+# NIfTI-1 header, see https://nifti.nimh.nih.gov/pub/dist/src/niftilib/nifti1.h
+NIFTI1_HEADER = struct.Struct("<i10s18sihcc8h3fhhhh8ffffhccffffii80s24shh6f4f4f4f16s4s")
+
+# Header followed by an empty extension flag
+NIFTI1_VOX_OFFSET = NIFTI1_HEADER.size + 4
+
+NIFTI_DATATYPES = {
+    np.dtype("uint8"): 2,
+    np.dtype("int16"): 4,
+    np.dtype("int32"): 8,
+    np.dtype("float32"): 16,
+    np.dtype("float64"): 64,
+    np.dtype("int8"): 256,
+    np.dtype("uint16"): 512,
+    np.dtype("uint32"): 768,
+}
+NIFTI_RGB24 = 128
+
+# xyzt_units: millimetres and seconds
+NIFTI_UNITS_MM_SEC = 2 | 8
+
+
+class NiftiStreamWriter:
+    """Write a NIfTI-1 image one frame at a time.
+
+    Frames are stacked along time (a 2D+t series) or, when `slice_spacing` is
+    given, along z (a 3D volume, or a 4D series of `n_volumes` volumes whose
+    frames are written volume after volume). The header only depends on the frame shape
+    and count, so it is written first and each frame is appended as soon as
+    it is decoded: the whole series is never held in memory.
+
+    :param f: The output file, opened in binary mode (e.g. a `gzip.GzipFile`).
+    :type f: BinaryIO
+    :param frame_shape: The shape of each frame, (rows, columns) or (rows, columns, 3).
+    :type frame_shape: Tuple[int, ...]
+    :param n_frames: The number of frames.
+    :type n_frames: int
+    :param dtype: The data type of the frames. RGB frames must be uint8.
+    :type dtype: numpy.dtype
+    :param spacing: The pixel spacing in mm, (rows, columns).
+    :type spacing: Sequence[float]
+    :param frame_time: The time between frames in seconds.
+    :type frame_time: float
+    :param slice_spacing: Stack the frames as slices this far apart, in mm,
+        instead of as time points.
+    :type slice_spacing: float, optional
+    :param scale: The slope and intercept mapping stored values to real values.
+    :type scale: Tuple[float, float]
+    :param n_volumes: The number of volumes the slices are split into.
+    :type n_volumes: int
+    :param affine: The 4x4 matrix mapping voxel indices (column, row, frame)
+        to RAS+ millimetres. The identity rotation is used if None.
+    :type affine: numpy.ndarray, optional
+    """
+
+    def __init__(
+        self,
+        f: BinaryIO,
+        frame_shape: Tuple[int, ...],
+        n_frames: int,
+        dtype: np.dtype,
+        spacing: Sequence[float] = (1.0, 1.0),
+        frame_time: float = 0.0,
+        slice_spacing: Optional[float] = None,
+        scale: Tuple[float, float] = (1.0, 0.0),
+        n_volumes: int = 1,
+        affine: Optional[np.ndarray] = None,
+    ):
+        self.f = f
+        self.frame_shape = tuple(frame_shape)
+        self.n_frames = n_frames
+        self.dtype = np.dtype(dtype).newbyteorder("<")
+        self.spacing = spacing
+        self.frame_time = frame_time
+        self.slice_spacing = slice_spacing
+        self.scale = scale
+        self.n_volumes = n_volumes
+        self.affine = affine
+        self.frames_written = 0
+        if n_frames % n_volumes:
+            raise ValueError(f"{n_frames} frames can not be split into {n_volumes} volumes")
+        if len(self.frame_shape) == 3:
+            if self.frame_shape[2] != 3 or self.dtype != np.uint8:
+                raise ValueError("Only 8 bits RGB frames can be written to NIfTI")
+            self.datatype, self.bitpix = NIFTI_RGB24, 24
+        elif self.dtype.newbyteorder("=") in NIFTI_DATATYPES:
+            self.datatype = NIFTI_DATATYPES[self.dtype.newbyteorder("=")]
+            self.bitpix = self.dtype.itemsize * 8
+        else:
+            raise ValueError(f"Unsupported data type for NIfTI: {self.dtype}")
+        self.write_header()
+
+    def write_header(self):
+        rows, columns = self.frame_shape[:2]
+        row_spacing, column_spacing = (float(v) for v in self.spacing)
+        if self.slice_spacing is None:
+            dim = [4, columns, rows, 1, self.n_frames, 1, 1, 1]
+            pixdim = [1.0, column_spacing, row_spacing, 1.0, self.frame_time, 0.0, 0.0, 0.0]
+        else:
+            slices = self.n_frames // self.n_volumes
+            dim = [3 if self.n_volumes == 1 else 4, columns, rows, slices, self.n_volumes, 1, 1, 1]
+            pixdim = [
+                1.0, column_spacing, row_spacing, float(self.slice_spacing),
+                self.frame_time, 0.0, 0.0, 0.0,
+            ]
+        if self.affine is None:
+            # Scanner-based qform with the identity rotation
+            qform_code, sform_code = 1, 0
+            srow = [0.0] * 12
+        else:
+            # Scanner-based sform, which readers use when there is no qform
+            qform_code, sform_code = 0, 1
+            srow = [float(v) for v in np.asarray(self.affine)[:3].ravel()]
+        header = NIFTI1_HEADER.pack(
+            NIFTI1_HEADER.size,
+            b"",
+            b"",
+            0,
+            0,
+            b"r",
+            b"\0",
+            *dim,
+            0.0, 0.0, 0.0,
+            0,
+            self.datatype,
+            self.bitpix,
+            0,
+            # qfac, then voxel sizes and the time step
+            *pixdim,
+            float(NIFTI1_VOX_OFFSET),
+            float(self.scale[0]),
+            float(self.scale[1]),
+            0,
+            b"\0",
+            bytes([NIFTI_UNITS_MM_SEC]),
+            0.0,
+            0.0,
+            0.0,
+            0.0,
+            0,
+            0,
+            b"dcm2mids",
+            b"",
+            qform_code,
+            sform_code,
+            0.0, 0.0, 0.0, 0.0, 0.0, 0.0,
+            *srow,
+            b"",
+            b"n+1\0",
+        )
+        self.f.write(header + b"\0\0\0\0")
+
+    def write(self, frame: np.ndarray):
+        """
+        Append a frame.
+
+        :param frame: The frame, with the shape and data type given to the writer.
+        :type frame: numpy.ndarray
+        :raises ValueError: If the frame has the wrong shape or all the frames were written.
+        """
+        if frame.shape != self.frame_shape:
+            raise ValueError(f"Expected a frame of shape {self.frame_shape}, got {frame.shape}")
+        if self.frames_written == self.n_frames:
+            raise ValueError(f"All the {self.n_frames} frames were already written")
+        # Written from the buffer of the frame, which may be a view of a mapped file
+        self.f.write(memoryview(np.ascontiguousarray(frame, dtype=self.dtype)).cast("B"))
+        self.frames_written += 1
+
+    def close(self):
+        """Check that every frame was written."""
+        if self.frames_written != self.n_frames:
+            raise ValueError(
+                f"Only {self.frames_written} of {self.n_frames} frames were written"
+            )
@@ -0,0 +1 @@
+from .nuclear_medicine_procedure import NuclearMedicineProcedures
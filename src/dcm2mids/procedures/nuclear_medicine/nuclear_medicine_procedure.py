@@ -0,0 +1,321 @@
+import logging
+import re
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from pydicom import Dataset, dcmread
+from pydicom.datadict import keyword_for_tag
+from pydicom.fileset import FileInstance
+
+from ..nifti import NiftiStreamWriter
+from ..pixel_data import FrameReader, instance_file
+from ..procedures import Procedures
+
+logger = logging.getLogger("dcm2mids").getChild("nuclear_medicine_procedure")
+
+# Entity used in the file name for each Frame Increment Pointer vector
+NM_VECTORS = {
+    "EnergyWindowVector": "ew",
+    "DetectorVector": "det",
+    "PhaseVector": "phase",
+    "RotationVector": "rot",
+    "RRIntervalVector": "rr",
+    "TimeSlotVector": "gate",
+    "SliceVector": "slice",
+    "AngularViewVector": "view",
+    "TimeSliceVector": "frame",
+}
+
+# Vectors stacked inside each volume, in order of preference. Frames with the
+# same value in every other vector make up one volume.
+VOLUME_AXES = ["SliceVector", "AngularViewVector", "TimeSliceVector", "TimeSlotVector"]
+
+
+def frame_vectors(dataset: Dataset) -> Dict[str, np.ndarray]:
+    """
+    Return the vectors indexed by the Frame Increment Pointer of a multi-frame dataset.
+
+    :param dataset: The dataset.
+    :type dataset: pydicom.Dataset
+    :return: The one-based index of each frame along each vector, by keyword.
+    :rtype: Dict[str, numpy.ndarray]
+    """
+    n_frames = int(dataset.get("NumberOfFrames", 1) or 1)
+    pointers = dataset.get("FrameIncrementPointer", [])
+    if isinstance(pointers, int):
+        pointers = [pointers]
+    vectors = {}
+    for tag in pointers:
+        keyword = keyword_for_tag(tag)
+        if keyword not in NM_VECTORS:
+            logger.debug("Ignoring frame increment pointer %s", keyword or tag)
+            continue
+        if tag not in dataset:
+            logger.warning("Frame increment pointer %s is missing from the dataset", keyword)
+            continue
+        vector = np.atleast_1d(np.asarray(dataset[tag].value, dtype=int))
+        if len(vector) != n_frames:
+            logger.warning(
+                "%s has %d values for %d frames, ignoring it", keyword, len(vector), n_frames
+            )
+            continue
+        vectors[keyword] = vector
+    return vectors
+
+
+def split_frames(
+    dataset: Dataset,
+) -> Tuple[Optional[str], List[Tuple[Dict[str, int], np.ndarray]]]:
+    """
+    Group the frames of a multi-frame NM dataset into volumes.
+
+    The frames are grouped by the combination of their values in every vector
+    but the volume axis, and sorted along the volume axis within each group,
+    with array operations over all the frames at once.
+
+    :param dataset: The dataset.
+    :type dataset: pydicom.Dataset
+    :return: The keyword of the volume axis (None if there is none) and, for
+        each volume, the vector values identifying it and the zero-based indices
+        of its frames in order.
+    :rtype: Tuple[Optional[str], List[Tuple[Dict[str, int], numpy.ndarray]]]
+    """
+    n_frames = int(dataset.get("NumberOfFrames", 1) or 1)
+    vectors = frame_vectors(dataset)
+    axis = next((keyword for keyword in VOLUME_AXES if keyword in vectors), None)
+    group_keys = [keyword for keyword in vectors if keyword != axis]
+    if group_keys:
+        table = np.column_stack([vectors[keyword] for keyword in group_keys])
+        groups, inverse = np.unique(table, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+    else:
+        groups = np.empty((1, 0), dtype=int)
+        inverse = np.zeros(n_frames, dtype=int)
+    axis_values = vectors[axis] if axis else np.zeros(n_frames, dtype=int)
+    # Sort by group, then along the axis, keeping the file order for ties
+    order = np.lexsort((np.arange(n_frames), axis_values, inverse))
+    bounds = np.flatnonzero(np.diff(inverse[order])) + 1
+    volumes = [
+        ({key: int(value) for key, value in zip(group_keys, groups[inverse[frames[0]]])}, frames)
+        for frames in np.split(order, bounds)
+    ]
+    return axis, volumes
+
+
+class NuclearMedicineProcedures(Procedures):
+    """Conversion logic for Nuclear Medicine procedures.
+
+    NM multi-frame instances pack detectors, energy windows, rotations, phases
+    and gates into a single frame sequence described by the Frame Increment
+    Pointer vectors. Each instance is split into one NIfTI volume per
+    combination of those dimensions, streamed from the DICOM file in chunks
+    of consecutive frames.
+    """
+
+    def __init__(
+        self,
+        mids_path: Path,
+        bodypart: str,
+        use_bodypart: bool,
+        use_viewposition: bool,
+        **kwargs,
+    ):
+        super().__init__(mids_path, bodypart, use_bodypart, use_viewposition, **kwargs)
+        self.scans_header = [
+            "ScanFile",
+            "BodyPart",
+            "SeriesNumber",
+            "AccessionNumber",
+            "Manufacturer",
+            "ManufacturerModelName",
+            "Modality",
+            "Columns",
+            "Rows",
+            "SeriesDescription",
+            "NumberOfDetectors",
+            "NumberOfEnergyWindows",
+        ]
+
+    def get_name(
+        self, dataset: Dataset, entities: Dict[str, int], mim: Tuple[str, ...] = ("mim-nm",)
+    ) -> Tuple[Path, Path]:
+        """
+        Generates a name for a volume based on its metadata.
+
+        :param dataset: The dataset containing the image metadata.
+        :type dataset: pydicom.Dataset
+        :param entities: The vector values identifying the volume in the instance.
+        :type entities: Dict[str, int]
+        :param mim: A tuple of labels to be included in the filepath.
+        :type mim: tuple[str, ...]
+        :returns: The path of the volume, without extension, and the path of its session.
+        :rtype: tuple[pathlib.Path, pathlib.Path]
+        """
+
+        sub = f"sub-{dataset.PatientID}"
+        ses = f"ses-{dataset.StudyID}"
+        run = (
+            f"run-{dataset.SeriesNumber}"
+            if dataset.data_element("SeriesNumber")
+            else ""
+        )
+        if self.use_bodypart:
+            bp = (
+                f"bp-{dataset.BodyPartExamined}"
+                if "BodyPartExamined" in dataset
+                else f"bp-{self.bodypart}"
+            )
+        else:
+            bp = ""
+        chunk = (
+            f"chunk-{dataset.InstanceNumber}"
+            if dataset.data_element("InstanceNumber") and self.use_chunk
+            else ""
+        )
+        dims = [f"{NM_VECTORS[keyword]}-{value}" for keyword, value in entities.items()]
+        filename = "_".join(
+            [part for part in [sub, ses, run, bp, chunk, *dims, "nm"] if part != ""]
+        )
+        return (
+            self.mids_path.joinpath(sub, ses, *mim, filename),
+            self.mids_path.joinpath(sub, ses),
+        )
+
+    @staticmethod
+    def frame_duration(dataset: Dataset, entities: Dict[str, int]) -> float:
+        """Return the duration of each frame of a volume in seconds, 0 if unknown."""
+        phases = dataset.get("PhaseInformationSequence", [])
+        phase = entities.get("PhaseVector")
+        if (
+            phase is not None
+            and 0 < phase <= len(phases)
+            and phases[phase - 1].get("ActualFrameDuration")
+        ):
+            return float(phases[phase - 1].ActualFrameDuration) / 1000
+        if dataset.get("ActualFrameDuration"):
+            return float(dataset.ActualFrameDuration) / 1000
+        return 0.0
+
+    def convert_volume(
+        self,
+        reader: FrameReader,
+        axis: Optional[str],
+        entities: Dict[str, int],
+        frames: np.ndarray,
+        file_path_mids: Path,
+    ):
+        """
+        Writes the frames of one volume to a NIfTI file, reading them in chunks.
+
+        :param reader: The reader of the instance.
+        :type reader: dcm2mids.procedures.pixel_data.FrameReader
+        :param axis: The vector along which the frames are stacked.
+        :type axis: Optional[str]
+        :param entities: The vector values identifying the volume.
+        :type entities: Dict[str, int]
+        :param frames: The zero-based indices of the frames, in order.
+        :type frames: numpy.ndarray
+        :param file_path_mids: The path where the volume will be saved.
+        :type file_path_mids: pathlib.Path
+        """
+        dataset = reader.dataset
+        spacing = [float(v) for v in dataset.get("PixelSpacing", [1.0, 1.0])]
+        slice_spacing = None
+        if axis == "SliceVector":
+            slice_spacing = float(
+                dataset.get("SpacingBetweenSlices") or dataset.get("SliceThickness") or 1.0
+            )
+        scale = (
+            float(dataset.get("RescaleSlope", 1) or 1),
+            float(dataset.get("RescaleIntercept", 0) or 0),
+        )
+        with self.writer.open(file_path_mids) as f, self.writer.encoding.compress(f) as gz:
+            nifti = NiftiStreamWriter(
+                gz,
+                reader.shape,
+                len(frames),
+                reader.dtype,
+                spacing,
+                self.frame_duration(dataset, entities),
+                slice_spacing,
+                scale,
+            )
+            for frame in reader.iter_frames(frames):
+                nifti.write(frame)
+            nifti.close()
+
+    def get_scan_metadata(self, dataset, file_path_mids):
+        subs = lambda s: re.sub(r"(?<!^)(?=[A-Z])", "_", s).lower()
+        return {
+            subs(key): value
+            for key, value in zip(
+                self.scans_header,
+                [
+                    str(file_path_mids),
+                    (
+                        dataset.BodyPartExamined
+                        if "BodyPartExamined" in dataset
+                        else self.bodypart
+                    ),
+                    *[
+                        (dataset[i].value if i in dataset else "n/a")
+                        for i in self.scans_header[2:]
+                    ],
+                ],
+            )
+        }
+
+    def run(self, instance_list: List[FileInstance]):
+        """
+        Runs the image conversion pipeline on a list of instances.
+
+        :param instance_list: The DICOM instances of the series.
+        :type instance_list: list[pydicom.fileset.FileInstance]
+        """
+
+        self.use_chunk = len(instance_list) > 1
+        self.select_profile(instance_list)
+        list_scan_metadata = []
+        for instance in instance_list:
+            # Without images, only the header is read
+            reader = FrameReader(instance_file(instance), self.decoder) if self.profile.image else None
+            try:
+                # Named from the staged header, which has the StudyID and
+                # SeriesNumber the TSVs use
+                header = dcmread(instance.path, stop_before_pixels=True)
+                axis, volumes = split_frames(header)
+                logger.debug(
+                    "%d frames split into %d volumes along %s",
+                    int(header.get("NumberOfFrames") or 1),
+                    len(volumes),
+                    axis,
+                )
+                for entities, frames in volumes:
+                    file_path_mids, session_absolute_path_mids = self.get_name(
+                        header, entities
+                    )
+                    if reader is not None:
+                        self.convert_volume(
+                            reader,
+                            axis,
+                            entities,
+                            frames,
+                            file_path_mids.with_suffix(self.writer.encoding.nifti_suffix),
+                        )
+                    self.convert_to_jsonfile(header, file_path_mids.with_suffix(".json"))
+                    file_path_relative_mids = file_path_mids.relative_to(
+                        session_absolute_path_mids
+                    ).with_suffix(self.writer.encoding.nifti_suffix)
+                    list_scan_metadata.append(
+                        self.get_scan_metadata(header, self.scan_path(file_path_relative_mids))
+                    )
+                    logger.info("Saved to %s", file_path_relative_mids.name)
+            finally:
+                if reader is not None:
+                    reader.close()
+            logger.info(
+                "Successfully processed instance %s",
+                instance.path,
+            )
+        return list_scan_metadata
@@ -0,0 +1,402 @@
+import logging
+import os
+import struct
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, BinaryIO, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from pydicom import Dataset, dcmread
+from pydicom.encaps import encapsulate
+from pydicom.pixel_data_handlers.util import pixel_dtype
+from pydicom.uid import DeflatedExplicitVRLittleEndian
+
+logger = logging.getLogger("dcm2mids").getChild("pixel_data")
+
+PIXEL_DATA_TAG = 0x7FE00010
+
+# Length of an element with undefined length, as encapsulated pixel data
+UNDEFINED_LENGTH = 0xFFFFFFFF
+
+# The path of an instance, or its contents read in memory from an archive
+InstanceFile = Union[Path, str, BinaryIO]
+
+
+def instance_file(instance: Any) -> InstanceFile:
+    """
+    Return the file the pixel data of an instance is read from.
+
+    Instances staged from an archive or a gzip file hold their header only;
+    their whole file is read again, in memory, from their `source`.
+
+    :param instance: A FileInstance or IndexedInstance.
+    :type instance: pydicom.fileset.FileInstance
+    :return: The path of the instance, or its contents.
+    :rtype: Union[pathlib.Path, str, BinaryIO]
+    """
+    source = getattr(instance, "source", None)
+    if source is None:
+        return instance.path
+    return source.open()
+
+
+def load_instance(instance: Any) -> Dataset:
+    """
+    Load the dataset of an instance, with its pixel data.
+
+    For an instance staged without its pixel data, the staged header, with the
+    keys filled in when it was staged, is completed from its `source`.
+
+    :param instance: A FileInstance or IndexedInstance.
+    :type instance: pydicom.fileset.FileInstance
+    :return: The dataset.
+    :rtype: pydicom.Dataset
+    """
+    if getattr(instance, "source", None) is None:
+        return instance.load()
+    dataset = dcmread(instance_file(instance))
+    dataset.update(instance.load())
+    return dataset
+
+
+@contextmanager
+def _open(path: InstanceFile) -> Iterator[BinaryIO]:
+    if isinstance(path, (str, os.PathLike)):
+        with open(path, "rb") as f:
+            yield f
+    else:
+        path.seek(0)
+        yield path
+
+
+def locate_pixel_data(path: InstanceFile) -> Tuple[Dataset, int, Optional[int]]:
+    """
+    Read the header of an instance and find where its pixel data starts, without reading it.
+
+    :param path: The path of the instance, or its contents.
+    :type path: Union[pathlib.Path, str, BinaryIO]
+    :return: The dataset without its pixel data, the file offset of the value of
+        the Pixel Data element, and its length (None for encapsulated pixel data).
+    :rtype: Tuple[pydicom.Dataset, int, Optional[int]]
+    :raises ValueError: If the instance has no pixel data, or if it is deflated
+        and the pixel data can not be located in the file.
+    """
+    with _open(path) as f:
+        # Reading stops right before the tag of the Pixel Data element
+        dataset = dcmread(f, stop_before_pixels=True)
+        if dataset.file_meta.get("TransferSyntaxUID") == DeflatedExplicitVRLittleEndian:
+            raise ValueError(f"{path} is deflated, its pixel data can not be streamed")
+        endian = "<" if dataset.is_little_endian else ">"
+        header = f.read(8 if dataset.is_implicit_VR else 12)
+        offset = f.tell()
+    if len(header) < 8:
+        raise ValueError(f"{path} has no pixel data")
+    group, element = struct.unpack(endian + "HH", header[:4])
+    if (group << 16 | element) != PIXEL_DATA_TAG:
+        raise ValueError(f"{path} has no pixel data")
+    if dataset.is_implicit_VR:
+        (length,) = struct.unpack(endian + "L", header[4:8])
+    else:
+        # OB and OW have two reserved bytes before a 4 bytes length
+        (length,) = struct.unpack(endian + "L", header[8:12])
+    return dataset, offset, None if length == UNDEFINED_LENGTH else length
+
+
+def map_native_pixels(
+    path: InstanceFile, offset: int, dtype: np.dtype, count: int
+) -> Optional[np.ndarray]:
+    """
+    Memory-map uncompressed pixel data, so it is only read from the file as it is used.
+
+    Contents already in memory are viewed instead, without being copied.
+
+    :param path: The path of the instance, or its contents.
+    :type path: Union[pathlib.Path, str, BinaryIO]
+    :param offset: The file offset of the pixel data.
+    :type offset: int
+    :param dtype: The data type of the pixels.
+    :type dtype: numpy.dtype
+    :param count: The number of pixel values (samples included) of all the frames.
+    :type count: int
+    :return: A read-only flat view of the pixel data, or None if it can not be
+        mapped, e.g. if the file is shorter than the pixel data.
+    :rtype: Optional[numpy.ndarray]
+    """
+    try:
+        if not isinstance(path, (str, os.PathLike)):
+            return np.frombuffer(path.getvalue(), dtype=dtype, count=count, offset=offset)  # type: ignore[attr-defined]
+        return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(count,))
+    except (AttributeError, OSError, ValueError) as e:
+        logger.debug("Can not map the pixel data of %s: %s", path, e)
+        return None
+
+
+def map_pixels(path: InstanceFile) -> Tuple[Dataset, np.ndarray]:
+    """
+    Read the header of an uncompressed instance and map its pixel data, without copying it.
+
+    :param path: The path of the instance, or its contents.
+    :type path: Union[pathlib.Path, str, BinaryIO]
+    :return: The dataset without its pixel data, and a read-only view of the
+        pixels with the same shape as `Dataset.pixel_array`.
+    :rtype: Tuple[pydicom.Dataset, numpy.ndarray]
+    :raises ValueError: If the pixel data is compressed, big endian, bit-packed,
+        subsampled or can not be mapped.
+    """
+    dataset, offset, length = locate_pixel_data(path)
+    if length is None:
+        raise ValueError(f"{path}: compressed pixel data can not be mapped")
+    if not dataset.is_little_endian:
+        raise ValueError(f"{path}: big endian pixel data can not be mapped")
+    if int(dataset.BitsAllocated) % 8:
+        raise ValueError(f"{path}: bit-packed pixel data can not be mapped")
+    if str(dataset.get("PhotometricInterpretation", "")).endswith("_422"):
+        raise ValueError(f"{path}: subsampled pixel data can not be mapped")
+    n_frames = int(dataset.get("NumberOfFrames", 1) or 1)
+    shape = frame_shape(dataset)
+    pixels = map_native_pixels(path, offset, pixel_dtype(dataset), n_frames * int(np.prod(shape)))
+    if pixels is None:
+        raise ValueError(f"{path}: the pixel data can not be mapped")
+    pixels = reshape_frames(pixels, dataset)
+    return dataset, pixels if n_frames > 1 else pixels[0]
+
+
+def frame_shape(dataset: Dataset) -> Tuple[int, ...]:
+    """Return the shape of a single frame, (rows, columns) or (rows, columns, samples)."""
+    samples = int(dataset.get("SamplesPerPixel", 1) or 1)
+    shape: Tuple[int, ...] = (int(dataset.Rows), int(dataset.Columns))
+    return shape + (samples,) if samples > 1 else shape
+
+
+def reshape_frames(pixels: np.ndarray, dataset: Dataset) -> np.ndarray:
+    """Reshape flat uncompressed pixels to (frames, rows, columns[, samples]), as views."""
+    shape = frame_shape(dataset)
+    if len(shape) == 3 and int(dataset.get("PlanarConfiguration", 0) or 0) == 1:
+        return pixels.reshape(-1, shape[2], shape[0], shape[1]).transpose(0, 2, 3, 1)
+    return pixels.reshape((-1,) + shape)
+
+
+# Item tag (FFFE,E000) and sequence delimiter tag (FFFE,E0DD) of encapsulated pixel data
+ITEM_TAG = 0xFFFEE000
+SEQUENCE_DELIMITER_TAG = 0xFFFEE0DD
+
+# Default number of consecutive uncompressed frames read at once
+CHUNK_FRAMES = 64
+
+
+class FrameReader:
+    """Random access to the frames of an instance, without reading all the pixel data.
+
+    Uncompressed frames are memory-mapped, so they are returned as read-only
+    views of the file without being copied, or read at their offset in the
+    file, in chunks of consecutive frames, if the file can not be mapped.
+    For encapsulated pixel data, the position of every fragment is indexed
+    once by skipping over them, and each frame is then read and decoded on
+    its own.
+
+    :param path: The path of the instance, or its contents.
+    :type path: Union[pathlib.Path, str, BinaryIO]
+    :param decoder: Decoder whose backends are used for compressed frames. Frames
+        are decoded with pydicom if None, or if no backend can decode them.
+    :type decoder: dcm2mids.procedures.decoders.FrameDecoder, optional
+    :param mmap: Memory-map uncompressed pixel data.
+    :type mmap: bool
+    """
+
+    def __init__(self, path: InstanceFile, decoder=None, mmap: bool = True):
+        self.path = path
+        self.decoder = decoder
+        self.dataset, self.offset, self.length = locate_pixel_data(path)
+        self.n_frames = int(self.dataset.get("NumberOfFrames", 1) or 1)
+        self.shape = frame_shape(self.dataset)
+        self.dtype = pixel_dtype(self.dataset)
+        self._f = open(path, "rb") if isinstance(path, (str, os.PathLike)) else path
+        self._pixels: Optional[np.ndarray] = None
+        if self.length is None:
+            self._frames = self._index_fragments()
+        else:
+            if int(self.dataset.BitsAllocated) % 8:
+                raise ValueError("Bit-packed pixel data can not be read frame by frame")
+            self.frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+            if mmap:
+                self._pixels = map_native_pixels(
+                    path, self.offset, self.dtype, self.n_frames * int(np.prod(self.shape))
+                )
+
+    @property
+    def pixels(self) -> Optional[np.ndarray]:
+        """All the uncompressed frames as a read-only memory-mapped view, or None if not mapped."""
+        if self._pixels is None:
+            return None
+        return self._reshape(self._pixels)
+
+    def _index_fragments(self) -> List[List[Tuple[int, int]]]:
+        """Return the (offset, length) of the fragments of each frame."""
+        self._f.seek(self.offset)
+        tag, length = self._read_item_header()
+        if tag != ITEM_TAG:
+            raise ValueError(f"{self.path}: the pixel data has no Basic Offset Table")
+        offsets = list(struct.unpack(f"<{length // 4}L", self._f.read(length)))
+        fragments = []
+        while True:
+            tag, length = self._read_item_header()
+            if tag != ITEM_TAG:
+                break
+            fragments.append((self._f.tell(), length))
+            self._f.seek(length, 1)
+        if self.n_frames == 1:
+            return [fragments]
+        if offsets:
+            # Offsets are relative to the first fragment item, headers included
+            first = fragments[0][0] - 8
+            starts = np.searchsorted(
+                [position - 8 - first for position, _ in fragments], offsets
+            )
+            bounds = list(starts) + [len(fragments)]
+            return [fragments[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+        if len(fragments) == self.n_frames:
+            return [[fragment] for fragment in fragments]
+        raise ValueError(
+            f"{self.path}: {len(fragments)} fragments for {self.n_frames} frames "
+            "and no Basic Offset Table"
+        )
+
+    def _read_item_header(self) -> Tuple[int, int]:
+        header = self._f.read(8)
+        if len(header) < 8:
+            return SEQUENCE_DELIMITER_TAG, 0
+        group, element, length = struct.unpack("<HHL", header)
+        return group << 16 | element, length
+
+    def _reshape(self, frames: np.ndarray) -> np.ndarray:
+        return reshape_frames(frames, self.dataset)
+
+    def read(self, index: int) -> np.ndarray:
+        """
+        Read and decode a single frame.
+
+        :param index: The zero-based index of the frame.
+        :type index: int
+        :return: The frame, of shape (rows, columns) or (rows, columns, samples).
+        :rtype: numpy.ndarray
+        """
+        if not 0 <= index < self.n_frames:
+            raise IndexError(f"Frame {index} out of range for {self.n_frames} frames")
+        if self.length is not None:
+            return self._read_native(index, 1)[0]
+        frame = b"".join(self._read_at(position, length) for position, length in self._frames[index])
+        array = self.decoder.decode_frame(frame, self.dataset) if self.decoder else None
+        return array if array is not None else decode_frame(frame, self.dataset)
+
+    def _read_at(self, position: int, length: int) -> bytes:
+        self._f.seek(position)
+        return self._f.read(length)
+
+    def _read_native(self, index: int, count: int) -> np.ndarray:
+        if self._pixels is not None:
+            size = self.frame_bytes // self.dtype.itemsize
+            return self._reshape(self._pixels[index * size : (index + count) * size])
+        data = self._read_at(self.offset + index * self.frame_bytes, count * self.frame_bytes)
+        return self._reshape(np.frombuffer(data, dtype=self.dtype))
+
+    def iter_frames(
+        self, indices: Optional[Sequence[int]] = None, chunk_frames: int = CHUNK_FRAMES
+    ) -> Iterator[np.ndarray]:
+        """
+        Read frames one at a time, in the given order.
+
+        Runs of consecutive uncompressed frames are read with a single read
+        of at most `chunk_frames` frames.
+
+        :param indices: The zero-based indices of the frames. Defaults to all of them.
+        :type indices: Sequence[int], optional
+        :param chunk_frames: Maximum number of frames read at once.
+        :type chunk_frames: int
+        :return: An iterator over the frames.
+        :rtype: Iterator[numpy.ndarray]
+        """
+        indices = list(range(self.n_frames)) if indices is None else [int(i) for i in indices]
+        if self.length is None:
+            for index in indices:
+                yield self.read(index)
+            return
+        start = 0
+        while start < len(indices):
+            end = start + 1
+            while (
+                end < len(indices)
+                and end - start < chunk_frames
+                and indices[end] == indices[end - 1] + 1
+            ):
+                end += 1
+            yield from self._read_native(indices[start], end - start)
+            start = end
+
+    def close(self):
+        # The map is released once the views handed out are released too
+        self._pixels = None
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def decode_frame(frame: bytes, dataset: Dataset) -> np.ndarray:
+    """
+    Decode a single encapsulated frame with pydicom.
+
+    :param frame: The encoded frame.
+    :type frame: bytes
+    :param dataset: The header of the instance.
+    :type dataset: pydicom.Dataset
+    :return: The decoded frame.
+    :rtype: numpy.ndarray
+    """
+    single = Dataset()
+    single.file_meta = dataset.file_meta
+    single.is_little_endian = True
+    single.is_implicit_VR = False
+    for keyword in [
+        "Rows",
+        "Columns",
+        "SamplesPerPixel",
+        "BitsAllocated",
+        "BitsStored",
+        "HighBit",
+        "PixelRepresentation",
+        "PhotometricInterpretation",
+        "PlanarConfiguration",
+    ]:
+        if keyword in dataset:
+            setattr(single, keyword, dataset[keyword].value)
+    single.NumberOfFrames = 1
+    single.PixelData = encapsulate([frame])
+    single["PixelData"].VR = "OB"
+    single["PixelData"].is_undefined_length = True
+    return single.pixel_array
+
+
+def iter_frames(
+    path: InstanceFile, decoder=None
+) -> Tuple[Dataset, Iterator[np.ndarray]]:
+    """
+    Read the frames of an instance one at a time, never holding all of them in memory.
+
+    :param path: The path of the instance, or its contents.
+    :type path: Union[pathlib.Path, str, BinaryIO]
+    :param decoder: Decoder whose backends are used for compressed frames. Frames
+        are decoded with pydicom if None.
+    :type decoder: dcm2mids.procedures.decoders.FrameDecoder, optional
+    :return: The dataset without its pixel data, and an iterator over the frames.
+    :rtype: Tuple[pydicom.Dataset, Iterator[numpy.ndarray]]
+    """
+    reader = FrameReader(path, decoder)
+
+    def frames() -> Iterator[np.ndarray]:
+        with reader:
+            yield from reader.iter_frames()
+
+    return reader.dataset, frames()
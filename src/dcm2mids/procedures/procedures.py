@@ -2,12 +2,24 @@ import json
 import logging
 from abc import ABC, abstractmethod
 from pathlib import Path
+from typing import TYPE_CHECKING, Optional, Union
 
-from pydicom import Dataset
+import SimpleITK as sitk
+from pydicom import Dataset, dcmread
 
+from ..deduplicate import ContentStore, pixel_digest
+from ..profiles import OutputProfile, OutputProfiles
+from ..writers import FilesystemWriter, OutputWriter, output_discarded
+from .decoders import FrameDecoder, array_to_image
+from .pixel_data import load_instance
 from .dictify import dictify
 
+if TYPE_CHECKING:
+    from ..export_metadata import MetadataExporter
+
 logger = logging.getLogger("dcm2mids").getChild("procedures")
+
+
 class Procedures(ABC):
     def __init__(
         self,
@@ -15,11 +27,22 @@ class Procedures(ABC):
         bodypart: str,
         use_bodypart: bool,
         use_viewposition: bool,
+        content_store: Optional[ContentStore] = None,
+        decoder: Optional[FrameDecoder] = None,
+        writer: Optional[OutputWriter] = None,
+        metadata_exporter: Optional["MetadataExporter"] = None,
+        output_profiles: Optional[OutputProfiles] = None,
     ):
         self.mids_path = mids_path
         self.bodypart = bodypart
         self.use_bodypart = use_bodypart
         self.use_viewposition = use_viewposition
+        self.content_store = content_store
+        self.decoder = decoder
+        self.writer = writer or FilesystemWriter(mids_path)
+        self.metadata_exporter = metadata_exporter
+        self.output_profiles = output_profiles or OutputProfiles()
+        self.profile: OutputProfile = self.output_profiles.default
         self.use_chunk: bool
 
     # @abstractmethod
@@ -33,11 +56,102 @@ class Procedures(ABC):
     @abstractmethod
     def run(self):
         pass
-    
-    @staticmethod
-    def convert_to_jsonfile(dataset: Dataset, file_path_mids: Path):
+
+    def select_profile(self, instance_list) -> OutputProfile:
+        """
+        Select the output profile of a series, from the modality of its first instance.
+
+        :param instance_list: The DICOM instances of the series.
+        :type instance_list: list[pydicom.fileset.FileInstance]
+        :return: The profile, also kept in `self.profile` while the series is converted.
+        :rtype: dcm2mids.profiles.OutputProfile
+        """
+        self.profile = self.output_profiles.get(getattr(instance_list[0], "Modality", None))
+        return self.profile
+
+    def load_dataset(self, instance) -> Dataset:
         """
-        Convert a dataset to a JSON file.
+        Load the dataset of an instance, without its pixel data if no image is written.
+
+        :param instance: The DICOM instance.
+        :type instance: pydicom.fileset.FileInstance
+        :return: The dataset.
+        :rtype: pydicom.Dataset
+        """
+        if self.profile.image:
+            return load_instance(instance)
+        return dcmread(instance.path, stop_before_pixels=True)
+
+    def scan_path(self, file_path_relative_mids: Path) -> Union[Path, str]:
+        """
+        Return the file listed for a scan in the scans TSV.
+
+        Without images, the scan is listed by its sidecar instead, or as `n/a`
+        if no sidecar is written either, so the TSV never lists a missing file.
+
+        :param file_path_relative_mids: The path of the image, relative to its session.
+        :type file_path_relative_mids: pathlib.Path
+        :return: The path of the image or of the sidecar, or `n/a`.
+        :rtype: Union[pathlib.Path, str]
+        """
+        if self.profile.image:
+            return file_path_relative_mids
+        if self.profile.sidecar == "off":
+            return "n/a"
+        name = file_path_relative_mids.name
+        stem = name[: -len(".nii.gz")] if name.endswith(".nii.gz") else Path(name).stem
+        return file_path_relative_mids.with_name(stem + ".json")
+
+    def read_image(self, instance) -> sitk.Image:
+        """
+        Read the image of an instance.
+
+        Uses the parallel decoder when one is available, so compressed frames
+        are decoded in its thread pool; otherwise reads it with SimpleITK, or
+        with pydicom if it is read in memory from an archive.
+
+        :param instance: The DICOM image instance.
+        :type instance: pydicom.fileset.FileInstance
+        :return: The image.
+        :rtype: SimpleITK.Image
+        """
+        if self.decoder is None and getattr(instance, "source", None) is None:
+            return sitk.ReadImage(instance.path)
+        if self.decoder is None:
+            dataset = load_instance(instance)
+            return array_to_image(dataset.pixel_array, dataset)
+        dataset, array = self.decoder.read(instance)
+        return array_to_image(array, dataset)
+
+    def save_image(self, instance, dataset: Dataset, file_path_mids: Path):
+        """
+        Convert an instance to an image, unless the same content was already converted.
+
+        When a content store is available and an output file with the same
+        pixel data and extension exists, it is linked instead of re-encoded.
+
+        :param instance: The DICOM image instance.
+        :type instance: pydicom.fileset.FileInstance
+        :param dataset: The dataset loaded from the instance.
+        :type dataset: pydicom.Dataset
+        :param file_path_mids: The path where the converted image will be saved.
+        :type file_path_mids: pathlib.Path
+        """
+        if self.content_store is None:
+            self.convert_to_image(instance, file_path_mids)
+            return
+        digest = pixel_digest(dataset)
+        if not self.content_store.reuse(digest, file_path_mids):
+            self.convert_to_image(instance, file_path_mids)
+            # Nothing was written if the conversion was abandoned meanwhile
+            if not output_discarded():
+                self.content_store.add(digest, file_path_mids)
+
+    def convert_to_jsonfile(self, dataset: Dataset, file_path_mids: Path):
+        """
+        Convert a dataset to a JSON file, and export its header if an exporter is set.
+
+        The elements written, if any, are selected by the output profile of the series.
 
         :param dataset: The dataset to be converted.
         :type dataset: pydicom.Dataset
@@ -46,9 +160,10 @@ class Procedures(ABC):
         :return: None
         :rtype: None
         """
-        json_dict = dictify(dataset)
-        file_path_mids.parent.mkdir(parents=True, exist_ok=True)
-        with open(file_path_mids, "w") as f:
-            json.dump(json_dict, f, indent=4)
+        if self.profile.sidecar != "off":
+            json_dict = dictify(self.profile.sidecar_dataset(dataset))
+            self.writer.write_text(file_path_mids, json.dumps(json_dict, indent=4))
+        if self.metadata_exporter is not None:
+            self.metadata_exporter.add(dataset, file_path_mids)
+
 
-    
@@ -0,0 +1 @@
+from .ultrasound_procedure import UltrasoundProcedures
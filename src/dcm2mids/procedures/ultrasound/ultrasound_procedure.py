@@ -0,0 +1,256 @@
+import logging
+import re
+from pathlib import Path
+from typing import List, Tuple
+
+from pydicom import Dataset, dcmread
+from pydicom.fileset import FileInstance
+from pydicom.pixel_data_handlers.util import pixel_dtype
+
+from ..nifti import NiftiStreamWriter
+from ..pixel_data import frame_shape, instance_file, iter_frames
+from ..procedures import Procedures
+
+logger = logging.getLogger("dcm2mids").getChild("ultrasound_procedure")
+
+# PhysicalUnitsXDirection/PhysicalUnitsYDirection code for centimetres
+US_UNITS_CM = 3
+
+
+class UltrasoundProcedures(Procedures):
+    """Conversion logic for Ultrasound procedures.
+
+    Single-frame instances are converted to PNG. Multi-frame instances (cine
+    loops) are converted to a NIfTI time series, streamed one frame at a time
+    from the DICOM file to the output so that the whole cine is never held in
+    memory.
+    """
+
+    def __init__(
+        self,
+        mids_path: Path,
+        bodypart: str,
+        use_bodypart: bool,
+        use_viewposition: bool,
+        **kwargs,
+    ):
+        super().__init__(mids_path, bodypart, use_bodypart, use_viewposition, **kwargs)
+        self.scans_header = [
+            "ScanFile",
+            "BodyPart",
+            "SeriesNumber",
+            "AccessionNumber",
+            "Manufacturer",
+            "ManufacturerModelName",
+            "Modality",
+            "Columns",
+            "Rows",
+            "PhotometricInterpretation",
+            "NumberOfFrames",
+            "FrameTime",
+        ]
+
+    @staticmethod
+    def number_of_frames(dataset: Dataset) -> int:
+        return int(dataset.get("NumberOfFrames", 1) or 1)
+
+    def classify_image_type(self, dataset: Dataset) -> Tuple[str, Tuple[str, ...], str]:
+        """
+        Classifies an ultrasound image as a still image or a cine loop.
+
+        :param dataset: The dataset of the instance, pixel data excluded.
+        :type dataset: pydicom.Dataset
+        :returns: A tuple containing the image type, a tuple of labels for that
+            type and the extension of the converted file.
+        :rtype: tuple[str, tuple[str, ...], str]
+        """
+        if self.number_of_frames(dataset) > 1:
+            return ("us", ("mim-us",), self.writer.encoding.nifti_suffix)
+        return ("us", ("mim-us",), ".png")
+
+    def get_name(
+        self, dataset: Dataset, modality: str, mim: Tuple[str, ...]
+    ) -> Tuple[Path, Path]:
+        """
+        Generates a name for the image based on its metadata.
+
+        :param dataset: The dataset containing the image metadata.
+        :type dataset: pydicom.Dataset
+        :param modality: The modality of the image.
+        :type modality: str
+        :param mim: A tuple of labels to be included in the filepath.
+        :type mim: tuple[str, ...]
+        :returns: The path of the image, without extension, and the path of its session.
+        :rtype: tuple[pathlib.Path, pathlib.Path]
+        """
+
+        sub = f"sub-{dataset.PatientID}"
+        ses = f"ses-{dataset.StudyID}"
+        run = (
+            f"run-{dataset.SeriesNumber}"
+            if dataset.data_element("SeriesNumber")
+            else ""
+        )
+        if self.use_bodypart:
+            bp = (
+                f"bp-{dataset.BodyPartExamined}"
+                if "BodyPartExamined" in dataset
+                else f"bp-{self.bodypart}"
+            )
+        else:
+            bp = ""
+        lat = f"lat-{dataset.Laterality}" if dataset.data_element("Laterality") else ""
+        chunk = (
+            f"chunk-{dataset.InstanceNumber}"
+            if dataset.data_element("InstanceNumber") and self.use_chunk
+            else ""
+        )
+        filename = "_".join(
+            [part for part in [sub, ses, run, bp, lat, chunk, modality] if part != ""]
+        )
+        return (
+            self.mids_path.joinpath(sub, ses, *mim, filename),
+            self.mids_path.joinpath(sub, ses),
+        )
+
+    @staticmethod
+    def pixel_spacing(dataset: Dataset) -> Tuple[float, float]:
+        """
+        Return the pixel spacing in mm, (rows, columns).
+
+        Ultrasound stores it in the calibrated regions of the image, in cm,
+        rather than in Pixel Spacing.
+
+        :param dataset: The dataset of the instance.
+        :type dataset: pydicom.Dataset
+        :return: The spacing, (1.0, 1.0) if the image is not calibrated.
+        :rtype: Tuple[float, float]
+        """
+        for region in dataset.get("SequenceOfUltrasoundRegions", []):
+            if (
+                region.get("PhysicalUnitsXDirection") == US_UNITS_CM
+                and region.get("PhysicalUnitsYDirection") == US_UNITS_CM
+            ):
+                return (
+                    abs(float(region.PhysicalDeltaY)) * 10,
+                    abs(float(region.PhysicalDeltaX)) * 10,
+                )
+        if "PixelSpacing" in dataset:
+            row_spacing, column_spacing = (float(v) for v in dataset.PixelSpacing)
+            return row_spacing, column_spacing
+        return 1.0, 1.0
+
+    @staticmethod
+    def frame_time(dataset: Dataset) -> float:
+        """Return the time between frames in seconds, 0 if unknown."""
+        if dataset.get("FrameTime"):
+            return float(dataset.FrameTime) / 1000
+        if dataset.get("CineRate"):
+            return 1 / float(dataset.CineRate)
+        if dataset.get("RecommendedDisplayFrameRate"):
+            return 1 / float(dataset.RecommendedDisplayFrameRate)
+        return 0.0
+
+    def convert_to_image(self, instance: FileInstance, file_path_mids: Path):
+        """
+        Converts a single-frame DICOM to an image.
+
+        :param instance: The DICOM image instance.
+        :type instance: pydicom.fileset.FileInstance
+        :param file_path_mids: The path where the converted image will be saved.
+        :type file_path_mids: pathlib.Path
+        """
+        image = self.read_image(instance)
+        self.writer.write_image(image, file_path_mids)
+
+    def convert_cine(self, instance: FileInstance, file_path_mids: Path):
+        """
+        Converts a multi-frame DICOM to a NIfTI time series, one frame at a time.
+
+        :param instance: The DICOM image instance.
+        :type instance: pydicom.fileset.FileInstance
+        :param file_path_mids: The path where the converted series will be saved.
+        :type file_path_mids: pathlib.Path
+        """
+        dataset, frames = iter_frames(instance_file(instance), self.decoder)
+        with self.writer.open(file_path_mids) as f, self.writer.encoding.compress(f) as gz:
+            nifti = NiftiStreamWriter(
+                gz,
+                frame_shape(dataset),
+                self.number_of_frames(dataset),
+                pixel_dtype(dataset),
+                self.pixel_spacing(dataset),
+                self.frame_time(dataset),
+            )
+            for frame in frames:
+                nifti.write(frame)
+            nifti.close()
+
+    def get_scan_metadata(self, dataset, file_path_mids):
+        subs = lambda s: re.sub(r"(?<!^)(?=[A-Z])", "_", s).lower()
+        return {
+            subs(key): value
+            for key, value in zip(
+                self.scans_header,
+                [
+                    str(file_path_mids),
+                    (
+                        dataset.BodyPartExamined
+                        if "BodyPartExamined" in dataset
+                        else self.bodypart
+                    ),
+                    *[
+                        (dataset[i].value if i in dataset else "n/a")
+                        for i in self.scans_header[2:]
+                    ],
+                ],
+            )
+        }
+
+    def run(self, instance_list: List[FileInstance]):
+        """
+        Runs the image conversion pipeline on a list of instances.
+
+        :param instance_list: The DICOM instances of the series.
+        :type instance_list: list[pydicom.fileset.FileInstance]
+        """
+
+        self.use_chunk = len(instance_list) > 1
+        self.select_profile(instance_list)
+        headers = [dcmread(instance.path, stop_before_pixels=True) for instance in instance_list]
+        if self.decoder is not None and self.profile.image:
+            self.decoder.prefetch(
+                [
+                    instance
+                    for instance, header in zip(instance_list, headers)
+                    if self.number_of_frames(header) == 1
+                ]
+            )
+        list_scan_metadata = []
+        for instance, header in zip(instance_list, headers):
+            modality, mim, ext = self.classify_image_type(header)
+            file_path_mids, session_absolute_path_mids = self.get_name(
+                header, modality, mim
+            )
+            if self.profile.image and ext != ".png":
+                self.convert_cine(instance, file_path_mids.with_suffix(ext))
+            elif self.profile.image:
+                # The pixel data is only read for the digest of the content store
+                dataset = header if self.content_store is None else self.load_dataset(instance)
+                self.save_image(instance, dataset, file_path_mids.with_suffix(ext))
+            self.convert_to_jsonfile(header, file_path_mids.with_suffix(".json"))
+            file_path_relative_mids = file_path_mids.relative_to(
+                session_absolute_path_mids
+            ).with_suffix(ext)
+            list_scan_metadata.append(
+                self.get_scan_metadata(header, self.scan_path(file_path_relative_mids))
+            )
+            logger.info(
+                "Successfully processed instance %s",
+                instance.path,
+            )
+            logger.info(
+                "Saved to %s",
+                file_path_relative_mids.name,
+            )
+        return list_scan_metadata
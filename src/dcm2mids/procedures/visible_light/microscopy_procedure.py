@@ -2,18 +2,26 @@ from datetime import datetime
 import logging
 import re
 from pathlib import Path
-from shutil import copyfile
 from typing import List, Tuple
 
 import SimpleITK as sitk
 from pydicom import Dataset
 from pydicom.fileset import FileInstance
 
+from ..pixel_data import instance_file
 from ..procedures import Procedures
 
 logger = logging.getLogger("dcm2mids").getChild("microscopy_procedure")
 
 
+def format_acquisition_datetime(value) -> str:
+    """Format a DICOM DT value as ISO 8601, or return `n/a` if it is missing or malformed."""
+    try:
+        return datetime.strptime(str(value)[:14], "%Y%m%d%H%M%S").strftime("%Y-%m-%dT%H:%M:%S")
+    except (TypeError, ValueError):
+        return "n/a"
+
+
 class MicroscopyProcedures(Procedures):
     """Conversion logic for Visible Light Imaging procedures."""
 
@@ -23,8 +31,9 @@ class MicroscopyProcedures(Procedures):
         bodypart: str,
         use_bodypart: bool,
         use_viewposition: bool,
+        **kwargs,
     ):
-        super().__init__(mids_path, bodypart, use_bodypart, use_viewposition)
+        super().__init__(mids_path, bodypart, use_bodypart, use_viewposition, **kwargs)
 
     def classify_image_type(
         self, instance: FileInstance
@@ -133,14 +142,15 @@ class MicroscopyProcedures(Procedures):
         :param file_path_mids: The path where the converted image will be saved.
         :type file_path_mids: pathlib.Path
         """
-        file_path_mids.parent.mkdir(parents=True, exist_ok=True)
         if file_path_mids.suffix == ".dcm":
-            print("instance.path", instance.path)
-            copyfile(instance.path, file_path_mids)
+            source = instance_file(instance)
+            if isinstance(source, (Path, str)):
+                self.writer.write_file(source, file_path_mids)
+            else:
+                self.writer.write_bytes(file_path_mids, source.read())
         else:
-            file_path_mids.parent.mkdir(parents=True, exist_ok=True)
-            image = sitk.ReadImage(instance.path)
-            sitk.WriteImage(image, file_path_mids)
+            image = self.read_image(instance)
+            self.writer.write_image(image, file_path_mids)
 
     def get_scan_metadata(self, dataset, file_path_mids):
         subs = lambda s: re.sub(r"(?<!^)(?=[A-Z])", "_", s).lower()
@@ -156,9 +166,7 @@ class MicroscopyProcedures(Procedures):
                         if "BodyPartExamined" in dataset
                         else self.bodypart
                     ),
-                    datetime.strptime(
-                        dataset.AcquisitionDateTime[:14], "%Y%m%d%H%M%S"
-                    ).strftime("%Y-%m-%dT%H:%M:%S"),
+                    format_acquisition_datetime(dataset.get("AcquisitionDateTime")),
                     *[
                         (dataset[i].value if i in dataset else "n/a")
                         for i in self.scans_header[3:-1]
@@ -178,21 +186,25 @@ class MicroscopyProcedures(Procedures):
         """
 
         self.use_chunk = len(instance_list) > 1
+        self.select_profile(instance_list)
+        if self.decoder is not None and self.profile.image:
+            self.decoder.prefetch(instance_list)
         list_scan_metadata = []
         for instance in instance_list:
-            dataset = instance.load()
+            dataset = self.load_dataset(instance)
             modality, mim, ext = self.classify_image_type(instance)
             file_path_mids, session_absolute_path_mids = self.get_name(
                 dataset, modality, mim
             )
 
-            self.convert_to_image(instance, file_path_mids.with_suffix(ext))
+            if self.profile.image:
+                self.save_image(instance, dataset, file_path_mids.with_suffix(ext))
             self.convert_to_jsonfile(dataset, file_path_mids.with_suffix(".json"))
             file_path_relative_mids = file_path_mids.relative_to(
                 session_absolute_path_mids
             ).with_suffix(ext)
             list_scan_metadata.append(
-                self.get_scan_metadata(dataset, file_path_relative_mids)
+                self.get_scan_metadata(dataset, self.scan_path(file_path_relative_mids))
             )
             logger.info(
                 "Successfully processed instance %s",
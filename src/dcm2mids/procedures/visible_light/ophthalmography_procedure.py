@@ -21,8 +21,9 @@ class OphthalmographyProcedures(Procedures):
         bodypart: str,
         use_bodypart: bool,
         use_viewposition: bool,
+        **kwargs,
     ):
-        super().__init__(mids_path, bodypart, use_bodypart, use_viewposition)
+        super().__init__(mids_path, bodypart, use_bodypart, use_viewposition, **kwargs)
 
     def classify_image_type(
         self, instance: FileInstance
@@ -129,9 +130,8 @@ class OphthalmographyProcedures(Procedures):
         :type file_path_mids: pathlib.Path
         """
 
-        file_path_mids.parent.mkdir(parents=True, exist_ok=True)
-        image = sitk.ReadImage(instance.path)
-        sitk.WriteImage(image, file_path_mids)
+        image = self.read_image(instance)
+        self.writer.write_image(image, file_path_mids)
 
     def get_scan_metadata(self, dataset, file_path_mids):
         subs = lambda s: re.sub(r"(?<!^)(?=[A-Z])", "_", s).lower()
@@ -140,7 +140,7 @@ class OphthalmographyProcedures(Procedures):
             for key, value in zip(
                 self.scans_header,
                 [
-                    str(file_path_mids.with_suffix(".png")),
+                    str(file_path_mids),
                     (
                         dataset.BodyPartExamined
                         if "BodyPartExamined" in dataset
@@ -163,20 +163,24 @@ class OphthalmographyProcedures(Procedures):
         """
 
         self.use_chunk = len(instance_list) > 1
+        self.select_profile(instance_list)
+        if self.decoder is not None and self.profile.image:
+            self.decoder.prefetch(instance_list)
         list_scan_metadata = []
         for instance in instance_list:
-            dataset = instance.load()
+            dataset = self.load_dataset(instance)
             modality, mim = self.classify_image_type(instance)
             file_path_mids, session_absolute_path_mids = self.get_name(
                 dataset, modality, mim
             )
-            self.convert_to_image(instance, file_path_mids.with_suffix(".png"))
+            if self.profile.image:
+                self.save_image(instance, dataset, file_path_mids.with_suffix(".png"))
             self.convert_to_jsonfile(dataset, file_path_mids.with_suffix(".json"))
             file_path_relative_mids = file_path_mids.relative_to(
                 session_absolute_path_mids
             ).with_suffix(".png")
             list_scan_metadata.append(
-                self.get_scan_metadata(dataset, file_path_relative_mids)
+                self.get_scan_metadata(dataset, self.scan_path(file_path_relative_mids))
             )
             logger.info(
                 "Successfully processed instance %s",
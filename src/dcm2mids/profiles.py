@@ -0,0 +1,202 @@
+import logging
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Union
+
+from pydicom import Dataset
+from pydicom.tag import BaseTag, Tag
+
+try:
+    import tomllib
+except ImportError:  # pragma: no cover
+    try:
+        import tomli as tomllib  # type: ignore[no-redef]
+    except ImportError:
+        tomllib = None  # type: ignore[assignment]
+
+try:
+    import yaml
+except ImportError:  # pragma: no cover
+    yaml = None
+
+logger = logging.getLogger("dcm2mids").getChild("profiles")
+
+SIDECAR_MODES = ["full", "summary", "off"]
+TSV_FILES = ["scans", "sessions", "participants"]
+# Section of the configuration file applying to every modality
+DEFAULT_SECTION = "default"
+
+
+class OutputProfile:
+    """Which outputs are written for the series of a modality.
+
+    :param image: Write the image (PNG, NIfTI, cine or waveform) of each
+        acquisition. When disabled, the pixel data is neither read nor decoded.
+    :type image: bool
+    :param sidecar: `full` writes every element of the header to the JSON
+        sidecar, `summary` only its top-level elements, without sequences and
+        private tags, and `off` writes no sidecar.
+    :type sidecar: str
+    :param tags: Only write these elements to the sidecar, given by keyword
+        (`EchoTime`) or tag (`00180081`). Every element is written if None.
+    :type tags: Iterable[str], optional
+    :param tsvs: The TSV files listing the series: `scans`, `sessions` and
+        `participants`.
+    :type tsvs: Iterable[str], optional
+    """
+
+    def __init__(
+        self,
+        image: bool = True,
+        sidecar: str = "full",
+        tags: Optional[Iterable[str]] = None,
+        tsvs: Optional[Iterable[str]] = None,
+    ):
+        if sidecar not in SIDECAR_MODES:
+            raise ValueError(f"Unknown sidecar mode {sidecar}, expected one of {', '.join(SIDECAR_MODES)}")
+        tsvs = list(TSV_FILES if tsvs is None else tsvs)
+        unknown = [tsv for tsv in tsvs if tsv not in TSV_FILES]
+        if unknown:
+            raise ValueError(f"Unknown TSV files {', '.join(unknown)}, expected some of {', '.join(TSV_FILES)}")
+        self.image = bool(image)
+        self.sidecar = sidecar
+        self.tags = None if tags is None else [str(tag) for tag in tags]
+        self.tsvs = tsvs
+        self._tags: Optional[List[BaseTag]] = None
+        if self.tags is not None:
+            self._tags = []
+            for tag in self.tags:
+                try:
+                    self._tags.append(Tag(tag))
+                except ValueError:
+                    raise ValueError(f"Unknown DICOM tag {tag}") from None
+
+    def __repr__(self) -> str:
+        return (
+            f"OutputProfile(image={self.image}, sidecar={self.sidecar!r}, "
+            f"tags={self.tags!r}, tsvs={self.tsvs!r})"
+        )
+
+    def sidecar_dataset(self, dataset: Dataset) -> Dataset:
+        """
+        Return the elements of a dataset written to its sidecar.
+
+        :param dataset: The dataset of the instance.
+        :type dataset: pydicom.Dataset
+        :return: The dataset itself for a full sidecar, otherwise a new dataset
+            with the selected elements only.
+        :rtype: pydicom.Dataset
+        """
+        if self.sidecar == "full" and self._tags is None:
+            return dataset
+        tags = dataset.keys() if self._tags is None else self._tags
+        selected = Dataset()
+        for tag in tags:
+            if tag not in dataset:
+                continue
+            elem = dataset[tag]
+            if self.sidecar == "summary" and (elem.VR == "SQ" or elem.tag.is_private):
+                continue
+            selected.add(elem)
+        return selected
+
+
+class OutputProfiles:
+    """The output profile of each modality, falling back to a default profile.
+
+    :param default: The profile of the modalities without their own.
+        Every output is written if None.
+    :type default: dcm2mids.profiles.OutputProfile, optional
+    :param modalities: The profile of each modality, e.g. `MR` or `CT`.
+    :type modalities: Dict[str, dcm2mids.profiles.OutputProfile], optional
+    """
+
+    def __init__(
+        self,
+        default: Optional[OutputProfile] = None,
+        modalities: Optional[Dict[str, OutputProfile]] = None,
+    ):
+        self.default = default or OutputProfile()
+        self.modalities = {
+            modality.upper(): profile for modality, profile in (modalities or {}).items()
+        }
+
+    def __repr__(self) -> str:
+        return f"OutputProfiles(default={self.default!r}, modalities={self.modalities!r})"
+
+    def get(self, modality: Optional[str]) -> OutputProfile:
+        """Return the profile of a modality, or the default profile."""
+        return self.modalities.get(str(modality or "").upper(), self.default)
+
+    def writes_tsv(self, name: str) -> bool:
+        """Whether the sessions or participants TSV file is written, from the default profile."""
+        return name in self.default.tsvs
+
+    @classmethod
+    def from_dict(cls, config: Dict[str, Any]) -> "OutputProfiles":
+        """
+        Build the profiles from a parsed configuration file.
+
+        The `default` section sets the options of every modality; the section
+        of each modality only overrides some of them.
+
+        :param config: The sections of the configuration, by modality.
+        :type config: Dict[str, Any]
+        :raises ValueError: If a section or an option is invalid.
+        :return: The profiles.
+        :rtype: dcm2mids.profiles.OutputProfiles
+        """
+        if not isinstance(config, dict):
+            raise ValueError("An output profile configuration maps modalities to their options")
+        options = {"image", "sidecar", "tags", "tsvs"}
+        sections = {}
+        for name, section in config.items():
+            if not isinstance(section, dict):
+                raise ValueError(f"The {name} section of the output profiles is not a table")
+            unknown = set(section) - options
+            if unknown:
+                raise ValueError(f"Unknown output profile options {', '.join(sorted(unknown))} in {name}")
+            sections[str(name)] = section
+        base = sections.pop(DEFAULT_SECTION, {})
+        return cls(
+            OutputProfile(**base),
+            {name: OutputProfile(**dict(base, **section)) for name, section in sections.items()},
+        )
+
+
+def load_profiles(path: Union[Path, str]) -> OutputProfiles:
+    """
+    Read the output profiles from a TOML or YAML file, e.g.
+
+    .. code-block:: toml
+
+        [default]
+        sidecar = "summary"
+
+        [MR]
+        image = false
+        tags = ["SeriesDescription", "EchoTime", "RepetitionTime"]
+        tsvs = ["scans"]
+
+    :param path: The path of the file, ending with `.toml`, `.yaml` or `.yml`.
+    :type path: Union[pathlib.Path, str]
+    :raises ValueError: If the file is not TOML or YAML, or the profiles are invalid.
+    :raises RuntimeError: If the package reading the format is not installed.
+    :return: The profiles.
+    :rtype: dcm2mids.profiles.OutputProfiles
+    """
+    path = Path(path)
+    suffix = path.suffix.lower()
+    if suffix == ".toml":
+        if tomllib is None:
+            raise RuntimeError("The tomli package is needed to read TOML files before Python 3.11")
+        with open(path, "rb") as f:
+            config = tomllib.load(f)
+    elif suffix in (".yaml", ".yml"):
+        if yaml is None:
+            raise RuntimeError("The PyYAML package is needed to read YAML files")
+        config = yaml.safe_load(path.read_text()) or {}
+    else:
+        raise ValueError(f"Output profiles are read from TOML or YAML files, not {path.name}")
+    profiles = OutputProfiles.from_dict(config)
+    logger.debug("Output profiles from %s: %r", path, profiles)
+    return profiles
@@ -0,0 +1,42 @@
+import logging
+import time
+from typing import Any, Dict, List, Optional
+
+from .memory import format_size, peak_rss
+
+logger = logging.getLogger("dcm2mids").getChild("report")
+
+
+class RunReport:
+    """Summary of a conversion run: processed series, counters and resources."""
+
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.elapsed: Optional[float] = None
+        self.series: List[Dict[str, Any]] = []
+        self.stats: Dict[str, Any] = {}
+
+    def add_series(self, **row: Any):
+        """Record the outcome of a converted series."""
+        self.series.append(row)
+
+    def finish(self) -> "RunReport":
+        """Stop the clock and collect the final resource usage."""
+        self.elapsed = time.perf_counter() - self.start_time
+        self.stats["peak_rss"] = peak_rss()
+        return self
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Return the report as a plain dictionary."""
+        return {"elapsed": self.elapsed, "series": self.series, **self.stats}
+
+    def log(self):
+        """Write the summary of the run to the log."""
+        if self.elapsed is None:
+            self.finish()
+        logger.info("Series processed: %d", len(self.series))
+        logger.info("Elapsed time: %.2f s", self.elapsed)
+        for key, value in self.stats.items():
+            if key.endswith("rss") or key.endswith("bytes"):
+                value = format_size(value)
+            logger.info("%s: %s", key.replace("_", " ").capitalize(), value)
@@ -0,0 +1,176 @@
+import logging
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Union
+
+from pydicom import Dataset, dcmread
+from pydicom.fileset import FileSet
+
+logger = logging.getLogger("dcm2mids").getChild("scan_index")
+
+# Directory record elements that describe the referenced instance, mapped to
+# the keyword the element has in the instance itself.
+REFERENCED_KEYWORDS = {
+    "ReferencedSOPInstanceUIDInFile": "SOPInstanceUID",
+    "ReferencedSOPClassUIDInFile": "SOPClassUID",
+    "ReferencedTransferSyntaxUIDInFile": "TransferSyntaxUID",
+}
+
+
+class IndexedInstance:
+    """Header values of a single SOP instance and the path to its file.
+
+    Behaves like a :class:`pydicom.fileset.FileInstance` for the attributes
+    used by the procedures (``path``, ``load()`` and keyword access), but the
+    values come from the index and the file is only opened by ``load()``.
+    The ``source`` of an instance staged without its pixel data is kept.
+    """
+
+    def __init__(self, path: Union[Path, str], record: Dict[str, Any], source: Any = None):
+        self.path = str(path)
+        self.record = record
+        self.source = source
+
+    def __contains__(self, keyword: str) -> bool:
+        return keyword in self.record
+
+    def __getitem__(self, keyword: str) -> Any:
+        return self.record[keyword]
+
+    def __getattr__(self, keyword: str) -> Any:
+        record = self.__dict__.get("record", {})
+        if keyword in record:
+            return record[keyword]
+        raise AttributeError(keyword)
+
+    def __repr__(self) -> str:
+        return f"IndexedInstance({self.path!r})"
+
+    def load(self) -> Dataset:
+        """
+        Read the referenced instance from disk.
+
+        :return: The dataset stored in the instance file.
+        :rtype: pydicom.Dataset
+        """
+        return dcmread(self.path)
+
+
+class ScanIndex:
+    """In-memory index of the instances to be converted.
+
+    Exposes the subset of the :class:`pydicom.fileset.FileSet` API used by
+    :func:`~dcm2mids.create_mids_directory.create_mids_directory`, so both can
+    be used interchangeably. Searches run against the indexed header values,
+    so the ``load`` arguments are accepted but never open any file.
+    """
+
+    def __init__(self, instances: Optional[List[IndexedInstance]] = None):
+        self._instances: List[IndexedInstance] = list(instances or [])
+
+    def __len__(self) -> int:
+        return len(self._instances)
+
+    def __iter__(self) -> Iterator[IndexedInstance]:
+        return iter(self._instances)
+
+    def add(self, instance: IndexedInstance) -> IndexedInstance:
+        """
+        Add an instance to the index.
+
+        :param instance: The instance to add.
+        :type instance: IndexedInstance
+        :return: The added instance.
+        :rtype: IndexedInstance
+        """
+        self._instances.append(instance)
+        return instance
+
+    @classmethod
+    def from_fileset(cls, fileset: FileSet) -> "ScanIndex":
+        """
+        Build the index from the directory records of a FileSet.
+
+        The PATIENT/STUDY/SERIES/IMAGE records are merged into a single record
+        per instance; none of the referenced instances is read.
+
+        :param fileset: The FileSet, usually read from a DICOMDIR file.
+        :type fileset: pydicom.fileset.FileSet
+        :return: The index with one entry per instance in the FileSet.
+        :rtype: ScanIndex
+        """
+        index = cls()
+        for instance in fileset:
+            record = {}
+            # Records are visited from the lowest (IMAGE) to the highest
+            # (PATIENT) level, so the most specific value wins.
+            for node in instance.node.reverse():
+                for elem in node._record:
+                    if elem.keyword in REFERENCED_KEYWORDS:
+                        record.setdefault(REFERENCED_KEYWORDS[elem.keyword], elem.value)
+                    elif elem.keyword and elem.tag.group != 0x0004:
+                        record.setdefault(elem.keyword, elem.value)
+            if not record.get("StudyID"):
+                logger.warning(
+                    "`StudyID` not found for %s. `AccessionNumber` will be used instead.",
+                    instance.path,
+                )
+                record["StudyID"] = record.get("AccessionNumber")
+            if not record.get("SeriesNumber"):
+                logger.warning(
+                    "`SeriesNumber` not found for %s. `InstanceNumber` will be used instead.",
+                    instance.path,
+                )
+                record["SeriesNumber"] = record.get("InstanceNumber")
+            index.add(IndexedInstance(instance.path, record, getattr(instance, "source", None)))
+        logger.info("ScanIndex has %d elements", len(index))
+        return index
+
+    def find(self, load: bool = False, **kwargs: Any) -> List[IndexedInstance]:
+        """
+        Return the instances matching all the given element values.
+
+        :param load: Ignored, kept for compatibility with ``FileSet.find``.
+        :type load: bool
+        :return: A list of matching instances.
+        :rtype: list[IndexedInstance]
+        """
+        return [
+            instance
+            for instance in self._instances
+            if all(
+                key in instance.record and instance.record[key] == value
+                for key, value in kwargs.items()
+            )
+        ]
+
+    def find_values(
+        self,
+        elements: Union[str, List[str]],
+        instances: Optional[List[IndexedInstance]] = None,
+        load: bool = False,
+    ) -> Union[List[Any], Dict[str, List[Any]]]:
+        """
+        Return a list of unique values for the given element(s).
+
+        :param elements: The keyword(s) of the element(s) to search for.
+        :type elements: Union[str, list[str]]
+        :param instances: Search within these instances instead of the whole index.
+        :type instances: list[IndexedInstance], optional
+        :param load: Ignored, kept for compatibility with ``FileSet.find_values``.
+        :type load: bool
+        :return: A list of values if a single element was queried, otherwise a
+            dict of lists of values keyed by element.
+        :rtype: Union[list, dict]
+        """
+        element_list = elements if isinstance(elements, list) else [elements]
+        results: Dict[str, List[Any]] = {element: [] for element in element_list}
+        for instance in instances or self._instances:
+            for element in element_list:
+                if element not in instance.record:
+                    continue
+                value = instance.record[element]
+                if value not in results[element]:
+                    results[element].append(value)
+        if isinstance(elements, list):
+            return results
+        return results[elements]
@@ -0,0 +1,190 @@
+import logging
+import threading
+import time
+from collections import deque
+from itertools import chain
+from typing import Any, Callable, Deque, Dict, Hashable, List, Optional, Tuple
+
+from .memory import MemoryBudget, estimate_instance_size, format_size
+
+logger = logging.getLogger("dcm2mids").getChild("scheduler")
+
+
+class SeriesTask:
+    """A series waiting to be converted, with the estimates used to schedule it.
+
+    :param key: Identifies the series, e.g. (subject, session, series).
+    :type key: Hashable
+    :param instances: The instances of the series.
+    :type instances: list
+    :param nbytes: The estimated memory taken by the series while it is converted.
+        Estimated from the sizes in the index of each instance if None.
+    :type nbytes: int, optional
+    """
+
+    def __init__(self, key: Hashable, instances: List[Any], nbytes: Optional[int] = None):
+        self.key = key
+        self.instances = instances
+        self.nbytes = (
+            sum(estimate_instance_size(instance) for instance in instances)
+            if nbytes is None
+            else nbytes
+        )
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.worker: Optional[int] = None
+        self.stolen = False
+        self.start: Optional[float] = None
+        self.end: Optional[float] = None
+
+    @property
+    def cost(self) -> Tuple[int, int]:
+        """The sort key of the series: its estimated bytes, then its number of instances."""
+        return (self.nbytes, len(self.instances))
+
+    def __repr__(self) -> str:
+        return f"SeriesTask({self.key!r}, {len(self.instances)} instances, {format_size(self.nbytes)})"
+
+
+class SeriesScheduler:
+    """Convert series in a pool of worker threads, balancing their load.
+
+    The series are sorted by their estimated size, largest first, and dealt
+    to the least loaded worker (longest processing time first), so a few huge
+    series do not end up queued behind many small ones. Each worker takes
+    the largest series of its own queue; once it is empty, it steals the
+    smallest series of the most loaded worker. Before starting a series, a
+    worker reserves its estimated size in the memory budget: when it does
+    not fit, the worker starts the largest series that fits instead, and
+    only waits for memory when none does.
+
+    :param workers: The number of worker threads.
+    :type workers: int
+    :param memory_budget: Budget the estimated size of each series is reserved in.
+    :type memory_budget: dcm2mids.memory.MemoryBudget, optional
+    """
+
+    def __init__(self, workers: int, memory_budget: Optional[MemoryBudget] = None):
+        self.workers = max(int(workers), 1)
+        self.memory_budget = memory_budget
+        self.queues: List[Deque[SeriesTask]] = [deque() for _ in range(self.workers)]
+        # Estimated bytes still queued per worker, to find the most loaded one
+        self.queued = [0] * self.workers
+        self.busy = [0.0] * self.workers
+        self.done = [0] * self.workers
+        self.stolen = 0
+        self.makespan = 0.0
+        self._lock = threading.Lock()
+
+    def assign(self, tasks: List[SeriesTask]):
+        """Deal the series to the workers, largest first, each to the least loaded one."""
+        loads = [0] * self.workers
+        for task in sorted(tasks, key=lambda task: task.cost, reverse=True):
+            worker = loads.index(min(loads))
+            self.queues[worker].append(task)
+            self.queued[worker] += task.nbytes
+            # Series without pixel estimates still weigh their number of instances
+            loads[worker] += max(task.nbytes, len(task.instances))
+
+    def _admits(self, task: SeriesTask) -> bool:
+        return self.memory_budget is None or self.memory_budget.try_acquire(task.nbytes)
+
+    def _remove(self, owner: int, task: SeriesTask, worker: int) -> SeriesTask:
+        self.queues[owner].remove(task)
+        self.queued[owner] -= task.nbytes
+        task.stolen = owner != worker
+        return task
+
+    def _take(self, worker: int) -> Tuple[Optional[SeriesTask], bool]:
+        """Return the next series of a worker and whether its memory is already reserved."""
+        with self._lock:
+            own = self.queues[worker]
+            victim = max(
+                (i for i, queue in enumerate(self.queues) if i != worker and queue),
+                key=lambda i: self.queued[i],
+                default=None,
+            )
+            if not own and victim is None:
+                return None, False
+            others = self.queues[victim] if victim is not None else deque()
+            # Largest series of its own queue first, then the smallest of the victim
+            candidates = chain(
+                ((worker, task) for task in own),
+                ((victim, task) for task in reversed(others)),
+            )
+            for owner, task in candidates:
+                if self._admits(task):
+                    return self._remove(owner, task, worker), True
+            if own:
+                return self._remove(worker, own[0], worker), False
+            return self._remove(victim, others[-1], worker), False
+
+    def _work(self, worker: int, func: Callable[[SeriesTask, int], Any]):
+        while True:
+            task, reserved = self._take(worker)
+            if task is None:
+                return
+            if self.memory_budget is not None and not reserved:
+                self.memory_budget.acquire(task.nbytes)
+            if task.stolen:
+                with self._lock:
+                    self.stolen += 1
+                logger.debug("Worker %d stole %r", worker, task)
+            task.worker = worker
+            task.start = time.perf_counter()
+            try:
+                task.result = func(task, worker)
+            except Exception as e:
+                task.error = e
+            finally:
+                task.end = time.perf_counter()
+                if self.memory_budget is not None:
+                    self.memory_budget.release(task.nbytes)
+            self.busy[worker] += task.end - task.start
+            self.done[worker] += 1
+
+    def run(self, tasks: List[SeriesTask], func: Callable[[SeriesTask, int], Any]) -> List[SeriesTask]:
+        """
+        Convert the series and wait for all of them.
+
+        :param tasks: The series.
+        :type tasks: List[dcm2mids.scheduler.SeriesTask]
+        :param func: Called with each series and the index of its worker. Its
+            result, or the error it raised, is stored in the series.
+        :type func: Callable[[dcm2mids.scheduler.SeriesTask, int], Any]
+        :return: The series, in the order they were given.
+        :rtype: List[dcm2mids.scheduler.SeriesTask]
+        """
+        self.assign(tasks)
+        start = time.perf_counter()
+        threads = [
+            threading.Thread(target=self._work, args=(i, func), name=f"dcm2mids-series-{i}")
+            for i in range(self.workers)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.makespan = time.perf_counter() - start
+        return tasks
+
+    def idle(self) -> List[float]:
+        """Return the seconds each worker spent without a series during the run."""
+        return [round(max(self.makespan - busy, 0.0), 3) for busy in self.busy]
+
+    def summary(self) -> Dict[str, Any]:
+        """Return the makespan and the load of each worker, for the run report."""
+        return {
+            "series_workers": self.workers,
+            "makespan_seconds": round(self.makespan, 3),
+            "worker_idle_seconds": self.idle(),
+            "worker_series": list(self.done),
+            "series_stolen": self.stolen,
+        }
+
+    def log_stats(self):
+        """Write the load of each worker to the log."""
+        for worker, (busy, idle, done) in enumerate(zip(self.busy, self.idle(), self.done)):
+            logger.info(
+                "Worker %d: %d series, %.2f s busy, %.2f s idle", worker, done, busy, idle
+            )
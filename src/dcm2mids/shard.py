@@ -0,0 +1,85 @@
+import hashlib
+import logging
+from pathlib import Path
+from typing import Any
+
+logger = logging.getLogger("dcm2mids").getChild("shard")
+
+SHARD_KEYS = ["PatientID", "StudyInstanceUID"]
+
+
+def shard_of(value: Any, count: int) -> int:
+    """
+    Return the shard a value belongs to.
+
+    The assignment uses a SHA-1 digest of the value, so it is the same on every
+    node and interpreter (unlike the built-in `hash`).
+
+    :param value: The value to assign, usually a PatientID or StudyInstanceUID.
+    :type value: Any
+    :param count: The total number of shards.
+    :type count: int
+    :return: The shard index, between 0 and `count - 1`.
+    :rtype: int
+    """
+    digest = hashlib.sha1(str(value).strip().encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % count
+
+
+class Shard:
+    """One of `count` static partitions of the input, selected by a header key.
+
+    With the `PatientID` key every subject belongs to a single shard, so all
+    shards can write into the same MIDS root. With the `StudyInstanceUID` key
+    the sessions of a subject can be spread over several shards, so each shard
+    writes into its own root (`<output>/shard-<i>-of-<N>`).
+    """
+
+    def __init__(self, index: int, count: int, key: str = "PatientID"):
+        if count < 1 or not 0 <= index < count:
+            raise ValueError(f"Invalid shard {index}/{count}: expected 0 <= i < N.")
+        if key not in SHARD_KEYS:
+            raise ValueError(f"Invalid shard key {key}: expected one of {SHARD_KEYS}.")
+        self.index = index
+        self.count = count
+        self.key = key
+
+    @classmethod
+    def parse(cls, text: str, key: str = "PatientID") -> "Shard":
+        """
+        Parse a shard given as `i/N`, where `i` is zero-based.
+
+        :param text: The shard specification, e.g. `0/4`.
+        :type text: str
+        :param key: The header keyword used to assign instances to shards.
+        :type key: str
+        :raises ValueError: If the specification is not valid.
+        :return: The shard.
+        :rtype: Shard
+        """
+        try:
+            index, count = (int(part) for part in text.split("/"))
+        except ValueError:
+            raise ValueError(f"Invalid shard {text}: expected i/N.") from None
+        return cls(index, count, key)
+
+    @property
+    def name(self) -> str:
+        return f"shard-{self.index}-of-{self.count}"
+
+    def owns(self, value: Any) -> bool:
+        """Return True if the value of the shard key belongs to this shard."""
+        return shard_of(value, self.count) == self.index
+
+    def output_root(self, mids_path: Path) -> Path:
+        """Return the MIDS root this shard writes into."""
+        if self.key == "PatientID":
+            return mids_path
+        return mids_path.joinpath(self.name)
+
+    def participants_fragment(self, mids_path: Path) -> Path:
+        """Return the path of the partial participants TSV written by this shard."""
+        return mids_path.joinpath("shards", f"{self.name}_participants.tsv")
+
+    def __repr__(self) -> str:
+        return f"Shard({self.index}, {self.count}, key={self.key!r})"
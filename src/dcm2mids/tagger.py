@@ -1,19 +1,152 @@
+import logging
 from pathlib import Path
-from typing import Union
+from typing import Any, Dict, List, Union
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger("dcm2mids").getChild("tagger")
+
+
+def to_float(value: Any) -> float:
+    """Convert a header value to float, using the first value of multi-valued elements."""
+    if isinstance(value, (list, tuple)):
+        value = value[0] if value else None
+    elif isinstance(value, str) and value.startswith("["):
+        # Multi-valued elements as written by `dictify`, e.g. "['0.5', '0.5']"
+        value = value.strip("[]").split(",")[0].strip(" '\"")
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
 
 
 class Tagger:
-    def __init__(self, protocol_table_path: Union[Path, str]):
-        if type(protocol_table_path) is str:
-            self.protocol_table_path = Path(protocol_table_path)
-            self.table_protocols = pd.read_csv(
-                protocol_table_path, sep="\t", index_col=False
+    """Classify series into protocols from the ranges of their header values.
+
+    The protocol table is a TSV file with one rule per row. The `protocol`
+    column holds the label assigned by the rule. Columns named `<Keyword>_min`
+    and `<Keyword>_max` bound the numeric value of a header element (an empty
+    cell leaves that side unbounded). Any other column must match the header
+    value exactly (an empty cell matches anything). Rules are evaluated in
+    table order and the first matching rule wins.
+
+    The table is compiled once into NumPy arrays, so a whole batch of series
+    is classified with broadcast comparisons instead of a loop over the rules.
+    """
+
+    def __init__(self, protocol_table_path: Union[Path, str], batch_size: int = 4096):
+        self.protocol_table_path = Path(protocol_table_path)
+        self.table_protocols = pd.read_csv(
+            self.protocol_table_path, sep="\t", index_col=False, dtype=str
+        )
+        self.batch_size = batch_size
+        self.compile()
+
+    def compile(self):
+        """Compile the protocol table into the rule arrays."""
+        table = self.table_protocols
+        if "protocol" not in table.columns:
+            raise ValueError(
+                f"{self.protocol_table_path} has no `protocol` column."
+            )
+        self.labels = table["protocol"].to_numpy(dtype=object)
+        bound_columns = [c for c in table.columns if c.endswith(("_min", "_max"))]
+        self.range_keys = sorted({c.rsplit("_", 1)[0] for c in bound_columns})
+        self.match_keys = [
+            c for c in table.columns if c != "protocol" and c not in bound_columns
+        ]
+
+        def bounds(suffix: str, default: float) -> np.ndarray:
+            columns = [
+                pd.to_numeric(table[f"{key}{suffix}"], errors="coerce")
+                if f"{key}{suffix}" in table.columns
+                else pd.Series(np.nan, index=table.index)
+                for key in self.range_keys
+            ]
+            array = np.column_stack(columns) if columns else np.empty((len(table), 0))
+            return np.where(np.isnan(array), default, array)
+
+        self.lower = bounds("_min", -np.inf)
+        self.upper = bounds("_max", np.inf)
+        self.unbounded = np.isinf(self.lower) & np.isinf(self.upper)
+        match_values = table[self.match_keys].fillna("").to_numpy(dtype=object)
+        self.match_values = match_values.reshape(len(table), len(self.match_keys))
+        self.wildcard = self.match_values == ""
+        logger.debug(
+            "Compiled %d rules over %d ranges and %d exact matches",
+            len(table),
+            len(self.range_keys),
+            len(self.match_keys),
+        )
+
+    def header_arrays(self, headers: List[Dict[str, Any]]):
+        """
+        Extract the values used by the rules from a batch of headers.
+
+        :param headers: The headers, e.g. as returned by `dictify`.
+        :type headers: List[dict]
+        :return: The numeric values (NaN if missing) and the exact-match values.
+        :rtype: Tuple[numpy.ndarray, numpy.ndarray]
+        """
+        values = np.array(
+            [[to_float(h.get(key)) for key in self.range_keys] for h in headers],
+            dtype=float,
+        ).reshape(len(headers), len(self.range_keys))
+        strings = np.array(
+            [[str(h.get(key, "")) for key in self.match_keys] for h in headers],
+            dtype=object,
+        ).reshape(len(headers), len(self.match_keys))
+        return values, strings
+
+    def match_matrix(self, headers: List[Dict[str, Any]]) -> np.ndarray:
+        """
+        Evaluate every rule against every header.
+
+        :param headers: The headers to classify.
+        :type headers: List[dict]
+        :return: A boolean array of shape (headers, rules).
+        :rtype: numpy.ndarray
+        """
+        values, strings = self.header_arrays(headers)
+        with np.errstate(invalid="ignore"):
+            in_range = (values[:, None, :] >= self.lower[None]) & (
+                values[:, None, :] <= self.upper[None]
             )
-        else:
-            self.protocol_table_path = protocol_table_path
-            self.table_protocols = pd.read_csv(
-                protocol_table_path, sep="\t", index_col=False
+        in_range |= self.unbounded[None]
+        matches = (strings[:, None, :] == self.match_values[None]) | self.wildcard[None]
+        return in_range.all(axis=2) & matches.all(axis=2)
+
+    def classify(self, headers: List[Dict[str, Any]]) -> pd.DataFrame:
+        """
+        Classify a batch of series headers.
+
+        :param headers: The headers to classify, one per series.
+        :type headers: List[dict]
+        :return: One row per header with the matched `protocol` ("n/a" if no
+            rule matched), the index of the matching `rule` (-1 if none) and
+            the number of rules that matched (`matches`).
+        :rtype: pandas.DataFrame
+        """
+        rule = np.full(len(headers), -1, dtype=int)
+        n_matches = np.zeros(len(headers), dtype=int)
+        for start in range(0, len(headers), self.batch_size):
+            batch = self.match_matrix(headers[start : start + self.batch_size])
+            matched = batch.any(axis=1)
+            rule[start : start + len(batch)] = np.where(
+                matched, batch.argmax(axis=1), -1
             )
+            n_matches[start : start + len(batch)] = batch.sum(axis=1)
+        protocol = np.where(rule >= 0, self.labels[np.maximum(rule, 0)], "n/a")
+        return pd.DataFrame({"protocol": protocol, "rule": rule, "matches": n_matches})
 
     def classification_by_min_max(self, json: dict) -> list:
-        pass
+        """
+        Return the labels of all the rules matching a single header.
+
+        :param json: The header, e.g. as returned by `dictify`.
+        :type json: dict
+        :return: The matching protocol labels, in table order.
+        :rtype: list
+        """
+        return list(self.labels[self.match_matrix([json])[0]])
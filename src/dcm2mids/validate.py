@@ -0,0 +1,424 @@
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Set, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from .deduplicate import STATE_FOLDER
+from .generate_tsvs import read_tsv, write_tsv
+from .logger import set_logger
+from .writers import OutputWriter
+
+logger = logging.getLogger("dcm2mids").getChild("validate")
+
+MANIFEST_NAME = "manifest.tsv"
+HASH_CHUNK_BYTES = 1 << 20
+# Manifest rows hashed by each task
+MANIFEST_BATCH = 256
+
+PNG_TRAILER = b"\x00\x00\x00\x00IEND\xaeB`\x82"
+NIFTI1_HEADER_BYTES = 348
+# Extensions made of several suffixes, removed as a whole to get the stem of a file
+MULTI_SUFFIXES = (".nii.gz", ".ome.tif", ".ome.tiff")
+
+
+def file_stem(name: str) -> str:
+    """Return the name of a file without its extension, e.g. `sub-1_mr` for `sub-1_mr.nii.gz`."""
+    for suffix in MULTI_SUFFIXES:
+        if name.endswith(suffix):
+            return name[: -len(suffix)]
+    return os.path.splitext(name)[0]
+
+
+def file_digest(path: Union[Path, str]) -> str:
+    """Return the SHA-256 of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def nifti_data_bytes(header: bytes) -> Optional[int]:
+    """
+    Return the size a NIfTI-1 file should have, from its header.
+
+    :param header: The first 348 bytes of the file.
+    :type header: bytes
+    :return: The offset of the voxels plus their size, or None if the header
+        is not a NIfTI-1 header.
+    :rtype: Optional[int]
+    """
+    if len(header) < NIFTI1_HEADER_BYTES:
+        return None
+    for endian in "<>":
+        if struct.unpack(endian + "i", header[:4])[0] == NIFTI1_HEADER_BYTES:
+            break
+    else:
+        return None
+    dims = struct.unpack(endian + "8h", header[40:56])
+    bitpix = struct.unpack(endian + "h", header[72:74])[0]
+    vox_offset = struct.unpack(endian + "f", header[108:112])[0]
+    n_dims = min(max(dims[0], 0), 7)
+    voxels = int(np.prod([max(dim, 1) for dim in dims[1 : n_dims + 1]], dtype=np.int64))
+    return int(vox_offset) + voxels * bitpix // 8
+
+
+def check_file(path: Path) -> Optional[Tuple[str, str]]:
+    """
+    Check that an output file is complete, reading only what its format needs.
+
+    NIfTI files are compared with the size given by their header (for `.nii.gz`,
+    with the uncompressed size stored in the gzip trailer), PNG files must end
+    with their `IEND` chunk, NumPy files must hold the array of their header and
+    JSON files must parse. Any other file must not be empty.
+
+    :param path: The path to the file.
+    :type path: pathlib.Path
+    :return: The kind of the problem and a description, or None if the file is fine.
+    :rtype: Optional[Tuple[str, str]]
+    """
+    try:
+        size = path.stat().st_size
+        if size == 0:
+            return "empty", "the file is empty"
+        name = path.name
+        if name.endswith(".nii.gz"):
+            with gzip.open(path, "rb") as f:
+                expected = nifti_data_bytes(f.read(NIFTI1_HEADER_BYTES))
+            with open(path, "rb") as f:
+                f.seek(-4, os.SEEK_END)
+                stored = struct.unpack("<I", f.read(4))[0]
+            if expected is not None and stored != expected % (1 << 32):
+                return "truncated", f"{stored} bytes uncompressed, expected {expected}"
+        elif name.endswith(".nii"):
+            with open(path, "rb") as f:
+                expected = nifti_data_bytes(f.read(NIFTI1_HEADER_BYTES))
+            if expected is not None and size < expected:
+                return "truncated", f"{size} bytes, expected {expected}"
+        elif name.endswith(".png"):
+            with open(path, "rb") as f:
+                f.seek(-len(PNG_TRAILER), os.SEEK_END)
+                if f.read() != PNG_TRAILER:
+                    return "truncated", "the IEND chunk is missing"
+        elif name.endswith(".npy"):
+            with open(path, "rb") as f:
+                if np.lib.format.read_magic(f) == (1, 0):
+                    shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+                else:
+                    shape, _, dtype = np.lib.format.read_array_header_2_0(f)
+                expected = f.tell() + int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+            if size < expected:
+                return "truncated", f"{size} bytes, expected {expected}"
+        elif name.endswith(".json"):
+            with open(path, "rb") as f:
+                json.load(f)
+    except (OSError, EOFError, ValueError, struct.error) as e:
+        return "invalid", f"{type(e).__name__}: {e}"
+    return None
+
+
+class ValidationReport:
+    """Problems found in a MIDS dataset, one row per file."""
+
+    def __init__(self):
+        self.issues: List[Dict[str, str]] = []
+        self.files_checked = 0
+        self.checksums_verified = 0
+
+    def add(self, kind: str, path: Union[Path, str], detail: str = ""):
+        """Record a problem with a file: `missing`, `orphan`, `empty`, `truncated`, `invalid` or `checksum`."""
+        self.issues.append({"path": str(path), "kind": kind, "detail": detail})
+
+    def extend(self, other: "ValidationReport"):
+        """Add the problems and counters of another report."""
+        self.issues.extend(other.issues)
+        self.files_checked += other.files_checked
+        self.checksums_verified += other.checksums_verified
+
+    @property
+    def ok(self) -> bool:
+        """Whether no problem was found."""
+        return not self.issues
+
+    def counts(self) -> Dict[str, int]:
+        """Return the number of problems of each kind."""
+        counts: Dict[str, int] = {}
+        for issue in self.issues:
+            counts[issue["kind"]] = counts.get(issue["kind"], 0) + 1
+        return counts
+
+    def save(self, tsv_path: Path, writer: Optional[OutputWriter] = None):
+        """Write the problems to a TSV file."""
+        df = pd.DataFrame(self.issues, columns=["path", "kind", "detail"])
+        write_tsv(df.sort_values(["kind", "path"]), tsv_path, writer)
+
+    def log(self):
+        """Write the summary of the validation to the log."""
+        logger.info("Files checked: %d", self.files_checked)
+        if self.checksums_verified:
+            logger.info("Checksums verified: %d", self.checksums_verified)
+        for kind, count in sorted(self.counts().items()):
+            logger.warning("%s: %d", kind.capitalize(), count)
+        if self.ok:
+            logger.info("No problems found")
+
+
+def _list_ids(tsv_path: Path, column: str, fallback: str, prefix: str) -> Optional[Set[str]]:
+    if not tsv_path.exists():
+        return None
+    df = read_tsv(tsv_path)
+    if column in df.columns:
+        return {f"{prefix}{value}" for value in df[column]}
+    # Older files only have the BIDS id
+    return {f"{prefix}{value.split('-', 1)[-1]}" for value in df.get(fallback, [])}
+
+
+def _walk_files(directory: Path) -> Iterator[Path]:
+    stack = [directory]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(Path(entry.path))
+                else:
+                    yield Path(entry.path)
+
+
+def validate_session(mids_path: Path, session_dir: Path) -> ValidationReport:
+    """
+    Cross-check the scans TSV of a session with the files of its folder.
+
+    Every scan listed must exist and be complete, and its sidecars (the files
+    with the same stem, e.g. `.json`, `.bval`) must be valid. Files that
+    belong to no listed scan are orphans.
+
+    :param mids_path: The MIDS root, to report paths relative to it.
+    :type mids_path: pathlib.Path
+    :param session_dir: The folder of the session.
+    :type session_dir: pathlib.Path
+    :return: The problems found.
+    :rtype: dcm2mids.validate.ValidationReport
+    """
+    report = ValidationReport()
+    subject, session = session_dir.parent.name, session_dir.name
+    scans_tsv = session_dir / f"{subject}_{session}_scans.tsv"
+    files = {path for path in _walk_files(session_dir) if path != scans_tsv}
+    listed: Set[Tuple[Path, str]] = set()
+    if not scans_tsv.exists():
+        report.add("missing", scans_tsv.relative_to(mids_path), "no scans TSV for the session")
+    else:
+        df = read_tsv(scans_tsv)
+        for scan_file in df.iloc[:, 0] if len(df.columns) else []:
+            if scan_file == "n/a":
+                # A scan converted without image nor sidecar
+                continue
+            path = session_dir / scan_file
+            listed.add((path.parent, file_stem(path.name)))
+            if path not in files:
+                report.add("missing", path.relative_to(mids_path), "listed in the scans TSV")
+    for path in sorted(files):
+        relative = path.relative_to(mids_path)
+        if (path.parent, file_stem(path.name)) not in listed:
+            report.add("orphan", relative, "not listed in the scans TSV")
+            continue
+        report.files_checked += 1
+        problem = check_file(path)
+        if problem is not None:
+            report.add(problem[0], relative, problem[1])
+    return report
+
+
+def validate_subject(mids_path: Path, subject_dir: Path) -> Tuple[ValidationReport, List[Path]]:
+    """
+    Cross-check the sessions TSV of a subject with its session folders.
+
+    :return: The problems found, and the session folders to validate.
+    :rtype: Tuple[dcm2mids.validate.ValidationReport, List[pathlib.Path]]
+    """
+    report = ValidationReport()
+    subject = subject_dir.name
+    sessions_tsv = subject_dir / f"{subject}_sessions.tsv"
+    folders = sorted(p for p in subject_dir.iterdir() if p.is_dir() and p.name.startswith("ses-"))
+    listed = _list_ids(sessions_tsv, "session_pseudo_id", "session_id", "ses-")
+    if listed is None:
+        report.add("missing", sessions_tsv.relative_to(mids_path), "no sessions TSV for the subject")
+    else:
+        for name in sorted(listed - {p.name for p in folders}):
+            report.add("missing", (subject_dir / name).relative_to(mids_path), "listed in the sessions TSV")
+        for folder in folders:
+            if folder.name not in listed:
+                report.add("orphan", folder.relative_to(mids_path), "not listed in the sessions TSV")
+    return report, folders
+
+
+def _verify_checksums(mids_path: Path, rows: List[Dict[str, str]]) -> ValidationReport:
+    report = ValidationReport()
+    for row in rows:
+        path = mids_path / row["path"]
+        try:
+            size = path.stat().st_size
+        except OSError:
+            report.add("missing", row["path"], "listed in the manifest")
+            continue
+        if str(size) != str(row["size"]):
+            report.add("checksum", row["path"], f"{size} bytes, the manifest has {row['size']}")
+            continue
+        if file_digest(path) != row["sha256"]:
+            report.add("checksum", row["path"], "the SHA-256 differs from the manifest")
+        report.checksums_verified += 1
+    return report
+
+
+def _digest_files(paths: List[Path]) -> List[str]:
+    return [file_digest(path) for path in paths]
+
+
+def write_manifest(
+    mids_path: Union[Path, str], workers: Optional[int] = None
+) -> Path:
+    """
+    Write the size and SHA-256 of every file of the dataset to `.dcm2mids/manifest.tsv`.
+
+    :param mids_path: The MIDS root.
+    :type mids_path: Union[pathlib.Path, str]
+    :param workers: Threads hashing the files.
+    :type workers: int, optional
+    :return: The path of the manifest.
+    :rtype: pathlib.Path
+    """
+    mids_path = Path(mids_path)
+    state = mids_path / STATE_FOLDER
+    paths = [p for p in _walk_files(mids_path) if state not in p.parents]
+    with ThreadPoolExecutor(workers) as executor:
+        tasks = [
+            executor.submit(_digest_files, paths[i : i + MANIFEST_BATCH])
+            for i in range(0, len(paths), MANIFEST_BATCH)
+        ]
+        digests = [digest for task in tasks for digest in task.result()]
+    df = pd.DataFrame(
+        {
+            "path": [str(p.relative_to(mids_path)) for p in paths],
+            "size": [p.stat().st_size for p in paths],
+            "sha256": digests,
+        }
+    )
+    manifest = state / MANIFEST_NAME
+    write_tsv(df.sort_values("path"), manifest)
+    logger.info("Manifest of %d files written to %s", len(df), manifest)
+    return manifest
+
+
+def validate(
+    mids_path: Union[Path, str], workers: Optional[int] = None, checksums: bool = True
+) -> ValidationReport:
+    """
+    Validate a MIDS dataset.
+
+    The participants, sessions and scans TSV files are cross-checked with the
+    folders and files present, each listed file is checked for truncation and
+    each sidecar must parse. If `.dcm2mids/manifest.tsv` exists, the size and
+    SHA-256 of its files are verified too. Subjects, sessions and manifest
+    batches are validated in a thread pool.
+
+    :param mids_path: The MIDS root.
+    :type mids_path: Union[pathlib.Path, str]
+    :param workers: Threads used for the validation.
+    :type workers: int, optional
+    :param checksums: Verify the checksums of the manifest, if there is one.
+    :type checksums: bool
+    :return: The problems found.
+    :rtype: dcm2mids.validate.ValidationReport
+    """
+    mids_path = Path(mids_path)
+    if not mids_path.is_dir():
+        raise NotADirectoryError(f"{mids_path} is not a directory.")
+    report = ValidationReport()
+    subjects = sorted(p for p in mids_path.iterdir() if p.is_dir() and p.name.startswith("sub-"))
+    participants_tsv = mids_path / "participants.tsv"
+    listed = _list_ids(participants_tsv, "participant_pseudo_id", "participant_id", "sub-")
+    if listed is None:
+        report.add("missing", "participants.tsv", "no participants TSV")
+    else:
+        for name in sorted(listed - {p.name for p in subjects}):
+            report.add("missing", name, "listed in the participants TSV")
+        for subject_dir in subjects:
+            if subject_dir.name not in listed:
+                report.add("orphan", subject_dir.name, "not listed in the participants TSV")
+
+    with ThreadPoolExecutor(workers) as executor:
+        session_tasks = []
+        for subject_report, folders in executor.map(
+            lambda subject_dir: validate_subject(mids_path, subject_dir), subjects
+        ):
+            report.extend(subject_report)
+            session_tasks.extend(
+                executor.submit(validate_session, mids_path, folder) for folder in folders
+            )
+        manifest = mids_path / STATE_FOLDER / MANIFEST_NAME
+        checksum_tasks = []
+        if checksums and manifest.exists():
+            rows = read_tsv(manifest).to_dict("records")
+            checksum_tasks = [
+                executor.submit(_verify_checksums, mids_path, rows[i : i + MANIFEST_BATCH])
+                for i in range(0, len(rows), MANIFEST_BATCH)
+            ]
+        for task in session_tasks + checksum_tasks:
+            report.extend(task.result())
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check that the files of a MIDS dataset match its TSV files and manifest."
+    )
+    parser.add_argument(
+        "-o", "--output", type=Path, help="Path to the MIDS folder", required=True
+    )
+    parser.add_argument(
+        "-j", "--workers", type=int, help="Threads used for the validation"
+    )
+    parser.add_argument(
+        "--no-checksums",
+        dest="checksums",
+        action="store_false",
+        help="Do not verify the checksums of the manifest",
+    )
+    parser.add_argument(
+        "--write-manifest",
+        dest="write_manifest",
+        action="store_true",
+        help="Write the checksums of every file to .dcm2mids/manifest.tsv after the validation",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        dest="verbose",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        default="INFO",
+        help="Verbose level. One of DEBUG, INFO, WARNING, ERROR",
+    )
+    parser.add_argument(
+        "-log", "--logfile", type=Path, help="Path to the file to store logs"
+    )
+    args = parser.parse_args()
+    set_logger(level=getattr(logging, args.verbose), outpath=args.logfile)
+    report = validate(args.output, args.workers, args.checksums)
+    report.log()
+    if not report.ok:
+        report.save(args.output / STATE_FOLDER / "validation.tsv")
+    if args.write_manifest:
+        write_manifest(args.output, args.workers)
+    raise SystemExit(0 if report.ok else 1)
+
+
+if __name__ == "__main__":
+    main()
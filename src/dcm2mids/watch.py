@@ -0,0 +1,476 @@
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+import pandas as pd
+from pydicom import dcmread
+
+from .create_mids_directory import update_mids_directory
+from .deduplicate import STATE_FOLDER, ContentStore, DuplicateDetector
+from .generate_tsvs import append_tsv, read_tsv
+from .get_dicomdir import get_dicomdir, is_dicom_file
+from .journal import FailureJournal, FaultPolicy
+from .memory import MemoryBudget
+from .report import RunReport
+from .writers import FilesystemWriter
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:  # pragma: no cover
+    INotify = None
+
+logger = logging.getLogger("dcm2mids").getChild("watch")
+
+# Seconds without new files after which a series is considered complete
+QUIET_PERIOD = 30.0
+
+# Seconds between two polls of the input tree, or maximum wait for inotify events
+POLL_INTERVAL = 2.0
+
+
+def snapshot(
+    input_dir: Union[Path, str], exclude_paths: List[Union[Path, str]] = None
+) -> Dict[str, Tuple[int, float]]:
+    """
+    Return the size and modification time of every file under a directory.
+
+    :param input_dir: The directory to walk.
+    :type input_dir: Union[pathlib.Path, str]
+    :param exclude_paths: Files or directories to leave out of the walk.
+    :type exclude_paths: List[Union[pathlib.Path, str]], optional
+    :return: The (size, mtime) of each file, by path.
+    :rtype: Dict[str, Tuple[int, float]]
+    """
+    excluded = {os.path.abspath(p) for p in exclude_paths or []}
+    files = {}
+    stack = [os.path.abspath(input_dir)]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.path in excluded or entry.name == "DICOMDIR":
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file():
+                    stat = entry.stat()
+                    files[entry.path] = (stat.st_size, stat.st_mtime)
+            except OSError:
+                continue
+    return files
+
+
+class PollingObserver:
+    """Report the files created or modified under a directory by walking it periodically.
+
+    :param input_dir: The directory to watch.
+    :type input_dir: Union[pathlib.Path, str]
+    :param exclude_paths: Files or directories to ignore.
+    :type exclude_paths: List[Union[pathlib.Path, str]], optional
+    """
+
+    def __init__(
+        self, input_dir: Union[Path, str], exclude_paths: List[Union[Path, str]] = None
+    ):
+        self.input_dir = input_dir
+        self.exclude_paths = exclude_paths
+        self.files: Dict[str, Tuple[int, float]] = {}
+
+    def poll(self, timeout: float) -> List[Path]:
+        """
+        Return the files that changed since the last call, the existing ones on the first.
+
+        :param timeout: Seconds to wait before walking the directory, except on the first call.
+        :type timeout: float
+        :return: The changed files.
+        :rtype: List[pathlib.Path]
+        """
+        if self.files:
+            time.sleep(timeout)
+        files = snapshot(self.input_dir, self.exclude_paths)
+        changed = [Path(p) for p, stat in files.items() if self.files.get(p) != stat]
+        self.files = files
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyObserver:
+    """Report the files written under a directory with inotify, watching new folders as they appear.
+
+    Needs the optional `inotify_simple` package, and Linux.
+
+    :param input_dir: The directory to watch.
+    :type input_dir: Union[pathlib.Path, str]
+    :param exclude_paths: Files or directories to ignore.
+    :type exclude_paths: List[Union[pathlib.Path, str]], optional
+    """
+
+    def __init__(
+        self, input_dir: Union[Path, str], exclude_paths: List[Union[Path, str]] = None
+    ):
+        if INotify is None:
+            raise RuntimeError("inotify_simple is not installed")
+        self.excluded = {os.path.abspath(p) for p in exclude_paths or []}
+        self.inotify = INotify()
+        self.mask = flags.CREATE | flags.CLOSE_WRITE | flags.MOVED_TO
+        self.directories: Dict[int, str] = {}
+        self.pending = self._add_tree(os.path.abspath(input_dir))
+
+    def _add_tree(self, root: str) -> List[Path]:
+        """Watch a directory and its subdirectories, returning the files already in them."""
+        files = []
+        for directory, subdirectories, filenames in os.walk(root):
+            subdirectories[:] = [
+                d for d in subdirectories if os.path.join(directory, d) not in self.excluded
+            ]
+            self.directories[self.inotify.add_watch(directory, self.mask)] = directory
+            files.extend(
+                Path(directory, name)
+                for name in filenames
+                if name != "DICOMDIR" and os.path.join(directory, name) not in self.excluded
+            )
+        return files
+
+    def poll(self, timeout: float) -> List[Path]:
+        """
+        Return the files written since the last call, the existing ones on the first.
+
+        :param timeout: Maximum seconds to wait for an event.
+        :type timeout: float
+        :return: The written files.
+        :rtype: List[pathlib.Path]
+        """
+        changed, self.pending = self.pending, []
+        if changed:
+            return changed
+        for event in self.inotify.read(timeout=int(timeout * 1000)):
+            directory = self.directories.get(event.wd)
+            if directory is None or not event.name:
+                continue
+            path = os.path.join(directory, event.name)
+            if path in self.excluded or event.name == "DICOMDIR":
+                continue
+            if event.mask & flags.ISDIR:
+                if event.mask & (flags.CREATE | flags.MOVED_TO):
+                    changed.extend(self._add_tree(path))
+            elif event.mask & (flags.CLOSE_WRITE | flags.MOVED_TO):
+                changed.append(Path(path))
+        return changed
+
+    def close(self):
+        self.inotify.close()
+
+
+def make_observer(
+    input_dir: Union[Path, str],
+    exclude_paths: List[Union[Path, str]] = None,
+    polling: bool = False,
+):
+    """Return an inotify observer when available, a polling observer otherwise."""
+    if not polling and INotify is not None:
+        try:
+            return InotifyObserver(input_dir, exclude_paths)
+        except OSError as e:
+            logger.warning("inotify is not available (%s), polling instead", e)
+    else:
+        logger.debug("Polling %s for new files", input_dir)
+    return PollingObserver(input_dir, exclude_paths)
+
+
+class SeriesTracker:
+    """Group arriving files by series and release each series once it is quiet.
+
+    A series is complete when none of its files changed for `quiet_period`
+    seconds. Files whose header can not be read yet, e.g. while they are
+    being copied, are retried until they have not changed for as long.
+
+    :param quiet_period: Seconds without changes after which a series is complete.
+    :type quiet_period: float
+    """
+
+    def __init__(self, quiet_period: float = QUIET_PERIOD):
+        self.quiet_period = quiet_period
+        self.series: Dict[str, Dict[Path, Tuple[int, float]]] = {}
+        self.last_change: Dict[str, float] = {}
+        self.unreadable: Dict[Path, float] = {}
+
+    def add(self, path: Path, now: float):
+        """
+        Record a new or modified file.
+
+        :param path: The file.
+        :type path: pathlib.Path
+        :param now: The time of the change, from `time.monotonic()`.
+        :type now: float
+        """
+        try:
+            stat = path.stat()
+        except OSError:
+            return
+        if not (path.name.lower().endswith(".dcm") or is_dicom_file(path)):
+            if stat.st_size >= 132:
+                return
+            # Too short to tell yet
+            self.unreadable[path] = now
+            return
+        try:
+            ds = dcmread(path, stop_before_pixels=True, specific_tags=["SeriesInstanceUID"])
+            uid = str(ds.SeriesInstanceUID)
+        except Exception:
+            self.unreadable[path] = now
+            return
+        self.unreadable.pop(path, None)
+        self.series.setdefault(uid, {})[path] = (stat.st_size, stat.st_mtime)
+        self.last_change[uid] = now
+
+    def pop_ready(self, now: float) -> List[List[Path]]:
+        """
+        Remove and return the files of each complete series.
+
+        :param now: The current time, from `time.monotonic()`.
+        :type now: float
+        :return: The files of each complete series.
+        :rtype: List[List[pathlib.Path]]
+        """
+        for path, changed in list(self.unreadable.items()):
+            if now - changed >= self.quiet_period:
+                logger.debug("Ignoring %s: not a readable DICOM file", path)
+                del self.unreadable[path]
+            else:
+                self.add(path, changed)
+        ready = [
+            uid
+            for uid, changed in self.last_change.items()
+            if now - changed >= self.quiet_period
+        ]
+        for uid in ready:
+            del self.last_change[uid]
+        return [sorted(self.series.pop(uid)) for uid in ready]
+
+    @property
+    def pending(self) -> int:
+        """The number of series waiting for their quiet period to end."""
+        return len(self.series)
+
+
+class WatchState:
+    """The input files already converted by the watcher, persisted in `.dcm2mids/watched.tsv`.
+
+    The file only grows: each batch appends its rows, and the last row of a
+    file wins when it is read back.
+
+    :param mids_path: The MIDS root.
+    :type mids_path: Union[pathlib.Path, str]
+    """
+
+    def __init__(self, mids_path: Union[Path, str]):
+        self.path = Path(mids_path).joinpath(STATE_FOLDER, "watched.tsv")
+        self.files: Dict[str, Tuple[int, float]] = {}
+        self.unsaved: Dict[str, Tuple[int, float]] = {}
+        if self.path.exists():
+            df = read_tsv(self.path)
+            self.files = {
+                p: (int(size), float(mtime))
+                for p, size, mtime in zip(df["path"], df["size"], df["mtime"])
+            }
+
+    def is_converted(self, path: Path) -> bool:
+        try:
+            stat = path.stat()
+        except OSError:
+            return False
+        return self.files.get(str(path)) == (stat.st_size, stat.st_mtime)
+
+    def add(self, files: Dict[Path, Tuple[int, float]]):
+        files = {str(p): stat for p, stat in files.items()}
+        self.files.update(files)
+        self.unsaved.update(files)
+
+    def save(self):
+        """Append the files added since the last save."""
+        if not self.unsaved:
+            return
+        append_tsv(
+            pd.DataFrame(
+                [(p, size, repr(mtime)) for p, (size, mtime) in self.unsaved.items()],
+                columns=["path", "size", "mtime"],
+            ),
+            self.path,
+        )
+        self.unsaved = {}
+
+
+class Watcher:
+    """Convert the series arriving in an input folder as they complete.
+
+    The decoder, content store, duplicate detector and memory budget are
+    created once and kept across arrivals. Each batch of complete series is
+    converted with `update_mids_directory`, so only the affected TSV rows change.
+    A batch that fails is logged and its files are recorded in the failure
+    journal, with the `batch` stage, and the watcher goes on with the next one.
+
+    :param input_dir: The folder to watch.
+    :type input_dir: Union[pathlib.Path, str]
+    :param mids_path: The MIDS root, on the filesystem.
+    :type mids_path: Union[pathlib.Path, str]
+    :param bodypart: The body part of the dataset.
+    :type bodypart: str
+    :param quiet_period: Seconds without new files after which a series is complete.
+    :type quiet_period: float
+    :param poll_interval: Seconds between two polls of the input folder.
+    :type poll_interval: float
+    :param exclude_paths: Files or folders inside the input folder to ignore.
+    :type exclude_paths: List[Union[pathlib.Path, str]], optional
+    :param observer: The observer of the input folder. By default inotify is
+        used when available, polling otherwise.
+    :param polling: Poll the input folder even if inotify is available.
+    :type polling: bool
+    :param fault_policy: Isolate the files and series that fail within a batch,
+        with its timeout and retries. Its journal also records the failed batches.
+    :type fault_policy: dcm2mids.journal.FaultPolicy, optional
+    :param options: Passed to `create_mids_directory`, e.g. `decoder` or `content_store`.
+    """
+
+    def __init__(
+        self,
+        input_dir: Union[Path, str],
+        mids_path: Union[Path, str],
+        bodypart: str,
+        quiet_period: float = QUIET_PERIOD,
+        poll_interval: float = POLL_INTERVAL,
+        exclude_paths: List[Union[Path, str]] = None,
+        observer=None,
+        polling: bool = False,
+        duplicate_detector: Optional[DuplicateDetector] = None,
+        memory_budget: Optional[MemoryBudget] = None,
+        content_store: Optional[ContentStore] = None,
+        fault_policy: Optional[FaultPolicy] = None,
+        **options,
+    ):
+        self.input_dir = Path(input_dir)
+        self.mids_path = Path(mids_path)
+        self.bodypart = bodypart
+        self.poll_interval = poll_interval
+        # Never watch the output if it is inside the input folder
+        self.exclude_paths = list(exclude_paths or []) + [self.mids_path]
+        self.observer = observer or make_observer(
+            self.input_dir, self.exclude_paths, polling
+        )
+        self.tracker = SeriesTracker(quiet_period)
+        self.state = WatchState(self.mids_path)
+        self.duplicate_detector = duplicate_detector or DuplicateDetector()
+        self.memory_budget = memory_budget
+        self.content_store = content_store
+        self.fault_policy = fault_policy
+        # Failed batches are journaled even without a fault policy
+        self.journal = (
+            fault_policy.journal if fault_policy is not None else FailureJournal(self.mids_path)
+        )
+        self.writer = options.pop("writer", None) or FilesystemWriter(self.mids_path)
+        self.options = options
+        self.batches = 0
+        self.failed_batches = 0
+
+    def step(self, now: Optional[float] = None) -> Optional[RunReport]:
+        """
+        Wait for changes once, and convert the series that became complete.
+
+        :param now: The current time, from `time.monotonic()`. Taken after polling if None.
+        :type now: float, optional
+        :return: The report of the conversion, or None if no series was complete.
+        :rtype: Optional[dcm2mids.report.RunReport]
+        """
+        for path in self.observer.poll(self.poll_interval):
+            if not self.state.is_converted(path):
+                self.tracker.add(path, time.monotonic() if now is None else now)
+        ready = self.tracker.pop_ready(time.monotonic() if now is None else now)
+        if not ready:
+            return None
+        return self.convert([path for series in ready for path in series])
+
+    def convert(self, paths: List[Path]) -> Optional[RunReport]:
+        """
+        Convert a batch of files and merge them into the existing TSVs.
+
+        :param paths: The files of the complete series.
+        :type paths: List[pathlib.Path]
+        :return: The report of the conversion, or None if every file was skipped
+            or the batch failed.
+        :rtype: Optional[dcm2mids.report.RunReport]
+        """
+        stats = {}
+        for path in paths:
+            try:
+                stat = path.stat()
+                stats[path] = (stat.st_size, stat.st_mtime)
+            except OSError:
+                logger.warning("%s disappeared before it was converted", path)
+        try:
+            report = self._convert_batch(list(stats))
+        except Exception as e:
+            self.failed_batches += 1
+            logger.exception("Batch of %d files failed", len(stats))
+            # Not marked as converted, so a restarted watcher tries them again
+            self.journal.record("batch", list(stats), e)
+            return None
+        self.state.add(stats)
+        self.state.save()
+        return report
+
+    def _convert_batch(self, paths: List[Path]) -> Optional[RunReport]:
+        try:
+            fileset = get_dicomdir(
+                self.input_dir,
+                duplicate_detector=self.duplicate_detector,
+                paths=paths,
+                fault_policy=self.fault_policy,
+            )
+        except RuntimeError:
+            logger.info("No new instances in %d files", len(paths))
+            return None
+        report = update_mids_directory(
+            fileset,
+            self.mids_path,
+            self.bodypart,
+            writer=self.writer,
+            memory_budget=self.memory_budget,
+            content_store=self.content_store,
+            fault_policy=self.fault_policy,
+            **self.options,
+        )
+        self.batches += 1
+        logger.info(
+            "Converted %d series from %d files, %d series pending",
+            len(report.series),
+            len(paths),
+            self.tracker.pending,
+        )
+        return report
+
+    def run(self, stop: Optional[threading.Event] = None):
+        """
+        Watch the input folder until `stop` is set or the process is interrupted.
+
+        :param stop: Event ending the watch.
+        :type stop: threading.Event, optional
+        """
+        logger.info("Watching %s", self.input_dir)
+        try:
+            while stop is None or not stop.is_set():
+                report = self.step()
+                if report is not None:
+                    report.log()
+        except KeyboardInterrupt:
+            logger.info("Stopped watching %s", self.input_dir)
+        finally:
+            self.observer.close()
@@ -0,0 +1,388 @@
+import io
+import logging
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import weakref
+import zipfile
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from pathlib import Path
+from typing import BinaryIO, Iterator, List, Optional, Union
+
+import SimpleITK as sitk
+
+from .encoding import EncodingProfile
+
+logger = logging.getLogger("dcm2mids").getChild("writers")
+
+# Output names ending with one of these are written as archives
+ARCHIVE_SUFFIXES = [".tar.gz", ".tgz", ".tar", ".zip"]
+
+# Already compressed formats, stored as they are in zip archives
+COMPRESSED_SUFFIXES = [".png", ".jpg", ".jpeg", ".gz", ".zip"]
+
+
+def _current_umask() -> int:
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# Permissions of the files written, as open() would create them
+FILE_MODE = 0o666 & ~_current_umask()
+
+
+# Threads whose writes are dropped, e.g. a conversion abandoned after a timeout
+_discarded_threads: "weakref.WeakSet[threading.Thread]" = weakref.WeakSet()
+
+
+def discard_output(thread: threading.Thread):
+    """Drop every file written by `thread` from now on, instead of writing it to the output."""
+    _discarded_threads.add(thread)
+
+
+def output_discarded() -> bool:
+    """Whether the files written by the current thread are dropped."""
+    return threading.current_thread() in _discarded_threads
+
+
+def output_suffix(path: Path) -> str:
+    """Return the extension of an output file, keeping `.nii.gz` whole."""
+    return ".nii.gz" if path.name.endswith(".nii.gz") else path.suffix
+
+
+def archive_suffix(path: Path) -> Optional[str]:
+    """Return the archive extension of `path`, or None if it is not an archive name."""
+    return next((s for s in ARCHIVE_SUFFIXES if path.name.endswith(s)), None)
+
+
+class OutputWriter(ABC):
+    """Destination of the files of a MIDS dataset.
+
+    Procedures and TSV writers address files by their path under `root`, as
+    if they were written to a directory, and the writer decides where the
+    bytes actually go.
+
+    :param root: The root of the MIDS dataset.
+    :type root: Union[pathlib.Path, str]
+    :param encoding: How images are encoded. SimpleITK defaults if None.
+    :type encoding: dcm2mids.encoding.EncodingProfile, optional
+    """
+
+    def __init__(self, root: Union[Path, str], encoding: Optional[EncodingProfile] = None):
+        self.root = Path(root)
+        self.encoding = encoding or EncodingProfile()
+        self.files_written = 0
+        self.bytes_written = 0
+        # Series may be converted in several threads at once
+        self._lock = threading.Lock()
+
+    def _count(self, nbytes: int):
+        with self._lock:
+            self.files_written += 1
+            self.bytes_written += nbytes
+
+    @abstractmethod
+    def write_bytes(self, path: Path, data: bytes):
+        """Write `data` to the file at `path`."""
+
+    @abstractmethod
+    def write_file(self, source: Union[Path, str], path: Path):
+        """Copy the existing file `source` to `path`."""
+
+    def write_text(self, path: Path, text: str):
+        """Write `text`, encoded as UTF-8, to the file at `path`."""
+        self.write_bytes(path, text.encode("utf-8"))
+
+    def write_image(self, image: sitk.Image, path: Path):
+        """
+        Write an image, in the format given by the extension of `path`.
+
+        SimpleITK can only write to files, so the image is written to a
+        temporary file which is then copied to `path`.
+
+        :param image: The image.
+        :type image: SimpleITK.Image
+        :param path: The path of the image in the dataset.
+        :type path: pathlib.Path
+        """
+        with tempfile.TemporaryDirectory(prefix="dcm2mids-") as tmp_dir:
+            tmp_path = Path(tmp_dir, "image" + output_suffix(path))
+            self.encoding.write_image(image, tmp_path)
+            self.write_file(tmp_path, path)
+
+    @contextmanager
+    def open(self, path: Path) -> Iterator[BinaryIO]:
+        """
+        Open the file at `path` for writing in binary mode, e.g. to stream it in chunks.
+
+        The data is written to a temporary file, which is copied to `path`
+        when the context exits without error.
+
+        :param path: The path of the file in the dataset.
+        :type path: pathlib.Path
+        :return: A context manager yielding the open file.
+        :rtype: Iterator[BinaryIO]
+        """
+        with tempfile.TemporaryDirectory(prefix="dcm2mids-") as tmp_dir:
+            tmp_path = Path(tmp_dir, "stream" + output_suffix(path))
+            with open(tmp_path, "wb") as f:
+                yield f
+            self.write_file(tmp_path, path)
+
+    def close(self):
+        """Flush and close the output."""
+        self.encoding.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FilesystemWriter(OutputWriter):
+    """Write the files to a directory tree.
+
+    Files and images are written atomically: the data goes to a temporary
+    file in the same directory, which then replaces the target, so readers
+    never see a partially written file and a target linked to another output
+    is never written through.
+    """
+
+    @contextmanager
+    def _replace(self, path: Path, suffix: str = ".tmp") -> Iterator[Optional[Path]]:
+        """
+        Yield a temporary path next to `path`, which replaces it when the
+        context exits without error.
+
+        :param path: The path of the file in the dataset.
+        :type path: pathlib.Path
+        :param suffix: The extension of the temporary file.
+        :type suffix: str
+        :return: A context manager yielding the temporary path, or None if
+            the output of the current thread is discarded.
+        :rtype: Iterator[Optional[pathlib.Path]]
+        """
+        if output_discarded():
+            yield None
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(
+            dir=path.parent, prefix=f".{path.name}.", suffix=suffix
+        )
+        os.close(fd)
+        tmp_path = Path(tmp_name)
+        try:
+            yield tmp_path
+            if output_discarded():
+                # Abandoned while the file was being written
+                tmp_path.unlink()
+                return
+            # mkstemp creates the file readable by its owner only
+            os.chmod(tmp_path, FILE_MODE)
+            os.replace(tmp_path, path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+        self._count(path.stat().st_size)
+
+    def write_bytes(self, path: Path, data: bytes):
+        with self.open(path) as f:
+            f.write(data)
+
+    @contextmanager
+    def open(self, path: Path) -> Iterator[BinaryIO]:
+        with self._replace(path) as tmp_path:
+            with open(tmp_path or os.devnull, "wb") as f:
+                yield f
+
+    def write_file(self, source: Union[Path, str], path: Path):
+        with self._replace(path) as tmp_path:
+            if tmp_path is not None:
+                shutil.copyfile(source, tmp_path)
+
+    def write_image(self, image: sitk.Image, path: Path):
+        # SimpleITK picks the format from the extension of the temporary file
+        with self._replace(path, ".tmp" + output_suffix(path)) as tmp_path:
+            if tmp_path is not None:
+                self.encoding.write_image(image, tmp_path)
+
+
+class ArchiveWriter(OutputWriter):
+    """Stream the files into an archive, or a sequence of size-bounded archives.
+
+    Nothing is written under `root`: the path of each file relative to it
+    becomes its name in the archive. With `max_bytes`, a new archive is
+    started whenever the next file would take the current one over the limit
+    (a single larger file gets an archive of its own), and the archives are
+    numbered `<name>-0000<suffix>`, `<name>-0001<suffix>`, ...
+
+    :param root: The root of the MIDS dataset.
+    :type root: Union[pathlib.Path, str]
+    :param archive_path: The path of the archive.
+    :type archive_path: Union[pathlib.Path, str]
+    :param max_bytes: Maximum size of the files in each archive, before compression.
+    :type max_bytes: int, optional
+    :param encoding: How images are encoded. SimpleITK defaults if None.
+    :type encoding: dcm2mids.encoding.EncodingProfile, optional
+    """
+
+    def __init__(
+        self,
+        root: Union[Path, str],
+        archive_path: Union[Path, str],
+        max_bytes: Optional[int] = None,
+        encoding: Optional[EncodingProfile] = None,
+    ):
+        super().__init__(root, encoding)
+        self.archive_path = Path(archive_path)
+        self.max_bytes = max_bytes
+        self.archives: List[Path] = []
+        self._archive = None
+        self._size = 0
+
+    def _next_path(self) -> Path:
+        if self.max_bytes is None:
+            return self.archive_path
+        suffix = archive_suffix(self.archive_path) or ""
+        stem = self.archive_path.name[: len(self.archive_path.name) - len(suffix)]
+        return self.archive_path.with_name(f"{stem}-{len(self.archives):04d}{suffix}")
+
+    def _arcname(self, path: Path) -> str:
+        try:
+            return Path(path).relative_to(self.root).as_posix()
+        except ValueError:
+            raise ValueError(f"{path} is outside the dataset root {self.root}") from None
+
+    def _reserve(self, nbytes: int):
+        if (
+            self._archive is not None
+            and self.max_bytes is not None
+            and self._size > 0
+            and self._size + nbytes > self.max_bytes
+        ):
+            self._close_archive()
+        if self._archive is None:
+            path = self._next_path()
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self._archive = self._open(path)
+            self.archives.append(path)
+            logger.info("Writing to %s", path)
+        self._size += nbytes
+        self.files_written += 1
+        self.bytes_written += nbytes
+
+    def write_bytes(self, path: Path, data: bytes):
+        if output_discarded():
+            return
+        name = self._arcname(path)
+        with self._lock:
+            self._reserve(len(data))
+            self._add_bytes(name, data)
+
+    def write_file(self, source: Union[Path, str], path: Path):
+        if output_discarded():
+            return
+        name = self._arcname(path)
+        with self._lock:
+            self._reserve(os.path.getsize(source))
+            self._add_file(source, name)
+
+    def _close_archive(self):
+        self._archive.close()
+        self._archive = None
+        self._size = 0
+
+    def close(self):
+        if self._archive is not None:
+            self._close_archive()
+        super().close()
+
+    @abstractmethod
+    def _open(self, path: Path):
+        """Open a new archive for writing."""
+
+    @abstractmethod
+    def _add_bytes(self, name: str, data: bytes):
+        """Add a member with the given contents to the current archive."""
+
+    @abstractmethod
+    def _add_file(self, source: Union[Path, str], name: str):
+        """Add an existing file as a member of the current archive."""
+
+
+class TarWriter(ArchiveWriter):
+    """Stream the files into tar archives, gzip compressed if the name ends with `.gz` or `.tgz`."""
+
+    def _open(self, path: Path):
+        compressed = path.name.endswith((".gz", ".tgz"))
+        return tarfile.open(str(path), "w|gz" if compressed else "w|")
+
+    def _add_bytes(self, name: str, data: bytes):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        self._archive.addfile(info, io.BytesIO(data))
+
+    def _add_file(self, source: Union[Path, str], name: str):
+        self._archive.add(str(source), arcname=name, recursive=False)
+
+
+class ZipWriter(ArchiveWriter):
+    """Write the files into zip archives, deflating all but the already compressed formats."""
+
+    def _open(self, path: Path):
+        return zipfile.ZipFile(path, "w", allowZip64=True)
+
+    @staticmethod
+    def _compress_type(name: str) -> int:
+        if name.lower().endswith(tuple(COMPRESSED_SUFFIXES)):
+            return zipfile.ZIP_STORED
+        return zipfile.ZIP_DEFLATED
+
+    def _add_bytes(self, name: str, data: bytes):
+        info = zipfile.ZipInfo(name, time.localtime()[:6])
+        info.compress_type = self._compress_type(name)
+        info.external_attr = 0o644 << 16
+        self._archive.writestr(info, data)
+
+    def _add_file(self, source: Union[Path, str], name: str):
+        self._archive.write(source, name, self._compress_type(name))
+
+
+def open_writer(
+    output: Union[Path, str],
+    max_bytes: Optional[int] = None,
+    encoding: Optional[EncodingProfile] = None,
+) -> OutputWriter:
+    """
+    Return the writer for an output path.
+
+    Paths ending with `.tar`, `.tar.gz`, `.tgz` or `.zip` are written as
+    archives, whose dataset root is the path without the archive extension.
+    Any other path is written as a directory.
+
+    :param output: The output directory or archive.
+    :type output: Union[pathlib.Path, str]
+    :param max_bytes: Split archives in parts of at most this many bytes. Ignored
+        for directories.
+    :type max_bytes: int, optional
+    :param encoding: How images are encoded. SimpleITK defaults if None.
+    :type encoding: dcm2mids.encoding.EncodingProfile, optional
+    :return: The writer.
+    :rtype: OutputWriter
+    """
+    output = Path(output)
+    suffix = archive_suffix(output)
+    if suffix is None:
+        return FilesystemWriter(output, encoding)
+    root = output.with_name(output.name[: -len(suffix)])
+    if suffix == ".zip":
+        return ZipWriter(root, output, max_bytes, encoding)
+    return TarWriter(root, output, max_bytes, encoding)
@@ -0,0 +1,108 @@
+import shutil
+from pathlib import Path
+
+from pydicom import dcmread
+from pydicom.data import get_testdata_file
+from pydicom.uid import generate_uid
+
+from dcm2mids import convert
+from dcm2mids.api import Converter
+from dcm2mids.generate_tsvs import read_tsv
+
+TEST_MR_DICOM = Path(get_testdata_file("MR_small.dcm", download=False))  # type: ignore
+TEST_SC_DICOM = Path(get_testdata_file("SC_rgb_small_odd.dcm", download=False))  # type: ignore
+TEST_ECG_DICOM = Path(get_testdata_file("waveform_ecg.dcm", download=False))  # type: ignore
+
+
+def make_inputs(tmp_path):
+    first, second = tmp_path / "first", tmp_path / "second"
+    first.mkdir()
+    second.mkdir()
+    shutil.copy(TEST_MR_DICOM, first / "mr.dcm")
+    # The same MR instance under the second root is converted only once
+    shutil.copy(TEST_MR_DICOM, second / "mr.dcm")
+    ds = dcmread(TEST_SC_DICOM)
+    ds.PatientID, ds.StudyID = "4MR1", "4MR1"
+    ds.SeriesInstanceUID = generate_uid()
+    ds.SOPInstanceUID = generate_uid()
+    ds.save_as(second / "sc.dcm")
+    return first, second
+
+
+def test_convert_several_inputs(tmp_path):
+    first, second = make_inputs(tmp_path)
+    output = tmp_path / "mids"
+    result = convert([first, second], output, "head")
+
+    assert [row["input"] for row in result.series] == [str(first), str(second)]
+    assert [row["modality"] for row in result.series] == ["MR", "OT"]
+    assert all(row["status"] == "converted" for row in result.series)
+    assert not result.failed
+    assert result.outputs() and all(path.exists() for path in result.outputs())
+    assert result.as_dict()["elapsed"] == result.elapsed
+
+    participants = read_tsv(output / "participants.tsv")
+    assert len(participants) == 1
+    scans = read_tsv(output / "sub-4MR1" / "ses-4MR1" / "sub-4MR1_ses-4MR1_scans.tsv")
+    assert len(scans) == 2
+    assert (output / ".dcm2mids" / "duplicates.tsv").exists()
+
+
+def test_converter_shares_procedures(tmp_path):
+    first, second = make_inputs(tmp_path)
+    with Converter(tmp_path / "mids", "head", decode_workers=2) as converter:
+        decoder = converter.decoder
+        converter.convert(first)
+        cached = dict(converter.procedure_cache)
+        converter.convert(second, update=True)
+        assert converter.decoder is decoder
+        # The MR procedures created for the first root are reused for the second one
+        assert all(converter.procedure_cache[key] is value for key, value in cached.items())
+        assert len(converter.procedure_cache) == 2
+        # Another root with the same modality adds no procedures
+        third = tmp_path / "third"
+        third.mkdir()
+        ds = dcmread(TEST_MR_DICOM)
+        ds.SOPInstanceUID = generate_uid()
+        ds.save_as(third / "mr.dcm")
+        report = converter.convert(third, update=True)
+        assert [row["status"] for row in report.series] == ["converted"]
+        assert len(converter.procedure_cache) == 2
+    assert converter.decoder is None
+
+
+def test_convert_records_failed_series(tmp_path, monkeypatch):
+    first, _ = make_inputs(tmp_path)
+    shutil.copy(TEST_ECG_DICOM, first / "ecg.dcm")
+
+    def fail(self, instances):
+        raise ValueError("broken series")
+
+    monkeypatch.setattr("dcm2mids.procedures.WaveformProcedures.run", fail)
+    result = convert(first, tmp_path / "mids", "head")
+    statuses = {row["modality"]: row["status"] for row in result.series}
+    assert statuses == {"MR": "converted", "ECG": "failed"}
+    assert result.failed[0]["error"] == "ValueError: broken series"
+    assert result.failed[0]["outputs"] == []
+
+
+def test_convert_goes_on_after_an_empty_input(tmp_path):
+    first, second = make_inputs(tmp_path)
+    empty = tmp_path / "empty"
+    empty.mkdir()
+    result = convert([first, empty, second], tmp_path / "mids", "head")
+    assert [row["input"] for row in result.series] == [str(first), str(second)]
+    assert result.reports[str(empty)].stats["error"].startswith("RuntimeError")
+
+
+def test_converter_closes_the_metadata_exporter(tmp_path):
+    closed = []
+
+    class Exporter:
+        def close(self):
+            closed.append(True)
+
+    converter = Converter(tmp_path / "mids", "head")
+    converter.metadata_exporter = Exporter()
+    converter.close()
+    assert closed == [True]
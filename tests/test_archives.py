@@ -0,0 +1,138 @@
+import gzip
+import io
+import tarfile
+import zipfile
+from pathlib import Path
+
+import pytest
+from pydicom import dcmread
+from pydicom.data import get_testdata_file
+from pydicom.uid import generate_uid
+
+from dcm2mids import convert
+from dcm2mids import archives
+from dcm2mids.archives import iter_archive, open_source, open_sources, split_archive_path
+from dcm2mids.get_dicomdir import get_dicomdir
+from dcm2mids.procedures.pixel_data import load_instance
+
+TEST_MR_DICOM = Path(get_testdata_file("MR_small.dcm", download=False))  # type: ignore
+TEST_SC_DICOM = Path(get_testdata_file("SC_rgb_small_odd.dcm", download=False))  # type: ignore
+
+
+def sc_bytes() -> bytes:
+    ds = dcmread(TEST_SC_DICOM)
+    ds.PatientID, ds.StudyID, ds.SeriesNumber = "4MR1", "4MR1", 2
+    ds.SeriesInstanceUID = generate_uid()
+    ds.SOPInstanceUID = generate_uid()
+    buffer = io.BytesIO()
+    ds.save_as(buffer)
+    return buffer.getvalue()
+
+
+def make_members():
+    return {
+        "export/mr/IM0001.dcm": TEST_MR_DICOM.read_bytes(),
+        "export/mr/note.txt": b"motion artefacts",
+        "export/sc/IM0001": sc_bytes(),
+        "export/README": b"not a DICOM file",
+    }
+
+
+def make_zip(path: Path) -> Path:
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, data in make_members().items():
+            zf.writestr(name, data)
+    return path
+
+
+def make_tar(path: Path) -> Path:
+    with tarfile.open(path, "w:gz") as tf:
+        # The note comes first, the members are read in a single pass
+        for name, data in sorted(make_members().items(), key=lambda item: "note" not in item[0]):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+    return path
+
+
+@pytest.mark.parametrize("make", [make_zip, make_tar])
+def test_iter_archive(tmp_path, make):
+    archive = make(tmp_path / ("export.zip" if make is make_zip else "export.tar.gz"))
+    sources = {}
+    for source in iter_archive(archive):
+        sources[source.path.relative_to(archive).as_posix()] = (source.open().read(), source.read_note())
+    assert sorted(sources) == ["export/mr/IM0001.dcm", "export/sc/IM0001"]
+    assert sources["export/mr/IM0001.dcm"] == (TEST_MR_DICOM.read_bytes(), "motion artefacts")
+    assert sources["export/sc/IM0001"][1] == ""
+
+    member = archive / "export" / "mr" / "IM0001.dcm"
+    assert split_archive_path(member) == (archive, "export/mr/IM0001.dcm")
+    assert open_source(member).open().read() == TEST_MR_DICOM.read_bytes()
+    with pytest.raises(FileNotFoundError):
+        open_source(archive / "export" / "missing.dcm")
+
+
+def test_open_sources_reads_each_archive_once(tmp_path, monkeypatch):
+    archive = make_tar(tmp_path / "export.tar.gz")
+    opened = []
+    tar_open = archives.tarfile.open
+    monkeypatch.setattr(
+        archives.tarfile, "open", lambda *args, **kwargs: opened.append(args) or tar_open(*args, **kwargs)
+    )
+    paths = [
+        archive / "export" / "sc" / "IM0001",
+        archive / "export" / "missing.dcm",
+        archive / "export" / "mr" / "IM0001.dcm",
+    ]
+
+    resolved = {
+        path: source.open().read()
+        for path, source in open_sources(paths)
+        if not isinstance(source, Exception)
+    }
+
+    assert len(opened) == 1
+    assert resolved[paths[2]] == TEST_MR_DICOM.read_bytes()
+    assert sorted(resolved) == sorted([paths[0], paths[2]])
+
+
+def test_get_dicomdir_reads_archives_and_gzip_files(tmp_path):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    make_tar(input_dir / "export.tar.gz")
+    ds = dcmread(TEST_MR_DICOM)
+    ds.PatientID = "other"
+    ds.SOPInstanceUID = generate_uid()
+    buffer = io.BytesIO()
+    ds.save_as(buffer)
+    (input_dir / "other.dcm.gz").write_bytes(gzip.compress(buffer.getvalue()))
+
+    fs = get_dicomdir(input_dir)
+
+    assert len(fs) == 3
+    assert sorted(fs.find_values("PatientID")) == ["4MR1", "other"]
+    notes = [instance.load().private_block(0x000B, "Note")[0x10].value for instance in fs]
+    assert "motion artefacts" in notes
+
+
+def test_archive_members_are_staged_without_pixel_data(tmp_path):
+    archive = make_tar(tmp_path / "export.tar.gz")
+
+    fs = get_dicomdir(archive)
+
+    (instance,) = fs.find(PatientID="4MR1", SeriesNumber=1)
+    assert "PixelData" not in dcmread(instance.path)
+    assert instance.source.path == archive / "export" / "mr" / "IM0001.dcm"
+    dataset = load_instance(instance)
+    assert dataset.PixelData == dcmread(TEST_MR_DICOM).PixelData
+    assert dataset.private_block(0x000B, "Note")[0x10].value == "motion artefacts"
+
+
+@pytest.mark.parametrize("make", [make_zip, make_tar])
+def test_convert_archive_input(tmp_path, make):
+    archive = make(tmp_path / ("export.zip" if make is make_zip else "export.tar.gz"))
+    result = convert(archive, tmp_path / "mids", "head")
+    assert not result.failed
+    assert len(result.outputs()) == 2
+    assert all(path.exists() for path in result.outputs())
+
@@ -0,0 +1,106 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+from pydicom import dcmread
+from pydicom.data import get_testdata_file
+from pydicom.encaps import encapsulate
+from pydicom.uid import JPEGBaseline8Bit
+
+from dcm2mids.procedures.decoders import DecoderBackend, FrameDecoder, array_to_image
+from dcm2mids.procedures.pixel_data import FrameReader, map_pixels
+from dcm2mids.scan_index import IndexedInstance
+
+TEST_RLE_DICOM = Path(get_testdata_file("SC_rgb_rle_2frame.dcm"))  # type: ignore
+TEST_CT_DICOM = Path(get_testdata_file("CT_small.dcm"))  # type: ignore
+
+
+class FakeBackend(DecoderBackend):
+    """Decodes frames made of raw little-endian uint8 pixels."""
+
+    name = "fake"
+    module = "numpy"
+    transfer_syntaxes = {JPEGBaseline8Bit}
+
+    def decode(self, frame, dataset):
+        return np.frombuffer(frame, dtype=np.uint8).reshape(dataset.Rows, dataset.Columns)
+
+
+def fake_compressed_dataset():
+    ds = dcmread(TEST_CT_DICOM)
+    ds.Rows, ds.Columns, ds.BitsAllocated, ds.BitsStored, ds.HighBit = 2, 3, 8, 8, 7
+    ds.PixelRepresentation = 0
+    ds.NumberOfFrames = 4
+    frames = [np.full((2, 3), i, dtype=np.uint8).tobytes() for i in range(4)]
+    ds.PixelData = encapsulate(frames)
+    ds["PixelData"].is_undefined_length = True
+    ds.file_meta.TransferSyntaxUID = JPEGBaseline8Bit
+    return ds
+
+
+def test_decode_frames_in_parallel_with_backend():
+    decoder = FrameDecoder(max_workers=2, backends=[FakeBackend()])
+    array = decoder.decode_instance(fake_compressed_dataset())
+    decoder.close()
+
+    assert array.shape == (4, 2, 3)
+    assert [int(frame[0, 0]) for frame in array] == [0, 1, 2, 3]
+    assert decoder.stats["fake"]["decodes"] == 4
+    assert "decode_fake_mb_per_s" in decoder.summary()
+
+
+def test_decode_falls_back_to_pydicom():
+    instance = IndexedInstance(TEST_RLE_DICOM, {})
+    decoder = FrameDecoder(max_workers=2, backends=[FakeBackend()])
+    decoder.prefetch([instance])
+    dataset, array = decoder.read(instance)
+    decoder.close()
+
+    assert "PixelData" not in dataset
+    assert np.array_equal(array, dcmread(TEST_RLE_DICOM).pixel_array)
+    assert decoder.stats["pydicom"]["decodes"] == 1
+
+
+def test_array_to_image_applies_rescale_and_spacing():
+    ds = dcmread(TEST_CT_DICOM)
+    image = array_to_image(ds.pixel_array, ds)
+
+    assert image.GetSize() == (ds.Columns, ds.Rows)
+    assert image.GetSpacing() == tuple(float(v) for v in ds.PixelSpacing[::-1])
+    expected = ds.pixel_array * float(ds.RescaleSlope) + float(ds.RescaleIntercept)
+    assert image[0, 0] == expected[0, 0]
+
+
+def test_map_pixels_is_a_view_of_the_file(tmp_path):
+    dataset, array = map_pixels(TEST_CT_DICOM)
+    assert isinstance(array.base, np.memmap) or isinstance(array, np.memmap)
+    assert not array.flags.writeable
+    assert "PixelData" not in dataset
+    assert np.array_equal(array, dcmread(TEST_CT_DICOM).pixel_array)
+
+    ds = dcmread(TEST_RLE_DICOM)
+    ds.decompress()
+    ds.save_as(tmp_path / "rgb.dcm")
+    dataset, array = map_pixels(tmp_path / "rgb.dcm")
+    assert array.shape == (2, ds.Rows, ds.Columns, 3)
+    assert np.array_equal(array, ds.pixel_array)
+    with FrameReader(tmp_path / "rgb.dcm") as reader:
+        assert reader.pixels is not None
+        assert np.array_equal(reader.read(1), array[1])
+    with FrameReader(tmp_path / "rgb.dcm", mmap=False) as reader:
+        assert reader.pixels is None
+        assert np.array_equal(reader.read(1), array[1])
+
+
+def test_decoder_maps_uncompressed_instances():
+    instance = IndexedInstance(TEST_CT_DICOM, {})
+    decoder = FrameDecoder(max_workers=2)
+    dataset, array = decoder.read(instance)
+    decoder.close()
+
+    assert not array.flags.writeable
+    assert "pydicom" not in decoder.stats
+    image = array_to_image(array, dataset)
+    assert image.GetSize() == (dataset.Columns, dataset.Rows)
+    with pytest.raises(ValueError):
+        map_pixels(TEST_RLE_DICOM)
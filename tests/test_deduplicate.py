@@ -0,0 +1,118 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from shutil import copyfile
+
+from pydicom import dcmread
+from pydicom.data import get_testdata_file
+from pydicom.fileset import FileSet
+from pydicom.uid import generate_uid
+
+from dcm2mids.create_mids_directory import create_mids_directory
+from dcm2mids.deduplicate import ContentStore, DuplicateDetector
+from dcm2mids.get_dicomdir import get_dicomdir
+from dcm2mids.writers import discard_output
+
+TEST_CT_DICOM = Path(get_testdata_file("CT_small.dcm"))  # type: ignore
+TEST_SC_DICOM = Path(get_testdata_file("SC_rgb_small_odd.dcm"))  # type: ignore
+
+
+def copy_with_new_uid(source: Path, target: Path, **changes):
+    ds = dcmread(source)
+    ds.SOPInstanceUID = generate_uid()
+    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+    for keyword, value in changes.items():
+        setattr(ds, keyword, value)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    ds.save_as(target)
+
+
+def test_get_dicomdir_skips_repeated_sop_instance_uid(tmp_path):
+    for folder in ["a", "b"]:
+        tmp_path.joinpath(folder).mkdir()
+        copyfile(TEST_CT_DICOM, tmp_path / folder / TEST_CT_DICOM.name)
+    detector = DuplicateDetector()
+
+    result = get_dicomdir(tmp_path, duplicate_detector=detector)
+
+    assert len(result) == 1
+    assert len(detector.skipped) == 1
+    assert detector.skipped[0]["reason"] == "SOPInstanceUID"
+
+
+def test_get_dicomdir_skips_identical_pixel_data(tmp_path):
+    copyfile(TEST_CT_DICOM, tmp_path / "a.dcm")
+    copy_with_new_uid(TEST_CT_DICOM, tmp_path / "b.dcm")
+
+    assert len(get_dicomdir(tmp_path)) == 2
+    detector = DuplicateDetector(hash_pixels=True)
+    assert len(get_dicomdir(tmp_path, duplicate_detector=detector)) == 1
+    assert detector.skipped[0]["reason"] == "PixelData"
+
+    detector.save_report(tmp_path / "duplicates.tsv")
+    assert len(tmp_path.joinpath("duplicates.tsv").read_text().splitlines()) == 2
+
+
+def test_get_dicomdir_skips_duplicates_listed_in_a_dicomdir(tmp_path):
+    tmp_path.joinpath("first").mkdir()
+    copyfile(TEST_CT_DICOM, tmp_path / "first" / "a.dcm")
+    copy_with_new_uid(TEST_CT_DICOM, tmp_path / "b.dcm")
+    fs = FileSet()
+    fs.add(dcmread(TEST_CT_DICOM))
+    fs.add(dcmread(tmp_path / "b.dcm"))
+    fs.write(tmp_path / "dicomdir")
+    detector = DuplicateDetector()
+
+    assert len(get_dicomdir(tmp_path / "first", duplicate_detector=detector)) == 1
+    assert len(get_dicomdir(tmp_path / "dicomdir", duplicate_detector=detector)) == 1
+    assert detector.skipped[0]["reason"] == "SOPInstanceUID"
+
+    detector = DuplicateDetector(hash_pixels=True)
+    assert len(get_dicomdir(tmp_path / "dicomdir", duplicate_detector=detector)) == 1
+    assert detector.skipped[0]["reason"] == "PixelData"
+
+
+def test_content_store_links_existing_output(tmp_path):
+    input_dir, output_dir = tmp_path / "input", tmp_path / "output"
+    input_dir.mkdir()
+    copyfile(TEST_SC_DICOM, input_dir / "a.dcm")
+    copy_with_new_uid(TEST_SC_DICOM, input_dir / "b.dcm", SeriesNumber=2)
+
+    store = ContentStore(output_dir)
+    report = create_mids_directory(get_dicomdir(input_dir), output_dir, "eye", content_store=store)
+
+    assert report.stats["outputs_linked"] == 1
+    images = sorted(output_dir.rglob("*.png"))
+    assert len(images) == 2
+    assert images[0].read_bytes() == images[1].read_bytes()
+    assert ContentStore(output_dir).files == store.files
+
+
+def test_content_store_is_thread_safe(tmp_path):
+    store = ContentStore(tmp_path)
+    existing = tmp_path / "a.png"
+    existing.write_bytes(b"png")
+    store.add("digest", existing)
+    paths = [tmp_path / f"{i}.png" for i in range(64)]
+
+    with ThreadPoolExecutor(8) as executor:
+        linked = list(executor.map(lambda path: store.reuse("digest", path), paths))
+        list(executor.map(lambda path: store.add(path.stem, path), paths))
+
+    assert all(linked) and store.linked == len(paths)
+    assert len(store.files) == len(paths) + 1
+
+
+def test_content_store_ignores_discarded_output(tmp_path):
+    store = ContentStore(tmp_path)
+    existing = tmp_path / "a.png"
+    existing.write_bytes(b"png")
+    store.add("digest", existing)
+
+    def abandoned():
+        discard_output(threading.current_thread())
+        return store.reuse("digest", tmp_path / "b.png")
+
+    with ThreadPoolExecutor(1) as executor:
+        assert not executor.submit(abandoned).result()
+    assert not (tmp_path / "b.png").exists()
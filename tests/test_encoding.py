@@ -0,0 +1,76 @@
+import gzip
+import io
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+from pydicom.data import get_testdata_file
+
+from dcm2mids import convert
+from dcm2mids.encoding import EncodingProfile, ParallelGzipFile, parse_profile
+from dcm2mids.validate import check_file
+
+TEST_MR_DICOM = Path(get_testdata_file("MR_small.dcm", download=False))  # type: ignore
+
+
+def test_parallel_gzip(tmp_path):
+    data = os.urandom(100_000) + bytes(300_000) + b"dcm2mids" * 20_000
+    path = tmp_path / "volume.nii.gz"
+    with ThreadPoolExecutor(4) as executor:
+        with open(path, "wb") as f, ParallelGzipFile(f, executor, 6, block_size=65536) as gz:
+            for start in range(0, len(data), 10_000):
+                gz.write(data[start : start + 10_000])
+    assert gzip.decompress(path.read_bytes()) == data
+    # A single gzip member, smaller than the input
+    assert path.stat().st_size < len(data)
+
+    buffer = io.BytesIO()
+    with ThreadPoolExecutor(2) as executor:
+        ParallelGzipFile(buffer, executor).close()
+    assert gzip.decompress(buffer.getvalue()) == b""
+
+
+def test_png_bits(tmp_path):
+    pixels = np.arange(12 * 10, dtype=np.int16).reshape(12, 10) * 200 - 4000
+    image = sitk.GetImageFromArray(pixels)
+    EncodingProfile(png_bits=16, png_level=9).write_image(image + 4000, tmp_path / "a.png")
+    assert np.array_equal(
+        sitk.GetArrayFromImage(sitk.ReadImage(str(tmp_path / "a.png"))), pixels + 4000
+    )
+    EncodingProfile(png_bits=8).write_image(image, tmp_path / "b.png")
+    written = sitk.ReadImage(str(tmp_path / "b.png"))
+    assert written.GetPixelID() == sitk.sitkUInt8
+    assert sitk.GetArrayFromImage(written).max() == 255
+    EncodingProfile(png_bits=16).write_image(image, tmp_path / "c.png")
+    assert sitk.GetArrayFromImage(sitk.ReadImage(str(tmp_path / "c.png"))).max() == 65535
+
+
+def test_parse_profile():
+    profile = parse_profile("fast,png_bits=16,gzip_threads=3")
+    assert (profile.png_level, profile.png_bits, profile.gzip_threads) == (1, 16, 3)
+    assert parse_profile("uncompressed").nifti_suffix == ".nii"
+    with pytest.raises(ValueError):
+        parse_profile("tiny")
+    with pytest.raises(ValueError):
+        parse_profile("default,png_level=0")
+    with pytest.raises(ValueError):
+        parse_profile("default,colour=1")
+
+
+@pytest.mark.parametrize("spec, suffix", [("uncompressed", ".nii"), ("default,gzip_threads=2", ".nii.gz")])
+def test_convert_with_profile(tmp_path, spec, suffix):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    shutil.copy(TEST_MR_DICOM, input_dir / "mr.dcm")
+    result = convert(input_dir, tmp_path / "mids", "head", encoding=spec)
+    assert not result.failed
+    (volume,) = result.outputs()
+    assert volume.name.endswith("_mr" + suffix)
+    path = tmp_path / "mids" / volume
+    assert check_file(path) is None
+    image = sitk.ReadImage(str(path))
+    assert image.GetSize() == (64, 64, 1)
@@ -0,0 +1,110 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import SimpleITK as sitk
+from pydicom import Dataset, dcmread
+from pydicom.data import get_testdata_file
+from pydicom.sequence import Sequence
+from pydicom.uid import generate_uid
+
+from dcm2mids.create_mids_directory import create_mids_directory
+from dcm2mids.get_dicomdir import get_dicomdir
+from dcm2mids.procedures.dictify import dictify
+from dcm2mids.procedures.enhanced import EnhancedFrames
+
+TEST_MR_DICOM = Path(get_testdata_file("MR_small.dcm", download=False))  # type: ignore
+
+
+def item(**fields):
+    ds = Dataset()
+    for keyword, value in fields.items():
+        setattr(ds, keyword, value)
+    return ds
+
+
+def enhanced_mr():
+    """Two time points of three slices, stored time point by time point, slices reversed."""
+    ds = dcmread(TEST_MR_DICOM)
+    ds.SOPInstanceUID = generate_uid()
+    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+    for keyword in ["ImagePositionPatient", "ImageOrientationPatient", "PixelSpacing"]:
+        delattr(ds, keyword)
+    frames = [(t, z) for t in [1, 2] for z in [2, 1, 0]]
+    ds.NumberOfFrames = len(frames)
+    ds.DimensionIndexSequence = Sequence(
+        [
+            item(DimensionIndexPointer=0x00209128),
+            item(DimensionIndexPointer=0x00209057),
+        ]
+    )
+    ds.SharedFunctionalGroupsSequence = Sequence(
+        [
+            item(
+                PlaneOrientationSequence=Sequence(
+                    [item(ImageOrientationPatient=[1, 0, 0, 0, 1, 0])]
+                ),
+                PixelMeasuresSequence=Sequence(
+                    [item(PixelSpacing=[0.5, 0.5], SliceThickness=2.5)]
+                ),
+                MRTimingAndRelatedParametersSequence=Sequence([item(RepetitionTime=2000)]),
+            )
+        ]
+    )
+    ds.PerFrameFunctionalGroupsSequence = Sequence(
+        [
+            item(
+                PlanePositionSequence=Sequence([item(ImagePositionPatient=[0, 0, 2.5 * z])]),
+                FrameContentSequence=Sequence(
+                    [
+                        item(
+                            TemporalPositionIndex=t,
+                            InStackPositionNumber=z + 1,
+                            DimensionIndexValues=[t, z + 1],
+                        )
+                    ]
+                ),
+            )
+            for t, z in frames
+        ]
+    )
+    ds.PixelData = np.stack(
+        [np.full((64, 64), 10 * t + z, dtype=np.int16) for t, z in frames]
+    ).tobytes()
+    return ds
+
+
+def test_enhanced_frames_and_summary():
+    ds = enhanced_mr()
+    frames = EnhancedFrames(ds)
+
+    assert frames.positions[:, 2].tolist() == [5.0, 2.5, 0.0, 5.0, 2.5, 0.0]
+    assert frames.orientations.shape == (6, 6)
+    assert frames.temporal_positions.tolist() == [1, 1, 1, 2, 2, 2]
+    assert frames.dimension_keywords == ["TemporalPositionIndex", "InStackPositionNumber"]
+    assert frames.dimension_indices.max(axis=0).tolist() == [2, 3]
+    assert frames.repetition_time == 2000
+
+    sidecar = dictify(ds)
+    assert "PerFrameFunctionalGroupsSequence" not in sidecar
+    summary = sidecar["PerFrameFunctionalGroupsSummary"]
+    assert summary["NumberOfFrames"] == 6
+    assert summary["TemporalPositions"] == 2
+    assert summary["DimensionIndexRanges"] == [[1, 2], [1, 3]]
+
+
+def test_enhanced_series(tmp_path):
+    input_dir, output_dir = tmp_path / "input", tmp_path / "output"
+    input_dir.mkdir()
+    enhanced_mr().save_as(input_dir / "enhanced.dcm")
+
+    create_mids_directory(get_dicomdir(input_dir), output_dir, "brain")
+
+    (bold,) = output_dir.rglob("*_bold.nii.gz")
+    image = sitk.ReadImage(str(bold))
+    assert image.GetSize() == (64, 64, 3, 2)
+    assert image.GetSpacing() == (0.5, 0.5, 2.5, 2.0)
+    array = sitk.GetArrayFromImage(image)
+    assert array[:, :, 0, 0].tolist() == [[10, 11, 12], [20, 21, 22]]
+    sidecar = json.loads(bold.with_name(bold.name.replace(".nii.gz", ".json")).read_text())
+    assert sidecar["PerFrameFunctionalGroupsSummary"]["NumberOfFrames"] == 6
@@ -0,0 +1,50 @@
+import shutil
+from pathlib import Path
+
+import pytest
+from pydicom import dcmread
+from pydicom.data import get_testdata_file
+
+from dcm2mids.create_mids_directory import create_mids_directory
+from dcm2mids.export_metadata import column_kind, metadata_record
+from dcm2mids.get_dicomdir import get_dicomdir
+
+TEST_MR_DICOM = Path(get_testdata_file("MR_small.dcm", download=False))  # type: ignore
+
+
+def test_metadata_record_types():
+    record = metadata_record(dcmread(TEST_MR_DICOM))
+    assert record["Modality"] == "MR"
+    assert record["SeriesNumber"] == 1
+    assert isinstance(record["RepetitionTime"], float)
+    assert record["ImageOrientationPatient"] == [1.0, 0.0, 0.0, 0.0, 1.0, 0.0]
+    assert record["Rows"] == 64
+    assert "PixelData" not in record
+
+    assert column_kind("SliceThickness") == ("float", False)
+    assert column_kind("PixelSpacing") == ("float", True)
+    assert column_kind("ImageType") == ("str", True)
+    assert column_kind("ReferencedImageSequence") == ("json", False)
+    assert column_kind("NotAKeyword") == ("str", False)
+
+
+def test_export_parquet(tmp_path):
+    pytest.importorskip("pyarrow")
+    import pyarrow.dataset as pds
+
+    from dcm2mids.export_metadata import METADATA_FOLDER, MetadataExporter
+
+    input_dir, output = tmp_path / "input", tmp_path / "mids"
+    input_dir.mkdir()
+    shutil.copy(TEST_MR_DICOM, input_dir / "mr.dcm")
+    exporter = MetadataExporter(output, "parquet", batch_rows=1)
+    report = create_mids_directory(
+        get_dicomdir(input_dir), output, "head", metadata_exporter=exporter
+    )
+    assert report.stats["rows_exported"] == 1
+
+    table = pds.dataset(output / METADATA_FOLDER, partitioning="hive").to_table()
+    assert table.num_rows == 1
+    row = table.to_pylist()[0]
+    assert row["participant_id"] == "sub-4MR1"
+    assert row["SliceThickness"] == pytest.approx(float(dcmread(TEST_MR_DICOM).SliceThickness))
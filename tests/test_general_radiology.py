@@ -0,0 +1,77 @@
+from pathlib import Path
+
+import numpy as np
+import SimpleITK as sitk
+
+from pydicom import dcmread
+from pydicom.data import get_testdata_file
+from pydicom.uid import generate_uid
+
+from dcm2mids import convert
+from dcm2mids.procedures.general_radiology.conventional_radiology_procedure import (
+    orientation_key,
+)
+
+TEST_CT_DICOM = Path(get_testdata_file("CT_small.dcm", download=False))  # type: ignore
+TEST_MR_DICOM = Path(get_testdata_file("MR_small.dcm", download=False))  # type: ignore
+
+
+def test_orientation_key():
+    assert orientation_key(["1.0", "0", "-0.0", "0", "0.99999", "0"]) == "1\\0\\0\\0\\1\\0"
+
+
+def test_convert_ct(tmp_path):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    ds = dcmread(TEST_CT_DICOM)
+    ds.StudyID = "1"
+    ds.save_as(input_dir / "ct.dcm")
+
+    result = convert(input_dir, tmp_path / "mids", "head")
+
+    assert not result.failed
+    (image,) = result.outputs()
+    assert image.name.endswith("_ct.nii.gz") and image.exists()
+    assert image.parent.name == "ct"
+    assert image.with_name(image.name.replace(".nii.gz", ".json")).exists()
+
+
+def test_convert_ct_series_into_one_volume(tmp_path):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for z in [2, 0, 1]:
+        ds = dcmread(TEST_CT_DICOM)
+        ds.StudyID = "1"
+        ds.SOPInstanceUID = generate_uid()
+        ds.InstanceNumber = 3 - z
+        ds.ImagePositionPatient = [0, 0, 5 * z]
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.PixelData = np.full((ds.Rows, ds.Columns), z, dtype=np.int16).tobytes()
+        ds.save_as(input_dir / f"ct{z}.dcm")
+
+    result = convert(input_dir, tmp_path / "mids", "head")
+
+    assert not result.failed
+    (image,) = result.outputs()
+    assert "chunk" not in image.name
+    volume = sitk.ReadImage(str(image))
+    assert volume.GetSize() == (128, 128, 3)
+    assert volume.GetSpacing()[2] == 5.0
+    slices = sitk.GetArrayFromImage(volume)[:, 0, 0] - float(ds.RescaleIntercept)
+    assert slices.tolist() == [0, 1, 2]
+
+
+def test_convert_dx(tmp_path):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    ds = dcmread(TEST_MR_DICOM)
+    ds.Modality = "DX"
+    ds.save_as(input_dir / "dx.dcm")
+
+    # MR_small is signed, which PNG can not store as it is
+    result = convert(input_dir, tmp_path / "mids", "chest", encoding="default,png_bits=16")
+
+    assert not result.failed
+    (image,) = result.outputs()
+    assert image.suffix == ".png" and image.exists()
+    assert image.parent.parts[-2:] == ("mim-rx", "dx")
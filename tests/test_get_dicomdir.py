@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 from shutil import copyfile
 from tempfile import TemporaryDirectory
@@ -6,7 +7,7 @@ import pytest
 from pydicom.data import get_testdata_file
 from pydicom.fileset import FileSet
 
-from dcm2mids.get_dicomdir import get_dicomdir
+from dcm2mids.get_dicomdir import get_dicomdir, iter_dicom_files
 
 TEST_DICOMDIR = Path(get_testdata_file("DICOMDIR")).parent  # type: ignore
 TEST_CT_DICOM = Path(get_testdata_file("CT_small.dcm"))  # type: ignore
@@ -86,3 +87,31 @@ def test_get_dicomdir_with_nonexistent_folder():
     # Call the get_dicomdir function with a nonexistent folder
     with pytest.raises(FileNotFoundError):
         get_dicomdir("/path/to/nonexistent/folder")
+
+
+def test_iter_dicom_files_detects_extensionless_files(tmp_nested_directory):
+    tmp_nested_directory.joinpath("CT", "IM0001").write_bytes(
+        TEST_CT_DICOM.read_bytes()
+    )
+    tmp_nested_directory.joinpath("CT", "note.txt").write_text("n/a")
+
+    found = list(iter_dicom_files(tmp_nested_directory))
+
+    assert tmp_nested_directory.joinpath("CT", "IM0001") in found
+    assert tmp_nested_directory.joinpath("CT", "note.txt") not in found
+    assert len(found) == 3
+
+
+def test_get_dicomdir_prunes_excluded_directories(tmp_nested_directory, monkeypatch):
+    excluded = tmp_nested_directory / "MR"
+    scandir = os.scandir
+
+    def checked_scandir(path):
+        if not isinstance(path, int):
+            assert os.path.abspath(path) != str(excluded)
+        return scandir(path)
+
+    monkeypatch.setattr(os, "scandir", checked_scandir)
+    result = get_dicomdir(tmp_nested_directory, exclude_paths=[excluded])
+
+    assert len(result) == 1
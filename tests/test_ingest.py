@@ -0,0 +1,81 @@
+from pathlib import Path
+
+import pytest
+from pydicom import dcmread
+from pydicom.data import get_testdata_file
+from pydicom.uid import generate_uid
+
+from dcm2mids.generate_tsvs import read_tsv
+from dcm2mids.ingest import StorageIngest
+
+TEST_MR_DICOM = Path(get_testdata_file("MR_small.dcm", download=False))  # type: ignore
+SCANS_TSV = Path("sub-4MR1", "ses-4MR1", "sub-4MR1_ses-4MR1_scans.tsv")
+
+
+def test_ingest_flushes_when_association_ends(tmp_path):
+    ingest = StorageIngest(tmp_path, "head", series_timeout=60)
+
+    assert ingest.receive(dcmread(TEST_MR_DICOM), association="a", now=0)
+    assert not ingest.receive(dcmread(TEST_MR_DICOM), association="b", now=1)
+    ingest.flush_expired(now=30)
+    assert len(ingest.pending) == 1
+
+    ingest.end_association("a")
+    ingest.close()
+
+    assert len(ingest.reports) == 1
+    assert len(read_tsv(tmp_path / SCANS_TSV)) == 1
+    assert len(ingest.duplicate_detector.skipped) == 1
+
+
+def test_ingest_only_flushes_the_series_of_the_ended_association(tmp_path):
+    ingest = StorageIngest(tmp_path, "head", series_timeout=60)
+    local = dcmread(TEST_MR_DICOM)
+    other = dcmread(TEST_MR_DICOM)
+    other.SeriesInstanceUID, other.SOPInstanceUID = generate_uid(), generate_uid()
+    ingest.receive(local, now=0)
+    ingest.receive(other, association="b", now=0)
+
+    ingest.end_association("a")
+
+    assert sorted(ingest.pending) == sorted([local.SeriesInstanceUID, other.SeriesInstanceUID])
+    (staged,) = ingest.pending[local.SeriesInstanceUID].fileset
+    assert "PixelData" not in dcmread(staged.path)
+    ingest.close()
+    assert len(ingest.reports) == 2
+    assert list((tmp_path / SCANS_TSV.parent).rglob("*.nii.gz"))
+
+
+def test_ingest_flushes_after_timeout(tmp_path):
+    ingest = StorageIngest(tmp_path, "head", series_timeout=60)
+    ingest.receive(dcmread(TEST_MR_DICOM), now=0)
+
+    ingest.flush_expired(now=59)
+    assert len(ingest.pending) == 1
+    ingest.flush_expired(now=60)
+    ingest.join()
+
+    assert not ingest.pending
+    assert (tmp_path / SCANS_TSV).exists()
+    ingest.close()
+
+
+def test_ingest_loopback_scu(tmp_path):
+    pynetdicom = pytest.importorskip("pynetdicom")
+    from pynetdicom.sop_class import MRImageStorage
+
+    ingest = StorageIngest(tmp_path, "head", series_timeout=60)
+    ingest.start("127.0.0.1", 0)
+    port = ingest._server.server_address[1]
+    try:
+        ae = pynetdicom.AE()
+        ae.add_requested_context(MRImageStorage)
+        assoc = ae.associate("127.0.0.1", port, ae_title="DCM2MIDS")
+        assert assoc.is_established
+        status = assoc.send_c_store(dcmread(TEST_MR_DICOM))
+        assert status.Status == 0x0000
+        assoc.release()
+    finally:
+        ingest.close()
+
+    assert (tmp_path / SCANS_TSV).exists()
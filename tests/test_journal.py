@@ -0,0 +1,148 @@
+import errno
+import shutil
+import time
+from pathlib import Path
+
+import pytest
+from pydicom import dcmread
+from pydicom.data import get_testdata_file
+from pydicom.uid import generate_uid
+
+from dcm2mids.create_mids_directory import create_mids_directory
+from dcm2mids.get_dicomdir import get_dicomdir
+from dcm2mids.journal import FailureJournal, FaultPolicy, WatchdogTimeout
+from dcm2mids.writers import FilesystemWriter
+
+TEST_MR_DICOM = Path(get_testdata_file("MR_small.dcm", download=False))  # type: ignore
+TEST_ECG_DICOM = Path(get_testdata_file("waveform_ecg.dcm", download=False))  # type: ignore
+
+
+def test_fault_policy_retries_transient_errors(tmp_path):
+    policy = FaultPolicy(FailureJournal(tmp_path), retries=2, backoff=0)
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise OSError(errno.EIO, "Input/output error")
+        return "done"
+
+    assert policy.run(flaky) == "done"
+    assert policy.retried == 2
+
+    def broken():
+        raise ValueError("corrupt")
+
+    with pytest.raises(ValueError):
+        policy.isolate("read", ["a.dcm"], broken)
+    assert policy.retried == 2
+    assert len(policy.journal) == 1
+
+
+def test_fault_policy_timeout(tmp_path):
+    policy = FaultPolicy(FailureJournal(tmp_path), file_timeout=0.05)
+    with pytest.raises(WatchdogTimeout):
+        policy.isolate("read", ["slow.dcm"], time.sleep, 1)
+    assert policy.summary()["timeouts"] == 1
+
+
+def test_batch_quarantine_and_replay(tmp_path, monkeypatch):
+    input_dir, output = tmp_path / "input", tmp_path / "mids"
+    input_dir.mkdir()
+    shutil.copy(TEST_MR_DICOM, input_dir / "mr.dcm")
+    shutil.copy(TEST_ECG_DICOM, input_dir / "ecg.dcm")
+    (input_dir / "corrupt.dcm").write_bytes(b"\0" * 128 + b"DICM" + b"\xff" * 16)
+
+    def fail(self, instances):
+        raise ValueError("broken series")
+
+    with monkeypatch.context() as m:
+        m.setattr("dcm2mids.procedures.WaveformProcedures.run", fail)
+        policy = FaultPolicy(FailureJournal(output), retries=0)
+        fileset = get_dicomdir(input_dir, fault_policy=policy)
+        report = create_mids_directory(fileset, output, "head", fault_policy=policy)
+    assert len(fileset) == 2
+    statuses = {row["modality"]: row["status"] for row in report.series}
+    assert statuses == {"MR": "converted", "ECG": "failed"}
+    assert report.stats["failures_quarantined"] == 2
+
+    journal = FailureJournal(output)
+    assert {Path(row["path"]).name: row["stage"] for row in journal.rows} == {
+        "corrupt.dcm": "read",
+        "ecg.dcm": "series",
+    }
+
+    # Replaying converts the series that now succeeds, the corrupt file stays quarantined
+    policy = FaultPolicy(journal, retries=0)
+    fileset = get_dicomdir(input_dir, paths=journal.pop_paths(), fault_policy=policy)
+    report = create_mids_directory(fileset, output, "head", update=True, fault_policy=policy)
+    assert [row["status"] for row in report.series] == ["converted"]
+    journal.finish_replay()
+    assert [Path(row["path"]).name for row in FailureJournal(output).rows] == ["corrupt.dcm"]
+
+
+def test_interrupted_replay_keeps_the_journal(tmp_path):
+    journal = FailureJournal(tmp_path)
+    journal.record("read", ["a.dcm", "b.dcm"], ValueError("corrupt"))
+    assert journal.pop_paths() == [Path("a.dcm"), Path("b.dcm")]
+    # The replay dies before finishing: the next run finds the files again
+    journal = FailureJournal(tmp_path)
+    assert [row["path"] for row in journal.rows] == ["a.dcm", "b.dcm"]
+    assert not journal.replaying_path.exists()
+
+    journal.pop_paths()
+    journal.finish_replay()
+    assert len(FailureJournal(tmp_path)) == 0
+
+
+def test_abandoned_call_output_is_discarded(tmp_path):
+    writer = FilesystemWriter(tmp_path)
+    policy = FaultPolicy(FailureJournal(tmp_path), file_timeout=0.05)
+
+    def slow_convert():
+        time.sleep(0.2)
+        writer.write_text(tmp_path / "late.json", "{}")
+        return "done"
+
+    with pytest.raises(WatchdogTimeout):
+        policy.isolate("series", ["slow.dcm"], slow_convert)
+    time.sleep(0.3)
+    assert not (tmp_path / "late.json").exists()
+    writer.write_text(tmp_path / "kept.json", "{}")
+    assert (tmp_path / "kept.json").exists()
+
+
+def test_abandoned_series_does_not_share_procedures(tmp_path, monkeypatch):
+    input_dir, output = tmp_path / "input", tmp_path / "mids"
+    input_dir.mkdir()
+    for number in (1, 2):
+        ds = dcmread(TEST_MR_DICOM)
+        ds.SeriesInstanceUID = ds.SOPInstanceUID = generate_uid()
+        ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+        ds.SeriesNumber = number
+        ds.save_as(input_dir / f"mr{number}.dcm")
+    seen = []
+
+    def slow_run(self, instances):
+        seen.append(self)
+        if len(seen) == 1:
+            time.sleep(0.3)
+        return []
+
+    monkeypatch.setattr("dcm2mids.procedures.MagneticResonanceProcedures.run", slow_run)
+    policy = FaultPolicy(FailureJournal(output), file_timeout=0.1)
+    create_mids_directory(
+        get_dicomdir(input_dir), output, "head", fault_policy=policy, procedure_cache={}
+    )
+    # The abandoned attempt still runs with the procedures it was given
+    assert len(seen) == 2 and seen[0] is not seen[1]
+    assert policy.summary()["timeouts"] == 1
+
+
+def test_journal_appends_failures(tmp_path):
+    journal = FailureJournal(tmp_path)
+    journal.record("read", ["a.dcm"], ValueError("corrupt"))
+    journal.path.write_text(journal.path.read_text() + "b.dcm\tread\tn/a\tn/a\tn/a\tx\t1\tt\n")
+    journal.record("series", ["c.dcm"], ValueError("broken"))
+    rows = FailureJournal(tmp_path).rows
+    assert [row["path"] for row in rows] == ["a.dcm", "b.dcm", "c.dcm"]
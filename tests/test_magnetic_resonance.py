@@ -0,0 +1,139 @@
+from pathlib import Path
+
+import numpy as np
+import SimpleITK as sitk
+from pydicom import dcmread
+from pydicom.data import get_testdata_file
+from pydicom.uid import generate_uid
+
+from dcm2mids.create_mids_directory import create_mids_directory
+from dcm2mids.get_dicomdir import get_dicomdir
+from dcm2mids.procedures.magnetic_resonance.magnetic_resonance_procedure import (
+    header_arrays,
+)
+
+TEST_MR_DICOM = Path(get_testdata_file("MR_small.dcm", download=False))  # type: ignore
+
+
+def mr_slice(z: float, value: int, instance: int, **fields):
+    ds = dcmread(TEST_MR_DICOM)
+    ds.SOPInstanceUID = generate_uid()
+    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+    ds.InstanceNumber = instance
+    ds.ImagePositionPatient = [0.0, 0.0, z]
+    for keyword, field in fields.items():
+        setattr(ds, keyword, field)
+    ds.PixelData = np.full((64, 64), value, dtype=np.int16).tobytes()
+    return ds
+
+
+def write_series(input_dir: Path, slices: list):
+    input_dir.mkdir()
+    for index, ds in enumerate(slices):
+        ds.save_as(input_dir / f"{index}.dcm")
+
+
+def test_diffusion_series(tmp_path):
+    input_dir, output_dir = tmp_path / "input", tmp_path / "output"
+    # Two volumes of three slices, the slices in no particular order
+    slices = [
+        mr_slice(
+            z,
+            100 * (volume + 1) + slice_number,
+            volume * 3 + slice_number + 1,
+            DiffusionBValue=[0, 1000][volume],
+            DiffusionGradientOrientation=[[0, 0, 0], [0, 1, 0]][volume],
+        )
+        for volume in range(2)
+        for slice_number, z in enumerate([0.0, 2.0, 4.0])
+    ]
+    write_series(input_dir, [slices[i] for i in [4, 0, 2, 5, 3, 1]])
+
+    create_mids_directory(get_dicomdir(input_dir), output_dir, "brain")
+
+    (dwi,) = output_dir.rglob("*_dwi.nii.gz")
+    assert dwi.parent.name == "dwi"
+    image = sitk.ReadImage(str(dwi))
+    assert image.GetSize() == (64, 64, 3, 2)
+    assert image.GetSpacing()[2] == 2.0
+    array = sitk.GetArrayFromImage(image)
+    assert array[:, :, 0, 0].tolist() == [[100, 101, 102], [200, 201, 202]]
+    assert dwi.with_name("sub-4MR1_ses-4MR1_run-1_dwi.bval").read_text() == "0 1000\n"
+    bvec = np.loadtxt(dwi.with_name("sub-4MR1_ses-4MR1_run-1_dwi.bvec"))
+    assert bvec[:, 1].tolist() == [0, 1, 0]
+
+
+def test_diffusion_gradients_follow_the_fsl_convention(tmp_path):
+    input_dir, output_dir = tmp_path / "input", tmp_path / "output"
+    # A tilted stack: the slices move along y as well as z
+    write_series(
+        input_dir,
+        [
+            mr_slice(
+                z,
+                volume,
+                volume * 2 + i + 1,
+                ImagePositionPatient=[0.0, z / 2, z],
+                DiffusionBValue=1000,
+                DiffusionGradientOrientation=[[1, 0, 0], [0, 0, 1]][volume],
+            )
+            for volume in range(2)
+            for i, z in enumerate([0.0, 2.0])
+        ],
+    )
+
+    create_mids_directory(get_dicomdir(input_dir), output_dir, "brain")
+
+    (bvec_file,) = output_dir.rglob("*_dwi.bvec")
+    bvec = np.loadtxt(bvec_file)
+    # Volumes are sorted by gradient: z is the projection on the slice
+    # direction of the stack, not on the slice normal
+    assert np.allclose(bvec[:, 0], [0, 0, 2 / np.sqrt(5)])
+    # The affine has a positive determinant, so x is flipped
+    assert bvec[:, 1].tolist() == [-1, 0, 0]
+
+
+def test_multi_echo_series(tmp_path):
+    input_dir, output_dir = tmp_path / "input", tmp_path / "output"
+    write_series(
+        input_dir,
+        [
+            mr_slice(z, echo, echo * 10 + i, EchoNumbers=echo, SeriesDescription="T2 TSE")
+            for echo in [1, 2]
+            for i, z in enumerate([0.0, 1.5])
+        ],
+    )
+
+    create_mids_directory(get_dicomdir(input_dir), output_dir, "brain")
+
+    volumes = sorted(output_dir.rglob("*_T2w.nii.gz"))
+    assert [v.name.split("_")[-2] for v in volumes] == ["echo-1", "echo-2"]
+    image = sitk.ReadImage(str(volumes[1]))
+    assert image.GetSize() == (64, 64, 2)
+    assert np.all(sitk.GetArrayFromImage(image) == 2)
+
+
+def test_echoes_with_the_same_number(tmp_path):
+    input_dir, output_dir = tmp_path / "input", tmp_path / "output"
+    write_series(
+        input_dir,
+        [
+            mr_slice(
+                z, echo, echo * 10 + i, EchoNumbers=1, EchoTime=echo * 20, SeriesDescription="T2 TSE"
+            )
+            for echo in [1, 2]
+            for i, z in enumerate([0.0, 1.5])
+        ],
+    )
+
+    create_mids_directory(get_dicomdir(input_dir), output_dir, "brain")
+
+    volumes = sorted(output_dir.rglob("*_T2w.nii.gz"))
+    assert [v.name.split("_")[-2] for v in volumes] == ["echo-1", "echo-2"]
+    assert np.all(sitk.GetArrayFromImage(sitk.ReadImage(str(volumes[1]))) == 2)
+
+
+def test_header_arrays_takes_the_first_of_several_echo_numbers():
+    ds = dcmread(TEST_MR_DICOM, stop_before_pixels=True)
+    ds.EchoNumbers = [2, 3]
+    assert header_arrays([ds])["echo"].tolist() == [2.0]
@@ -0,0 +1,82 @@
+import shutil
+import threading
+import time
+from pathlib import Path
+
+import pytest
+from pydicom.data import get_testdata_file
+
+from dcm2mids.create_mids_directory import create_mids_directory
+from dcm2mids.get_dicomdir import get_dicomdir
+from dcm2mids.memory import MemoryBudget, estimate_instance_size, parse_size
+from dcm2mids.procedures.magnetic_resonance import MagneticResonanceProcedures
+from dcm2mids.scan_index import IndexedInstance
+
+TEST_MR_DICOM = Path(get_testdata_file("MR_small.dcm", download=False))  # type: ignore
+
+
+@pytest.mark.parametrize(
+    "size, expected",
+    [("1024", 1024), ("2K", 2048), ("512M", 512 * 1024**2), ("1.5GB", 3 * 1024**3 // 2)],
+)
+def test_parse_size(size, expected):
+    assert parse_size(size) == expected
+
+
+def test_parse_size_invalid():
+    with pytest.raises(ValueError):
+        parse_size("a lot")
+
+
+def test_memory_budget_backpressure():
+    budget = MemoryBudget(100)
+    budget.acquire(80)
+    acquired = threading.Event()
+
+    def stage():
+        budget.acquire(50)
+        acquired.set()
+
+    thread = threading.Thread(target=stage)
+    thread.start()
+    time.sleep(0.05)
+    assert not acquired.is_set()
+    budget.release(80)
+    thread.join(timeout=1)
+    assert acquired.is_set()
+    assert budget.in_use == 50
+    assert budget.peak_in_use == 80
+
+
+def test_memory_budget_admits_oversized_reservation_when_empty():
+    budget = MemoryBudget(10)
+    with budget.reserve(100):
+        assert budget.in_use == 100
+        assert not budget.acquire(1, timeout=0.01)
+    assert budget.in_use == 0
+
+
+def test_estimate_instance_size(tmp_path):
+    path = tmp_path / "instance.dcm"
+    path.write_bytes(bytes(1000))
+    instance = IndexedInstance(
+        path, {"Rows": 10, "Columns": 20, "BitsAllocated": 16, "NumberOfFrames": 3}
+    )
+    assert estimate_instance_size(instance) == 1000 + 10 * 20 * 2 * 3
+
+
+def test_memory_budget_is_released_when_a_series_fails(tmp_path, monkeypatch):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    shutil.copy(TEST_MR_DICOM, input_dir / "mr.dcm")
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("conversion failed")
+
+    monkeypatch.setattr(MagneticResonanceProcedures, "run", fail)
+    budget = MemoryBudget(1)
+    with pytest.raises(RuntimeError):
+        create_mids_directory(get_dicomdir(input_dir), tmp_path / "mids", "head", budget)
+
+    assert budget.in_use == 0
+    assert budget.peak_in_use > 0
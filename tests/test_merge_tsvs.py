@@ -0,0 +1,81 @@
+from dcm2mids.generate_tsvs import read_tsv, save_participant_tsv, save_scans_tsv, save_session_tsv
+from dcm2mids.merge_tsvs import merge_tsvs
+
+
+def participant(subject, modalities, ages=("n/a",)):
+    return {
+        "participant_id": f"sub-{subject}",
+        "participant_pseudo_id": subject,
+        "sex": "F",
+        "participant_birthday": "n/a",
+        "ages": list(ages),
+        "modalities": list(modalities),
+        "body_parts_examined": ["head"],
+    }
+
+
+def test_save_participant_tsv_merge_keeps_other_rows(tmp_path):
+    save_participant_tsv([participant("A", ["CT"]), participant("B", ["MR"])], tmp_path)
+    save_participant_tsv([participant("B", ["CR"]), participant("C", ["OP"])], tmp_path, merge=True)
+
+    df = read_tsv(tmp_path / "participants.tsv")
+
+    assert list(df["participant_id"]) == ["sub-C", "sub-B", "sub-A"]
+    # The list columns of a reprocessed participant keep its earlier values
+    assert df.set_index("participant_id").loc["sub-B", "modalities"] == "['MR', 'CR']"
+    assert not list(tmp_path.glob(".*.tmp"))
+
+
+def test_save_scans_tsv_without_scans(tmp_path):
+    save_scans_tsv([], tmp_path, "A", "1")
+    assert not list(tmp_path.rglob("*.tsv"))
+
+    save_scans_tsv([{"scan_file": "anat/a.nii.gz"}], tmp_path, "A", "1")
+    save_scans_tsv([], tmp_path, "A", "1", merge=True)
+    assert len(read_tsv(tmp_path / "sub-A" / "ses-1" / "sub-A_ses-1_scans.tsv")) == 1
+
+
+def test_save_session_tsv_merge(tmp_path):
+    session = {"session_id": "s1", "session_pseudo_id": "1", "acq_time": "2020-01-01T00:00:00", "age": 30}
+    save_session_tsv([session], tmp_path, "A")
+    save_session_tsv([{**session, "session_id": "s2", "acq_time": "2021-01-01T00:00:00"}], tmp_path, "A", merge=True)
+
+    df = read_tsv(tmp_path / "sub-A" / "sub-A_sessions.tsv")
+
+    assert list(df["session_id"]) == ["s2", "s1"]
+
+
+def test_merge_tsvs_combines_fragments(tmp_path):
+    save_participant_tsv([participant("A", ["CT"])], tmp_path)
+    fragments = tmp_path / "shards"
+    save_participant_tsv(
+        [participant("B", ["CT"], ages=[40])], tmp_path, fragments / "shard-0-of-2_participants.tsv"
+    )
+    save_participant_tsv(
+        [participant("B", ["MR"], ages=[41])], tmp_path, fragments / "shard-1-of-2_participants.tsv"
+    )
+
+    merge_tsvs(tmp_path)
+    df = read_tsv(tmp_path / "participants.tsv").set_index("participant_id")
+
+    assert list(df.index) == ["sub-B", "sub-A"]
+    assert df.loc["sub-B", "modalities"] == "['CT', 'MR']"
+    assert df.loc["sub-B", "ages"] == "[40, 41]"
+
+
+def test_merge_tsvs_moves_per_shard_roots(tmp_path):
+    shard_root = tmp_path / "shard-1-of-2"
+    shard_root.joinpath("sub-A", "ses-2").mkdir(parents=True)
+    shard_root.joinpath("sub-A", "ses-2", "image.png").write_bytes(b"")
+    session = {"session_id": "s2", "session_pseudo_id": "2", "acq_time": "2021", "age": 1}
+    save_session_tsv([session], shard_root, "A")
+    save_participant_tsv(
+        [participant("A", ["CT"])], shard_root, shard_root / "shards" / "shard-1-of-2_participants.tsv"
+    )
+
+    merge_tsvs(tmp_path)
+
+    assert tmp_path.joinpath("sub-A", "ses-2", "image.png").exists()
+    assert tmp_path.joinpath("sub-A", "sub-A_sessions.tsv").exists()
+    assert tmp_path.joinpath("participants.tsv").exists()
+    assert not shard_root.exists()
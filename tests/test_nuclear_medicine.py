@@ -0,0 +1,94 @@
+import io
+import zipfile
+from pathlib import Path
+
+import numpy as np
+import SimpleITK as sitk
+from pydicom import dcmread
+from pydicom.data import get_testdata_file
+from pydicom.uid import generate_uid
+
+from dcm2mids.create_mids_directory import create_mids_directory
+from dcm2mids.generate_tsvs import read_tsv
+from dcm2mids.get_dicomdir import get_dicomdir
+from dcm2mids.procedures.nuclear_medicine.nuclear_medicine_procedure import split_frames
+
+TEST_CT_DICOM = Path(get_testdata_file("CT_small.dcm"))  # type: ignore
+
+
+def nm_dataset(vectors: dict, values: list):
+    ds = dcmread(TEST_CT_DICOM)
+    ds.SOPInstanceUID = generate_uid()
+    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+    ds.Modality = "NM"
+    ds.Rows, ds.Columns = 4, 5
+    ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 16, 16, 15, 0
+    ds.RescaleSlope, ds.RescaleIntercept = 1, 0
+    ds.NumberOfFrames = len(values)
+    for keyword, vector in vectors.items():
+        setattr(ds, keyword, vector)
+    ds.FrameIncrementPointer = [ds.data_element(k).tag for k in vectors]
+    ds.PixelData = np.stack(
+        [np.full((4, 5), v, dtype=np.uint16) for v in values]
+    ).tobytes()
+    return ds
+
+
+def test_split_frames_by_vectors():
+    # Time slices interleaved with detectors in file order
+    ds = nm_dataset(
+        {
+            "EnergyWindowVector": [1] * 6,
+            "DetectorVector": [1, 2, 1, 2, 1, 2],
+            "TimeSliceVector": [3, 3, 1, 1, 2, 2],
+        },
+        [13, 23, 11, 21, 12, 22],
+    )
+
+    axis, volumes = split_frames(ds)
+
+    assert axis == "TimeSliceVector"
+    assert [entities for entities, _ in volumes] == [
+        {"EnergyWindowVector": 1, "DetectorVector": 1},
+        {"EnergyWindowVector": 1, "DetectorVector": 2},
+    ]
+    assert [list(frames) for _, frames in volumes] == [[2, 4, 0], [3, 5, 1]]
+
+
+def test_nuclear_medicine_volumes(tmp_path):
+    input_dir, output_dir = tmp_path / "input", tmp_path / "output"
+    input_dir.mkdir()
+    ds = nm_dataset(
+        {"EnergyWindowVector": [1, 1, 1, 2, 2, 2], "SliceVector": [1, 2, 3, 1, 2, 3]},
+        [1, 2, 3, 4, 5, 6],
+    )
+    ds.SpacingBetweenSlices = 3.5
+    ds.save_as(input_dir / "nm.dcm")
+
+    create_mids_directory(get_dicomdir(input_dir), output_dir, "heart")
+
+    volumes = sorted(output_dir.rglob("*_nm.nii.gz"))
+    assert [v.name.split("_")[-2] for v in volumes] == ["ew-1", "ew-2"]
+    image = sitk.ReadImage(str(volumes[1]))
+    assert image.GetSize() == (5, 4, 3)
+    assert image.GetSpacing()[2] == 3.5
+    assert list(sitk.GetArrayFromImage(image)[:, 0, 0]) == [4, 5, 6]
+
+
+def test_nuclear_medicine_archive_names_match_scans_tsv(tmp_path):
+    ds = nm_dataset({"EnergyWindowVector": [1, 2]}, [1, 2])
+    # Filled in from these when the archive member is staged
+    ds.StudyID, ds.SeriesNumber = "", ""
+    ds.AccessionNumber, ds.InstanceNumber = "A1", 7
+    buffer = io.BytesIO()
+    ds.save_as(buffer)
+    archive = tmp_path / "nm.zip"
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.writestr("nm.dcm", buffer.getvalue())
+
+    create_mids_directory(get_dicomdir(archive), tmp_path / "output", "heart")
+
+    (scans_tsv,) = (tmp_path / "output").rglob("*_scans.tsv")
+    listed = read_tsv(scans_tsv).iloc[:, 0]
+    assert len(listed) == 2
+    assert all((scans_tsv.parent / path).exists() for path in listed)
@@ -0,0 +1,111 @@
+import json
+import shutil
+from pathlib import Path
+
+import pytest
+from pydicom import dcmread
+from pydicom.data import get_testdata_file
+from pydicom.uid import generate_uid
+
+from dcm2mids import convert
+from dcm2mids.generate_tsvs import read_tsv
+from dcm2mids.profiles import OutputProfile, OutputProfiles, load_profiles
+from dcm2mids.validate import validate
+
+TEST_MR_DICOM = Path(get_testdata_file("MR_small.dcm", download=False))  # type: ignore
+TEST_SC_DICOM = Path(get_testdata_file("SC_rgb_small_odd.dcm", download=False))  # type: ignore
+
+
+def test_load_profiles(tmp_path):
+    toml = tmp_path / "profiles.toml"
+    toml.write_text(
+        '[default]\nsidecar = "summary"\n\n[MR]\nimage = false\ntags = ["EchoTime", "00180080"]\n'
+    )
+    yml = tmp_path / "profiles.yaml"
+    yml.write_text("default:\n  sidecar: summary\nMR:\n  image: false\n  tags: [EchoTime, '00180080']\n")
+
+    for path in (toml, yml):
+        profiles = load_profiles(path)
+        mr, ct = profiles.get("MR"), profiles.get("CT")
+        assert (mr.image, mr.sidecar, mr.tags) == (False, "summary", ["EchoTime", "00180080"])
+        assert (ct.image, ct.sidecar, ct.tags) == (True, "summary", None)
+        assert profiles.writes_tsv("participants")
+
+    with pytest.raises(ValueError):
+        OutputProfile(sidecar="short")
+    with pytest.raises(ValueError):
+        OutputProfile(tags=["NotAKeyword"])
+    with pytest.raises(ValueError):
+        OutputProfile(tsvs=["series"])
+    (tmp_path / "profiles.ini").write_text("")
+    with pytest.raises(ValueError):
+        load_profiles(tmp_path / "profiles.ini")
+
+
+def test_sidecar_dataset():
+    ds = dcmread(TEST_MR_DICOM)
+    assert OutputProfile().sidecar_dataset(ds) is ds
+    summary = OutputProfile(sidecar="summary").sidecar_dataset(ds)
+    assert "PatientID" in summary and "PixelData" in summary
+    assert not any(elem.VR == "SQ" or elem.tag.is_private for elem in summary)
+    selected = OutputProfile(tags=["EchoTime", "00180080", "DiffusionBValue"]).sidecar_dataset(ds)
+    assert [elem.keyword for elem in selected] == ["RepetitionTime", "EchoTime"]
+
+
+def test_convert_with_profiles(tmp_path, monkeypatch):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    shutil.copy(TEST_MR_DICOM, input_dir / "mr.dcm")
+    ds = dcmread(TEST_SC_DICOM)
+    ds.PatientID, ds.StudyID, ds.SeriesNumber = "4MR1", "4MR1", 2
+    ds.SeriesInstanceUID = generate_uid()
+    ds.SOPInstanceUID = generate_uid()
+    ds.save_as(input_dir / "sc.dcm")
+    config = tmp_path / "profiles.toml"
+    config.write_text(
+        '[default]\ntsvs = ["scans"]\n\n'
+        '[MR]\nimage = false\ntags = ["EchoTime", "SeriesDescription"]\n\n'
+        '[OT]\nsidecar = "off"\n'
+    )
+
+    def no_pixels(*args, **kwargs):
+        raise AssertionError("pixel data read for a series without images")
+
+    # MR images are off, so the pixel data is never read
+    monkeypatch.setattr(
+        "dcm2mids.procedures.magnetic_resonance.magnetic_resonance_procedure.FrameReader",
+        no_pixels,
+    )
+    result = convert(input_dir, tmp_path / "mids", "head", output_profiles=config)
+
+    assert not result.failed
+    session = tmp_path / "mids" / "sub-4MR1" / "ses-4MR1"
+    (mr_sidecar,) = session.rglob("*.json")
+    assert json.loads(mr_sidecar.read_text()) == {
+        "EchoTime": str(dcmread(TEST_MR_DICOM).EchoTime)
+    }
+    assert not list(session.rglob("*.nii*"))
+    (sc_image,) = result.outputs()
+    assert sc_image.suffix == ".png" and sc_image.exists()
+    assert len((session / "sub-4MR1_ses-4MR1_scans.tsv").read_text().splitlines()) == 3
+    assert not (tmp_path / "mids" / "participants.tsv").exists()
+    assert not (tmp_path / "mids" / "sub-4MR1" / "sub-4MR1_sessions.tsv").exists()
+
+
+def test_convert_without_images_validates(tmp_path):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    shutil.copy(TEST_MR_DICOM, input_dir / "mr.dcm")
+    profiles = OutputProfiles(OutputProfile(image=False))
+
+    convert(input_dir, tmp_path / "mids", "head", output_profiles=profiles)
+
+    session = tmp_path / "mids" / "sub-4MR1" / "ses-4MR1"
+    scans = read_tsv(session / "sub-4MR1_ses-4MR1_scans.tsv")
+    assert list(scans.iloc[:, 0]) == ["anat/sub-4MR1_ses-4MR1_run-1_mr.json"]
+    assert validate(tmp_path / "mids").ok
+
+    # Neither image nor sidecar: the scan is listed as n/a
+    bare = OutputProfiles(OutputProfile(image=False, sidecar="off"))
+    convert(input_dir, tmp_path / "bare", "head", output_profiles=bare)
+    assert validate(tmp_path / "bare").ok
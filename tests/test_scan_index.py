@@ -0,0 +1,54 @@
+from pathlib import Path
+
+import pytest
+from pydicom.data import get_testdata_file
+from pydicom.fileset import FileInstance
+
+from dcm2mids.get_dicomdir import get_dicomdir
+from dcm2mids.scan_index import IndexedInstance, ScanIndex
+
+TEST_DICOMDIR = Path(get_testdata_file("DICOMDIR")).parent  # type: ignore
+
+
+@pytest.fixture
+def dicomdir_fileset():
+    return get_dicomdir(TEST_DICOMDIR)
+
+
+def test_scan_index_from_dicomdir_does_not_load(dicomdir_fileset, monkeypatch):
+    def fail(self):
+        raise AssertionError("instance loaded while indexing")
+
+    monkeypatch.setattr(FileInstance, "load", fail)
+    index = ScanIndex.from_fileset(dicomdir_fileset)
+
+    assert len(index) == len(dicomdir_fileset)
+    assert sorted(index.find_values("PatientID")) == sorted(
+        dicomdir_fileset.find_values("PatientID")
+    )
+
+
+def test_scan_index_hierarchy(dicomdir_fileset):
+    index = ScanIndex.from_fileset(dicomdir_fileset)
+
+    subject = index.find_values("PatientID")[0]
+    sessions = index.find_values("StudyID", index.find(PatientID=subject))
+    assert len(sessions) > 0
+    instances = index.find(PatientID=subject, StudyID=sessions[0])
+    assert all(isinstance(instance, IndexedInstance) for instance in instances)
+    assert all(instance.PatientID == subject for instance in instances)
+    assert all("SOPInstanceUID" in instance for instance in instances)
+
+    values = index.find_values(["Modality", "StudyDate"], instances)
+    assert set(values) == {"Modality", "StudyDate"}
+    assert len(values["Modality"]) > 0
+
+
+def test_indexed_instance_load():
+    path = get_testdata_file("CT_small.dcm")
+    instance = IndexedInstance(path, {"PatientID": "1CT1"})
+
+    assert instance.PatientID == "1CT1"
+    assert instance.load().Modality == "CT"
+    with pytest.raises(AttributeError):
+        instance.Modality
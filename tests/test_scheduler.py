@@ -0,0 +1,96 @@
+import shutil
+import threading
+import time
+from pathlib import Path
+
+from pydicom import dcmread
+from pydicom.data import get_testdata_file
+from pydicom.uid import generate_uid
+
+from dcm2mids import convert
+from dcm2mids.memory import MemoryBudget
+from dcm2mids.scheduler import SeriesScheduler, SeriesTask
+
+TEST_MR_DICOM = Path(get_testdata_file("MR_small.dcm", download=False))  # type: ignore
+TEST_SC_DICOM = Path(get_testdata_file("SC_rgb_small_odd.dcm", download=False))  # type: ignore
+
+
+def test_largest_first_and_work_stealing():
+    tasks = [SeriesTask(f"small{i}", [None], 10) for i in range(8)]
+    tasks.append(SeriesTask("big", [None] * 50, 100))
+    order = []
+
+    def run(task, worker):
+        order.append((worker, task.key))
+        # The estimate is wrong: the big series is fast, the small ones are slow
+        time.sleep(0 if task.key == "big" else 0.02)
+        return task.key
+
+    scheduler = SeriesScheduler(2)
+    scheduler.run(tasks, run)
+
+    assert [task.result for task in tasks] == [task.key for task in tasks]
+    assert order[0] == (0, "big")
+    assert scheduler.stolen > 0
+    assert sum(scheduler.done) == 9
+    summary = scheduler.summary()
+    assert summary["makespan_seconds"] > 0
+    assert len(summary["worker_idle_seconds"]) == 2
+
+
+def test_steal_from_the_most_loaded_worker():
+    scheduler = SeriesScheduler(3)
+    scheduler.assign([SeriesTask(i, [None], nbytes) for i, nbytes in enumerate([50, 40, 5, 5])])
+    assert scheduler.queued == [50, 40, 10]
+
+    task, reserved = scheduler._take(2)
+    assert (task.key, reserved, task.stolen) == (2, True, False)
+    scheduler._take(2)
+    # Worker 2 is done with its queue and steals from the most loaded worker
+    task, _ = scheduler._take(2)
+    assert (task.key, task.stolen) == (0, True)
+    assert scheduler.queued == [0, 40, 0]
+
+
+def test_memory_admission():
+    budget = MemoryBudget(100)
+    tasks = [SeriesTask(i, [None], nbytes) for i, nbytes in enumerate([80, 60, 30, 10, 10])]
+    running = []
+    lock = threading.Lock()
+
+    def run(task, worker):
+        with lock:
+            running.append(task.key)
+        time.sleep(0.02)
+        if task.key == 3:
+            raise ValueError("broken series")
+
+    SeriesScheduler(3, budget).run(tasks, run)
+
+    assert budget.peak_in_use <= 100
+    assert budget.in_use == 0
+    assert sorted(running) == [0, 1, 2, 3, 4]
+    assert isinstance(tasks[3].error, ValueError)
+
+
+def test_convert_series_in_parallel(tmp_path):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    shutil.copy(TEST_MR_DICOM, input_dir / "mr.dcm")
+    ds = dcmread(TEST_SC_DICOM)
+    ds.PatientID, ds.StudyID, ds.SeriesNumber = "4MR1", "4MR1", 2
+    ds.SeriesInstanceUID = generate_uid()
+    ds.SOPInstanceUID = generate_uid()
+    ds.save_as(input_dir / "sc.dcm")
+
+    result = convert(input_dir, tmp_path / "mids", "head", series_workers=2, max_memory="64M")
+
+    assert not result.failed
+    assert len(result.outputs()) == 2
+    (report,) = result.reports.values()
+    assert report.stats["series_workers"] == 2
+    assert sum(report.stats["worker_series"]) == 2
+    # The scans are listed as in a sequential run, whichever finished first
+    convert(input_dir, tmp_path / "sequential", "head")
+    scans = Path("sub-4MR1", "ses-4MR1", "sub-4MR1_ses-4MR1_scans.tsv")
+    assert (tmp_path / "mids" / scans).read_text() == (tmp_path / "sequential" / scans).read_text()
@@ -0,0 +1,50 @@
+from pathlib import Path
+from shutil import copyfile
+
+import pytest
+from pydicom import dcmread
+from pydicom.data import get_testdata_file
+
+from dcm2mids.get_dicomdir import get_dicomdir
+from dcm2mids.shard import Shard, shard_of
+
+TEST_FILES = [Path(get_testdata_file(name)) for name in ["CT_small.dcm", "MR_small.dcm"]]  # type: ignore
+
+
+def test_shard_parse():
+    shard = Shard.parse("1/4", key="StudyInstanceUID")
+    assert (shard.index, shard.count, shard.key) == (1, 4, "StudyInstanceUID")
+    assert shard.name == "shard-1-of-4"
+    assert shard.output_root(Path("out")) == Path("out", "shard-1-of-4")
+    assert Shard.parse("1/4").output_root(Path("out")) == Path("out")
+
+
+@pytest.mark.parametrize("text", ["4/4", "-1/2", "1", "a/b", "0/0"])
+def test_shard_parse_invalid(text):
+    with pytest.raises(ValueError):
+        Shard.parse(text)
+
+
+def test_shard_assignment_is_stable_and_complete():
+    values = [f"patient-{i}" for i in range(200)]
+    shards = [Shard(i, 3) for i in range(3)]
+    owners = [[shard.index for shard in shards if shard.owns(v)] for v in values]
+
+    assert all(len(owner) == 1 for owner in owners)
+    assert {owner[0] for owner in owners} == {0, 1, 2}
+    # The digest does not depend on the interpreter's hash seed
+    assert shard_of("patient-0", 1000) == 993
+    assert shard_of("patient-0", 7) == 6
+
+
+def test_get_dicomdir_shards_partition_the_input(tmp_path):
+    for path in TEST_FILES:
+        copyfile(path, tmp_path / path.name)
+    patients = {dcmread(path).PatientID for path in TEST_FILES}
+
+    found = []
+    for i in range(2):
+        fileset = get_dicomdir(tmp_path, shard=Shard(i, 2))
+        found.extend(fileset.find_values("PatientID", load=True))
+
+    assert sorted(found) == sorted(patients)
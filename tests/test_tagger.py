@@ -0,0 +1,45 @@
+import pytest
+
+from dcm2mids.tagger import Tagger
+
+PROTOCOLS = """protocol\tModality\tEchoTime_min\tEchoTime_max\tRepetitionTime_min\tRepetitionTime_max\tSliceThickness_max
+T1w\tMR\t\t15\t\t1000\t
+T2w\tMR\t80\t\t2000\t\t
+thin-CT\tCT\t\t\t\t\t1
+CT\tCT\t\t\t\t\t
+"""
+
+
+@pytest.fixture
+def tagger(tmp_path):
+    path = tmp_path / "protocols.tsv"
+    path.write_text(PROTOCOLS)
+    return Tagger(path)
+
+
+def test_tagger_compiles_rules(tagger):
+    assert tagger.range_keys == ["EchoTime", "RepetitionTime", "SliceThickness"]
+    assert tagger.match_keys == ["Modality"]
+    assert tagger.lower.shape == tagger.upper.shape == (4, 3)
+
+
+def test_tagger_classify_batch(tagger):
+    headers = [
+        {"Modality": "MR", "EchoTime": "10", "RepetitionTime": "500"},
+        {"Modality": "MR", "EchoTime": "100", "RepetitionTime": "4000"},
+        {"Modality": "CT", "SliceThickness": "0.625"},
+        {"Modality": "CT", "SliceThickness": "5"},
+        {"Modality": "MR", "EchoTime": "40"},
+        {"Modality": "US"},
+    ]
+
+    result = tagger.classify(headers)
+
+    assert list(result["protocol"]) == ["T1w", "T2w", "thin-CT", "CT", "n/a", "n/a"]
+    assert list(result["rule"]) == [0, 1, 2, 3, -1, -1]
+    assert list(result["matches"]) == [1, 1, 2, 1, 0, 0]
+
+
+def test_tagger_classification_by_min_max(tagger):
+    header = {"Modality": "CT", "SliceThickness": "['0.5', '0.5']"}
+    assert tagger.classification_by_min_max(header) == ["thin-CT", "CT"]
@@ -0,0 +1,85 @@
+from pathlib import Path
+
+import numpy as np
+import SimpleITK as sitk
+from pydicom import Dataset, dcmread
+from pydicom.data import get_testdata_file
+from pydicom.uid import RLELossless, generate_uid
+
+from dcm2mids.create_mids_directory import create_mids_directory
+from dcm2mids.get_dicomdir import get_dicomdir
+from dcm2mids.procedures.pixel_data import iter_frames
+
+TEST_SC_DICOM = Path(get_testdata_file("SC_rgb_small_odd.dcm"))  # type: ignore
+TEST_RLE_DICOM = Path(get_testdata_file("SC_rgb_rle_2frame.dcm"))  # type: ignore
+TEST_RTDOSE_DICOM = Path(get_testdata_file("rtdose.dcm"))  # type: ignore
+
+
+def write_cine(path: Path, n_frames: int, compress: bool = False) -> np.ndarray:
+    ds = dcmread(TEST_SC_DICOM)
+    ds.SOPInstanceUID = generate_uid()
+    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+    ds.Modality = "US"
+    ds.Rows, ds.Columns = 4, 6
+    ds.PhotometricInterpretation = "RGB"
+    ds.PlanarConfiguration = 0
+    ds.NumberOfFrames = n_frames
+    ds.FrameTime = "40"
+    region = Dataset()
+    region.PhysicalUnitsXDirection = 3
+    region.PhysicalUnitsYDirection = 3
+    region.PhysicalDeltaX = 0.02
+    region.PhysicalDeltaY = 0.05
+    ds.SequenceOfUltrasoundRegions = [region]
+    frames = np.random.default_rng(0).integers(0, 255, (n_frames, 4, 6, 3), dtype=np.uint8)
+    ds.PixelData = frames.tobytes()
+    if compress:
+        ds.compress(RLELossless)
+    ds.save_as(path)
+    return frames
+
+
+def test_iter_frames_matches_pixel_array():
+    for path in [TEST_RLE_DICOM, TEST_RTDOSE_DICOM]:
+        dataset, frames = iter_frames(path)
+        assert "PixelData" not in dataset
+        assert np.array_equal(np.stack(list(frames)), dcmread(path).pixel_array)
+
+
+def test_ultrasound_cine_to_nifti(tmp_path):
+    input_dir, output_dir = tmp_path / "input", tmp_path / "output"
+    input_dir.mkdir()
+    frames = write_cine(input_dir / "cine.dcm", 5, compress=True)
+    still = write_cine(input_dir / "still.dcm", 1)
+
+    create_mids_directory(get_dicomdir(input_dir), output_dir, "heart")
+
+    cine = next(output_dir.rglob("*.nii.gz"))
+    assert cine.parent.name == "mim-us"
+    image = sitk.ReadImage(str(cine))
+    assert image.GetSize() == (6, 4, 1, 5)
+    assert np.allclose(image.GetSpacing(), (0.2, 0.5, 1.0, 0.04))
+    assert np.array_equal(sitk.GetArrayFromImage(image)[:, 0], frames)
+    png = next(output_dir.rglob("*_us.png"))
+    assert np.array_equal(sitk.GetArrayFromImage(sitk.ReadImage(str(png))), still[0])
+    scans = next(output_dir.rglob("*_scans.tsv")).read_text()
+    assert cine.name in scans and png.name in scans
+
+
+def test_ultrasound_still_is_only_read_by_the_decoder(tmp_path, monkeypatch):
+    input_dir, output_dir = tmp_path / "input", tmp_path / "output"
+    input_dir.mkdir()
+    write_cine(input_dir / "still.dcm", 1)
+    loaded = []
+
+    def load_instance(instance):
+        loaded.append(instance.path)
+        return dcmread(instance.path)
+
+    for module in ["procedures", "ultrasound.ultrasound_procedure"]:
+        monkeypatch.setattr(
+            f"dcm2mids.procedures.{module}.load_instance", load_instance, raising=False
+        )
+    create_mids_directory(get_dicomdir(input_dir), output_dir, "heart")
+    assert not loaded
+    assert next(output_dir.rglob("*_us.png")).exists()
@@ -0,0 +1,71 @@
+import gzip
+import shutil
+from pathlib import Path
+
+import numpy as np
+from pydicom import dcmread
+from pydicom.data import get_testdata_file
+from pydicom.uid import generate_uid
+
+from dcm2mids import convert
+from dcm2mids.validate import check_file, validate, write_manifest
+
+TEST_MR_DICOM = Path(get_testdata_file("MR_small.dcm", download=False))  # type: ignore
+TEST_SC_DICOM = Path(get_testdata_file("SC_rgb_small_odd.dcm", download=False))  # type: ignore
+
+
+def make_dataset(tmp_path):
+    input_dir, output = tmp_path / "input", tmp_path / "mids"
+    input_dir.mkdir()
+    shutil.copy(TEST_MR_DICOM, input_dir / "mr.dcm")
+    ds = dcmread(TEST_SC_DICOM)
+    ds.PatientID, ds.StudyID, ds.SeriesNumber = "4MR1", "4MR1", 2
+    ds.SeriesInstanceUID = generate_uid()
+    ds.SOPInstanceUID = generate_uid()
+    ds.save_as(input_dir / "sc.dcm")
+    convert(input_dir, output, "head")
+    return output
+
+
+def test_check_file(tmp_path):
+    array = np.zeros((4, 3), dtype=np.float32)
+    np.save(tmp_path / "a.npy", array)
+    assert check_file(tmp_path / "a.npy") is None
+    data = (tmp_path / "a.npy").read_bytes()
+    (tmp_path / "a.npy").write_bytes(data[:-4])
+    assert check_file(tmp_path / "a.npy")[0] == "truncated"
+    (tmp_path / "a.json").write_text("{")
+    assert check_file(tmp_path / "a.json")[0] == "invalid"
+    (tmp_path / "a.png").write_bytes(b"")
+    assert check_file(tmp_path / "a.png")[0] == "empty"
+
+
+def test_validate(tmp_path):
+    output = make_dataset(tmp_path)
+    report = validate(output, workers=2)
+    assert report.ok, report.issues
+    assert report.files_checked == 4
+
+    session = output / "sub-4MR1" / "ses-4MR1"
+    nifti = next(session.rglob("*.nii.gz"))
+    png = next(session.rglob("*.png"))
+    write_manifest(output)
+    # Truncate the NIfTI, keeping a valid gzip stream
+    with gzip.open(nifti, "rb") as f:
+        data = f.read()
+    with gzip.open(nifti, "wb") as f:
+        f.write(data[:-100])
+    png.unlink()
+    (session / "anat" / "stray.txt").write_text("?")
+    (output / "sub-9").mkdir()
+
+    report = validate(output)
+    kinds = {(issue["kind"], Path(issue["path"]).name) for issue in report.issues}
+    assert ("truncated", nifti.name) in kinds
+    assert ("missing", png.name) in kinds
+    assert ("orphan", "stray.txt") in kinds
+    assert ("orphan", "sub-9") in kinds
+    assert ("missing", "sub-9_sessions.tsv") in kinds
+    # The manifest catches both modified files
+    assert ("checksum", nifti.name) in kinds
+    assert report.counts() == {"missing": 3, "truncated": 1, "checksum": 1, "orphan": 2}
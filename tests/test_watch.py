@@ -0,0 +1,114 @@
+import shutil
+from pathlib import Path
+
+from pydicom import dcmread
+from pydicom.data import get_testdata_file
+from pydicom.uid import generate_uid
+
+from dcm2mids import watch
+from dcm2mids.generate_tsvs import parse_list, read_tsv
+from dcm2mids.watch import PollingObserver, SeriesTracker, Watcher
+
+TEST_MR_DICOM = Path(get_testdata_file("MR_small.dcm", download=False))  # type: ignore
+TEST_SC_DICOM = Path(get_testdata_file("SC_rgb_small_odd.dcm", download=False))  # type: ignore
+
+
+def test_series_tracker_debounce(tmp_path):
+    shutil.copy(TEST_MR_DICOM, tmp_path / "a.dcm")
+    (tmp_path / "partial.dcm").write_bytes(b"\0" * 64)
+    tracker = SeriesTracker(quiet_period=10)
+
+    tracker.add(tmp_path / "a.dcm", now=0)
+    tracker.add(tmp_path / "partial.dcm", now=0)
+    assert tracker.pop_ready(now=5) == []
+    # The series changed again, which restarts its quiet period
+    tracker.add(tmp_path / "a.dcm", now=6)
+    assert tracker.pop_ready(now=12) == []
+    assert tracker.pop_ready(now=16) == [[tmp_path / "a.dcm"]]
+    assert tracker.unreadable == {}
+
+
+def test_watch_converts_new_series(tmp_path):
+    input_dir, output_dir = tmp_path / "input", tmp_path / "output"
+    input_dir.mkdir()
+    shutil.copy(TEST_MR_DICOM, input_dir / "mr.dcm")
+    watcher = Watcher(
+        input_dir,
+        output_dir,
+        "head",
+        quiet_period=10,
+        poll_interval=0,
+        observer=PollingObserver(input_dir),
+    )
+
+    assert watcher.step(now=0) is None
+    assert len(watcher.step(now=10).series) == 1
+
+    # A second series of the same subject arrives
+    ds = dcmread(TEST_SC_DICOM)
+    ds.PatientID, ds.StudyID = "4MR1", "4MR1"
+    ds.SeriesInstanceUID = generate_uid()
+    ds.SOPInstanceUID = generate_uid()
+    ds.save_as(input_dir / "sc.dcm")
+    assert watcher.step(now=20) is None
+    assert len(watcher.step(now=30).series) == 1
+
+    participants = read_tsv(output_dir / "participants.tsv")
+    assert len(participants) == 1
+    assert sorted(parse_list(participants["modalities"][0])) == ["MR", "OT"]
+    scans = read_tsv(output_dir / "sub-4MR1" / "ses-4MR1" / "sub-4MR1_ses-4MR1_scans.tsv")
+    assert len(scans) == 2
+
+    # A restarted watcher does not convert the same files again
+    restarted = Watcher(
+        input_dir,
+        output_dir,
+        "head",
+        quiet_period=10,
+        poll_interval=0,
+        observer=PollingObserver(input_dir),
+    )
+    assert restarted.step(now=0) is None
+    assert restarted.step(now=100) is None
+    assert restarted.tracker.pending == 0
+
+
+def test_watch_survives_a_failing_batch(tmp_path, monkeypatch):
+    input_dir, output_dir = tmp_path / "input", tmp_path / "output"
+    input_dir.mkdir()
+    shutil.copy(TEST_MR_DICOM, input_dir / "mr.dcm")
+    watcher = Watcher(
+        input_dir,
+        output_dir,
+        "head",
+        quiet_period=10,
+        poll_interval=0,
+        observer=PollingObserver(input_dir),
+    )
+    convert = watch.update_mids_directory
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("disk full")
+
+    monkeypatch.setattr(watch, "update_mids_directory", fail)
+    watcher.step(now=0)
+    assert watcher.step(now=10) is None
+    assert watcher.failed_batches == 1
+    (row,) = read_tsv(output_dir / ".dcm2mids" / "failures.tsv").to_dict("records")
+    assert (row["path"], row["stage"]) == (str(input_dir / "mr.dcm"), "batch")
+    assert not watcher.state.is_converted(input_dir / "mr.dcm")
+
+    # The next batch is converted, and appended to the watch state
+    monkeypatch.setattr(watch, "update_mids_directory", convert)
+    ds = dcmread(TEST_SC_DICOM)
+    ds.SeriesInstanceUID = generate_uid()
+    ds.SOPInstanceUID = generate_uid()
+    ds.save_as(input_dir / "sc.dcm")
+    watcher.step(now=20)
+    assert len(watcher.step(now=30).series) == 1
+    ds.SOPInstanceUID = generate_uid()
+    ds.save_as(input_dir / "sc2.dcm")
+    watcher.step(now=40)
+    watcher.step(now=50)
+    state = read_tsv(output_dir / ".dcm2mids" / "watched.tsv")
+    assert list(state["path"]) == [str(input_dir / name) for name in ["sc.dcm", "sc2.dcm"]]
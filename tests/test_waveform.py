@@ -0,0 +1,42 @@
+import json
+import shutil
+from pathlib import Path
+
+import numpy as np
+from pydicom import dcmread
+from pydicom.data import get_testdata_file
+from pydicom.waveforms.numpy_handler import generate_multiplex
+
+from dcm2mids.create_mids_directory import create_mids_directory
+from dcm2mids.get_dicomdir import get_dicomdir
+from dcm2mids.procedures.electrical_activity.waveform_procedure import iter_samples
+
+TEST_ECG_DICOM = Path(get_testdata_file("waveform_ecg.dcm", download=False))  # type: ignore
+
+
+def test_iter_samples_matches_pydicom():
+    ds = dcmread(TEST_ECG_DICOM)
+    for index, group in enumerate(ds.WaveformSequence):
+        expected = next(
+            a for i, a in enumerate(generate_multiplex(ds, as_raw=False)) if i == index
+        )
+        decoded = np.concatenate(list(iter_samples(group, chunk_samples=999)))
+        assert decoded.dtype == np.float32
+        np.testing.assert_allclose(decoded, expected, rtol=1e-5)
+
+
+def test_waveform_recordings(tmp_path):
+    input_dir, output_dir = tmp_path / "input", tmp_path / "output"
+    input_dir.mkdir()
+    shutil.copy(TEST_ECG_DICOM, input_dir / "ecg.dcm")
+
+    create_mids_directory(get_dicomdir(input_dir), output_dir, "heart")
+
+    recordings = sorted(output_dir.rglob("*_ecg.npy"))
+    assert [r.name.split("_")[-2] for r in recordings] == ["acq-medianbeat", "acq-rhythm"]
+    rhythm = np.load(recordings[1])
+    assert rhythm.shape == (10000, 12)
+    sidecar = json.loads(recordings[1].with_suffix(".json").read_text())
+    assert sidecar["SamplingFrequency"] == 1000.0
+    assert sidecar["Columns"][0] == "Lead I (Einthoven)"
+    assert "WaveformSequence" not in sidecar
@@ -0,0 +1,74 @@
+import os
+import tarfile
+import zipfile
+from pathlib import Path
+from shutil import copyfile
+
+import SimpleITK as sitk
+from pydicom.data import get_testdata_file
+
+from dcm2mids.create_mids_directory import create_mids_directory
+from dcm2mids.get_dicomdir import get_dicomdir
+from dcm2mids.writers import FILE_MODE, FilesystemWriter, TarWriter, ZipWriter, open_writer
+
+TEST_SC_DICOM = Path(get_testdata_file("SC_rgb_small_odd.dcm"))  # type: ignore
+
+
+def test_open_writer_by_suffix(tmp_path):
+    assert isinstance(open_writer(tmp_path / "mids"), FilesystemWriter)
+    writer = open_writer(tmp_path / "mids.tar.gz")
+    assert isinstance(writer, TarWriter)
+    assert writer.root == tmp_path / "mids"
+    assert isinstance(open_writer(tmp_path / "mids.zip"), ZipWriter)
+
+
+def test_create_mids_directory_into_tar(tmp_path):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    copyfile(TEST_SC_DICOM, input_dir / "a.dcm")
+
+    with open_writer(tmp_path / "mids.tar") as writer:
+        report = create_mids_directory(get_dicomdir(input_dir), writer.root, "eye", writer=writer)
+
+    assert not writer.root.exists()
+    with tarfile.open(tmp_path / "mids.tar") as tar:
+        names = tar.getnames()
+    assert "participants.tsv" in names
+    assert "sub-ID1/sub-ID1_sessions.tsv" in names
+    assert any(name.endswith("_op.png") for name in names)
+    assert any(name.endswith("_op.json") for name in names)
+    assert report.stats["files_written"] == len(names)
+
+
+def test_zip_writer_splits_by_size(tmp_path):
+    root = tmp_path / "mids"
+    with ZipWriter(root, tmp_path / "mids.zip", max_bytes=10) as writer:
+        for name in ["a.json", "b.json", "c.json"]:
+            writer.write_text(root / "sub-1" / name, "0123456")
+
+    assert [p.name for p in writer.archives] == ["mids-0000.zip", "mids-0001.zip", "mids-0002.zip"]
+    with zipfile.ZipFile(writer.archives[1]) as archive:
+        assert archive.namelist() == ["sub-1/b.json"]
+        assert archive.read("sub-1/b.json") == b"0123456"
+
+
+def test_filesystem_writer_replaces_linked_files(tmp_path):
+    writer = FilesystemWriter(tmp_path)
+    image = sitk.Image(4, 4, sitk.sitkUInt8)
+    writer.write_image(image, tmp_path / "a.png")
+    writer.write_text(tmp_path / "a.json", "{}")
+    os.link(tmp_path / "a.png", tmp_path / "b.png")
+    os.link(tmp_path / "a.json", tmp_path / "b.json")
+
+    writer.write_image(image + 200, tmp_path / "b.png")
+    writer.write_file(tmp_path / "a.png", tmp_path / "c.png")
+    writer.write_text(tmp_path / "b.json", '{"b": 1}')
+
+    assert sitk.GetArrayFromImage(sitk.ReadImage(str(tmp_path / "a.png"))).max() == 0
+    assert sitk.GetArrayFromImage(sitk.ReadImage(str(tmp_path / "b.png"))).min() == 200
+    assert (tmp_path / "a.json").read_text() == "{}"
+    for name in ["a.png", "b.png", "c.png", "b.json"]:
+        assert (tmp_path / name).stat().st_mode & 0o777 == FILE_MODE
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "a.json", "a.png", "b.json", "b.png", "c.png"
+    ]